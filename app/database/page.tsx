@@ -12,6 +12,7 @@ import {
   TableRow,
 } from "@/components/ui/table";
 import { Badge } from "@/components/ui/badge";
+import { Input } from "@/components/ui/input";
 import { useEffect, useState } from "react";
 import { toast } from "sonner";
 
@@ -23,6 +24,15 @@ interface CaseData {
   Confidence: string;
 }
 
+interface SearchFacets {
+  diagnosis: Record<string, number>;
+  status: Record<string, number>;
+  month: Record<string, number>;
+}
+
+// Cases fetched per page from the search endpoint
+const PAGE_SIZE = 100;
+
 function getConfidenceBadge(confidence: string) {
   const numericConfidence = parseFloat(confidence.replace("%", "")) / 100;
   if (numericConfidence >= 0.9) return "default";
@@ -53,29 +63,48 @@ export default function DatabasePage() {
   const [cases, setCases] = useState<CaseData[]>([]);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState<string | null>(null);
+  const [query, setQuery] = useState("");
+  const [diagnosis, setDiagnosis] = useState<string | null>(null);
+  const [facets, setFacets] = useState<SearchFacets | null>(null);
+  const [total, setTotal] = useState(0);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
 
-  useEffect(() => {
-    const fetchCases = async () => {
-      try {
-        const response = await fetch("http://localhost:8000/list/");
-
-        if (!response.ok) {
-          throw new Error(`HTTP error! status: ${response.status}`);
-        }
-
-        const data = await response.json();
-        setCases(data.forms || []);
-      } catch (err) {
-        console.error("Error fetching cases:", err);
-        setError("Failed to load cases from database");
-        toast.error("Failed to load cases from database");
-      } finally {
-        setLoading(false);
+  const fetchCases = async (cursor: string | null = null) => {
+    try {
+      const params = new URLSearchParams({ limit: String(PAGE_SIZE) });
+      if (query.trim()) params.set("q", query.trim());
+      if (diagnosis) params.set("diagnosis", diagnosis);
+      if (cursor) params.set("cursor", cursor);
+
+      const response = await fetch(
+        `http://localhost:8000/api/cases/search/?${params}`
+      );
+
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
       }
-    };
 
-    fetchCases();
-  }, []);
+      const { data } = await response.json();
+      setCases((previous) =>
+        cursor ? [...previous, ...data.cases] : data.cases
+      );
+      setFacets(data.facets);
+      setTotal(data.count);
+      setNextCursor(data.next_cursor);
+    } catch (err) {
+      console.error("Error fetching cases:", err);
+      setError("Failed to load cases from database");
+      toast.error("Failed to load cases from database");
+    } finally {
+      setLoading(false);
+    }
+  };
+
+  // Search again shortly after the query or diagnosis filter changes
+  useEffect(() => {
+    const timer = setTimeout(() => fetchCases(), 300);
+    return () => clearTimeout(timer);
+  }, [query, diagnosis]);
 
   if (loading) {
     return (
@@ -122,10 +151,32 @@ export default function DatabasePage() {
           <h1 className="text-3xl font-bold">Case Database</h1>
           <p className="text-muted-foreground mt-2">
             View all processed cases and their diagnostic results (
-            {cases.length} cases)
+            {total} cases)
           </p>
         </div>
 
+        <div className="flex flex-wrap items-center gap-3">
+          <Input
+            value={query}
+            onChange={(event) => setQuery(event.target.value)}
+            placeholder="Search by case, patient ID, image name or diagnosis"
+            className="max-w-md"
+          />
+          {facets &&
+            Object.entries(facets.diagnosis).map(([value, count]) => (
+              <button
+                key={value}
+                onClick={() =>
+                  setDiagnosis(diagnosis === value ? null : value)
+                }
+              >
+                <Badge variant={diagnosis === value ? "default" : "outline"}>
+                  {value} ({count})
+                </Badge>
+              </button>
+            ))}
+        </div>
+
         {cases.length === 0 ? (
           <div className="text-center py-8">
             <p className="text-muted-foreground">
@@ -175,6 +226,16 @@ export default function DatabasePage() {
                 ))}
               </TableBody>
             </Table>
+            {nextCursor && (
+              <div className="flex justify-center p-4">
+                <button
+                  onClick={() => fetchCases(nextCursor)}
+                  className="px-4 py-2 bg-primary text-primary-foreground rounded hover:bg-primary/90"
+                >
+                  Load more
+                </button>
+              </div>
+            )}
           </div>
         )}
       </div>
@@ -19,6 +19,7 @@ import Image from "next/image";
 import { toast } from "sonner";
 
 interface BoundingBox {
+  id?: number;
   x: number;
   y: number;
   width: number;
@@ -54,6 +55,16 @@ export default function LabelingPage() {
   const imageRef = useRef<HTMLDivElement>(null);
   const router = useRouter();
 
+  // Box ids stay stable across edits so the backend stores only changed boxes
+  const nextBoxId = useRef(0);
+  // Session created by the first autosave; later saves update it
+  const annotationSession = useRef<{ annotationId: string; version: number } | null>(null);
+  const lastSaved = useRef<string>("");
+  const latestDraft = useRef<string>("");
+
+  // Autosave interval in milliseconds
+  const AUTOSAVE_INTERVAL = 5000;
+
   // Calculate image size based on fullscreen state
   const imageSize = isFullscreen ? 1000 : 800;
 
@@ -64,6 +75,7 @@ export default function LabelingPage() {
     const storedCaseId = sessionStorage.getItem("caseId");
     const storedPatientId = sessionStorage.getItem("patientId");
     const existingAnnotations = sessionStorage.getItem("existingAnnotations");
+    const existingSession = sessionStorage.getItem("annotationSession");
 
     if (storedImage) {
       setCurrentImage(storedImage);
@@ -78,6 +90,16 @@ export default function LabelingPage() {
       setPatientId(storedPatientId);
     }
 
+    // Resave the session being edited instead of creating another one
+    if (existingSession) {
+      try {
+        annotationSession.current = JSON.parse(existingSession);
+      } catch (error) {
+        console.error("Error parsing annotation session:", error);
+      }
+      sessionStorage.removeItem("annotationSession");
+    }
+
     // Load existing annotations if in update mode
     if (existingAnnotations) {
       try {
@@ -86,7 +108,8 @@ export default function LabelingPage() {
 
         // Convert existing annotations to bounding boxes
         // Scale from relative coordinates back to absolute coordinates
-        const convertedBoxes: BoundingBox[] = annotations.map((annotation) => ({
+        const convertedBoxes: BoundingBox[] = annotations.map((annotation, index) => ({
+          id: annotation.id ?? index,
           x: annotation.relativeX * imageSize,
           y: annotation.relativeY * imageSize,
           width: annotation.relativeWidth * imageSize,
@@ -94,6 +117,8 @@ export default function LabelingPage() {
           label: annotation.label,
         }));
 
+        nextBoxId.current =
+          Math.max(-1, ...convertedBoxes.map((box) => box.id ?? 0)) + 1;
         setBoundingBoxes(convertedBoxes);
         setIsUpdateMode(true);
 
@@ -172,6 +197,7 @@ export default function LabelingPage() {
     // Only add box if it has meaningful size
     if (Math.abs(currentBox.width) > 10 && Math.abs(currentBox.height) > 10) {
       const normalizedBox = {
+        id: nextBoxId.current++,
         x:
           currentBox.width < 0 ? currentBox.x + currentBox.width : currentBox.x,
         y:
@@ -209,25 +235,81 @@ export default function LabelingPage() {
     );
   };
 
+  const toAnnotations = (boxes: BoundingBox[]) =>
+    boxes.map((box, index) => ({
+      id: box.id ?? index,
+      x: Math.round(box.x),
+      y: Math.round(box.y),
+      width: Math.round(box.width),
+      height: Math.round(box.height),
+      label: box.label,
+      // Convert coordinates to relative values (0-1) for database storage
+      relativeX: box.x / imageSize,
+      relativeY: box.y / imageSize,
+      relativeWidth: box.width / imageSize,
+      relativeHeight: box.height / imageSize,
+    }));
+
+  // Latest labeled boxes, read by the autosave timer
+  useEffect(() => {
+    latestDraft.current = JSON.stringify(
+      toAnnotations(boundingBoxes.filter((box) => box.label))
+    );
+  }, [boundingBoxes, imageSize]);
+
+  // Autosave the draft every few seconds while it has unsaved changes
+  useEffect(() => {
+    if (!caseId) return;
+
+    const timer = setInterval(async () => {
+      const draft = latestDraft.current;
+      if (!draft || draft === lastSaved.current) return;
+      if (!annotationSession.current && draft === "[]") return;
+
+      try {
+        const response = await fetch(
+          "http://localhost:8000/api/annotations/autosave/",
+          {
+            method: "POST",
+            headers: {
+              "Content-Type": "application/json",
+            },
+            body: JSON.stringify({
+              caseId,
+              patientId,
+              imageName,
+              ...annotationSession.current,
+              annotations: JSON.parse(draft),
+            }),
+          }
+        );
+        if (response.ok) {
+          const result = await response.json();
+          if (result.annotation_id) {
+            annotationSession.current = {
+              annotationId: result.annotation_id,
+              version: result.version,
+            };
+          }
+          lastSaved.current = draft;
+        }
+      } catch (error) {
+        // Autosave is best effort; the final submit still saves everything
+        console.warn("Autosave failed:", error);
+      }
+    }, AUTOSAVE_INTERVAL);
+
+    return () => clearInterval(timer);
+  }, [caseId, patientId, imageName]);
+
   const handleSubmit = async () => {
     // Prepare annotation data
     const annotationData = {
       caseId,
       patientId,
       imageName,
-      annotations: boundingBoxes.map((box, index) => ({
-        id: index,
-        x: Math.round(box.x),
-        y: Math.round(box.y),
-        width: Math.round(box.width),
-        height: Math.round(box.height),
-        label: box.label,
-        // Convert coordinates to relative values (0-1) for database storage
-        relativeX: box.x / imageSize,
-        relativeY: box.y / imageSize,
-        relativeWidth: box.width / imageSize,
-        relativeHeight: box.height / imageSize,
-      })),
+      ...annotationSession.current,
+      annotations: toAnnotations(boundingBoxes),
     };
 
     try {
@@ -241,6 +323,15 @@ export default function LabelingPage() {
       });
 
       if (response.ok) {
+        // Later autosaves and submits must build on the version just saved
+        const result = await response.json();
+        if (result.annotation_id) {
+          annotationSession.current = {
+            annotationId: result.annotation_id,
+            version: result.version,
+          };
+        }
+        lastSaved.current = latestDraft.current;
         const action = isUpdateMode ? "updated" : "completed";
         toast.success(`Annotations ${action} successfully for ${imageName}`);
       } else if (response.status === 404) {
@@ -266,6 +357,7 @@ export default function LabelingPage() {
     sessionStorage.removeItem("caseId");
     sessionStorage.removeItem("patientId");
     sessionStorage.removeItem("existingAnnotations");
+    sessionStorage.removeItem("annotationSession");
 
     // Redirect to appropriate page after a short delay
     setTimeout(() => {
@@ -286,6 +378,7 @@ export default function LabelingPage() {
     sessionStorage.removeItem("caseId");
     sessionStorage.removeItem("patientId");
     sessionStorage.removeItem("existingAnnotations");
+    sessionStorage.removeItem("annotationSession");
 
     if (isUpdateMode) {
       // If in update mode, go back to the receipt page
@@ -30,8 +30,11 @@ interface ReceiptData {
   Diagnosis: string;
   Confidence: string;
   Image?: string;
+  Preview?: string;
   imageName?: string;
   annotations?: Annotation[];
+  annotation_id?: string | null;
+  version?: number | null;
 }
 
 const IMAGE_DISPLAY_SIZE = 480;
@@ -179,6 +182,17 @@ Generated by cerv.AI - DOST-ASTI
             );
           }
 
+          // Edits are saved as a new version of the latest session
+          if (receipt.annotation_id) {
+            sessionStorage.setItem(
+              "annotationSession",
+              JSON.stringify({
+                annotationId: receipt.annotation_id,
+                version: receipt.version,
+              })
+            );
+          }
+
           // Navigate to labeling page
           router.push("/labeling");
         };
@@ -268,7 +282,7 @@ Generated by cerv.AI - DOST-ASTI
                     }}
                   >
                     <Image
-                      src={`http://localhost:8000${receipt.Image}`}
+                      src={`http://localhost:8000${receipt.Preview || receipt.Image}`}
                       alt="Medical scan"
                       width={IMAGE_DISPLAY_SIZE}
                       height={IMAGE_DISPLAY_SIZE}
@@ -10,14 +10,25 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 #media
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# Serve MEDIA_ROOT through forms.media.serve_media; turn off behind nginx or a CDN
+SERVE_MEDIA = True
+# Server directories that /upload/batch/ may ingest images from
+INGEST_DIRECTORIES = []
+# COCO files uploaded to /api/import/coco/; outside MEDIA_ROOT so they are never served
+IMPORT_ROOT = BASE_DIR / 'imports'
+# dHash bits (of 64) two images may differ in to be linked as duplicates, see forms.duplicates
+DUPLICATE_MAX_DISTANCE = 6
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -48,6 +59,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'forms.profiling.ProfilingMiddleware',  # Inactive unless PROFILING['ENABLED']
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -83,13 +95,75 @@ WSGI_APPLICATION = 'cdss.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
-
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+#
+# Chosen through the environment; check it under load with `manage.py stress_db`.
+#
+# CDSS_DB_ENGINE=sqlite (default): CDSS_DB_NAME is the database file. It runs
+# in WAL mode, so readers never block the writer. Writers wait up to
+# CDSS_DB_TIMEOUT seconds for the write lock instead of failing with
+# "database is locked". Transactions take the lock when they begin
+# (IMMEDIATE), so two of them cannot deadlock upgrading a read lock.
+#
+# CDSS_DB_ENGINE=postgresql: CDSS_DB_NAME, _USER, _PASSWORD, _HOST and _PORT.
+# Needs psycopg. Connections are kept for CDSS_DB_CONN_MAX_AGE seconds and
+# health-checked before reuse. Setting CDSS_DB_POOL_MAX_SIZE uses psycopg's
+# connection pool instead (pip install "psycopg[pool]").
+DB_ENGINE = os.environ.get('CDSS_DB_ENGINE', 'sqlite')
+DB_CONN_MAX_AGE = int(os.environ.get('CDSS_DB_CONN_MAX_AGE', 60))  # Seconds; 0 closes after each request
+
+if DB_ENGINE == 'sqlite':
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': os.environ.get('CDSS_SQLITE_SYNCHRONOUS', 'NORMAL'),  # Durable on commit with WAL
+        'mmap_size': int(os.environ.get('CDSS_SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),  # Bytes
+        'cache_size': -int(os.environ.get('CDSS_SQLITE_CACHE_KB', 64 * 1024)),  # Negative means KiB
+        'temp_store': 'MEMORY',
     }
-}
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('CDSS_DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'timeout': float(os.environ.get('CDSS_DB_TIMEOUT', 20)),  # Busy timeout, seconds
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': ';'.join(f'PRAGMA {name}={value}' for name, value in SQLITE_PRAGMAS.items()),
+            },
+            'TEST': {
+                # A file rather than SQLite's in-memory default, so `manage.py test`
+                # runs with the options above and test threads share the database
+                'NAME': os.environ.get('CDSS_TEST_DB_NAME', BASE_DIR / 'test_db.sqlite3'),
+            },
+        }
+    }
+elif DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('CDSS_DB_NAME', 'cdss'),
+            'USER': os.environ.get('CDSS_DB_USER', 'cdss'),
+            'PASSWORD': os.environ.get('CDSS_DB_PASSWORD', ''),
+            'HOST': os.environ.get('CDSS_DB_HOST', 'localhost'),
+            'PORT': os.environ.get('CDSS_DB_PORT', '5432'),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'connect_timeout': int(os.environ.get('CDSS_DB_TIMEOUT', 10)),
+            },
+        }
+    }
+    DB_POOL_MAX_SIZE = int(os.environ.get('CDSS_DB_POOL_MAX_SIZE', 0))
+    if DB_POOL_MAX_SIZE:
+        # The pool owns connection reuse; Django refuses persistent connections with it
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.environ.get('CDSS_DB_POOL_MIN_SIZE', 2)),
+            'max_size': DB_POOL_MAX_SIZE,
+            'timeout': float(os.environ.get('CDSS_DB_POOL_TIMEOUT', 10)),  # Seconds to wait for a free connection
+        }
+else:
+    raise ImproperlyConfigured(f"CDSS_DB_ENGINE must be 'sqlite' or 'postgresql', not {DB_ENGINE!r}")
 
 
 # Password validation
@@ -133,6 +207,94 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Model inference for uploaded cases (forms.inference). Add an ONNX model with e.g.
+# 'yolov8': {'BACKEND': 'forms.inference.OnnxBackend', 'VERSION': '1',
+#            'PATH': BASE_DIR / 'models' / 'yolov8.onnx', 'LABELS': {0: 'negative', 1: 'positive'}}
+INFERENCE = {
+    'DEFAULT_MODEL': 'dummy',
+    'WORKERS': 2,  # Inference processes; 0 runs batches in the dispatcher thread
+    'MAX_BATCH_SIZE': 8,
+    'MAX_BATCH_WAIT': 0.05,  # Seconds to wait for a batch to fill
+    'CACHE_SIZE': 10000,  # Cached predictions kept, see forms.inference
+    'MODELS': {
+        'dummy': {'BACKEND': 'forms.inference.DummyBackend', 'VERSION': '1'},
+    },
+}
+
+# Annotation boxes are stored packed on Annotation.packed_boxes (forms.boxpack).
+# BoundingBox rows are an extra queryable index; turn this off to stop writing
+# them and drop existing ones with `manage.py pack_boxes --drop-index`.
+BOUNDING_BOX_INDEX = True
+
+# Version history of annotation sessions (forms.versions)
+ANNOTATION_VERSIONS = {
+    'AUTOSAVE_WINDOW': 60,  # Seconds; autosaves within it are folded into one version
+    'MAX_VERSIONS': 200,  # Versions kept per session
+}
+
+# In-process R-tree over the relative boxes of every session (forms.spatial)
+SPATIAL_INDEX = {
+    'NODE_CAPACITY': 16,  # Entries per tree node
+    'MAX_PENDING': 50000,  # Changed rows kept outside the tree before it is repacked
+    'MAX_RESULTS': 1000,  # Largest page /api/boxes/ returns
+    'DELETE_RETENTION': 7 * 24 * 3600,  # Seconds deleted sessions are remembered; staler indexes reload
+}
+
+# Consensus of all doctor sessions of a case and inter-annotator agreement (forms.consensus)
+CONSENSUS = {
+    'IOU_THRESHOLD': 0.5,
+    'MIN_SUPPORT': 0.5,  # Share of raters that must draw a box for it to enter the consensus
+    'MIN_PAIR_CASES': 10,  # Shared cases before a rater pair's Cohen's kappa is reported
+}
+
+# Offline evaluation of model predictions against doctor annotations (forms.evaluation)
+EVALUATION = {
+    'MODEL': None,  # Defaults to INFERENCE['DEFAULT_MODEL']
+    'SCORE_THRESHOLD': 0.5,  # Confidence a prediction needs to count as a detection
+    'BATCH_SIZE': 500,
+}
+
+# Rendered JSON of /case/, /list/ and the annotation reads (forms.response_cache).
+# For a cache shared by all workers use e.g.
+# 'responses': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+#               'LOCATION': BASE_DIR / 'cache' / 'responses'}
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'cdss-responses',
+        'OPTIONS': {'MAX_ENTRIES': 5000},
+    },
+}
+RESPONSE_CACHE = {
+    'ENABLED': True,
+    'ALIAS': 'responses',
+    'TIMEOUT': 300,  # Seconds; invalidation does not depend on it
+}
+
+# Per-endpoint timing, query and allocation metrics (forms.profiling), served at /metrics
+PROFILING = {
+    'ENABLED': False,
+    'TRACE_ALLOCATIONS': False,  # tracemalloc peak per request; slows every allocation
+    'SERVER_TIMING': True,
+    'PROFILE_SAMPLE_RATE': 0.0,  # Fraction of requests run under cProfile
+    'PROFILE_SLOW_MS': 500,  # Sampled profiles are kept only for requests slower than this
+    'PROFILE_DIR': BASE_DIR / 'profiles',
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'forms': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
 REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
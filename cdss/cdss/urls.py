@@ -15,14 +15,16 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django_nextjs.views import nextjs_page
 from rest_framework import routers  # Import routers here
 from forms.viewsets import FormViewSet # Import FormViewSet here
 from forms.views import upload_image, list_forms
 from django.conf import settings
 from django.conf.urls.static import static
-from forms.views import upload_image, list_forms,case_detail
+from forms.views import upload_image, list_forms,case_detail, case_image_derivative
+from forms.views import batch_upload, chunked_upload, chunked_upload_detail, chunked_upload_finalize, metrics
+from forms.media import serve_media
 from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
 
 
@@ -39,10 +41,16 @@ urlpatterns = [
     path("about/", nextjs_page(stream=True), name="about"),
     path('api/', include((router.urls, 'core_api'), namespace='core_api')), # Use router.urls directly
     path("upload/", upload_image, name="upload_image"),
+    path("upload/batch/", batch_upload, name="batch_upload"),
+    path("upload/chunked/", chunked_upload, name="chunked_upload"),
+    path("upload/chunked/<uuid:upload_id>/", chunked_upload_detail, name="chunked_upload_detail"),
+    path("upload/chunked/<uuid:upload_id>/finalize/", chunked_upload_finalize, name="chunked_upload_finalize"),
     path("list/", list_forms, name="list_forms"),
     path("case/<int:case_id>/", case_detail, name="case_detail"),  # This handles both GET and DELETE
+    path("case/<int:case_id>/image/<str:size>/", case_image_derivative, name="case_image_derivative"),
     path('admin/', admin.site.urls),
     path('api/', include('forms.urls')),  # This includes your annotation endpoints
+    path("metrics", metrics, name="metrics"),  # Prometheus scrape target, 404 unless profiling is enabled
     
     # Schema generation endpoint
     path("api/schema/", SpectacularAPIView.as_view(), name="schema"),
@@ -52,6 +60,10 @@ urlpatterns = [
     path("api/redoc/", SpectacularRedocView.as_view(url_name="schema"), name="redoc"),
 ]
 if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+if settings.SERVE_MEDIA:
+    # Uploaded media with ETag/Range/Cache-Control support; disable when a
+    # reverse proxy serves MEDIA_ROOT directly
+    urlpatterns += [
+        re_path(rf"^{settings.MEDIA_URL.lstrip('/')}(?P<path>.*)$", serve_media, name="media"),
+    ]
\ No newline at end of file
@@ -1,19 +1,37 @@
 # forms/admin.py
 from django.contrib import admin
-from .models import Forms, CaseImage, Annotation, BoundingBox
+from django.db.models import CharField, Q
+from django.db.models.functions import Cast
+from .search import is_supported as search_supported, matching_case_ids
+from .models import Forms, CaseImage, Annotation, AnnotationVersion, BoundingBox, ImportJob, PredictionCache, ConsensusAnnotation, CaseEvaluation, EvaluationRun
 
 @admin.register(Forms)
 class FormsAdmin(admin.ModelAdmin):
-    list_display = ['CaseID', 'PatientID', 'Date', 'Diagnosis', 'Confidence']
-    list_filter = ['Date', 'Diagnosis']
+    list_display = ['CaseID', 'PatientID', 'Date', 'Diagnosis', 'Confidence', 'InferenceStatus', 'DuplicateOf']
+    list_filter = ['Date', 'Diagnosis', 'InferenceStatus']
     search_fields = ['PatientID', 'Diagnosis']
     readonly_fields = ['CaseID', 'PatientID', 'Date']
+
+    def get_search_results(self, request, queryset, search_term):
+        # Served by the case search index instead of icontains scans
+        if not search_term or not search_supported():
+            return super().get_search_results(request, queryset, search_term)
+        return queryset.filter(CaseID__in=matching_case_ids(search_term)), False
+
 @admin.register(CaseImage)
 class CaseImageAdmin(admin.ModelAdmin):
-    list_display = ['case_id', 'patient_id', 'image_name', 'status', 'uploaded_at']
-    list_filter = ['status', 'uploaded_at']
+    list_display = ['case_id', 'patient_id', 'image_name', 'status', 'diagnosis', 'uploaded_at']
+    list_filter = ['status', 'diagnosis', 'uploaded_at']
     search_fields = ['case_id', 'patient_id', 'image_name']
-    readonly_fields = ['uploaded_at']
+    readonly_fields = ['uploaded_at', 'latest_annotation', 'diagnosis',
+                      'positive_count', 'negative_count']
+
+    def get_search_results(self, request, queryset, search_term):
+        # Served by the case search index; images without a Forms case match by exact case_id
+        if not search_term or not search_supported():
+            return super().get_search_results(request, queryset, search_term)
+        case_ids = matching_case_ids(search_term).annotate(text=Cast('case_id', CharField())).values('text')
+        return queryset.filter(Q(case_id__in=case_ids) | Q(case_id=search_term.strip())), False
     
     def get_queryset(self, request):
         return super().get_queryset(request).prefetch_related('annotations')
@@ -25,9 +43,9 @@ class BoundingBoxInline(admin.TabularInline):
 
 @admin.register(Annotation)
 class AnnotationAdmin(admin.ModelAdmin):
-    list_display = ['annotation_id', 'case_image', 'total_annotations', 
+    list_display = ['annotation_id', 'case_image', 'source', 'total_annotations', 
                    'positive_count', 'negative_count', 'created_at']
-    list_filter = ['created_at', 'total_annotations']
+    list_filter = ['source', 'created_at', 'total_annotations']
     search_fields = ['annotation_id', 'case_image__case_id', 'case_image__patient_id']
     readonly_fields = ['annotation_id', 'total_annotations', 'positive_count', 
                       'negative_count', 'created_at', 'updated_at']
@@ -36,6 +54,12 @@ class AnnotationAdmin(admin.ModelAdmin):
     def get_queryset(self, request):
         return super().get_queryset(request).select_related('case_image')
 
+@admin.register(AnnotationVersion)
+class AnnotationVersionAdmin(admin.ModelAdmin):
+    list_display = ['annotation', 'number', 'box_count', 'autosave', 'updated_at']
+    list_filter = ['autosave']
+    readonly_fields = ['created_at', 'updated_at']
+
 @admin.register(BoundingBox)
 class BoundingBoxAdmin(admin.ModelAdmin):
     list_display = ['annotation', 'box_id', 'label', 'x', 'y', 'width', 'height']
@@ -43,4 +67,33 @@ class BoundingBoxAdmin(admin.ModelAdmin):
     search_fields = ['annotation__annotation_id', 'annotation__case_image__case_id']
     
     def get_queryset(self, request):
-        return super().get_queryset(request).select_related('annotation__case_image')
\ No newline at end of file
+        return super().get_queryset(request).select_related('annotation__case_image')
+
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'source', 'phase', 'images_done', 'annotations_done',
+                   'annotations_skipped', 'updated_at']
+    list_filter = ['phase']
+    readonly_fields = ['created_at', 'updated_at']
+@admin.register(PredictionCache)
+class PredictionCacheAdmin(admin.ModelAdmin):
+    list_display = ['image_hash', 'model_id', 'model_version', 'hits', 'last_used_at']
+    list_filter = ['model_id', 'model_version']
+    readonly_fields = ['created_at', 'last_used_at']
+@admin.register(ConsensusAnnotation)
+class ConsensusAnnotationAdmin(admin.ModelAdmin):
+    list_display = ['case_image', 'raters', 'diagnosis', 'diagnosis_agreement', 'updated_at']
+    list_filter = ['diagnosis', 'raters']
+    search_fields = ['case_image__case_id']
+    readonly_fields = ['updated_at']
+@admin.register(CaseEvaluation)
+class CaseEvaluationAdmin(admin.ModelAdmin):
+    list_display = ['case_image', 'model_id', 'ground_truth', 'prediction', 'evaluated_at']
+    list_filter = ['model_id']
+    search_fields = ['case_image__case_id']
+    readonly_fields = ['evaluated_at']
+@admin.register(EvaluationRun)
+class EvaluationRunAdmin(admin.ModelAdmin):
+    list_display = ['id', 'model_id', 'full', 'cases_total', 'cases_evaluated', 'started_at', 'finished_at']
+    list_filter = ['model_id', 'full']
+    readonly_fields = ['started_at', 'finished_at']
@@ -0,0 +1,231 @@
+# forms/annotations.py
+"""Write path for doctor annotation sessions.
+
+Every session, whether it comes from the labeling tool or a batch
+re-annotation push, goes through ingest_annotation_sessions so the
+Annotation with its packed boxes (forms.boxpack), the optional BoundingBox
+index rows and the CaseImage summary are written together in one
+transaction with a fixed number of queries. The cases' consensus
+(forms.consensus) is rebuilt in the same transaction.
+
+Later saves and autosaves of the same session go through
+update_annotation_session, which stores only the changed boxes as a new
+version (forms.versions) and touches only their index rows.
+"""
+import uuid
+from datetime import datetime, timedelta
+
+
+from django.db import transaction
+from django.utils import timezone
+
+from forms.boxpack import box_index_enabled, pack
+from forms.consensus import update_consensus
+from forms.models import Annotation, AnnotationVersion, BoundingBox, CaseImage, count_labels
+from forms.response_cache import invalidate_cases
+from forms.versions import VersionConflict, diff, get_config as get_version_config, is_empty, undo
+
+BOX_BATCH_SIZE = 1000
+
+
+def new_annotation_id(case_id):
+    return f"ann_{case_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+
+def build_bounding_boxes(annotation, boxes):
+    """Unsaved BoundingBox rows for the frontend box dicts of one session."""
+    return [
+        BoundingBox(
+            annotation=annotation,
+            box_id=box_data['id'],
+            x=box_data['x'],
+            y=box_data['y'],
+            width=box_data['width'],
+            height=box_data['height'],
+            relative_x=box_data['relativeX'],
+            relative_y=box_data['relativeY'],
+            relative_width=box_data['relativeWidth'],
+            relative_height=box_data['relativeHeight'],
+            label=box_data['label'],
+            confidence=box_data.get('confidence'),
+        )
+        for box_data in boxes
+    ]
+
+
+def bounding_box_data(box):
+    """Frontend dict for a stored BoundingBox, the inverse of build_bounding_boxes."""
+    data = {
+        'id': box.box_id,
+        'x': box.x,
+        'y': box.y,
+        'width': box.width,
+        'height': box.height,
+        'label': box.label,
+        'relativeX': box.relative_x,
+        'relativeY': box.relative_y,
+        'relativeWidth': box.relative_width,
+        'relativeHeight': box.relative_height,
+    }
+    if box.confidence is not None:
+        data['confidence'] = box.confidence
+    return data
+
+
+def bulk_create_annotations(annotations):
+    """bulk_create Annotation rows, making sure every object ends up with its pk."""
+    Annotation.objects.bulk_create(annotations)
+    if annotations and annotations[0].pk is None:
+        # Backend cannot return ids from a bulk insert
+        ids = dict(Annotation.objects.filter(
+            annotation_id__in=[a.annotation_id for a in annotations]
+        ).values_list('annotation_id', 'id'))
+        for annotation in annotations:
+            annotation.pk = ids[annotation.annotation_id]
+    return annotations
+
+
+def ingest_annotation_sessions(sessions):
+    """Save one annotation session per validated AnnotationRequestSerializer payload.
+
+    All sessions are written atomically: either every Annotation and
+    BoundingBox is stored and the case summaries updated, or nothing is.
+    Returns the created Annotation objects in input order.
+    """
+    if not sessions:
+        return []
+
+    with transaction.atomic():
+        # Create the missing case images in one statement, then reload them
+        # all so primary keys are available on every backend
+        case_ids = {session['caseId'] for session in sessions}
+        existing = set(
+            CaseImage.objects.filter(case_id__in=case_ids).values_list('case_id', flat=True)
+        )
+        missing = {}
+        for session in sessions:
+            if session['caseId'] not in existing and session['caseId'] not in missing:
+                missing[session['caseId']] = CaseImage(
+                    case_id=session['caseId'],
+                    patient_id=session['patientId'],
+                    image_name=session['imageName'],
+                    status='uploaded',
+                )
+        CaseImage.objects.bulk_create(missing.values(), ignore_conflicts=True)
+        case_images = {
+            case_image.case_id: case_image
+            for case_image in CaseImage.objects.select_for_update().filter(case_id__in=case_ids)
+        }
+
+        annotated_at = timezone.now().isoformat()
+        annotations = []
+        for session in sessions:
+            total, positive, negative = count_labels(session['annotations'])
+            annotations.append(Annotation(
+                case_image=case_images[session['caseId']],
+                annotation_id=new_annotation_id(session['caseId']),
+                annotations_data={
+                    'caseId': session['caseId'],
+                    'patientId': session['patientId'],
+                    'imageName': session['imageName'],
+                    'annotations': session['annotations'],
+                    'annotated_at': annotated_at,
+                },
+                packed_boxes=pack(session['annotations']),
+                total_annotations=total,
+                positive_count=positive,
+                negative_count=negative,
+            ))
+        bulk_create_annotations(annotations)
+
+        if box_index_enabled():
+            boxes = []
+            for session, annotation in zip(sessions, annotations):
+                boxes.extend(build_bounding_boxes(annotation, session['annotations']))
+            BoundingBox.objects.bulk_create(boxes, batch_size=BOX_BATCH_SIZE)
+
+        # Sessions are applied in order, so the last one per case wins
+        for annotation in annotations:
+            case_image = annotation.case_image
+            case_image.status = 'annotated'
+            case_image.set_latest_annotation(annotation)
+        CaseImage.objects.bulk_update(
+            case_images.values(),
+            ['status', 'latest_annotation', 'diagnosis', 'positive_count', 'negative_count'],
+        )
+        update_consensus(case_image.pk for case_image in case_images.values())
+        invalidate_cases(case_ids)
+
+    return annotations
+
+
+def update_annotation_session(session, autosave=False):
+    """Apply a full box list to an existing doctor session as a new version.
+
+    `session` is a validated AnnotationRequestSerializer payload with
+    `annotationId` and optionally `version`, the head the client edited;
+    VersionConflict is raised when the head has moved on since, and
+    Annotation.DoesNotExist for an unknown session. Saves that change
+    nothing write nothing. Returns (annotation, changed).
+    """
+    config = get_version_config()
+    with transaction.atomic():
+        annotation = Annotation.objects.select_for_update().select_related('case_image').get(
+            annotation_id=session['annotationId'], source=Annotation.DOCTOR,
+            case_image__case_id=session['caseId'],
+        )
+        if session.get('version') is not None and session['version'] != annotation.version:
+            raise VersionConflict(
+                f"Session is at version {annotation.version}, not {session['version']}"
+            )
+
+        old = (annotation.annotations_data or {}).get('annotations', [])
+        new = session['annotations']
+        delta = diff(old, new)
+        if is_empty(delta):
+            return annotation, False
+
+        now = timezone.now()
+        head = annotation.versions.filter(number=annotation.version).first()
+        # The window runs from the head version's creation: measured from its
+        # last fold, a draft autosaved every few seconds would never get a new version
+        if (autosave and head is not None and head.autosave
+                and now - head.created_at <= timedelta(seconds=config['AUTOSAVE_WINDOW'])):
+            # Fold into the previous autosave: re-diff against the version before it
+            head.delta = diff(undo(old, head.delta), new)
+            if is_empty(head.delta):
+                head.delete()
+                annotation.version -= 1
+            else:
+                head.box_count = len(new)
+                head.save(update_fields=['delta', 'box_count', 'updated_at'])
+        else:
+            annotation.version += 1
+            AnnotationVersion.objects.create(
+                annotation=annotation, number=annotation.version, delta=delta,
+                box_count=len(new), autosave=autosave,
+            )
+            annotation.versions.filter(number__lte=annotation.version - config['MAX_VERSIONS']).delete()
+
+        annotation.annotations_data = {
+            **(annotation.annotations_data or {}),
+            'annotations': new,
+            'annotated_at': now.isoformat(),
+        }
+        annotation.packed_boxes = pack(new)
+        annotation.save()  # save() recounts the labels
+
+        if box_index_enabled():
+            changed = delta['added'] + [box for _, box in delta['modified']]
+            stale_ids = [box['id'] for box in delta['removed']] + [old_box['id'] for old_box, _ in delta['modified']]
+            if stale_ids:
+                annotation.bounding_boxes.filter(box_id__in=stale_ids).delete()
+            BoundingBox.objects.bulk_create(build_bounding_boxes(annotation, changed), batch_size=BOX_BATCH_SIZE)
+
+        case_image = annotation.case_image
+        if case_image.latest_annotation_id == annotation.pk:
+            case_image.set_latest_annotation(annotation)
+            case_image.save(update_fields=['diagnosis', 'positive_count', 'negative_count'])
+        update_consensus([case_image.pk])
+        invalidate_cases([case_image.case_id])
+    return annotation, True
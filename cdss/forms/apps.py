@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.core import checks
+from django.db.models.signals import post_delete, post_migrate, pre_migrate
 
 
 class FormsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'forms'
+
+    def ready(self):
+        from forms import search, spatial
+        checks.register(search.check_triggers, checks.Tags.database)
+        pre_migrate.connect(search.suspend_for_migrate, sender=self)
+        post_migrate.connect(search.restore_after_migrate, sender=self)
+        post_delete.connect(spatial.record_deletion, sender=self.get_model('Annotation'))
@@ -0,0 +1,244 @@
+# forms/benchmark.py
+"""Synthetic data and scripted workloads for `manage.py benchmark`.
+
+The dataset is generated as a COCO file shaped like
+samples/sample_annotations.coco.json: 640x640 images with 200x180-ish
+Positive/Negative boxes. It is loaded through the regular COCO importer,
+so the tables look exactly like imported data.
+
+Workloads drive the API in-process through the Django test client. For
+each request they record latency and the number of queries run on its
+thread. Results can be saved as a baseline and compared on later runs.
+"""
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import django
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+
+from forms.coco import CATEGORIES, create_import_job, run_import
+from forms.models import CaseImage, Forms
+
+IMAGE_SIZE = 640
+MEAN_BOX_SIZE = (200, 180)
+
+
+# Synthetic data
+
+def synthetic_image(seed, size=IMAGE_SIZE):
+    """A distinct JPEG per seed: smooth random blobs, so hashes never collide."""
+    rng = random.Random(seed)
+    base = Image.new('RGB', (16, 16))
+    base.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(256)])
+    buffer = io.BytesIO()
+    base.resize((size, size), Image.BILINEAR).save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def synthetic_boxes(rng, count, size=IMAGE_SIZE):
+    """[(x, y, width, height, label)] scattered over one image."""
+    boxes = []
+    for _ in range(count):
+        width = min(size, max(8.0, rng.gauss(MEAN_BOX_SIZE[0], 60)))
+        height = min(size, max(8.0, rng.gauss(MEAN_BOX_SIZE[1], 60)))
+        x = rng.uniform(0, size - width)
+        y = rng.uniform(0, size - height)
+        label = 'positive' if rng.random() < 0.3 else 'negative'
+        boxes.append((round(x, 1), round(y, 1), round(width, 1), round(height, 1), label))
+    return boxes
+
+
+def synthetic_coco(cases, boxes_per_case, seed):
+    """A COCO dataset of `cases` images with `boxes_per_case` boxes each."""
+    rng = random.Random(seed)
+    category_ids = {category['name'].lower(): category['id'] for category in CATEGORIES}
+    images, annotations = [], []
+    for image_id in range(cases):
+        images.append({
+            'id': image_id, 'license': 1, 'file_name': f'synthetic_{image_id:06d}.jpg',
+            'height': IMAGE_SIZE, 'width': IMAGE_SIZE,
+            'date_captured': timezone.now().isoformat(),
+        })
+        for x, y, width, height, label in synthetic_boxes(rng, boxes_per_case):
+            annotations.append({
+                'id': len(annotations), 'image_id': image_id, 'category_id': category_ids[label],
+                'bbox': [x, y, width, height], 'area': round(width * height, 1),
+                'segmentation': [], 'iscrowd': 0,
+            })
+    return {
+        'info': {'description': f'CDSS synthetic benchmark dataset (seed {seed})'},
+        'licenses': [{'id': 1, 'name': 'synthetic'}],
+        'categories': CATEGORIES,
+        'images': images,
+        'annotations': annotations,
+    }
+
+
+def load_synthetic_dataset(directory, cases, boxes_per_case, seed):
+    """Write the synthetic COCO file and images under `directory` and import them."""
+    coco = synthetic_coco(cases, boxes_per_case, seed)
+    images_dir = os.path.join(directory, 'images')
+    os.makedirs(images_dir, exist_ok=True)
+    for image in coco['images']:
+        with open(os.path.join(images_dir, image['file_name']), 'wb') as f:
+            f.write(synthetic_image(seed * 1_000_003 + image['id']))
+    source = os.path.join(directory, 'synthetic.coco.json')
+    with open(source, 'w') as f:
+        json.dump(coco, f)
+    return run_import(create_import_job(source, images_dir))
+
+
+# Workloads
+
+class Workload:
+    """A named request script; `request(client, rng)` issues one request."""
+    def __init__(self, name, request, expected_status=200):
+        self.name = name
+        self.request = request
+        self.expected_status = expected_status
+
+
+def annotation_payload(case_image, rng, boxes_per_case):
+    annotations = []
+    for index, (x, y, width, height, label) in enumerate(synthetic_boxes(rng, boxes_per_case), start=1):
+        annotations.append({
+            'id': index, 'x': x, 'y': y, 'width': width, 'height': height, 'label': label,
+            'relativeX': x / IMAGE_SIZE, 'relativeY': y / IMAGE_SIZE,
+            'relativeWidth': width / IMAGE_SIZE, 'relativeHeight': height / IMAGE_SIZE,
+        })
+    return json.dumps({
+        'caseId': case_image.case_id,
+        'patientId': case_image.patient_id,
+        'imageName': case_image.image_name,
+        'annotations': annotations,
+    })
+
+
+def build_workloads(boxes_per_case, seed):
+    """The standard workloads, reads first so writes do not skew them."""
+    case_ids = list(Forms.objects.order_by('CaseID').values_list('CaseID', flat=True))
+    case_images = list(CaseImage.objects.order_by('pk'))
+    upload_seed = iter(range(seed * 1_000_003 + 10_000_000, seed * 1_000_003 + 20_000_000))
+    upload_lock = threading.Lock()
+
+    def upload(client, rng):
+        with upload_lock:
+            image_seed = next(upload_seed)
+        image = SimpleUploadedFile('benchmark.jpg', synthetic_image(image_seed), content_type='image/jpeg')
+        return client.post('/upload/', {'image': image})
+
+    return [
+        Workload('list_forms', lambda client, rng: client.get('/list/')),
+        Workload('list_forms_page', lambda client, rng: client.get('/list/', {'limit': 50})),
+        Workload('case_detail', lambda client, rng: client.get(f'/case/{rng.choice(case_ids)}/')),
+        Workload('get_annotations', lambda client, rng: client.get(
+            f'/api/annotations/{rng.choice(case_images).case_id}/')),
+        Workload('list_annotations', lambda client, rng: client.get('/api/annotations/list/')),
+        Workload('forms_api_list', lambda client, rng: client.get('/api/forms/')),
+        Workload('forms_api_detail', lambda client, rng: client.get(f'/api/forms/{rng.choice(case_ids)}/')),
+        Workload('save_annotations', lambda client, rng: client.post(
+            '/api/annotations/', annotation_payload(rng.choice(case_images), rng, boxes_per_case),
+            content_type='application/json'), expected_status=201),
+        Workload('upload_image', upload),
+    ]
+
+
+def percentile(sorted_values, fraction):
+    """Linear-interpolated percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def run_workload(workload, iterations, concurrency=1, seed=0):
+    """Run one workload; returns its latency (ms), throughput and query statistics."""
+    latencies, queries, errors = [], [], []
+    lock = threading.Lock()
+
+    def worker(worker_index, count):
+        client = Client()
+        rng = random.Random(f'{seed}:{workload.name}:{worker_index}')
+        for _ in range(count):
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = workload.request(client, rng)
+                elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed * 1000)
+                queries.append(len(captured))
+                if response.status_code != workload.expected_status:
+                    errors.append(response.status_code)
+
+    shares = [iterations // concurrency + (1 if i < iterations % concurrency else 0) for i in range(concurrency)]
+    start = time.perf_counter()
+    if concurrency == 1:
+        worker(0, iterations)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(worker, range(concurrency), shares))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'iterations': iterations,
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p90_ms': round(percentile(latencies, 0.90), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'mean_ms': round(statistics.fmean(latencies), 3) if latencies else 0.0,
+        'max_ms': round(latencies[-1], 3) if latencies else 0.0,
+        'throughput_rps': round(iterations / wall, 2) if wall else 0.0,
+        'queries_mean': round(statistics.fmean(queries), 2) if queries else 0.0,
+        'queries_max': max(queries, default=0),
+    }
+
+
+# Baselines
+
+def run_metadata(cases, boxes_per_case, iterations, concurrency, seed):
+    return {
+        'database': connection.vendor,
+        'cases': cases,
+        'boxes_per_case': boxes_per_case,
+        'iterations': iterations,
+        'concurrency': concurrency,
+        'seed': seed,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'created_at': timezone.now().isoformat(),
+    }
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """[(workload, message)] for every regression against a saved baseline.
+
+    A workload regresses when its p95 latency grows by more than `threshold`
+    (a fraction) or when it runs more queries per request than before.
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        if result['p95_ms'] > previous['p95_ms'] * (1 + threshold):
+            regressions.append((name, f"p95 {previous['p95_ms']:.1f} -> {result['p95_ms']:.1f} ms"))
+        if result['queries_mean'] > previous['queries_mean']:
+            regressions.append((name, f"queries/request {previous['queries_mean']} -> {result['queries_mean']}"))
+    return regressions
@@ -0,0 +1,186 @@
+# forms/boxpack.py
+"""Packed columnar encoding of an annotation session's boxes.
+
+Annotation.packed_boxes holds all boxes of a session in one binary value.
+The layout is little-endian and every column is 4-byte aligned:
+
+    header      magic b'CBX1', uint32 box count, uint8 flags, 3 pad bytes
+    box_ids     int32[N]
+    coords      float32[8][N]: x, y, width, height, relative x, y, width, height
+    confidence  float32[N], NaN where missing (only when FLAG_CONFIDENCE is set)
+    labels      ceil(N / 8) bytes, one bit per box, 1 = positive (LSB first)
+
+About 36-40 bytes a box. A BoundingBox row (ten doubles plus its key and
+index entries) or the JSON session dict each take several times that.
+unpack() wraps the value with np.frombuffer, so decoding copies nothing
+until the values are turned into Python objects.
+
+Decoded coordinates carry float32 precision. Python values are rounded to
+3 decimals for pixels and 6 for fractions of the image, so they
+round-trip the frontend's numbers without float32 noise.
+
+BoundingBox rows are now an optional, queryable index, written only while
+settings.BOUNDING_BOX_INDEX is true. Readers go through load_packed() or
+iter_packed(). For sessions written before packing existed (packed_boxes
+is NULL), these fall back to the annotations_data JSON; `manage.py
+pack_boxes` backfills them.
+"""
+import struct
+
+import numpy as np
+from django.conf import settings
+
+from forms.models import Annotation
+
+MAGIC = b'CBX1'
+HEADER = struct.Struct('<4sIB3x')
+FLAG_CONFIDENCE = 1
+
+# Box ids are stored as int32, here and in BoundingBox.box_id; writers validate them against this
+BOX_ID_RANGE = range(-2 ** 31, 2 ** 31)
+COORDINATE_KEYS = ('x', 'y', 'width', 'height', 'relativeX', 'relativeY', 'relativeWidth', 'relativeHeight')
+ROW_FIELDS = ('x', 'y', 'width', 'height', 'relative_x', 'relative_y', 'relative_width', 'relative_height')
+# Decimals kept when converting to Python floats: pixels, then fractions of the image
+DECIMALS = (3, 3, 3, 3, 6, 6, 6, 6)
+
+
+def box_index_enabled():
+    """Whether write paths also store BoundingBox rows."""
+    return getattr(settings, 'BOUNDING_BOX_INDEX', True)
+
+
+class PackedBoxes:
+    """Read-only column view over one packed session.
+
+    `box_ids` (N,) int32, `coords` (8, N) float32 in COORDINATE_KEYS order,
+    `confidence` (N,) float32 or None, `positive` (N,) bool.
+    """
+    __slots__ = ('count', 'box_ids', 'coords', 'confidence', 'positive')
+
+    def __init__(self, count, box_ids, coords, confidence, positive):
+        self.count = count
+        self.box_ids = box_ids
+        self.coords = coords
+        self.confidence = confidence
+        self.positive = positive
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def label_ids(self):
+        """0 = negative, 1 = positive, as forms.geometry.LABEL_IDS."""
+        return self.positive.view(np.int8)
+
+    @property
+    def labels(self):
+        return ['positive' if value else 'negative' for value in self.positive.tolist()]
+
+    def columns(self):
+        """Coordinate columns as Python lists, rounded (see DECIMALS)."""
+        return [
+            np.round(self.coords[index].astype(np.float64), decimals).tolist()
+            for index, decimals in enumerate(DECIMALS)
+        ]
+
+    def confidences(self):
+        if self.confidence is None:
+            return [None] * self.count
+        return [None if value != value else value for value in np.round(self.confidence.astype(np.float64), 6).tolist()]
+
+    def to_dicts(self):
+        """Frontend box dicts, as stored in annotations_data and returned by bounding_box_data()."""
+        boxes = []
+        for box_id, *values, label, confidence in zip(
+            self.box_ids.tolist(), *self.columns(), self.labels, self.confidences()
+        ):
+            box = {'id': box_id, **dict(zip(COORDINATE_KEYS[:4], values[:4])), 'label': label,
+                   **dict(zip(COORDINATE_KEYS[4:], values[4:]))}
+            if confidence is not None:
+                box['confidence'] = confidence
+            boxes.append(box)
+        return boxes
+
+    def to_rows(self):
+        """Dicts shaped like serialized BoundingBox rows (box_id, x, ..., relative_x, ..., label, confidence)."""
+        return [
+            {'box_id': box_id, **dict(zip(ROW_FIELDS, values)), 'label': label, 'confidence': confidence}
+            for box_id, *values, label, confidence in zip(
+                self.box_ids.tolist(), *self.columns(), self.labels, self.confidences()
+            )
+        ]
+
+
+def pack(boxes):
+    """Encode frontend box dicts (annotations_data['annotations']) as bytes.
+
+    Raises OverflowError for a box id outside BOX_ID_RANGE.
+    """
+    count = len(boxes)
+    box_ids = np.fromiter((box['id'] for box in boxes), dtype='<i4', count=count)
+    coords = np.array([[box[key] for box in boxes] for key in COORDINATE_KEYS], dtype='<f4').reshape(8, count)
+    confidences = [box.get('confidence') for box in boxes]
+    has_confidence = any(value is not None for value in confidences)
+    positive = np.fromiter((box['label'] == 'positive' for box in boxes), dtype=bool, count=count)
+    parts = [HEADER.pack(MAGIC, count, FLAG_CONFIDENCE if has_confidence else 0), box_ids.tobytes(), coords.tobytes()]
+    if has_confidence:
+        parts.append(np.array([np.nan if value is None else value for value in confidences], dtype='<f4').tobytes())
+    parts.append(np.packbits(positive, bitorder='little').tobytes())
+    return b''.join(parts)
+
+
+def unpack(data):
+    """PackedBoxes view over a packed value (bytes or memoryview)."""
+    magic, count, flags = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a packed box set")
+    offset = HEADER.size
+    box_ids = np.frombuffer(data, dtype='<i4', count=count, offset=offset)
+    offset += 4 * count
+    coords = np.frombuffer(data, dtype='<f4', count=8 * count, offset=offset).reshape(8, count)
+    offset += 32 * count
+    confidence = None
+    if flags & FLAG_CONFIDENCE:
+        confidence = np.frombuffer(data, dtype='<f4', count=count, offset=offset)
+        offset += 4 * count
+    bits = np.frombuffer(data, dtype=np.uint8, count=(count + 7) // 8, offset=offset)
+    positive = np.unpackbits(bits, count=count, bitorder='little').view(bool)
+    return PackedBoxes(count, box_ids, coords, confidence, positive)
+
+
+def iter_packed(annotations, *fields, chunk_size=2000):
+    """Yield (*fields, PackedBoxes) for each row of an Annotation queryset.
+
+    Only packed_boxes is read; the JSON of sessions that are not packed yet
+    is fetched per chunk as a fallback.
+    """
+    def resolve(batch):
+        missing = [row[-2] for row in batch if row[-1] is None]
+        sessions = dict(
+            Annotation.objects.filter(pk__in=missing).values_list('pk', 'annotations_data')
+        ) if missing else {}
+        for row in batch:
+            data = row[-1]
+            if data is None:
+                data = pack((sessions[row[-2]] or {}).get('annotations', []))
+            yield (*row[:-2], unpack(data))
+
+    batch = []
+    for row in annotations.values_list(*fields, 'pk', 'packed_boxes').iterator(chunk_size=chunk_size):
+        batch.append(row)
+        if len(batch) >= chunk_size:
+            yield from resolve(batch)
+            batch = []
+    yield from resolve(batch)
+
+
+def load_packed(annotation_ids):
+    """{annotation pk: PackedBoxes} for the given annotations."""
+    return dict(iter_packed(Annotation.objects.filter(pk__in=list(annotation_ids)), 'pk'))
+
+
+def packed_session(annotation):
+    """PackedBoxes of a loaded Annotation, packing its JSON if it is not packed yet."""
+    if annotation.packed_boxes is not None:
+        return unpack(annotation.packed_boxes)
+    return unpack(pack((annotation.annotations_data or {}).get('annotations', [])))
@@ -0,0 +1,582 @@
+# forms/coco.py
+"""COCO dataset export and import, in the format of samples/sample_annotations.coco.json.
+
+The export is produced as a stream of JSON text chunks. Images and boxes
+are read with QuerySet.iterator(), which uses server-side cursors where the
+database supports them, so memory stays bounded by the chunk size rather
+than the number of cases exported. Boxes are decoded from each session's
+packed columns (forms.boxpack), one value per case rather than a row per box.
+Images carry their real pixel size (forms.dimensions) and each bbox is the
+box's relative coordinates scaled to it.
+
+The import walks the file incrementally with JSONStreamReader in two
+passes (images, then annotations) and writes each batch in its own
+transaction together with the ImportJob checkpoint, so an interrupted
+import resumes from the last committed batch. Boxes that carry a score are
+model predictions and become a model session (named by ImportJob.model_id)
+instead of ground truth.
+"""
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from datetime import date
+
+from django.core.files import File
+from django.db import connection, transaction
+from django.utils import timezone
+
+from forms.annotations import (
+    BOX_BATCH_SIZE, bounding_box_data, bulk_create_annotations, new_annotation_id,
+)
+from forms.boxpack import BOX_ID_RANGE, box_index_enabled, iter_packed, pack
+from forms.consensus import update_consensus
+from forms.dimensions import image_sizes, read_size
+from forms.jsonstream import JSONStreamReader
+from forms.models import (
+    Annotation, BoundingBox, CaseImage, ConsensusAnnotation, DIAGNOSIS_CHOICES, Forms, ImportedImage,
+    ImportJob, count_labels,
+)
+from forms.response_cache import invalidate_cases
+
+logger = logging.getLogger(__name__)
+
+# Category ids match the sample dataset and the cerv.AI training configs
+CATEGORIES = [
+    {'id': 0, 'name': 'cancer', 'supercategory': 'none'},
+    {'id': 1, 'name': 'Negative', 'supercategory': 'cancer'},
+    {'id': 2, 'name': 'Positive', 'supercategory': 'cancer'},
+]
+LABEL_TO_CATEGORY = {'negative': 1, 'positive': 2}
+RELATIVE_KEYS = ('relativeX', 'relativeY', 'relativeWidth', 'relativeHeight')
+
+EXPORT_CHUNK_SIZE = 2000
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MODEL_ID = 'coco_import'  # Model named on imported predictions when the job names none
+
+
+def filter_case_images(params):
+    """CaseImage queryset for the export filters shared by the API and command.
+
+    Accepts `diagnosis`, `status`, `date_from`, `date_to` (upload date, ISO
+    format) and `case_ids` (comma separated). Raises ValueError on bad input.
+    """
+    case_images = CaseImage.objects.all()
+
+    diagnosis = params.get('diagnosis')
+    if diagnosis:
+        matches = [choice for choice in DIAGNOSIS_CHOICES if choice.lower() == diagnosis.lower()]
+        if not matches:
+            raise ValueError(f"diagnosis must be one of: {', '.join(DIAGNOSIS_CHOICES)}")
+        case_images = case_images.filter(diagnosis=matches[0])
+
+    if params.get('status'):
+        case_images = case_images.filter(status=params['status'])
+
+    for param, lookup in (('date_from', 'uploaded_at__date__gte'), ('date_to', 'uploaded_at__date__lte')):
+        value = params.get(param)
+        if value:
+            try:
+                case_images = case_images.filter(**{lookup: date.fromisoformat(value)})
+            except ValueError:
+                raise ValueError(f'{param} must be an ISO date (YYYY-MM-DD)')
+
+    case_ids = params.get('case_ids')
+    if case_ids:
+        case_images = case_images.filter(case_id__in=[c.strip() for c in case_ids.split(',') if c.strip()])
+
+    return case_images
+
+
+def _export_sizes(batch):
+    """{CaseImage pk: (width, height)} for a batch of (pk, ...) rows; unreadable images are left out."""
+    sizes = image_sizes([row[0] for row in batch])
+    for pk, size in sizes.items():
+        if size is None:
+            logger.warning("Leaving case image %s out of the export: its size is unknown", pk)
+    return {pk: size for pk, size in sizes.items() if size}
+
+
+def _bbox(relative, width, height):
+    """COCO [x, y, width, height] in image pixels from relative x, y, width, height."""
+    x, y, box_width, box_height = relative
+    return [round(x * width, 2), round(y * height, 2), round(box_width * width, 2), round(box_height * height, 2)]
+
+
+def iter_images(case_images, chunk_size=EXPORT_CHUNK_SIZE):
+    """COCO images with their pixel size (forms.dimensions), read once for rows that lack it."""
+    rows = case_images.order_by('pk').values_list('pk', 'image_name', 'uploaded_at')
+    batch = []
+
+    def flush(batch):
+        sizes = _export_sizes(batch)
+        for pk, image_name, uploaded_at in batch:
+            if pk not in sizes:
+                continue
+            width, height = sizes[pk]
+            yield {
+                'id': pk,
+                'file_name': image_name,
+                'height': height,
+                'width': width,
+                'date_captured': uploaded_at.isoformat() if uploaded_at else None,
+            }
+
+    for row in rows.iterator(chunk_size=chunk_size):
+        batch.append(row)
+        if len(batch) >= chunk_size:
+            yield from flush(batch)
+            batch = []
+    yield from flush(batch)
+
+
+def iter_annotations(case_images, chunk_size=EXPORT_CHUNK_SIZE):
+    """COCO annotations for the boxes of each case's latest annotation session.
+
+    Boxes are placed by their relative coordinates, since the stored pixel
+    values are in the space of whatever canvas they were drawn on.
+    """
+    sessions = Annotation.objects.filter(
+        pk__in=case_images.filter(latest_annotation__isnull=False).values('latest_annotation_id')
+    ).order_by('case_image_id')
+    annotation_id = 0
+    for image_id, width, height, packed in iter_packed(
+        sessions, 'case_image_id', 'case_image__width', 'case_image__height', chunk_size=chunk_size
+    ):
+        if not (width and height):
+            # Left out by iter_images as well
+            continue
+        relative = packed.columns()[4:]
+        confidence = packed.confidences()
+        for index, label in enumerate(packed.labels):
+            annotation_id += 1
+            bbox = _bbox([column[index] for column in relative], width, height)
+            annotation = {
+                'id': annotation_id,
+                'image_id': image_id,
+                'category_id': LABEL_TO_CATEGORY[label],
+                'bbox': bbox,
+                'area': round(bbox[2] * bbox[3], 2),
+                'segmentation': [],
+                'iscrowd': 0,
+            }
+            if confidence[index] is not None:
+                annotation['score'] = confidence[index]
+            yield annotation
+
+
+def iter_consensus_annotations(case_images, chunk_size=EXPORT_CHUNK_SIZE):
+    """COCO annotations for the fused consensus boxes of each case (see forms.consensus)."""
+    rows = ConsensusAnnotation.objects.filter(case_image__in=case_images).order_by('case_image_id').values_list(
+        'case_image_id', 'case_image__width', 'case_image__height', 'boxes'
+    )
+    annotation_id = 0
+    for image_id, width, height, boxes in rows.iterator(chunk_size=chunk_size):
+        if not (width and height):
+            continue
+        for box in boxes:
+            annotation_id += 1
+            bbox = _bbox([box[key] for key in RELATIVE_KEYS], width, height)
+            yield {
+                'id': annotation_id,
+                'image_id': image_id,
+                'category_id': LABEL_TO_CATEGORY[box['label']],
+                'bbox': bbox,
+                'area': round(bbox[2] * bbox[3], 2),
+                'segmentation': [],
+                'iscrowd': 0,
+                'support': box['support'],
+            }
+
+
+EXPORT_LABELS = {
+    'latest': iter_annotations,
+    'consensus': iter_consensus_annotations,
+}
+
+
+def _iter_json_array(items, chunk_size):
+    # Join encoded items in groups so each yielded chunk is reasonably large
+    buffer = []
+    first = True
+    for item in items:
+        buffer.append(json.dumps(item))
+        if len(buffer) >= chunk_size:
+            yield ('' if first else ',') + ','.join(buffer)
+            first = False
+            buffer = []
+    if buffer:
+        yield ('' if first else ',') + ','.join(buffer)
+
+
+def iter_coco_export(case_images, chunk_size=EXPORT_CHUNK_SIZE, labels='latest'):
+    """Yield a COCO JSON document for the given CaseImage queryset as text chunks.
+
+    `labels` picks the boxes exported: 'latest' doctor session or fused 'consensus'.
+    """
+    iter_boxes = EXPORT_LABELS[labels]
+    now = timezone.now()
+    header = {
+        'info': {
+            'year': str(now.year),
+            'version': '1',
+            'description': 'CDSS annotation export',
+            'contributor': '',
+            'url': '',
+            'date_created': now.isoformat(),
+        },
+        'licenses': [],
+        'categories': CATEGORIES,
+    }
+    # Emit the header object without its closing brace, then the two arrays
+    yield json.dumps(header)[:-1] + ', "images": ['
+    yield from _iter_json_array(iter_images(case_images, chunk_size), chunk_size)
+    yield '], "annotations": ['
+    yield from _iter_json_array(iter_boxes(case_images, chunk_size), chunk_size)
+    yield ']}'
+
+
+# Import
+
+def default_category_map(categories):
+    """Map COCO category ids to box labels by category name (Positive/Negative)."""
+    return {
+        str(category['id']): category['name'].lower()
+        for category in categories
+        if str(category.get('name', '')).lower() in LABEL_TO_CATEGORY
+    }
+
+
+def parse_category_map(value):
+    """Parse a '1=negative,2=positive' override into a category map."""
+    category_map = {}
+    for pair in value.split(','):
+        category_id, _, label = pair.partition('=')
+        label = label.strip().lower()
+        if label not in LABEL_TO_CATEGORY:
+            raise ValueError(f"Unknown label {label!r} in category map; use positive or negative")
+        category_map[category_id.strip()] = label
+    return category_map
+
+
+def create_import_job(source, images_dir='', category_map=None, model_id=''):
+    source = os.path.abspath(source)
+    return ImportJob.objects.create(
+        source=source,
+        source_size=os.path.getsize(source),
+        images_dir=images_dir or '',
+        category_map=category_map or {},
+        model_id=model_id or '',
+    )
+
+
+def find_resumable_job(source):
+    """The latest unfinished job for the same file, if any."""
+    source = os.path.abspath(source)
+    return ImportJob.objects.filter(
+        source=source, source_size=os.path.getsize(source)
+    ).exclude(phase='done').order_by('-pk').first()
+
+
+def _iter_section(job, section, categories=None):
+    """Yield (index, element) for one streamed top-level array of the job's file.
+
+    The categories array, if met on the way, is collected into `categories`.
+    """
+    index = 0
+    with open(job.source, encoding='utf-8') as fp:
+        for key, value in JSONStreamReader(fp).items(stream_keys={'images', 'annotations'}):
+            if key == section:
+                index += 1
+                yield index, value
+            elif key == 'categories' and categories is not None:
+                categories.extend(value)
+
+
+def _batches(items, skip, batch_size):
+    batch = []
+    for index, item in items:
+        if index <= skip:
+            continue
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _store_images(job, images):
+    with transaction.atomic():
+        forms = []
+        for image, patient_id in zip(images, Forms.allocate_patient_ids(len(images))):
+            form = Forms(PatientID=patient_id, Diagnosis='', Confidence='')
+            if job.images_dir:
+                path = os.path.join(job.images_dir, image.get('file_name', ''))
+                if os.path.isfile(path):
+                    with open(path, 'rb') as f:
+                        form.Image.save(os.path.basename(path), File(f), save=False)
+            forms.append(form)
+        Forms.objects.bulk_create(forms)
+        sizes = [
+            read_size(form.Image.name) if form.Image and not (image.get('width') and image.get('height')) else None
+            for image, form in zip(images, forms)
+        ]
+        if forms[0].pk is None:
+            ids = dict(Forms.objects.filter(
+                PatientID__in=[f.PatientID for f in forms]
+            ).values_list('PatientID', 'CaseID'))
+            for form in forms:
+                form.CaseID = ids[form.PatientID]
+
+        CaseImage.objects.bulk_create([
+            CaseImage(
+                case_id=str(form.CaseID),
+                patient_id=form.PatientID,
+                image_name=image.get('file_name', ''),
+                image_path=form.Image.name or None,
+                status='uploaded',
+                # The file's bbox values are in these pixels
+                width=image.get('width') or (size and size[0]),
+                height=image.get('height') or (size and size[1]),
+            )
+            for image, form, size in zip(images, forms, sizes)
+        ])
+        case_images = CaseImage.objects.in_bulk(
+            [str(form.CaseID) for form in forms], field_name='case_id'
+        )
+        ImportedImage.objects.bulk_create([
+            ImportedImage(
+                job=job,
+                source_image_id=image['id'],
+                case_image=case_images[str(form.CaseID)],
+                width=image.get('width'),
+                height=image.get('height'),
+            )
+            for image, form in zip(images, forms)
+        ])
+
+        job.images_done += len(images)
+        job.save(update_fields=['images_done', 'updated_at'])
+        invalidate_cases()
+
+
+def _score(item):
+    return item.get('score', item.get('confidence'))
+
+
+def _image_size(image):
+    """(width, height) the bboxes of an ImportedImage are in, or None when unknown.
+
+    The file's own size comes first; without it, the size _store_images()
+    read from the image in images_dir.
+    """
+    if image.width and image.height:
+        return image.width, image.height
+    if image.case_image.width and image.case_image.height:
+        return image.case_image.width, image.case_image.height
+    return None
+
+
+def _store_annotations(job, items):
+    """Stage one batch of COCO annotations as BoundingBox rows of their image's sessions.
+
+    Boxes with a score are model predictions (a results file, or results
+    mixed into a dataset). They go to a separate model session, so they
+    never count as ground truth for evaluation, consensus or the diagnosis.
+    """
+    with transaction.atomic():
+        imported = {
+            image.source_image_id: image
+            for image in ImportedImage.objects.filter(
+                job=job, source_image_id__in={item.get('image_id') for item in items}
+            ).select_related('case_image')
+        }
+
+        # Boxes are stored with relative coordinates, so an image whose size
+        # is neither in the file nor readable from images_dir has none to keep.
+        # Box ids are int32 (see forms.boxpack); larger COCO ids are skipped too.
+        accepted = []
+        skipped = 0
+        for offset, item in enumerate(items):
+            label = job.category_map.get(str(item.get('category_id')))
+            image = imported.get(item.get('image_id'))
+            bbox = item.get('bbox') or []
+            size = _image_size(image) if image is not None else None
+            box_id = item.get('id', job.annotations_done + offset)
+            valid_id = isinstance(box_id, int) and not isinstance(box_id, bool) and box_id in BOX_ID_RANGE
+            if label is None or size is None or len(bbox) != 4 or not valid_id:
+                skipped += 1
+                continue
+            accepted.append((box_id, item, label, image, size))
+
+        # One imported session per image and source, created on its first box
+        scored = {item.get('image_id') for _, item, _, _, _ in accepted if _score(item) is not None}
+        unscored = {item.get('image_id') for _, item, _, _, _ in accepted if _score(item) is None}
+        new_sessions = [
+            (image, field) for field, image_ids in (('annotation', unscored), ('prediction', scored))
+            for image_id, image in imported.items()
+            if image_id in image_ids and getattr(image, f'{field}_id') is None
+        ]
+        annotations = bulk_create_annotations([
+            Annotation(
+                case_image=image.case_image,
+                annotation_id=new_annotation_id(image.case_image.case_id),
+                annotations_data={'source': 'coco_import', 'annotations': []},
+                source=Annotation.DOCTOR if field == 'annotation' else Annotation.MODEL,
+            )
+            for image, field in new_sessions
+        ])
+        for (image, field), annotation in zip(new_sessions, annotations):
+            setattr(image, field, annotation)
+        ImportedImage.objects.bulk_update({image for image, _ in new_sessions}, ['annotation', 'prediction'])
+
+        boxes = []
+        for box_id, item, label, image, (image_width, image_height) in accepted:
+            x, y, width, height = (float(v) for v in item['bbox'])
+            score = _score(item)
+            boxes.append(BoundingBox(
+                annotation_id=image.annotation_id if score is None else image.prediction_id,
+                box_id=box_id,
+                x=x,
+                y=y,
+                width=width,
+                height=height,
+                relative_x=x / image_width,
+                relative_y=y / image_height,
+                relative_width=width / image_width,
+                relative_height=height / image_height,
+                label=label,
+                confidence=score,
+            ))
+        BoundingBox.objects.bulk_create(boxes, batch_size=BOX_BATCH_SIZE)
+
+        job.annotations_done += len(items)
+        job.annotations_skipped += skipped
+        job.save(update_fields=['annotations_done', 'annotations_skipped', 'updated_at'])
+
+
+def _finalize_images(job, images):
+    """Fill annotations_data, packed boxes, counts and case summaries for imported sessions.
+
+    The BoundingBox rows written by _store_annotations() stage the boxes
+    until here; without the box index they are dropped once packed. Only
+    the doctor session sets the case's latest annotation and diagnosis.
+    """
+    with transaction.atomic():
+        sessions = [
+            (image, session) for image in images
+            for session in (image.annotation, image.prediction) if session is not None
+        ]
+        annotation_ids = [session.pk for _, session in sessions]
+        boxes = defaultdict(list)
+        for box in BoundingBox.objects.filter(annotation_id__in=annotation_ids).order_by('box_id'):
+            boxes[box.annotation_id].append(bounding_box_data(box))
+
+        now = timezone.now()
+        annotated_at = now.isoformat()
+        model_id = job.model_id or IMPORT_MODEL_ID
+        annotations = []
+        case_images = []
+        for image, annotation in sessions:
+            case_image = image.case_image
+            annotation.annotations_data = {
+                'caseId': case_image.case_id,
+                'patientId': case_image.patient_id,
+                'imageName': case_image.image_name,
+                'annotations': boxes[annotation.pk],
+                'annotated_at': annotated_at,
+                'source': 'coco_import',
+            }
+            if annotation.source == Annotation.MODEL:
+                annotation.annotations_data['model'] = model_id
+            annotation.packed_boxes = pack(boxes[annotation.pk])
+            annotation.updated_at = now  # bulk_update() skips auto_now; forms.spatial syncs on it
+            (annotation.total_annotations, annotation.positive_count,
+             annotation.negative_count) = count_labels(boxes[annotation.pk])
+            annotations.append(annotation)
+            if annotation.source == Annotation.DOCTOR:
+                case_image.status = 'annotated'
+                case_image.set_latest_annotation(annotation)
+                case_images.append(case_image)
+
+        Annotation.objects.bulk_update(
+            annotations, ['annotations_data', 'packed_boxes', 'total_annotations', 'positive_count',
+                          'negative_count', 'updated_at']
+        )
+        if not box_index_enabled():
+            BoundingBox.objects.filter(annotation_id__in=annotation_ids).delete()
+        CaseImage.objects.bulk_update(
+            case_images, ['status', 'latest_annotation', 'diagnosis', 'positive_count', 'negative_count']
+        )
+
+        update_consensus(case_image.pk for case_image in case_images)
+
+        job.finalized_upto = images[-1].pk
+        job.save(update_fields=['finalized_upto', 'updated_at'])
+        invalidate_cases({image.case_image.case_id for image, _ in sessions})
+
+
+def run_import(job, batch_size=IMPORT_BATCH_SIZE, progress=None):
+    """Run an import job to completion, resuming from its last checkpoint.
+
+    `progress(job)` is called after every committed batch.
+    """
+    report = progress or (lambda job: None)
+    try:
+        if job.error:
+            job.error = ''
+            job.save(update_fields=['error', 'updated_at'])
+
+        if job.phase == 'images':
+            categories = []
+            images = _iter_section(job, 'images', categories)
+            for batch in _batches(images, job.images_done, batch_size):
+                _store_images(job, batch)
+                report(job)
+            if not job.category_map:
+                job.category_map = default_category_map(categories)
+            job.phase = 'annotations'
+            job.save(update_fields=['category_map', 'phase', 'updated_at'])
+
+        if job.phase == 'annotations':
+            for batch in _batches(_iter_section(job, 'annotations'), job.annotations_done, batch_size):
+                _store_annotations(job, batch)
+                report(job)
+            job.phase = 'finalize'
+            job.save(update_fields=['phase', 'updated_at'])
+
+        if job.phase == 'finalize':
+            while True:
+                images = list(
+                    ImportedImage.objects.filter(job=job, pk__gt=job.finalized_upto)
+                    .select_related('case_image', 'annotation', 'prediction').order_by('pk')[:batch_size]
+                )
+                if not images:
+                    break
+                _finalize_images(job, images)
+                report(job)
+            job.phase = 'done'
+            job.save(update_fields=['phase', 'updated_at'])
+    except Exception as e:
+        job.error = str(e)
+        job.save(update_fields=['error', 'updated_at'])
+        raise
+    return job
+
+
+def start_import_thread(job, batch_size=IMPORT_BATCH_SIZE):
+    """Run an import job in a background thread for the API."""
+    def target():
+        try:
+            run_import(job, batch_size=batch_size)
+        except Exception:
+            logger.exception("COCO import %s failed", job.pk)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=target, name=f'coco-import-{job.pk}', daemon=True)
+    thread.start()
+    return thread
+
@@ -0,0 +1,359 @@
+# forms/consensus.py
+"""Consensus labels and inter-annotator agreement across doctor sessions.
+
+Every doctor session of a case is kept. Each rater contributes one
+session to the consensus:
+
+- a signed-in annotator (Annotation.annotated_by) contributes their
+  latest session;
+- anonymous sessions (imports, and saves without a signed-in user) are
+  one rater, `anonymous`, that likewise contributes its latest session.
+  Nothing tells two anonymous sessions' authors apart, so counting each
+  as a rater would turn one doctor's re-saves into agreement.
+
+The raters' boxes are clustered with forms.geometry.cluster(). Boxes are
+linked at IoU >= IOU_THRESHOLD, and never two boxes of the same rater.
+A cluster becomes a consensus box when at least MIN_SUPPORT of the raters
+drew it. Its corners are the mean of the members, and its label is the
+majority vote (ties go to positive, the safer call for screening). The
+consensus diagnosis is likewise the raters' majority diagnosis.
+
+Clustering, IoU and fusion use the relative coordinates: doctor boxes are
+in pixels of the labeling canvas, which differs between sessions (see
+forms.dimensions). The absolute coordinates of a consensus box are in
+image pixels, from CaseImage.width/height, and None when the size is
+unknown.
+
+The result is a ConsensusAnnotation per case. update_consensus() rebuilds
+it for just the cases a write touched, so the write paths keep it current
+and exports can use it without an offline pass.
+
+The stored per-rater diagnoses feed agreement_report():
+
+- Fleiss' kappa over all cases with two or more raters;
+- Cohen's kappa for each pair of raters that read enough cases together;
+- box-level F1 and mean IoU of the pairwise matching.
+
+Configured through settings.CONSENSUS.
+"""
+from collections import defaultdict
+from itertools import combinations
+
+import numpy as np
+from django.conf import settings
+
+from forms.dimensions import image_sizes
+from forms.geometry import LABEL_IDS, BoxSet, cluster, merge, pairwise_iou
+from forms.models import (
+    Annotation, ConsensusAnnotation, DIAGNOSIS_CHOICES, diagnosis_from_counts,
+)
+
+DEFAULT_CONFIG = {
+    'IOU_THRESHOLD': 0.5,  # Boxes of different raters at least this close describe the same finding
+    'MIN_SUPPORT': 0.5,  # Share of raters that must have drawn a box for it to enter the consensus
+    'MIN_PAIR_CASES': 10,  # Cases two raters must share before their Cohen's kappa is reported
+}
+
+ANONYMOUS_RATER = 'anonymous'
+# Decimals kept of fused coordinates; the packed boxes hold float32 (forms.boxpack)
+RELATIVE_DECIMALS = 6
+PIXEL_DECIMALS = 2
+
+
+def get_config():
+    return {**DEFAULT_CONFIG, **getattr(settings, 'CONSENSUS', {})}
+
+
+# Agreement statistics
+
+def cohen_kappa(first, second, categories=DIAGNOSIS_CHOICES):
+    """Cohen's kappa of two raters' labels on the same items; None when undefined."""
+    index = {category: position for position, category in enumerate(categories)}
+    first = np.asarray([index[value] for value in first], dtype=np.int64)
+    second = np.asarray([index[value] for value in second], dtype=np.int64)
+    if not len(first):
+        return None
+    table = np.zeros((len(categories), len(categories)))
+    np.add.at(table, (first, second), 1)
+    table /= len(first)
+    observed = np.trace(table)
+    expected = table.sum(axis=1) @ table.sum(axis=0)
+    if expected == 1:
+        return None
+    return float((observed - expected) / (1 - expected))
+
+
+def fleiss_kappa(counts):
+    """Fleiss' kappa from an (items, categories) matrix of rating counts.
+
+    Items may have different numbers of raters; those with fewer than two
+    are ignored. None when undefined.
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    raters = counts.sum(axis=1)
+    counts, raters = counts[raters >= 2], raters[raters >= 2]
+    if not len(counts):
+        return None
+    observed = ((counts ** 2).sum(axis=1) - raters) / (raters * (raters - 1))
+    shares = counts.sum(axis=0) / raters.sum()
+    expected = (shares ** 2).sum()
+    if expected == 1:
+        return None
+    return float((observed.mean() - expected) / (1 - expected))
+
+
+def match_pairs(first, second, iou_threshold):
+    """Greedy one-to-one matching of two box arrays by descending IoU.
+
+    Returns (first indices, second indices, IoUs) of the matched pairs.
+    """
+    iou = pairwise_iou(first, second)
+    rows, cols = np.nonzero(iou >= iou_threshold)
+    order = np.argsort(-iou[rows, cols], kind='stable')
+    used_rows, used_cols = set(), set()
+    matched = []
+    for row, col in zip(rows[order], cols[order]):
+        if row not in used_rows and col not in used_cols:
+            used_rows.add(row)
+            used_cols.add(col)
+            matched.append((row, col))
+    if not matched:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    rows, cols = (np.asarray(values, dtype=np.int64) for values in zip(*matched))
+    return rows, cols, iou[rows, cols]
+
+
+# Consensus per case
+
+def rater_sessions(sessions):
+    """{rater key: session} for a case's doctor sessions ordered oldest first."""
+    raters = {}
+    for session in sessions:
+        if session['annotated_by_id'] is not None:
+            key = f"user:{session['annotated_by_id']}"
+        else:
+            key = ANONYMOUS_RATER
+        raters[key] = session  # Later sessions replace earlier ones
+    return raters
+
+
+def _pixels(value, scale):
+    return round(float(value) * scale, PIXEL_DECIMALS) if scale else None
+
+
+def fuse(relative, labels, raters, rater_count, config, image_size=None):
+    """Consensus box dicts from the relative corners of all raters' boxes of one case.
+
+    Absolute coordinates are in pixels of an image of `image_size`
+    (width, height), or None when it is not known.
+    """
+    if not len(relative):
+        return []
+    width, height = image_size or (None, None)
+    clusters = cluster(relative, config['IOU_THRESHOLD'], groups=raters)
+    merged, _, members = merge(relative, clusters)
+    size = len(members)
+    distinct = np.bincount(np.unique(clusters * rater_count + raters) // rater_count, minlength=size)
+    positive = np.bincount(clusters, weights=(labels == LABEL_IDS['positive']).astype(np.float64), minlength=size)
+    support = distinct / rater_count
+
+    fused = []
+    for index in np.flatnonzero(support >= config['MIN_SUPPORT'] - 1e-9):
+        x1, y1, x2, y2 = merged[index]
+        votes = positive[index]
+        label = 'positive' if votes * 2 >= members[index] else 'negative'
+        fused.append({
+            'id': len(fused) + 1,
+            'x': _pixels(x1, width), 'y': _pixels(y1, height),
+            'width': _pixels(x2 - x1, width), 'height': _pixels(y2 - y1, height),
+            'label': label,
+            'relativeX': round(float(x1), RELATIVE_DECIMALS), 'relativeY': round(float(y1), RELATIVE_DECIMALS),
+            'relativeWidth': round(float(x2 - x1), RELATIVE_DECIMALS),
+            'relativeHeight': round(float(y2 - y1), RELATIVE_DECIMALS),
+            'support': round(float(support[index]), 4),
+            'labelAgreement': round(float(max(votes, members[index] - votes) / members[index]), 4),
+        })
+    return fused
+
+
+def box_agreement(per_rater, iou_threshold):
+    """Pairwise matching summary over every pair of raters of a case.
+
+    `per_rater` holds (relative corners, labels) for each rater.
+    """
+    pairs = matched = drawn = same_label = 0
+    iou_sum = 0.0
+    for (first_boxes, first_labels), (second_boxes, second_labels) in combinations(per_rater, 2):
+        rows, cols, ious = match_pairs(first_boxes, second_boxes, iou_threshold)
+        pairs += 1
+        matched += len(rows)
+        drawn += len(first_boxes) + len(second_boxes)
+        same_label += int((first_labels[rows] == second_labels[cols]).sum())
+        iou_sum += float(ious.sum())
+    return {
+        'pairs': pairs,
+        'matched': matched,
+        'drawn': drawn,
+        'sameLabel': same_label,
+        'iouSum': round(iou_sum, 6),
+        'f1': round(2 * matched / drawn, 4) if drawn else None,
+        'meanIou': round(iou_sum / matched, 4) if matched else None,
+    }
+
+
+def build_consensus(case_image_id, sessions, boxes, config, image_size=None):
+    """Unsaved ConsensusAnnotation for one case from its sessions and their BoxSet."""
+    raters = rater_sessions(sessions)
+    known = boxes.labels >= 0
+    rows, rater_index, per_rater, ratings = [], [], [], {}
+    for position, (key, session) in enumerate(raters.items()):
+        selected = np.arange(len(boxes))[boxes.slice(session['id'])]
+        selected = selected[known[selected]]
+        rows.append(selected)
+        rater_index.append(np.full(len(selected), position, dtype=np.int64))
+        per_rater.append((boxes.relative[selected], boxes.labels[selected]))
+        ratings[key] = diagnosis_from_counts(session['positive_count'], session['negative_count'])
+    rows = np.concatenate(rows)
+
+    fused = fuse(boxes.relative[rows], boxes.labels[rows],
+                 np.concatenate(rater_index), len(raters), config, image_size)
+    votes = defaultdict(int)
+    for diagnosis in ratings.values():
+        votes[diagnosis] += 1
+    # Majority diagnosis of the raters; ties resolve in DIAGNOSIS_CHOICES order (Positive first)
+    diagnosis = max(DIAGNOSIS_CHOICES, key=lambda choice: (votes[choice], -DIAGNOSIS_CHOICES.index(choice)))
+    return ConsensusAnnotation(
+        case_image_id=case_image_id,
+        sessions=[session['id'] for session in sessions],
+        raters=len(raters),
+        ratings=ratings,
+        diagnosis=diagnosis,
+        diagnosis_agreement=round(max(votes.values()) / len(raters), 4),
+        boxes=fused,
+        box_agreement=box_agreement(per_rater, config['IOU_THRESHOLD']),
+    )
+
+
+def update_consensus(case_image_ids):
+    """Rebuild the consensus of the given cases from all their doctor sessions.
+
+    Costs a fixed number of queries however many cases are passed; call it
+    inside the transaction that wrote the sessions.
+    """
+    case_image_ids = set(case_image_ids)
+    if not case_image_ids:
+        return []
+    config = get_config()
+    sessions = defaultdict(list)
+    for session in Annotation.objects.filter(
+        case_image_id__in=case_image_ids, source=Annotation.DOCTOR
+    ).order_by('created_at', 'id').values('id', 'case_image_id', 'annotated_by_id',
+                                          'positive_count', 'negative_count'):
+        sessions[session['case_image_id']].append(session)
+
+    ConsensusAnnotation.objects.filter(case_image_id__in=case_image_ids - set(sessions)).delete()
+    if not sessions:
+        return []
+    boxes = BoxSet.load_annotations(s['id'] for group in sessions.values() for s in group)
+    sizes = image_sizes(sessions)
+    consensus = [
+        build_consensus(case_image_id, case_sessions, boxes, config, sizes.get(case_image_id))
+        for case_image_id, case_sessions in sessions.items()
+    ]
+    ConsensusAnnotation.objects.bulk_create(
+        consensus, update_conflicts=True, unique_fields=['case_image'],
+        update_fields=['sessions', 'raters', 'ratings', 'diagnosis', 'diagnosis_agreement',
+                       'boxes', 'box_agreement', 'updated_at'],
+    )
+    return consensus
+
+
+def outdated_cases(case_images=None):
+    """Ids of cases whose stored consensus does not cover exactly their current sessions."""
+    sessions = defaultdict(list)
+    annotations = Annotation.objects.filter(source=Annotation.DOCTOR)
+    if case_images is not None:
+        annotations = annotations.filter(case_image__in=case_images)
+    for case_image_id, annotation_id in annotations.order_by('created_at', 'id').values_list(
+            'case_image_id', 'id').iterator(chunk_size=5000):
+        sessions[case_image_id].append(annotation_id)
+    stored = ConsensusAnnotation.objects.all()
+    if case_images is not None:
+        stored = stored.filter(case_image__in=case_images)
+    outdated = set(sessions)
+    for case_image_id, fused in stored.values_list('case_image_id', 'sessions').iterator(chunk_size=5000):
+        if sessions.get(case_image_id) == fused:
+            outdated.discard(case_image_id)
+        elif case_image_id not in sessions:
+            outdated.add(case_image_id)  # Sessions were deleted; update_consensus removes the row
+    return sorted(outdated)
+
+
+# Dataset report
+
+def agreement_report(case_images=None):
+    """Agreement statistics over the stored consensus of the given (default all) cases."""
+    config = get_config()
+    rows = ConsensusAnnotation.objects.all()
+    if case_images is not None:
+        rows = rows.filter(case_image__in=case_images)
+    category = {value: position for position, value in enumerate(DIAGNOSIS_CHOICES)}
+    counts = []
+    pair_ratings = defaultdict(lambda: ([], []))
+    totals = defaultdict(float)
+    cases = multi_rater = 0
+    for ratings, agreement in rows.values_list('ratings', 'box_agreement').iterator(chunk_size=2000):
+        cases += 1
+        if len(ratings) < 2:
+            continue
+        multi_rater += 1
+        row = [0] * len(DIAGNOSIS_CHOICES)
+        for diagnosis in ratings.values():
+            row[category[diagnosis]] += 1
+        counts.append(row)
+        for first, second in combinations(sorted(ratings), 2):
+            pair_ratings[first, second][0].append(ratings[first])
+            pair_ratings[first, second][1].append(ratings[second])
+        for key in ('matched', 'drawn', 'sameLabel', 'iouSum'):
+            totals[key] += agreement.get(key, 0)
+
+    pairs = [
+        {'raters': [first, second], 'cases': len(a), 'kappa': round(kappa, 4) if kappa is not None else None}
+        for (first, second), (a, b) in sorted(pair_ratings.items())
+        if len(a) >= config['MIN_PAIR_CASES']
+        for kappa in [cohen_kappa(a, b)]
+    ]
+    fleiss = fleiss_kappa(counts) if counts else None
+    return {
+        'cases': cases,
+        'multiRaterCases': multi_rater,
+        'diagnosis': {
+            'categories': list(DIAGNOSIS_CHOICES),
+            'fleissKappa': round(fleiss, 4) if fleiss is not None else None,
+            'cohenKappa': pairs,
+        },
+        'boxes': {
+            'iouThreshold': config['IOU_THRESHOLD'],
+            'f1': round(2 * totals['matched'] / totals['drawn'], 4) if totals['drawn'] else None,
+            'meanIou': round(totals['iouSum'] / totals['matched'], 4) if totals['matched'] else None,
+            'labelAgreement': round(totals['sameLabel'] / totals['matched'], 4) if totals['matched'] else None,
+        },
+    }
+
+
+def consensus_data(consensus):
+    """API representation of one ConsensusAnnotation."""
+    return {
+        'caseId': consensus.case_image.case_id,
+        'raters': consensus.raters,
+        'ratings': consensus.ratings,
+        'diagnosis': consensus.diagnosis,
+        'diagnosisAgreement': consensus.diagnosis_agreement,
+        'annotations': consensus.boxes,
+        'boxAgreement': consensus.box_agreement,
+        'sessions': list(
+            Annotation.objects.filter(pk__in=consensus.sessions).order_by('created_at', 'id')
+            .values_list('annotation_id', flat=True)
+        ),
+        'updatedAt': consensus.updated_at.isoformat(),
+    }
@@ -0,0 +1,107 @@
+# forms/derivatives.py
+"""Resized copies of uploaded cervigrams for previews.
+
+Derivatives are named after the SHA-256 of the original image, so a given
+name always refers to the same bytes and can be cached forever by clients.
+They are generated right after upload and, for images that predate the
+pipeline or whose generation failed, lazily on the first request for them.
+Forms.DerivativesAt records that every derivative of a case is stored;
+until then its URLs point at the view that generates them.
+"""
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image, ImageOps, features
+
+from forms.hashing import hash_field_file
+from forms.models import Forms
+from forms.response_cache import invalidate_cases
+
+# Longest side in pixels for each derivative
+DERIVATIVE_SIZES = {
+    'thumb': 256,
+    'medium': 1024,
+}
+
+if features.check('webp'):
+    DERIVATIVE_FORMAT, DERIVATIVE_EXT = 'WEBP', 'webp'
+else:
+    DERIVATIVE_FORMAT, DERIVATIVE_EXT = 'JPEG', 'jpg'
+DERIVATIVE_QUALITY = 80
+
+
+def derivative_name(image_hash, size):
+    return f'derivatives/{image_hash[:2]}/{image_hash}_{size}.{DERIVATIVE_EXT}'
+
+
+def render_derivative(image, max_side):
+    """Encode a copy of `image` scaled to fit in max_side x max_side."""
+    resized = image.copy()
+    resized.thumbnail((max_side, max_side), Image.LANCZOS)
+    out = BytesIO()
+    resized.save(out, DERIVATIVE_FORMAT, quality=DERIVATIVE_QUALITY)
+    return ContentFile(out.getvalue())
+
+
+def ensure_derivatives(form, record=True):
+    """Generate any missing derivatives for a case and record its image hash.
+
+    Returns {size: url}. Existing derivatives are reused, so calling this
+    again is cheap once the hash is known. Sets Forms.DerivativesAt once
+    every derivative is stored. With record=False only the form object is
+    updated and the caller saves ImageHash and DerivativesAt, as forms.ingest
+    does for the cases its worker threads prepare.
+    """
+    image_hash = form.ImageHash or hash_field_file(form.Image)[0]
+    missing = [
+        size for size in DERIVATIVE_SIZES
+        if not default_storage.exists(derivative_name(image_hash, size))
+    ]
+    if missing:
+        form.Image.open('rb')
+        try:
+            with Image.open(form.Image) as image:
+                image = ImageOps.exif_transpose(image).convert('RGB')
+                for size in missing:
+                    name = derivative_name(image_hash, size)
+                    # Storage may rename on collision; the content is identical,
+                    # so keep the canonical name only
+                    saved = default_storage.save(name, render_derivative(image, DERIVATIVE_SIZES[size]))
+                    if saved != name:
+                        default_storage.delete(saved)
+        finally:
+            form.Image.close()
+
+    if form.ImageHash != image_hash or form.DerivativesAt is None:
+        form.ImageHash = image_hash
+        form.DerivativesAt = form.DerivativesAt or timezone.now()
+        if record:
+            Forms.objects.filter(pk=form.pk).update(ImageHash=image_hash, DerivativesAt=form.DerivativesAt)
+            # Cached responses still carry the lazy URLs
+            invalidate_cases([form.CaseID])
+    return {size: default_storage.url(derivative_name(image_hash, size)) for size in DERIVATIVE_SIZES}
+
+
+def derivative_urls(form):
+    """Derivative URLs for a case without touching storage.
+
+    Cases whose derivatives are stored point straight at the hashed files;
+    the others, including hashed cases whose generation failed, point at
+    the view that generates them on demand.
+    """
+    if not form.Image:
+        return {size: None for size in DERIVATIVE_SIZES}
+    if form.ImageHash and form.DerivativesAt:
+        return {size: default_storage.url(derivative_name(form.ImageHash, size)) for size in DERIVATIVE_SIZES}
+    return lazy_derivative_urls(form)
+
+
+def lazy_derivative_urls(form):
+    """URLs of the view that generates a case's derivatives on demand."""
+    return {
+        size: reverse('case_image_derivative', args=[form.CaseID, size])
+        for size in DERIVATIVE_SIZES
+    }
@@ -0,0 +1,73 @@
+# forms/dimensions.py
+"""Pixel dimensions of case images.
+
+Box coordinates are stored twice: in pixels of the canvas they were drawn
+on (800 or 1000 pixels wide in the labeling tool, the image itself for
+model predictions and imports) and relative to the image. Only the relative
+values compare across sessions. Anything that needs image pixels, such as
+a COCO bbox, is computed as relative x CaseImage.width/height.
+
+The size is the one the image is shown and predicted at, after EXIF
+orientation. It is recorded when a case image is created by an upload, a
+batch ingest, inference or a COCO import. Rows without it (older rows, and
+rows created by an annotation save) are filled in by image_sizes() the
+first time they are needed. Only the image header is read.
+"""
+import logging
+
+from django.core.files.storage import default_storage
+from PIL import Image
+
+from forms.models import CaseImage, Forms
+
+logger = logging.getLogger(__name__)
+
+# EXIF orientations that rotate the image by 90 or 270 degrees
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def oriented_size(image):
+    """(width, height) of an open PIL image once its EXIF orientation is applied."""
+    width, height = image.size
+    if image.getexif().get(0x0112) in TRANSPOSED_ORIENTATIONS:
+        return height, width
+    return width, height
+
+
+def read_size(name):
+    """(width, height) of a stored image, or None when it cannot be read."""
+    try:
+        with default_storage.open(name, 'rb') as f:
+            with Image.open(f) as image:
+                return oriented_size(image)
+    except Exception as e:
+        logger.warning("Could not read the size of %s: %s", name, e)
+        return None
+
+
+def image_sizes(case_image_ids):
+    """{CaseImage pk: (width, height) or None}, reading and saving sizes not stored yet."""
+    rows = CaseImage.objects.filter(pk__in=list(case_image_ids)).values_list(
+        'pk', 'case_id', 'image_path', 'width', 'height'
+    )
+    sizes, missing = {}, []
+    for pk, case_id, image_path, width, height in rows:
+        if width and height:
+            sizes[pk] = (width, height)
+        else:
+            missing.append((pk, case_id, image_path))
+    if not missing:
+        return sizes
+
+    # Rows created by an annotation save have no image_path; the case has it
+    case_ids = [int(case_id) for _, case_id, image_path in missing if not image_path and case_id.isdigit()]
+    form_images = dict(Forms.objects.filter(CaseID__in=case_ids).values_list('CaseID', 'Image'))
+    found = []
+    for pk, case_id, image_path in missing:
+        name = image_path or (form_images.get(int(case_id)) if case_id.isdigit() else None)
+        size = read_size(name) if name else None
+        sizes[pk] = size
+        if size:
+            found.append(CaseImage(pk=pk, width=size[0], height=size[1]))
+    CaseImage.objects.bulk_update(found, ['width', 'height'])
+    return sizes
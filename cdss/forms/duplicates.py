@@ -0,0 +1,151 @@
+# forms/duplicates.py
+"""Duplicate and near-duplicate detection for case images.
+
+Exact copies are found by SHA-256 (Forms.ImageHash) and share one stored
+file. Near copies (re-encoded, resized, recompressed) are found through an
+in-memory BK-tree over the 64-bit dHashes in Forms.ImagePHash: a lookup
+only visits the branches within the Hamming distance threshold, so it
+stays well under a millisecond even with many thousands of images.
+
+Every process keeps its own index. It is loaded on first use and then
+picks up cases created elsewhere with one indexed query per lookup, so
+workers see each other's uploads. Matches are linked through
+Forms.DuplicateOf to the earliest case holding that image.
+"""
+import threading
+
+from django.conf import settings
+
+from forms.models import Forms
+
+DEFAULT_MAX_DISTANCE = 6  # Of 64 dHash bits
+
+
+def get_max_distance():
+    return getattr(settings, 'DUPLICATE_MAX_DISTANCE', DEFAULT_MAX_DISTANCE)
+
+
+class BKTree:
+    """Burkhard-Keller tree of 64-bit hashes under Hamming distance."""
+    def __init__(self):
+        self.root = None  # [hash, items, {distance: child}]
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = (node[0] ^ value).bit_count()
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """[(distance, item)] within max_distance, nearest first."""
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = (node[0] ^ value).bit_count()
+            if distance <= max_distance:
+                found.extend((distance, item) for item in node[1])
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        found.sort()
+        return found
+
+
+class DuplicateIndex:
+    """BK-tree of the dHashes of every stored case, keyed to CaseID."""
+    def __init__(self):
+        self.tree = BKTree()
+        self.lock = threading.Lock()
+        self.last_case_id = 0
+
+    def refresh(self):
+        """Load cases created since the last refresh."""
+        rows = (Forms.objects.filter(CaseID__gt=self.last_case_id)
+                .exclude(ImagePHash='')
+                .order_by('CaseID')
+                .values_list('CaseID', 'ImagePHash'))
+        with self.lock:
+            for case_id, phash in rows:
+                if case_id > self.last_case_id:
+                    self.tree.add(int(phash, 16), case_id)
+                    self.last_case_id = case_id
+
+    def add(self, case_id, phash):
+        with self.lock:
+            if case_id > self.last_case_id:
+                self.tree.add(int(phash, 16), case_id)
+                self.last_case_id = case_id
+
+    def search(self, phash, max_distance=None):
+        """[(distance, CaseID)] of indexed cases similar to phash."""
+        if max_distance is None:
+            max_distance = get_max_distance()
+        with self.lock:
+            return self.tree.search(int(phash, 16), max_distance)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = DuplicateIndex()
+        return _index
+
+
+def canonical_id(form):
+    """CaseID that duplicates of this case should link to."""
+    return form.DuplicateOf_id or form.CaseID
+
+
+def find_duplicates(hashes, exclude=()):
+    """Match (sha256, dhash) pairs against stored cases.
+
+    Returns one (form, distance) per pair, or (None, None) when the image is
+    new. Exact copies win over near ones; ties go to the earliest case. Uses
+    at most two queries however many pairs are given.
+    """
+    exclude = set(exclude)
+    index = get_index()
+    index.refresh()
+
+    exact = {}
+    sha_hashes = {sha for sha, _ in hashes if sha}
+    if sha_hashes:
+        for form in Forms.objects.filter(ImageHash__in=sha_hashes).exclude(CaseID__in=exclude).order_by('-CaseID'):
+            exact[form.ImageHash] = form
+
+    candidates = []
+    for sha, phash in hashes:
+        if sha in exact or not phash:
+            candidates.append([])
+        else:
+            candidates.append([(d, case_id) for d, case_id in index.search(phash) if case_id not in exclude])
+    wanted = {case_id for matches in candidates for _, case_id in matches}
+    # The index is append-only, so deleted cases drop out here
+    near = Forms.objects.in_bulk(wanted) if wanted else {}
+
+    results = []
+    for (sha, _), matches in zip(hashes, candidates):
+        if sha in exact:
+            results.append((exact[sha], 0))
+            continue
+        match = next(((near[case_id], d) for d, case_id in matches if case_id in near), (None, None))
+        results.append(match)
+    return results
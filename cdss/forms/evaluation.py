@@ -0,0 +1,362 @@
+# forms/evaluation.py
+"""Offline evaluation of model predictions against doctor annotations.
+
+For every case with both a doctor annotation (CaseImage.latest_annotation)
+and a prediction session of the model (the latest Annotation with
+source='model' for that model id), the boxes are matched COCO-style:
+
+- boxes are compared in relative coordinates, since doctor boxes are in
+  pixels of the labeling canvas and predictions in pixels of the image;
+- predictions are taken in descending confidence;
+- each one claims the unmatched doctor box of the same label with the
+  highest IoU, if that IoU reaches the threshold;
+- this is done for the ten IoU thresholds 0.50:0.05:0.95 at once, on arrays.
+
+The per-case result is stored in CaseEvaluation: the score, label and
+true-positive bits of each prediction, box and case counts per label at
+IoU 0.5 and SCORE_THRESHOLD, and a label confusion matrix. A run only
+re-evaluates the cases whose annotations changed since their row was
+written (or whose settings differ), so a nightly refresh costs the changed
+cases plus one pass over the stored rows to build the report:
+
+- AP@50 and AP@50:95 per label and their mean (101-point interpolation);
+- box-level sensitivity and precision per label;
+- case-level sensitivity and specificity per label, where a case is
+  positive for a label when it has at least one box of it;
+- the confusion matrix summed over all cases.
+
+Configured through settings.EVALUATION.
+"""
+import logging
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+from forms.geometry import LABEL_IDS, LABEL_NAMES, BoxSet, pairwise_iou
+from forms.inference import get_config as get_inference_config
+from forms.models import Annotation, CaseEvaluation, CaseImage, EvaluationRun
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    'MODEL': None,  # Model evaluated by default; the default inference model if None
+    'SCORE_THRESHOLD': 0.5,  # Minimum confidence for a prediction to count as a detection
+    'BATCH_SIZE': 500,  # Cases evaluated per database round trip
+}
+
+# Bump when the stored matching changes so every row is recomputed
+ENGINE_VERSION = 2
+
+IOU_THRESHOLDS = np.round(np.arange(0.5, 0.951, 0.05), 2)
+RECALL_POINTS = np.linspace(0.0, 1.0, 101)
+BACKGROUND = len(LABEL_IDS)
+CONFUSION_AXES = [LABEL_NAMES[index] for index in range(len(LABEL_IDS))] + ['background']
+
+
+def get_config():
+    return {**DEFAULT_CONFIG, **getattr(settings, 'EVALUATION', {})}
+
+
+def default_model_id():
+    return get_config()['MODEL'] or get_inference_config()['DEFAULT_MODEL']
+
+
+def signature(config):
+    return f"v{ENGINE_VERSION}:score={config['SCORE_THRESHOLD']}"
+
+
+# Matching
+
+def match(gt_boxes, gt_labels, pred_boxes, pred_labels, pred_scores, thresholds=IOU_THRESHOLDS):
+    """(P, T) true-positive flags of each prediction at each IoU threshold.
+
+    Predictions claim same-label ground truth boxes greedily in descending
+    score order; the ten thresholds are matched together as rows of a
+    (T, G) array, so the only Python loop is over the predictions.
+    """
+    tp = np.zeros((len(pred_boxes), len(thresholds)), dtype=bool)
+    if not len(pred_boxes) or not len(gt_boxes):
+        return tp
+    iou = pairwise_iou(pred_boxes, gt_boxes)
+    iou[pred_labels[:, None] != gt_labels[None, :]] = -1.0
+    thresholds = np.asarray(thresholds)[:, None]
+    matched = np.zeros((len(thresholds), len(gt_boxes)), dtype=bool)
+    rows = np.arange(len(thresholds))
+    for index in np.argsort(-pred_scores, kind='stable'):
+        candidates = np.where((iou[index] >= thresholds) & ~matched, iou[index], -1.0)
+        best = candidates.argmax(axis=1)
+        hit = candidates[rows, best] >= 0
+        matched[rows[hit], best[hit]] = True
+        tp[index] = hit
+    return tp
+
+
+def confusion_matrix(gt_boxes, gt_labels, pred_boxes, pred_labels, pred_scores, iou_threshold=0.5):
+    """Label confusion (3x3: negative, positive, background) from label-agnostic matching."""
+    confusion = np.zeros((BACKGROUND + 1, BACKGROUND + 1), dtype=np.int64)
+    matched_gt = np.zeros(len(gt_boxes), dtype=bool)
+    if len(pred_boxes) and len(gt_boxes):
+        iou = pairwise_iou(pred_boxes, gt_boxes)
+        for index in np.argsort(-pred_scores, kind='stable'):
+            candidates = np.where(matched_gt, -1.0, iou[index])
+            best = int(candidates.argmax())
+            if candidates[best] >= iou_threshold:
+                matched_gt[best] = True
+                confusion[gt_labels[best], pred_labels[index]] += 1
+            else:
+                confusion[BACKGROUND, pred_labels[index]] += 1
+    else:
+        np.add.at(confusion[BACKGROUND], pred_labels, 1)
+    np.add.at(confusion[:, BACKGROUND], gt_labels[~matched_gt], 1)
+    return confusion
+
+
+def evaluate_case(gt_boxes, gt_labels, pred_boxes, pred_labels, pred_scores, score_threshold):
+    """CaseEvaluation fields (matches, label_stats, confusion) for one case."""
+    tp = match(gt_boxes, gt_labels, pred_boxes, pred_labels, pred_scores)
+    bits = (tp.astype(np.int64) << np.arange(len(IOU_THRESHOLDS))).sum(axis=1)
+
+    detected = pred_scores >= score_threshold
+    tp50 = tp[:, 0] & detected
+    label_stats = {}
+    for name, label in LABEL_IDS.items():
+        gt = int((gt_labels == label).sum())
+        predicted = detected & (pred_labels == label)
+        hits = int((tp50 & (pred_labels == label)).sum())
+        label_stats[name] = {
+            'gt': gt,
+            'tp': hits,
+            'fp': int(predicted.sum()) - hits,
+            'fn': gt - hits,
+            'actual': gt > 0,
+            'predicted': bool(predicted.any()),
+        }
+
+    confusion = confusion_matrix(gt_boxes, gt_labels, pred_boxes[detected],
+                                 pred_labels[detected], pred_scores[detected])
+    return {
+        'matches': {
+            'scores': [round(float(score), 6) for score in pred_scores],
+            'labels': pred_labels.tolist(),
+            'tp': bits.tolist(),
+        },
+        'label_stats': label_stats,
+        'confusion': confusion.tolist(),
+    }
+
+
+# Incremental refresh
+
+def current_pairs(model_id):
+    """{case_image_id: (ground truth id, prediction id, last change)} for evaluable cases."""
+    latest_prediction = Annotation.objects.filter(
+        case_image=OuterRef('pk'), source=Annotation.MODEL, annotations_data__model=model_id,
+    ).order_by('-created_at', '-id')
+    rows = CaseImage.objects.filter(latest_annotation__isnull=False).annotate(
+        prediction_id=Subquery(latest_prediction.values('id')[:1]),
+        prediction_updated_at=Subquery(latest_prediction.values('updated_at')[:1]),
+    ).filter(prediction_id__isnull=False).values_list(
+        'id', 'latest_annotation_id', 'latest_annotation__updated_at', 'prediction_id', 'prediction_updated_at',
+    )
+    return {
+        case_image_id: (gt_id, prediction_id, max(gt_updated_at, prediction_updated_at))
+        for case_image_id, gt_id, gt_updated_at, prediction_id, prediction_updated_at in rows
+    }
+
+
+def stale_cases(model_id, pairs, config, full=False):
+    """Case image ids whose stored evaluation is missing or out of date."""
+    if full:
+        return sorted(pairs)
+    current = signature(config)
+    stored = {
+        case_image_id: (gt_id, prediction_id, row_signature, evaluated_at)
+        for case_image_id, gt_id, prediction_id, row_signature, evaluated_at in
+        CaseEvaluation.objects.filter(model_id=model_id).values_list(
+            'case_image_id', 'ground_truth_id', 'prediction_id', 'signature', 'evaluated_at')
+    }
+    stale = []
+    for case_image_id, (gt_id, prediction_id, changed_at) in pairs.items():
+        row = stored.get(case_image_id)
+        if (row is None or row[:3] != (gt_id, prediction_id, current)
+                or row[3] < changed_at):
+            stale.append(case_image_id)
+    return sorted(stale)
+
+
+def _evaluate_batch(model_id, case_image_ids, pairs, config):
+    annotation_ids = [annotation_id for case_image_id in case_image_ids for annotation_id in pairs[case_image_id][:2]]
+    boxes = BoxSet.load_annotations(annotation_ids)
+    known = boxes.labels >= 0
+    scores = np.nan_to_num(boxes.scores, nan=1.0)  # Sessions without confidences count as certain
+    evaluations = []
+    for case_image_id in case_image_ids:
+        gt_id, prediction_id, _ = pairs[case_image_id]
+        gt = np.arange(len(boxes))[boxes.slice(gt_id)]
+        gt = gt[known[gt]]
+        predicted = np.arange(len(boxes))[boxes.slice(prediction_id)]
+        predicted = predicted[known[predicted]]
+        result = evaluate_case(
+            boxes.relative[gt], boxes.labels[gt].astype(np.int64),
+            boxes.relative[predicted], boxes.labels[predicted].astype(np.int64), scores[predicted],
+            config['SCORE_THRESHOLD'],
+        )
+        evaluations.append(CaseEvaluation(
+            case_image_id=case_image_id, model_id=model_id, ground_truth_id=gt_id,
+            prediction_id=prediction_id, signature=signature(config), evaluated_at=timezone.now(), **result,
+        ))
+    CaseEvaluation.objects.bulk_create(
+        evaluations, update_conflicts=True, unique_fields=['case_image', 'model_id'],
+        update_fields=['ground_truth', 'prediction', 'signature', 'matches', 'label_stats',
+                       'confusion', 'evaluated_at'],
+    )
+
+
+def run_evaluation(model_id=None, full=False):
+    """Re-evaluate changed cases (every case if `full`) and store a fresh report."""
+    config = get_config()
+    model_id = model_id or default_model_id()
+    run = EvaluationRun.objects.create(model_id=model_id, full=full)
+
+    pairs = current_pairs(model_id)
+    removed, _ = CaseEvaluation.objects.filter(model_id=model_id).exclude(
+        case_image_id__in=list(pairs)).delete()
+    stale = stale_cases(model_id, pairs, config, full=full)
+    for start in range(0, len(stale), config['BATCH_SIZE']):
+        with transaction.atomic():
+            _evaluate_batch(model_id, stale[start:start + config['BATCH_SIZE']], pairs, config)
+
+    run.cases_total = len(pairs)
+    run.cases_evaluated = len(stale)
+    run.cases_removed = removed
+    run.report = build_report(model_id)
+    run.finished_at = timezone.now()
+    run.save()
+    logger.info("Evaluated %s on %d of %d cases", model_id, len(stale), len(pairs))
+    return run
+
+
+# Report
+
+def average_precision(scores, tp, positives):
+    """(T,) COCO 101-point interpolated AP per IoU threshold; None without ground truth."""
+    if positives == 0:
+        return None
+    if not len(scores):
+        return np.zeros(tp.shape[1])
+    order = np.argsort(-scores, kind='stable')
+    tp = tp[order]
+    true_positives = np.cumsum(tp, axis=0)
+    false_positives = np.cumsum(~tp, axis=0)
+    recall = true_positives / positives
+    precision = true_positives / (true_positives + false_positives)
+    # Precision envelope: best precision at any recall at least as high
+    precision = np.maximum.accumulate(precision[::-1], axis=0)[::-1]
+    ap = np.zeros(tp.shape[1])
+    for column in range(tp.shape[1]):
+        index = np.searchsorted(recall[:, column], RECALL_POINTS, side='left')
+        valid = index < len(recall)
+        ap[column] = precision[index[valid], column].sum() / len(RECALL_POINTS)
+    return ap
+
+
+def _ratio(numerator, denominator):
+    return round(numerator / denominator, 4) if denominator else None
+
+
+def build_report(model_id):
+    """Dataset-wide metrics from the stored CaseEvaluation rows of a model."""
+    config = get_config()
+    rows = CaseEvaluation.objects.filter(model_id=model_id).values_list('matches', 'label_stats', 'confusion')
+    scores, labels, bits = [], [], []
+    totals = {name: dict.fromkeys(['gt', 'tp', 'fp', 'fn', 'case_tp', 'case_fp', 'case_fn', 'case_tn'], 0)
+              for name in LABEL_IDS}
+    confusion = np.zeros((BACKGROUND + 1, BACKGROUND + 1), dtype=np.int64)
+    cases = 0
+    for matches, label_stats, case_confusion in rows.iterator(chunk_size=2000):
+        cases += 1
+        scores.extend(matches['scores'])
+        labels.extend(matches['labels'])
+        bits.extend(matches['tp'])
+        confusion += np.asarray(case_confusion, dtype=np.int64)
+        for name, stats in label_stats.items():
+            total = totals[name]
+            for key in ('gt', 'tp', 'fp', 'fn'):
+                total[key] += stats[key]
+            outcome = {(True, True): 'case_tp', (False, True): 'case_fp',
+                       (True, False): 'case_fn', (False, False): 'case_tn'}
+            total[outcome[stats['actual'], stats['predicted']]] += 1
+
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels, dtype=np.int64)
+    tp = (np.asarray(bits, dtype=np.int64)[:, None] >> np.arange(len(IOU_THRESHOLDS))) & 1 == 1
+
+    per_label = {}
+    for name, label in LABEL_IDS.items():
+        total = totals[name]
+        selected = labels == label
+        ap = average_precision(scores[selected], tp[selected], total['gt'])
+        per_label[name] = {
+            'ground_truth_boxes': total['gt'],
+            'predicted_boxes': int(selected.sum()),
+            'ap50': None if ap is None else round(float(ap[0]), 4),
+            'ap50_95': None if ap is None else round(float(ap.mean()), 4),
+            'box_sensitivity': _ratio(total['tp'], total['tp'] + total['fn']),
+            'box_precision': _ratio(total['tp'], total['tp'] + total['fp']),
+            'case_sensitivity': _ratio(total['case_tp'], total['case_tp'] + total['case_fn']),
+            'case_specificity': _ratio(total['case_tn'], total['case_tn'] + total['case_fp']),
+            'cases': {key[5:]: total[key] for key in ('case_tp', 'case_fp', 'case_fn', 'case_tn')},
+        }
+
+    def mean(key):
+        values = [stats[key] for stats in per_label.values() if stats[key] is not None]
+        return round(sum(values) / len(values), 4) if values else None
+
+    return {
+        'model': model_id,
+        'cases': cases,
+        'score_threshold': config['SCORE_THRESHOLD'],
+        'iou_thresholds': IOU_THRESHOLDS.tolist(),
+        'map50': mean('ap50'),
+        'map50_95': mean('ap50_95'),
+        'labels': per_label,
+        'confusion': {
+            'axes': CONFUSION_AXES,
+            'matrix': confusion.tolist(),  # Rows: doctor, columns: model
+        },
+        'generated_at': timezone.now().isoformat(),
+    }
+
+
+def case_report(evaluation):
+    """Per-case sensitivity/specificity and matches of one CaseEvaluation."""
+    labels = {}
+    for name, stats in evaluation.label_stats.items():
+        labels[name] = {
+            **stats,
+            'sensitivity': _ratio(stats['tp'], stats['gt']),
+            'precision': _ratio(stats['tp'], stats['tp'] + stats['fp']),
+            # Case level: does the model agree that the label is absent?
+            'specificity': None if stats['actual'] else (0.0 if stats['predicted'] else 1.0),
+        }
+    matches = evaluation.matches
+    return {
+        'caseId': evaluation.case_image.case_id,
+        'model': evaluation.model_id,
+        'groundTruthAnnotation': evaluation.ground_truth.annotation_id,
+        'predictionAnnotation': evaluation.prediction.annotation_id,
+        'labels': labels,
+        'predictions': [
+            {
+                'label': LABEL_NAMES[label],
+                'score': score,
+                'tp': {f'{threshold:.2f}': bool(bits >> index & 1) for index, threshold in enumerate(IOU_THRESHOLDS)},
+            }
+            for score, label, bits in zip(matches['scores'], matches['labels'], matches['tp'])
+        ],
+        'confusion': {'axes': CONFUSION_AXES, 'matrix': evaluation.confusion},
+        'evaluatedAt': evaluation.evaluated_at.isoformat(),
+    }
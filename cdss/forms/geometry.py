@@ -0,0 +1,262 @@
+# forms/geometry.py
+"""Vectorized bounding-box geometry on NumPy arrays.
+
+Boxes are float arrays of shape (N, 4) in corner form (x1, y1, x2, y2),
+as BoundingBox stores them in absolute pixels as x, y, width, height.
+Convert with xywh_to_xyxy()/xyxy_to_xywh(). Every operation works on whole
+arrays, so comparing thousands of boxes costs a few array passes instead
+of Python loops.
+
+BoxSet loads the boxes of one annotation, a case or a whole dataset into
+contiguous arrays, either from the packed sessions (load_annotations) or by
+querying the BoundingBox index (load). The rows are sorted by annotation,
+so each session is a slice of the set.
+"""
+import numpy as np
+
+from forms.models import BoundingBox
+
+LABEL_IDS = {'negative': 0, 'positive': 1}
+LABEL_NAMES = {value: key for key, value in LABEL_IDS.items()}
+
+# nms() builds an N x N IoU matrix up to this many boxes (32 MB of float64)
+NMS_MATRIX_LIMIT = 2048
+
+
+# Conversions
+
+def xywh_to_xyxy(boxes):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1)
+
+
+def xyxy_to_xywh(boxes):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return np.concatenate([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]], axis=1)
+
+
+def normalize(boxes, width, height):
+    """Absolute corner boxes to fractions of the image size (BoundingBox.relative_*)."""
+    scale = np.asarray([width, height, width, height], dtype=np.float64)
+    return np.asarray(boxes, dtype=np.float64).reshape(-1, 4) / scale
+
+
+def denormalize(boxes, width, height):
+    scale = np.asarray([width, height, width, height], dtype=np.float64)
+    return np.asarray(boxes, dtype=np.float64).reshape(-1, 4) * scale
+
+
+def clip(boxes, width, height):
+    """Clip corner boxes to the image, fixing any inverted corners first."""
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    lower = np.minimum(boxes[:, :2], boxes[:, 2:])
+    upper = np.maximum(boxes[:, :2], boxes[:, 2:])
+    limit = np.asarray([width, height], dtype=np.float64)
+    return np.concatenate([np.clip(lower, 0, limit), np.clip(upper, 0, limit)], axis=1)
+
+
+# Overlap
+
+def areas(boxes):
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    return np.clip(boxes[:, 2] - boxes[:, 0], 0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0, None)
+
+
+def pairwise_iou(a, b=None):
+    """(N, M) intersection over union of corner boxes `a` against `b` (default `a`)."""
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 4)
+    b = a if b is None else np.asarray(b, dtype=np.float64).reshape(-1, 4)
+    # One (N, M) plane per step, computed in place, rather than (N, M, 2) temporaries
+    width = np.minimum(a[:, None, 2], b[None, :, 2])
+    width -= np.maximum(a[:, None, 0], b[None, :, 0])
+    np.clip(width, 0, None, out=width)
+    height = np.minimum(a[:, None, 3], b[None, :, 3])
+    height -= np.maximum(a[:, None, 1], b[None, :, 1])
+    np.clip(height, 0, None, out=height)
+    intersection = width
+    intersection *= height
+    union = height
+    np.add(areas(a)[:, None], areas(b)[None, :], out=union)
+    union -= intersection
+    # Zero-area pairs have no intersection either, so leaving them at 0 is right
+    return np.divide(intersection, union, out=intersection, where=union > 0)
+
+
+def nms(boxes, scores, iou_threshold=0.5, labels=None):
+    """Indices of the boxes kept by greedy non-maximum suppression, best first.
+
+    With `labels`, boxes only suppress boxes of the same label.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=np.float64)
+    if labels is not None and len(boxes):
+        # Shift each label into its own region so labels never overlap
+        offset = (boxes.max() + 1) * np.asarray(labels, dtype=np.float64)
+        boxes = boxes + offset[:, None]
+    order = np.argsort(-scores, kind='stable')
+    if len(order) <= NMS_MATRIX_LIMIT:
+        # One IoU matrix, then a cheap greedy pass over its boolean rows
+        suppresses = pairwise_iou(boxes[order]) > iou_threshold
+        suppressed = np.zeros(len(order), dtype=bool)
+        keep = []
+        for position in range(len(order)):
+            if not suppressed[position]:
+                keep.append(order[position])
+                suppressed |= suppresses[position]
+        return np.asarray(keep, dtype=np.int64)
+
+    # Too many boxes for the matrix: compare the best box against the rest each round
+    box_areas = areas(boxes)
+    keep = []
+    while order.size:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        top_left = np.maximum(boxes[best, :2], boxes[rest, :2])
+        bottom_right = np.minimum(boxes[best, 2:], boxes[rest, 2:])
+        intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=1)
+        union = box_areas[best] + box_areas[rest] - intersection
+        iou = np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+        order = rest[iou <= iou_threshold]
+    return np.asarray(keep, dtype=np.int64)
+
+
+# Clustering across annotators
+
+def cluster(boxes, iou_threshold=0.5, labels=None, groups=None):
+    """Cluster ids for boxes that overlap by at least `iou_threshold`.
+
+    Boxes are linked when their IoU reaches the threshold, they share a
+    label (if `labels` is given) and they come from different groups (for
+    instance annotators, if `groups` is given). Each connected component
+    becomes one cluster, numbered 0..K-1 in order of first appearance.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    count = len(boxes)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+    linked = pairwise_iou(boxes) >= iou_threshold
+    if labels is not None:
+        labels = np.asarray(labels)
+        linked &= labels[:, None] == labels[None, :]
+    if groups is not None:
+        groups = np.asarray(groups)
+        linked &= groups[:, None] != groups[None, :]
+    rows, cols = np.nonzero(np.triu(linked, k=1))
+
+    # Label propagation: every box takes the smallest id among its links
+    # until nothing changes (at most the component diameter passes)
+    parent = np.arange(count)
+    while True:
+        smallest = np.minimum(parent[rows], parent[cols])
+        updated = parent.copy()
+        np.minimum.at(updated, rows, smallest)
+        np.minimum.at(updated, cols, smallest)
+        updated = updated[updated]
+        if np.array_equal(updated, parent):
+            break
+        parent = updated
+    _, ids = np.unique(parent, return_inverse=True)
+    return ids.astype(np.int64)
+
+
+def merge(boxes, clusters, weights=None):
+    """Fuse each cluster into one box, as the weighted mean of its corners.
+
+    Returns (merged boxes (K, 4), weight sums (K,), member counts (K,)).
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    clusters = np.asarray(clusters, dtype=np.int64)
+    weights = np.ones(len(boxes)) if weights is None else np.asarray(weights, dtype=np.float64)
+    size = int(clusters.max()) + 1 if len(clusters) else 0
+    totals = np.bincount(clusters, weights=weights, minlength=size)
+    counts = np.bincount(clusters, minlength=size)
+    merged = np.zeros((size, 4))
+    np.add.at(merged, clusters, boxes * weights[:, None])
+    merged /= np.where(totals > 0, totals, 1)[:, None]
+    return merged, totals, counts
+
+
+# Loading
+
+class BoxSet:
+    """Bounding boxes as arrays, sorted by annotation.
+
+    Attributes: `boxes` (N, 4) absolute corners, `relative` (N, 4) relative
+    corners, `labels` (N,) 0=negative/1=positive, `scores` (N,) confidence
+    (NaN when none), `box_ids`, and `annotation_ids` (N,) with `offsets`
+    so rows offsets[i]:offsets[i + 1] belong to `annotations[i]`.
+    """
+    FIELDS = ('annotation_id', 'box_id', 'x', 'y', 'width', 'height',
+              'relative_x', 'relative_y', 'relative_width', 'relative_height', 'label', 'confidence')
+
+    def __init__(self, rows):
+        rows = list(rows)
+        if rows:
+            columns = list(zip(*rows))
+        else:
+            columns = [()] * len(self.FIELDS)
+        self._set_columns(
+            np.asarray(columns[0], dtype=np.int64),
+            np.asarray(columns[1], dtype=np.int64),
+            np.column_stack(columns[2:6]) if rows else np.zeros((0, 4)),
+            np.column_stack(columns[6:10]) if rows else np.zeros((0, 4)),
+            np.asarray([LABEL_IDS.get(label, -1) for label in columns[10]], dtype=np.int8),
+            np.asarray([np.nan if value is None else value for value in columns[11]], dtype=np.float64),
+        )
+
+    def _set_columns(self, annotation_ids, box_ids, xywh, relative_xywh, labels, scores):
+        self.annotation_ids = annotation_ids
+        self.box_ids = box_ids
+        self.boxes = np.ascontiguousarray(xywh_to_xyxy(xywh))
+        self.relative = np.ascontiguousarray(xywh_to_xyxy(relative_xywh))
+        self.labels = labels
+        self.scores = scores
+        self.annotations, starts = np.unique(self.annotation_ids, return_index=True)
+        self.offsets = np.append(starts, len(self.annotation_ids))
+
+    @classmethod
+    def load(cls, queryset=None, **filters):
+        """Load BoundingBox rows, e.g. BoxSet.load(annotation_id__in=ids)."""
+        queryset = BoundingBox.objects.all() if queryset is None else queryset
+        rows = queryset.filter(**filters).order_by('annotation_id', 'box_id').values_list(*cls.FIELDS)
+        return cls(rows)
+
+    @classmethod
+    def load_annotations(cls, annotation_ids):
+        """Load the boxes of the given sessions from their packed columns (forms.boxpack).
+
+        Rows keep each session's own box order rather than box_id order.
+        """
+        from forms.boxpack import load_packed
+        packed = sorted(load_packed(annotation_ids).items())
+        box_set = cls.__new__(cls)
+        coords = np.concatenate([boxes.coords for _, boxes in packed], axis=1) if packed else np.zeros((8, 0))
+        confidence = [
+            boxes.confidence if boxes.confidence is not None else np.full(len(boxes), np.nan)
+            for _, boxes in packed
+        ]
+        box_set._set_columns(
+            np.repeat([annotation_id for annotation_id, _ in packed],
+                      [len(boxes) for _, boxes in packed]).astype(np.int64),
+            np.concatenate([boxes.box_ids for _, boxes in packed] or [np.zeros(0)]).astype(np.int64),
+            coords[:4].T.astype(np.float64),
+            coords[4:].T.astype(np.float64),
+            np.concatenate([boxes.label_ids for _, boxes in packed] or [np.zeros(0)]).astype(np.int8),
+            np.concatenate(confidence or [np.zeros(0)]).astype(np.float64),
+        )
+        return box_set
+
+    def __len__(self):
+        return len(self.annotation_ids)
+
+    def slice(self, annotation_id):
+        """Row slice of one annotation's boxes (empty if it has none)."""
+        index = np.searchsorted(self.annotations, annotation_id)
+        if index == len(self.annotations) or self.annotations[index] != annotation_id:
+            return slice(0, 0)
+        return slice(int(self.offsets[index]), int(self.offsets[index + 1]))
+
+    def groups(self):
+        """Yield (annotation_id, row slice) for every annotation in the set."""
+        for index, annotation_id in enumerate(self.annotations):
+            yield int(annotation_id), slice(int(self.offsets[index]), int(self.offsets[index + 1]))
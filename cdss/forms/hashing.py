@@ -0,0 +1,52 @@
+# forms/hashing.py
+"""Content hashes for case images.
+
+The SHA-256 identifies exact copies (derivative names, prediction cache
+keys); the 64-bit difference hash (dHash) stays close in Hamming distance
+for re-encoded or resized copies of the same cervigram.
+"""
+import hashlib
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+PHASH_BITS = 64
+READ_BLOCK_SIZE = 64 * 1024
+
+
+def dhash(image):
+    """64-bit difference hash of a PIL image as 16 hex characters."""
+    gray = ImageOps.exif_transpose(image).convert('L').resize((9, 8), Image.LANCZOS)
+    pixels = list(gray.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f'{bits:016x}'
+
+
+def hash_bytes(data):
+    """(sha256, dhash) of an encoded image held in memory."""
+    with Image.open(BytesIO(data)) as image:
+        return hashlib.sha256(data).hexdigest(), dhash(image)
+
+
+def hash_field_file(field_file):
+    """(sha256, dhash) of a stored image, streaming it for the SHA-256."""
+    digest = hashlib.sha256()
+    field_file.open('rb')
+    try:
+        for chunk in field_file.chunks(READ_BLOCK_SIZE):
+            digest.update(chunk)
+        field_file.seek(0)
+        with Image.open(field_file) as image:
+            return digest.hexdigest(), dhash(image)
+    finally:
+        field_file.close()
+
+
+def hamming(a, b):
+    """Hamming distance between two hex dHashes."""
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
@@ -0,0 +1,526 @@
+# forms/inference.py
+"""Model inference for uploaded cases.
+
+Uploads only enqueue their case here and return immediately. A dispatcher
+thread groups queued cases per model into micro-batches (up to
+MAX_BATCH_SIZE cases, or whatever arrived within MAX_BATCH_WAIT seconds)
+and runs each batch in a process pool, so CPU inference scales with cores
+and never blocks request threads. Predictions are stored as an Annotation
+with source='model' whose boxes carry the model confidence, and
+the case's Diagnosis/Confidence are filled from them.
+
+Models are configured in settings.INFERENCE['MODELS']; each entry names a
+backend class implementing InferenceBackend.
+
+Successful outputs are kept in PredictionCache keyed by (image SHA-256,
+model id, model VERSION), so re-uploads of an image already seen by the
+same model version are answered without running the model. Bumping a
+model's VERSION invalidates its entries; the cache is capped at
+INFERENCE['CACHE_SIZE'] entries, evicting the least recently used.
+"""
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.db import DatabaseError, close_old_connections, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from PIL import Image, ImageOps
+
+from forms.annotations import build_bounding_boxes, bulk_create_annotations, new_annotation_id
+from forms.boxpack import box_index_enabled, pack
+from forms.models import Annotation, BoundingBox, CaseImage, Forms, PredictionCache, count_labels
+from forms.response_cache import invalidate_cases
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    'DEFAULT_MODEL': 'dummy',
+    'WORKERS': 2,
+    'MAX_BATCH_SIZE': 8,
+    'MAX_BATCH_WAIT': 0.05,
+    'CACHE_SIZE': 10000,
+    'MODELS': {
+        'dummy': {'BACKEND': 'forms.inference.DummyBackend', 'VERSION': '1'},
+    },
+}
+
+
+def get_config():
+    return {**DEFAULT_CONFIG, **getattr(settings, 'INFERENCE', {})}
+
+
+def get_model_config(model_id):
+    models = get_config()['MODELS']
+    if model_id not in models:
+        raise ImproperlyConfigured(f"Unknown inference model {model_id!r}")
+    return models[model_id]
+
+
+# Backends
+
+class InferenceBackend:
+    """Interface for detection models.
+
+    predict_batch receives RGB PIL images and returns, per image, a list of
+    boxes in absolute pixels: {'x', 'y', 'width', 'height', 'label', 'confidence'}
+    with label 'positive' or 'negative'.
+    """
+    def __init__(self, model_id, config):
+        self.model_id = model_id
+        self.version = str(config.get('VERSION', '1'))
+        self.config = config
+
+    def predict_batch(self, images):
+        raise NotImplementedError
+
+
+class DummyBackend(InferenceBackend):
+    """Deterministic stand-in model: boxes are derived from the pixel data only."""
+    def predict_batch(self, images):
+        return [self._predict(image) for image in images]
+
+    def _predict(self, image):
+        digest = hashlib.sha256(image.resize((16, 16)).tobytes()).digest()
+        width, height = image.size
+        boxes = []
+        for i in range(1 + digest[0] % 3):
+            b = digest[1 + i * 5:6 + i * 5]
+            box_width = width * (0.1 + b[2] / 255 * 0.2)
+            box_height = height * (0.1 + b[3] / 255 * 0.2)
+            boxes.append({
+                'x': (width - box_width) * b[0] / 255,
+                'y': (height - box_height) * b[1] / 255,
+                'width': box_width,
+                'height': box_height,
+                'label': 'positive' if b[4] % 2 else 'negative',
+                'confidence': round(0.5 + b[4] / 255 * 0.5, 4),
+            })
+        return boxes
+
+
+class OnnxBackend(InferenceBackend):
+    """YOLO-style detector exported to ONNX, run with ONNX Runtime on CPU.
+
+    Config: PATH to the .onnx file, INPUT_SIZE (default 640),
+    SCORE_THRESHOLD (0.25), IOU_THRESHOLD (0.45) and LABELS mapping class
+    index to 'positive'/'negative'. The model output is expected in the
+    YOLOv8 layout (batch, 4 + classes, anchors) with cx, cy, w, h boxes.
+    """
+    def __init__(self, model_id, config):
+        super().__init__(model_id, config)
+        try:
+            import numpy as np
+            import onnxruntime
+        except ImportError:
+            raise ImproperlyConfigured("OnnxBackend requires the onnxruntime and numpy packages")
+        from forms.geometry import nms, xywh_to_xyxy
+        self.nms, self.xywh_to_xyxy = nms, xywh_to_xyxy
+        self.np = np
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = int(config.get('THREADS', 1))
+        self.session = onnxruntime.InferenceSession(
+            str(config['PATH']), options, providers=['CPUExecutionProvider']
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        self.input_size = int(config.get('INPUT_SIZE', 640))
+        self.score_threshold = float(config.get('SCORE_THRESHOLD', 0.25))
+        self.iou_threshold = float(config.get('IOU_THRESHOLD', 0.45))
+        self.labels = {int(k): v for k, v in config.get('LABELS', {0: 'negative', 1: 'positive'}).items()}
+
+    def _preprocess(self, image):
+        # Letterbox to a square input, keeping the scale to map boxes back
+        np = self.np
+        scale = self.input_size / max(image.size)
+        resized = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))))
+        canvas = Image.new('RGB', (self.input_size, self.input_size), (114, 114, 114))
+        canvas.paste(resized, (0, 0))
+        return np.asarray(canvas, dtype=np.float32).transpose(2, 0, 1) / 255.0, scale
+
+    def predict_batch(self, images):
+        np = self.np
+        inputs, scales = zip(*(self._preprocess(image) for image in images))
+        output = self.session.run(None, {self.input_name: np.stack(inputs)})[0]
+        results = []
+        for prediction, scale in zip(output, scales):
+            prediction = prediction.T  # (anchors, 4 + classes)
+            class_scores = prediction[:, 4:]
+            classes = class_scores.argmax(axis=1)
+            scores = class_scores.max(axis=1)
+            mask = scores >= self.score_threshold
+            cxcywh, classes, scores = prediction[mask, :4] / scale, classes[mask], scores[mask]
+            xywh = np.column_stack([cxcywh[:, 0] - cxcywh[:, 2] / 2, cxcywh[:, 1] - cxcywh[:, 3] / 2,
+                                    cxcywh[:, 2], cxcywh[:, 3]])
+            boxes = []
+            for i in self.nms(self.xywh_to_xyxy(xywh), scores, self.iou_threshold):
+                label = self.labels.get(int(classes[i]))
+                if label is None:
+                    continue
+                x, y, w, h = (float(v) for v in xywh[i])
+                boxes.append({'x': x, 'y': y, 'width': w, 'height': h,
+                              'label': label, 'confidence': round(float(scores[i]), 4)})
+            results.append(boxes)
+        return results
+
+
+def load_backend(model_id):
+    config = get_model_config(model_id)
+    return import_string(config['BACKEND'])(model_id, config)
+
+
+# Worker process side
+
+_backends = {}
+
+
+def _init_worker():
+    # Spawned workers need Django configured before touching storage
+    import django
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cdss.settings')
+    django.setup()
+
+
+def _open_image(name):
+    with default_storage.open(name, 'rb') as f:
+        with Image.open(f) as image:
+            return ImageOps.exif_transpose(image).convert('RGB')
+
+
+def run_batch(model_id, image_names):
+    """Run one micro-batch; returns per image (width, height, boxes) or an error string."""
+    if model_id not in _backends:
+        _backends[model_id] = load_backend(model_id)
+    backend = _backends[model_id]
+
+    images, outputs = [], []
+    for name in image_names:
+        try:
+            images.append(_open_image(name))
+            outputs.append(None)
+        except Exception as e:
+            outputs.append(f'Could not read image: {e}')
+    predictions = iter(backend.predict_batch(images) if images else [])
+    image_iter = iter(images)
+    for index, output in enumerate(outputs):
+        if output is None:
+            image = next(image_iter)
+            outputs[index] = (image.width, image.height, next(predictions))
+    return backend.version, outputs
+
+
+# Storing results
+
+def diagnosis_from_predictions(boxes):
+    """Forms.Diagnosis/Confidence for a set of predicted boxes."""
+    if not boxes:
+        return 'Negative', ''
+    positive = [box['confidence'] for box in boxes if box['label'] == 'positive']
+    confidence = max(positive) if positive else max(box['confidence'] for box in boxes)
+    return ('Positive' if positive else 'Negative'), f"{confidence * 100:.0f}%"
+
+
+def store_predictions(model_id, version, forms, outputs):
+    """Write one model Annotation per case and update Forms for a finished batch."""
+    with transaction.atomic():
+        case_images = {
+            case_image.case_id: case_image
+            for case_image in CaseImage.objects.filter(case_id__in=[str(f.CaseID) for f in forms])
+        }
+        # The model saw the image at its oriented size, so record it (forms.dimensions)
+        sizes = {
+            str(form.CaseID): output[:2] for form, output in zip(forms, outputs) if not isinstance(output, str)
+        }
+        missing = []
+        for form in forms:
+            if str(form.CaseID) not in case_images:
+                width, height = sizes.get(str(form.CaseID), (None, None))
+                missing.append(CaseImage(
+                    case_id=str(form.CaseID), patient_id=form.PatientID,
+                    image_name=os.path.basename(form.Image.name), image_path=form.Image.name,
+                    width=width, height=height,
+                ))
+        unsized = [
+            case_image for case_id, case_image in case_images.items()
+            if case_image.width is None and case_id in sizes
+        ]
+        for case_image in unsized:
+            case_image.width, case_image.height = sizes[case_image.case_id]
+        CaseImage.objects.bulk_update(unsized, ['width', 'height'])
+        CaseImage.objects.bulk_create(missing, ignore_conflicts=True)
+        if missing:
+            case_images = CaseImage.objects.in_bulk([str(f.CaseID) for f in forms], field_name='case_id')
+
+        annotations, sessions = [], []
+        for form, output in zip(forms, outputs):
+            if isinstance(output, str):
+                form.InferenceStatus = Forms.INFERENCE_FAILED
+                form.Diagnosis, form.Confidence = '', ''
+                logger.warning("Inference failed for case %s: %s", form.CaseID, output)
+                continue
+            width, height, boxes = output
+            session = [
+                {
+                    'id': index,
+                    'x': box['x'], 'y': box['y'], 'width': box['width'], 'height': box['height'],
+                    'label': box['label'],
+                    'relativeX': box['x'] / width, 'relativeY': box['y'] / height,
+                    'relativeWidth': box['width'] / width, 'relativeHeight': box['height'] / height,
+                    'confidence': box['confidence'],
+                }
+                for index, box in enumerate(boxes)
+            ]
+            case_image = case_images[str(form.CaseID)]
+            total, positive, negative = count_labels(session)
+            annotations.append(Annotation(
+                case_image=case_image,
+                annotation_id=new_annotation_id(case_image.case_id),
+                source=Annotation.MODEL,
+                annotations_data={
+                    'caseId': case_image.case_id,
+                    'patientId': case_image.patient_id,
+                    'imageName': case_image.image_name,
+                    'annotations': session,
+                    'annotated_at': timezone.now().isoformat(),
+                    'model': model_id,
+                    'model_version': version,
+                },
+                packed_boxes=pack(session),
+                total_annotations=total,
+                positive_count=positive,
+                negative_count=negative,
+            ))
+            sessions.append(session)
+            form.Diagnosis, form.Confidence = diagnosis_from_predictions(boxes)
+            form.InferenceStatus = Forms.INFERENCE_DONE
+
+        bulk_create_annotations(annotations)
+        if box_index_enabled():
+            boxes = []
+            for annotation, session in zip(annotations, sessions):
+                boxes.extend(build_bounding_boxes(annotation, session))
+            BoundingBox.objects.bulk_create(boxes)
+        Forms.objects.bulk_update(forms, ['Diagnosis', 'Confidence', 'InferenceStatus'])
+        invalidate_cases([form.CaseID for form in forms])
+
+
+# Prediction cache
+
+def cached_predictions(model_id, version, forms):
+    """Cached outputs for the cases whose image this model version has seen."""
+    hashes = {form.ImageHash for form in forms if form.ImageHash}
+    if not hashes:
+        return {}
+    return {
+        entry.image_hash: entry
+        for entry in PredictionCache.objects.filter(
+            image_hash__in=hashes, model_id=model_id, model_version=version
+        )
+    }
+
+
+def cache_predictions(model_id, version, forms, outputs):
+    """Remember successful outputs and drop stale or least recently used entries."""
+    entries = {}
+    for form, output in zip(forms, outputs):
+        if form.ImageHash and not isinstance(output, str):
+            width, height, boxes = output
+            entries[form.ImageHash] = PredictionCache(
+                image_hash=form.ImageHash, model_id=model_id, model_version=version,
+                predictions={'width': width, 'height': height, 'boxes': boxes},
+            )
+    if not entries:
+        return
+    PredictionCache.objects.bulk_create(entries.values(), ignore_conflicts=True)
+    PredictionCache.objects.filter(model_id=model_id).exclude(model_version=version).delete()
+
+    excess = PredictionCache.objects.count() - get_config()['CACHE_SIZE']
+    if excess > 0:
+        oldest = PredictionCache.objects.order_by('last_used_at', 'id').values_list('id', flat=True)[:excess]
+        PredictionCache.objects.filter(id__in=list(oldest)).delete()
+
+
+def _serve_from_cache(model_id, forms):
+    """Store cached predictions for the cases that have one; returns the rest."""
+    version = get_model_config(model_id)['VERSION']
+    entries = cached_predictions(model_id, version, forms)
+    hits = [form for form in forms if form.ImageHash in entries]
+    if not hits:
+        return forms
+    outputs = []
+    for form in hits:
+        predictions = entries[form.ImageHash].predictions
+        outputs.append((predictions['width'], predictions['height'], predictions['boxes']))
+    store_predictions(model_id, version, hits, outputs)
+    PredictionCache.objects.filter(id__in=[entry.id for entry in entries.values()]).update(
+        hits=F('hits') + 1, last_used_at=timezone.now()
+    )
+    return [form for form in forms if form.ImageHash not in entries]
+
+
+# Dispatcher
+
+class InferenceService:
+    """Queues cases, micro-batches them per model and runs them in a process pool."""
+    def __init__(self, config=None):
+        self.config = config or get_config()
+        self.queue = queue.Queue()
+        self.pool = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.outstanding = 0  # Cases queued or running
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                if self.config['WORKERS'] > 0:
+                    self.pool = ProcessPoolExecutor(
+                        max_workers=self.config['WORKERS'], initializer=_init_worker
+                    )
+                self.thread = threading.Thread(target=self._run, name='inference-dispatcher', daemon=True)
+                self.thread.start()
+
+    def submit(self, case_ids, model_id=None):
+        """Queue cases for inference; returns immediately."""
+        self.start()
+        model_id = model_id or self.config['DEFAULT_MODEL']
+        with self.lock:
+            self.outstanding += len(case_ids)
+        for case_id in case_ids:
+            self.queue.put(('job', model_id, case_id))
+
+    def _run(self):
+        pending = defaultdict(list)  # model id -> [(case id, queued at)]
+        while True:
+            timeout = None
+            if pending:
+                oldest = min(items[0][1] for items in pending.values())
+                timeout = max(0.0, oldest + self.config['MAX_BATCH_WAIT'] - time.monotonic())
+            elif self.queue.empty():
+                # Idle until the next upload: hold no database connection meanwhile
+                connections.close_all()
+            try:
+                message = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                message = None
+
+            try:
+                close_old_connections()
+                if message and message[0] == 'job':
+                    _, model_id, case_id = message
+                    pending[model_id].append((case_id, time.monotonic()))
+                elif message and message[0] == 'result':
+                    _, model_id, case_ids, future = message
+                    self._finish_batch(model_id, case_ids, future)
+
+                now = time.monotonic()
+                for model_id in list(pending):
+                    items = pending[model_id]
+                    while items and (len(items) >= self.config['MAX_BATCH_SIZE']
+                                     or now - items[0][1] >= self.config['MAX_BATCH_WAIT']):
+                        batch = items[:self.config['MAX_BATCH_SIZE']]
+                        del items[:len(batch)]
+                        self._start_batch(model_id, [case_id for case_id, _ in batch])
+                    if not items:
+                        del pending[model_id]
+            except Exception:
+                logger.exception("Inference dispatcher error")
+
+    def _done(self, count):
+        with self.lock:
+            self.outstanding -= count
+            if self.outstanding <= 0:
+                self.idle.notify_all()
+
+    def _start_batch(self, model_id, case_ids):
+        forms = list(Forms.objects.filter(CaseID__in=case_ids).exclude(Image=''))
+        # Cases deleted (or without an image) since they were queued are dropped
+        self._done(len(case_ids) - len(forms))
+        if not forms:
+            return
+        try:
+            Forms.objects.filter(CaseID__in=[f.CaseID for f in forms]).update(
+                InferenceStatus=Forms.INFERENCE_RUNNING
+            )
+        except DatabaseError:
+            # The status is informational; the batch itself can still run
+            logger.warning("Could not mark %d cases as running", len(forms))
+        names = [form.Image.name for form in forms]
+        ids = [form.CaseID for form in forms]
+        future = Future()
+        try:
+            if self.pool is not None:
+                future = self.pool.submit(run_batch, model_id, names)
+            else:
+                future.set_result(run_batch(model_id, names))
+        except Exception as e:
+            future.set_exception(e)
+        future.add_done_callback(lambda f: self.queue.put(('result', model_id, ids, f)))
+
+    def _finish_batch(self, model_id, case_ids, future):
+        try:
+            try:
+                version, outputs = future.result()
+            except Exception:
+                logger.exception("Inference batch for model %s failed", model_id)
+                Forms.objects.filter(CaseID__in=case_ids).update(InferenceStatus=Forms.INFERENCE_FAILED)
+                invalidate_cases(case_ids)
+                return
+            by_id = dict(zip(case_ids, outputs))
+            try:
+                forms = list(Forms.objects.filter(CaseID__in=case_ids))
+                outputs = [by_id[form.CaseID] for form in forms]
+                store_predictions(model_id, version, forms, outputs)
+            except Exception:
+                # Left as failed so `manage.py run_inference --failed` can retry
+                logger.exception("Could not store predictions of model %s", model_id)
+                Forms.objects.filter(CaseID__in=case_ids).update(InferenceStatus=Forms.INFERENCE_FAILED)
+                invalidate_cases(case_ids)
+                return
+            try:
+                cache_predictions(model_id, version, forms, outputs)
+            except Exception:
+                logger.exception("Could not cache predictions of model %s", model_id)
+        finally:
+            self._done(len(case_ids))
+
+    def wait(self, timeout=None):
+        """Block until every submitted case has been processed; False on timeout."""
+        with self.lock:
+            return self.idle.wait_for(lambda: self.outstanding <= 0, timeout)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = InferenceService()
+        return _service
+
+
+def request_inference(forms, model_id=None):
+    """Answer cases from the prediction cache; mark the rest pending and queue them."""
+    model_id = model_id or get_config()['DEFAULT_MODEL']
+    forms = _serve_from_cache(model_id, forms)
+    if not forms:
+        return
+    case_ids = [form.CaseID for form in forms]
+    Forms.objects.filter(CaseID__in=case_ids).update(InferenceStatus=Forms.INFERENCE_PENDING)
+    invalidate_cases(case_ids)
+    for form in forms:
+        form.InferenceStatus = Forms.INFERENCE_PENDING
+    # Only queue once the rows are visible to the dispatcher thread
+    transaction.on_commit(lambda: get_service().submit(case_ids, model_id))
@@ -0,0 +1,258 @@
+# forms/ingest.py
+"""Bulk ingest of case images from a ZIP archive or a directory.
+
+Entries are read straight out of the archive (no extraction to disk),
+validated, hashed and written to storage by a thread pool, while the
+Forms/CaseImage rows for each batch are created with bulk_create on the
+calling thread. Worker threads never touch the database. Exact copies of
+an image already stored (or earlier in the batch) reuse its file, and
+near copies are linked through Forms.DuplicateOf (see forms.duplicates).
+"""
+import logging
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import Image
+
+from forms.derivatives import ensure_derivatives
+from forms.dimensions import oriented_size
+from forms.duplicates import canonical_id, find_duplicates, get_index, get_max_distance
+from forms.hashing import hamming, hash_bytes
+from forms.inference import request_inference
+from forms.models import CaseImage, Forms, get_upload_path
+from forms.response_cache import invalidate_cases
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp'}
+INGEST_BATCH_SIZE = 32
+INGEST_WORKERS = min(8, (os.cpu_count() or 1) + 4)
+MAX_IMAGE_SIZE = 50 * 1024 * 1024
+
+
+def is_image_name(name):
+    base = os.path.basename(name)
+    return (
+        not base.startswith('.')
+        and '__MACOSX' not in name
+        and os.path.splitext(base)[1].lower() in IMAGE_EXTENSIONS
+    )
+
+
+def iter_zip_entries(archive):
+    """Yield (name, opener) for image members of an open ZipFile."""
+    for info in archive.infolist():
+        if info.is_dir() or not is_image_name(info.filename):
+            continue
+        if info.file_size > MAX_IMAGE_SIZE:
+            yield info.filename, None
+            continue
+        yield info.filename, (lambda info=info: archive.open(info))
+
+
+def iter_directory_entries(root):
+    """Yield (relative name, opener) for image files below a directory, in sorted order."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            name = os.path.relpath(path, root)
+            if not is_image_name(name):
+                continue
+            if os.path.getsize(path) > MAX_IMAGE_SIZE:
+                yield name, None
+                continue
+            yield name, (lambda path=path: open(path, 'rb'))
+
+
+def _read_and_validate(entry):
+    """Worker step: load one entry, check it decodes as an image and hash it."""
+    name, opener = entry
+    if opener is None:
+        return {'name': name, 'status': 'invalid', 'error': 'File too large'}
+    try:
+        with opener() as f:
+            data = f.read(MAX_IMAGE_SIZE + 1)
+        if len(data) > MAX_IMAGE_SIZE:
+            return {'name': name, 'status': 'invalid', 'error': 'File too large'}
+        with Image.open(BytesIO(data)) as image:
+            image.verify()
+        with Image.open(BytesIO(data)) as image:
+            width, height = oriented_size(image)
+        image_hash, phash = hash_bytes(data)
+    except Exception:
+        return {'name': name, 'status': 'invalid', 'error': 'Not a readable image'}
+    return {'name': name, 'data': data, 'hash': image_hash, 'phash': phash, 'width': width, 'height': height}
+
+
+def _store(item):
+    """Worker step: write the image bytes to storage under the case's upload path."""
+    try:
+        item['stored_name'] = default_storage.save(item['upload_path'], ContentFile(item.pop('data')))
+    except Exception as e:
+        item.update(status='failed', error=f'Could not store image: {e}')
+    return item
+
+
+def _make_derivatives(form):
+    """Worker step: store a new case's derivatives; the caller records DerivativesAt."""
+    try:
+        ensure_derivatives(form, record=False)
+    except Exception as e:
+        # Served lazily by case_image_derivative instead
+        logger.warning("Could not generate derivatives for case %s: %s", form.CaseID, e)
+        return False
+    return True
+
+
+def _match_duplicates(items):
+    """Link items to an earlier copy of their image, stored or earlier in the batch.
+
+    Exact copies get `shared_name` (an already stored file) or `shared_item`
+    (a batch item whose file they reuse) and are not stored again.
+    """
+    matches = find_duplicates([(item['hash'], item['phash']) for item in items])
+    max_distance = get_max_distance()
+    for position, (item, (match, distance)) in enumerate(zip(items, matches)):
+        if match is not None:
+            item.update(duplicate_of=canonical_id(match), duplicate_distance=distance)
+            if match.ImageHash == item['hash']:
+                item['shared_name'] = match.Image.name
+            continue
+        for earlier in items[:position]:
+            distance = hamming(earlier['phash'], item['phash'])
+            if distance > max_distance:
+                continue
+            if 'duplicate_of' in earlier:
+                item['duplicate_of'] = earlier['duplicate_of']
+            else:
+                item['duplicate_item'] = earlier.get('duplicate_item', earlier)
+            item['duplicate_distance'] = distance
+            if earlier['hash'] == item['hash']:
+                if 'shared_name' in earlier:
+                    item['shared_name'] = earlier['shared_name']
+                else:
+                    item['shared_item'] = earlier.get('shared_item', earlier)
+            break
+
+
+def _create_rows(items):
+    """Create the Forms and CaseImage rows for one batch of stored images."""
+    with transaction.atomic():
+        forms = [
+            Forms(PatientID=item['patient_id'], Image=item['stored_name'],
+                  ImageHash=item['hash'], ImagePHash=item['phash'],
+                  DuplicateOf_id=item.get('duplicate_of'), DuplicateDistance=item.get('duplicate_distance'))
+            for item in items
+        ]
+        Forms.objects.bulk_create(forms)
+        if forms and forms[0].pk is None:
+            ids = dict(Forms.objects.filter(
+                PatientID__in=[f.PatientID for f in forms]
+            ).values_list('PatientID', 'CaseID'))
+            for form in forms:
+                form.CaseID = ids[form.PatientID]
+
+        # Links to cases created in this same batch need their CaseIDs
+        for item, form in zip(items, forms):
+            item['form'] = form
+        linked = []
+        for item, form in zip(items, forms):
+            if 'duplicate_item' in item:
+                root = item['duplicate_item'].get('form')
+                form.DuplicateOf_id = root.CaseID if root else None
+                form.DuplicateDistance = item['duplicate_distance'] if root else None
+                linked.append(form)
+        Forms.objects.bulk_update(linked, ['DuplicateOf', 'DuplicateDistance'])
+        CaseImage.objects.bulk_create([
+            CaseImage(
+                case_id=str(form.CaseID),
+                patient_id=form.PatientID,
+                image_name=os.path.basename(item['name']),
+                image_path=form.Image.name,
+                status='uploaded',
+                width=item['width'],
+                height=item['height'],
+            )
+            for item, form in zip(items, forms)
+        ])
+    return forms
+
+
+def _ingest_batch(pool, entries):
+    results = list(pool.map(_read_and_validate, entries))
+    valid = [item for item in results if 'data' in item]
+
+    _match_duplicates(valid)
+
+    for item, patient_id in zip(valid, Forms.allocate_patient_ids(len(valid))):
+        item['patient_id'] = patient_id
+        item['upload_path'] = get_upload_path(Forms(PatientID=patient_id), os.path.basename(item['name']))
+    new_files = [item for item in valid if 'shared_name' not in item and 'shared_item' not in item]
+    list(pool.map(_store, new_files))
+    for item in valid:
+        if 'shared_name' in item:
+            item['stored_name'] = item['shared_name']
+        elif 'shared_item' in item:
+            if 'stored_name' in item['shared_item']:
+                item['stored_name'] = item['shared_item']['stored_name']
+            else:
+                item.update(status='failed', error=item['shared_item']['error'])
+    stored = [item for item in valid if 'stored_name' in item]
+
+    try:
+        forms = _create_rows(stored)
+    except Exception as e:
+        for item in stored:
+            if 'shared_name' not in item and 'shared_item' not in item:
+                default_storage.delete(item['stored_name'])
+            item.update(status='failed', error=f'Could not create case: {e}')
+    else:
+        index = get_index()
+        for form in forms:
+            index.add(form.CaseID, form.ImagePHash)
+        generated = [form for form, done in zip(forms, pool.map(_make_derivatives, forms)) if done]
+        Forms.objects.bulk_update(generated, ['DerivativesAt'])
+        invalidate_cases([form.CaseID for form in forms])
+        request_inference(forms)
+        for item, form in zip(stored, forms):
+            item.update(status='created', CaseID=form.CaseID, PatientID=form.PatientID,
+                        DuplicateOf=form.DuplicateOf_id)
+
+    for item in results:
+        for key in ('data', 'patient_id', 'upload_path', 'stored_name', 'form', 'duplicate_of',
+                    'duplicate_distance', 'duplicate_item', 'shared_name', 'shared_item'):
+            item.pop(key, None)
+    return results
+
+
+def ingest_entries(entries, workers=INGEST_WORKERS, batch_size=INGEST_BATCH_SIZE):
+    """Ingest (name, opener) entries, yielding one result dict per entry.
+
+    Results carry `name`, `status` ('created', 'invalid' or 'failed') and
+    either `CaseID`/`PatientID`/`DuplicateOf` or `error`. At most one batch of image bytes
+    is held in memory at a time.
+    """
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest') as pool:
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                yield from _ingest_batch(pool, batch)
+                batch = []
+        if batch:
+            yield from _ingest_batch(pool, batch)
+
+
+def ingest_path(path, **kwargs):
+    """Ingest a ZIP archive or a directory on the server."""
+    if os.path.isdir(path):
+        yield from ingest_entries(iter_directory_entries(path), **kwargs)
+    else:
+        with zipfile.ZipFile(path) as archive:
+            yield from ingest_entries(iter_zip_entries(archive), **kwargs)
@@ -0,0 +1,89 @@
+# forms/jsonstream.py
+"""Incremental reader for large JSON documents.
+
+Only the elements of selected top-level arrays are materialized one at a
+time, so a multi-gigabyte COCO file can be walked with memory bounded by
+the largest single element plus the read buffer.
+"""
+import json
+
+READ_SIZE = 1 << 16
+WHITESPACE = ' \t\r\n'
+
+
+class JSONStreamReader:
+    def __init__(self, fp, read_size=READ_SIZE):
+        self.fp = fp
+        self.read_size = read_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        data = self.fp.read(self.read_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def _peek(self):
+        """Skip whitespace and return the next character, or '' at end of input."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def _next_char(self, expected):
+        char = self._peek()
+        if char not in expected:
+            raise ValueError(f"Expected one of {expected!r} at offset {self.pos}, found {char!r}")
+        self.pos += 1
+        return char
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value ending exactly at the buffer edge may be a truncated
+                # number, so only trust it once more input (or EOF) follows
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def items(self, stream_keys=()):
+        """Yield (key, value) pairs of the top-level object.
+
+        Arrays under `stream_keys` are not returned whole; instead one
+        (key, element) pair is yielded per element.
+        """
+        self._next_char('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self._value()
+            self._next_char(':')
+            if key in stream_keys and self._peek() == '[':
+                self.pos += 1
+                if self._peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield key, self._value()
+                        if self._next_char(',]') == ']':
+                            break
+            else:
+                yield key, self._value()
+            if self._next_char(',}') == '}':
+                return
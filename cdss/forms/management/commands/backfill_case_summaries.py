@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+
+from forms.boxpack import load_packed
+from forms.models import Annotation, CaseImage, diagnosis_from_counts
+from forms.response_cache import invalidate_cases
+
+SUMMARY_FIELDS = ['latest_annotation', 'diagnosis', 'positive_count', 'negative_count']
+
+
+class Command(BaseCommand):
+    help = "Backfill or verify the materialized diagnosis and latest annotation on CaseImage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help="Only report cases whose stored summary is stale")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        verify = options['verify']
+
+        latest_annotation = Annotation.objects.filter(
+            case_image=OuterRef('pk'), source=Annotation.DOCTOR
+        ).order_by('-created_at', '-id').values('id')[:1]
+        case_images = CaseImage.objects.annotate(
+            computed_latest_id=Subquery(latest_annotation)
+        ).order_by('pk')
+
+        checked = stale = 0
+        batch = []
+        for case_image in case_images.iterator(chunk_size=batch_size):
+            batch.append(case_image)
+            if len(batch) >= batch_size:
+                stale += self.process_batch(batch, verify)
+                checked += len(batch)
+                batch = []
+        if batch:
+            stale += self.process_batch(batch, verify)
+            checked += len(batch)
+
+        if verify:
+            if stale:
+                raise CommandError(f"{stale} of {checked} case summaries are stale")
+            self.stdout.write(self.style.SUCCESS(f"All {checked} case summaries are up to date"))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Updated {stale} of {checked} case summaries"))
+
+    def process_batch(self, batch, verify):
+        """Compare one batch against freshly computed summaries; returns the stale count."""
+        annotation_ids = [c.computed_latest_id for c in batch if c.computed_latest_id]
+        counts = {}
+        for annotation_id, packed in load_packed(annotation_ids).items():
+            positive = int(packed.positive.sum())
+            counts[annotation_id] = {'positive': positive, 'negative': len(packed) - positive}
+
+        stale = []
+        for case_image in batch:
+            row = counts.get(case_image.computed_latest_id, {})
+            expected = {
+                'latest_annotation_id': case_image.computed_latest_id,
+                'positive_count': row.get('positive', 0),
+                'negative_count': row.get('negative', 0),
+            }
+            expected['diagnosis'] = diagnosis_from_counts(
+                expected['positive_count'], expected['negative_count']
+            )
+            if any(getattr(case_image, field) != value for field, value in expected.items()):
+                if verify:
+                    self.stdout.write(f"Stale summary for case {case_image.case_id}")
+                for field, value in expected.items():
+                    setattr(case_image, field, value)
+                stale.append(case_image)
+
+        if stale and not verify:
+            with transaction.atomic():
+                CaseImage.objects.bulk_update(stale, SUMMARY_FIELDS)
+                invalidate_cases([case_image.case_id for case_image in stale])
+        return len(stale)
@@ -0,0 +1,113 @@
+import json
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from forms.benchmark import (
+    build_workloads, compare_to_baseline, load_synthetic_dataset, run_metadata, run_workload,
+)
+from forms.inference import get_service
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the API against a throwaway test database filled with synthetic cases. "
+            "Works on SQLite and PostgreSQL; the real database and media are never touched.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cases', type=int, default=200)
+        parser.add_argument('--boxes', type=int, default=5, help="Boxes per case")
+        parser.add_argument('--iterations', type=int, default=100, help="Requests per workload")
+        parser.add_argument('--concurrency', type=int, default=1, help="Client threads per workload")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--workloads', help="Comma-separated subset of workloads to run")
+        parser.add_argument('--response-cache', action='store_true',
+                            help="Leave the response cache on (off by default so reads hit the database)")
+        parser.add_argument('--save-baseline', metavar='PATH', help="Write the results to PATH")
+        parser.add_argument('--compare', metavar='PATH', help="Compare the results with a saved baseline")
+        parser.add_argument('--threshold', type=float, default=20.0,
+                            help="Allowed p95 slowdown against the baseline, in percent")
+        parser.add_argument('--keepdb', action='store_true', help="Keep the benchmark database afterwards")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    baseline = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"Could not read baseline {options['compare']}: {e}")
+
+        with tempfile.TemporaryDirectory(prefix='cdss-benchmark-') as workdir:
+            test_settings = connection.settings_dict.setdefault('TEST', {})
+            if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+                # A file, not the in-memory default, so client threads and the
+                # inference dispatcher share one database
+                test_settings['NAME'] = os.path.join(workdir, 'benchmark.sqlite3')
+            old_name = connection.creation.create_test_db(
+                verbosity=0, autoclobber=True, serialize=False, keepdb=options['keepdb']
+            )
+            response_cache = {**getattr(settings, 'RESPONSE_CACHE', {}), 'ENABLED': options['response_cache']}
+            try:
+                with override_settings(MEDIA_ROOT=os.path.join(workdir, 'media'),
+                                       RESPONSE_CACHE=response_cache, ALLOWED_HOSTS=['testserver']):
+                    results = self.run(workdir, options)
+            finally:
+                get_service().wait(60)
+                connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        meta = run_metadata(options['cases'], options['boxes'], options['iterations'],
+                            options['concurrency'], options['seed'])
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump({'meta': meta, 'results': results}, f, indent=2)
+            self.stdout.write(f"Baseline written to {options['save_baseline']}")
+
+        if baseline is not None:
+            self.report_comparison(results, meta, baseline, options['threshold'] / 100)
+
+    def run(self, workdir, options):
+        self.stdout.write(f"Generating {options['cases']} cases with {options['boxes']} boxes each "
+                          f"on {connection.vendor}...")
+        load_synthetic_dataset(workdir, options['cases'], options['boxes'], options['seed'])
+
+        workloads = build_workloads(options['boxes'], options['seed'])
+        if options['workloads']:
+            wanted = {name.strip() for name in options['workloads'].split(',')}
+            unknown = wanted - {workload.name for workload in workloads}
+            if unknown:
+                raise CommandError(f"Unknown workloads: {', '.join(sorted(unknown))}")
+            workloads = [workload for workload in workloads if workload.name in wanted]
+
+        self.stdout.write(f"{'workload':<18}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}"
+                          f"{'req/s':>9}{'queries':>9}{'errors':>8}")
+        results = {}
+        for workload in workloads:
+            result = run_workload(workload, options['iterations'], options['concurrency'], options['seed'])
+            results[workload.name] = result
+            self.stdout.write(
+                f"{workload.name:<18}{result['p50_ms']:>9.1f}{result['p90_ms']:>9.1f}"
+                f"{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}{result['throughput_rps']:>9.1f}"
+                f"{result['queries_mean']:>9.1f}{result['errors']:>8}"
+            )
+            # Let queued inference finish so it does not run into the next workload
+            get_service().wait(60)
+        self.stdout.write("Latencies in ms")
+        return results
+
+    def report_comparison(self, results, meta, baseline, threshold):
+        previous = baseline.get('meta', {})
+        for key in ('database', 'cases', 'boxes_per_case', 'concurrency'):
+            if previous.get(key) != meta[key]:
+                self.stdout.write(self.style.WARNING(
+                    f"Baseline was recorded with {key}={previous.get(key)!r}, this run uses {meta[key]!r}"
+                ))
+        regressions = compare_to_baseline(results, baseline, threshold)
+        if regressions:
+            for name, message in regressions:
+                self.stdout.write(self.style.ERROR(f"{name}: {message}"))
+            raise CommandError(f"{len(regressions)} regressions against {baseline.get('meta', {}).get('created_at')}")
+        self.stdout.write(self.style.SUCCESS("No regressions against the baseline"))
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from forms.consensus import outdated_cases, update_consensus
+from forms.models import Annotation, CaseImage
+
+
+class Command(BaseCommand):
+    help = "Build missing or outdated consensus annotations from all doctor sessions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="Rebuild every case, e.g. after changing settings.CONSENSUS")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if options['all']:
+            case_image_ids = sorted(set(
+                Annotation.objects.filter(source=Annotation.DOCTOR).values_list('case_image_id', flat=True)
+            ) | set(CaseImage.objects.filter(consensus__isnull=False).values_list('pk', flat=True)))
+        else:
+            case_image_ids = outdated_cases()
+
+        batch_size = options['batch_size']
+        for start in range(0, len(case_image_ids), batch_size):
+            with transaction.atomic():
+                update_consensus(case_image_ids[start:start + batch_size])
+        self.stdout.write(self.style.SUCCESS(f"Updated the consensus of {len(case_image_ids)} cases"))
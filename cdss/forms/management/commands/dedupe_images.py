@@ -0,0 +1,104 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from forms.duplicates import BKTree, get_max_distance
+from forms.hashing import hash_field_file
+from forms.models import CaseImage, Forms
+from forms.response_cache import invalidate_all
+
+
+class Command(BaseCommand):
+    help = ("Hash stored case images, link duplicates to the earliest case holding the image "
+            "and delete redundant copies of identical files. Restart the server afterwards so "
+            "its duplicate index picks up backfilled hashes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Report what would change without writing anything")
+        parser.add_argument('--max-distance', type=int, default=None,
+                            help="dHash bits two images may differ in (default DUPLICATE_MAX_DISTANCE)")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def backfill_hashes(self, options):
+        forms = Forms.objects.exclude(Image='').filter(ImageHash='') | Forms.objects.exclude(Image='').filter(ImagePHash='')
+        batch, hashed = [], 0
+        for form in forms.order_by('CaseID').iterator(chunk_size=options['batch_size']):
+            try:
+                form.ImageHash, form.ImagePHash = hash_field_file(form.Image)
+            except Exception as e:
+                self.stderr.write(f"Case {form.CaseID}: {e}")
+                continue
+            batch.append(form)
+            if len(batch) >= options['batch_size']:
+                hashed += self.save_hashes(batch)
+                batch = []
+        return hashed + self.save_hashes(batch)
+
+    def save_hashes(self, forms):
+        if forms:
+            Forms.objects.bulk_update(forms, ['ImageHash', 'ImagePHash'])
+        return len(forms)
+
+    def handle(self, *args, **options):
+        # A dry run does all the work and rolls it back, so its report is exact
+        with transaction.atomic():
+            redundant, report = self.dedupe(options)
+            if options['dry_run']:
+                transaction.set_rollback(True)
+        if not options['dry_run']:
+            still_used = set(Forms.objects.filter(Image__in=redundant).values_list('Image', flat=True))
+            for name in redundant - still_used:
+                default_storage.delete(name)
+
+        prefix = "Would update" if options['dry_run'] else "Updated"
+        self.stdout.write(self.style.SUCCESS(f"{prefix}: {report}"))
+
+    def dedupe(self, options):
+        max_distance = options['max_distance']
+        if max_distance is None:
+            max_distance = get_max_distance()
+        hashed = self.backfill_hashes(options)
+
+        exact = {}  # sha256 -> (root CaseID, stored name)
+        tree = BKTree()
+        roots = {}  # CaseID -> root CaseID
+        changed, moved = [], []
+        rows = (Forms.objects.exclude(Image='').exclude(ImagePHash='').order_by('CaseID')
+                .values_list('CaseID', 'Image', 'ImageHash', 'ImagePHash', 'DuplicateOf', 'DuplicateDistance'))
+        for case_id, image, sha, phash, duplicate_of, duplicate_distance in rows.iterator(chunk_size=options['batch_size']):
+            link, distance = None, None
+            if sha in exact:
+                link, distance = exact[sha][0], 0
+                if image != exact[sha][1]:
+                    moved.append((case_id, image, exact[sha][1]))
+                    image = exact[sha][1]
+            else:
+                matches = tree.search(int(phash, 16), max_distance)
+                if matches:
+                    distance, nearest = matches[0]
+                    link = roots[nearest]
+                exact[sha] = (link or case_id, image)
+            roots[case_id] = link or case_id
+            tree.add(int(phash, 16), case_id)
+            if (link, distance) != (duplicate_of, duplicate_distance):
+                changed.append(Forms(CaseID=case_id, DuplicateOf_id=link, DuplicateDistance=distance))
+
+        redundant = {old for _, old, _ in moved}
+        reclaimed = 0
+        for name in redundant:
+            try:
+                reclaimed += default_storage.size(name)
+            except OSError:
+                pass
+
+        Forms.objects.bulk_update(changed, ['DuplicateOf', 'DuplicateDistance'], batch_size=options['batch_size'])
+        for case_id, _, new in moved:
+            Forms.objects.filter(CaseID=case_id).update(Image=new)
+            CaseImage.objects.filter(case_id=str(case_id)).update(image_path=new)
+        if changed or moved:
+            invalidate_all()
+
+        report = (f"hashed {hashed} images, relinked {len(changed)} cases, "
+                  f"merged {len(redundant)} identical files ({reclaimed / 2**20:.1f} MiB)")
+        return redundant, report
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from forms.evaluation import default_model_id, run_evaluation
+from forms.inference import get_config
+
+
+class Command(BaseCommand):
+    help = "Evaluate model predictions against doctor annotations and store a dataset report"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', action='append',
+                            help="Model id to evaluate; repeat for several (default model if omitted)")
+        parser.add_argument('--all-models', action='store_true', help="Evaluate every configured model")
+        parser.add_argument('--full', action='store_true',
+                            help="Re-evaluate every case, not only those changed since the last run")
+
+    def handle(self, *args, **options):
+        models = get_config()['MODELS']
+        model_ids = list(models) if options['all_models'] else options['model'] or [default_model_id()]
+        for model_id in model_ids:
+            if model_id not in models:
+                raise CommandError(f"Unknown model {model_id}")
+
+        for model_id in model_ids:
+            run = run_evaluation(model_id, full=options['full'])
+            report = run.report
+            self.stdout.write(
+                f"{model_id}: {run.cases_evaluated} of {run.cases_total} cases evaluated, "
+                f"{run.cases_removed} removed"
+            )
+            self.stdout.write(f"  mAP@50 {report['map50']}  mAP@50:95 {report['map50_95']}")
+            for label, stats in report['labels'].items():
+                self.stdout.write(
+                    f"  {label}: AP@50 {stats['ap50']}  AP@50:95 {stats['ap50_95']}  "
+                    f"sensitivity {stats['case_sensitivity']}  specificity {stats['case_specificity']}"
+                )
+        self.stdout.write(self.style.SUCCESS(f"Evaluated {len(model_ids)} model(s)"))
@@ -0,0 +1,36 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from forms.coco import EXPORT_CHUNK_SIZE, EXPORT_LABELS, filter_case_images, iter_coco_export
+
+
+class Command(BaseCommand):
+    help = "Stream a COCO JSON export of the latest (or consensus) annotation of each case"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', help="Output file (defaults to stdout)")
+        parser.add_argument('--diagnosis', help="Positive, Negative or 'Not Annotated'")
+        parser.add_argument('--status', help="CaseImage status, e.g. annotated")
+        parser.add_argument('--date-from', help="Earliest upload date (YYYY-MM-DD)")
+        parser.add_argument('--date-to', help="Latest upload date (YYYY-MM-DD)")
+        parser.add_argument('--case-ids', help="Comma separated case ids")
+        parser.add_argument('--labels', choices=list(EXPORT_LABELS), default='latest',
+                            help="Boxes to export: the latest doctor session or the fused consensus")
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            case_images = filter_case_images(options)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        chunks = iter_coco_export(case_images, chunk_size=options['chunk_size'], labels=options['labels'])
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as out:
+                for chunk in chunks:
+                    out.write(chunk)
+            self.stderr.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+        else:
+            for chunk in chunks:
+                sys.stdout.write(chunk)
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from forms.derivatives import ensure_derivatives
+from forms.models import Forms
+from forms.response_cache import invalidate_all
+
+
+class Command(BaseCommand):
+    help = "Generate missing thumbnail and preview derivatives for case images"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help="Check every case, not only those without stored derivatives")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        forms = Forms.objects.exclude(Image='').order_by('CaseID')
+        if not options['all']:
+            forms = forms.filter(DerivativesAt__isnull=True)
+
+        done = failed = 0
+        for form in forms.iterator(chunk_size=options['batch_size']):
+            try:
+                ensure_derivatives(form)
+                done += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"Case {form.CaseID}: {e}")
+
+        if done:
+            invalidate_all()
+        self.stdout.write(self.style.SUCCESS(f"Generated derivatives for {done} cases ({failed} failed)"))
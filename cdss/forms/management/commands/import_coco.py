@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from forms.coco import (
+    IMPORT_BATCH_SIZE, IMPORT_MODEL_ID, create_import_job, find_resumable_job, parse_category_map, run_import,
+)
+from forms.models import ImportJob
+
+
+class Command(BaseCommand):
+    help = "Import cases and pre-annotations from a COCO file, resuming unfinished imports"
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help="Path to the COCO JSON file")
+        parser.add_argument('--images-dir', default='',
+                            help="Directory holding the image files named in the COCO file")
+        parser.add_argument('--category-map',
+                            help="Override label mapping, e.g. '1=negative,2=positive'")
+        parser.add_argument('--model', default='',
+                            help=f"Model id for boxes with a score (default {IMPORT_MODEL_ID!r})")
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+        parser.add_argument('--job', type=int, help="Resume this ImportJob id")
+        parser.add_argument('--restart', action='store_true',
+                            help="Start a new job even if an unfinished one exists for this file")
+
+    def handle(self, *args, **options):
+        try:
+            category_map = parse_category_map(options['category_map']) if options['category_map'] else None
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if options['job']:
+            try:
+                job = ImportJob.objects.get(pk=options['job'])
+            except ImportJob.DoesNotExist:
+                raise CommandError(f"Import job {options['job']} does not exist")
+        else:
+            job = None if options['restart'] else find_resumable_job(options['source'])
+            if job is None:
+                job = create_import_job(options['source'], options['images_dir'], category_map, options['model'])
+            else:
+                self.stdout.write(f"Resuming import job {job.pk} at phase {job.phase}")
+
+        def progress(job):
+            self.stdout.write(
+                f"[{job.phase}] images={job.images_done} annotations={job.annotations_done} "
+                f"skipped={job.annotations_skipped}"
+            )
+
+        try:
+            run_import(job, batch_size=options['batch_size'], progress=progress)
+        except Exception as e:
+            raise CommandError(f"Import job {job.pk} stopped: {e}. Re-run to resume.")
+        self.stdout.write(self.style.SUCCESS(f"Import job {job.pk} finished"))
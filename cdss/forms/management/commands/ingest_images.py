@@ -0,0 +1,31 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from forms.ingest import INGEST_BATCH_SIZE, INGEST_WORKERS, ingest_path
+
+
+class Command(BaseCommand):
+    help = "Create cases from every image in a ZIP archive or directory"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="ZIP archive or directory of images")
+        parser.add_argument('--workers', type=int, default=INGEST_WORKERS)
+        parser.add_argument('--batch-size', type=int, default=INGEST_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if not os.path.exists(options['path']):
+            raise CommandError(f"{options['path']} does not exist")
+
+        counts = {'created': 0, 'invalid': 0, 'failed': 0}
+        results = ingest_path(options['path'], workers=options['workers'], batch_size=options['batch_size'])
+        for result in results:
+            counts[result['status']] += 1
+            if result['status'] == 'created':
+                self.stdout.write(f"{result['name']}: case {result['CaseID']} ({result['PatientID']})")
+            else:
+                self.stderr.write(f"{result['name']}: {result['status']} - {result['error']}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {counts['created']} cases, {counts['invalid']} invalid, {counts['failed']} failed"
+        ))
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from forms.annotations import BOX_BATCH_SIZE, build_bounding_boxes
+from forms.boxpack import box_index_enabled, pack, unpack
+from forms.models import Annotation, BoundingBox
+
+
+class Command(BaseCommand):
+    help = "Backfill Annotation.packed_boxes and manage the optional BoundingBox index"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        index = parser.add_mutually_exclusive_group()
+        index.add_argument('--drop-index', action='store_true',
+                           help="Delete the BoundingBox rows of packed sessions (BOUNDING_BOX_INDEX off)")
+        index.add_argument('--rebuild-index', action='store_true',
+                           help="Recreate missing BoundingBox rows from the packed sessions")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if options['drop_index'] and box_index_enabled():
+            raise CommandError("Set BOUNDING_BOX_INDEX = False before dropping the index")
+
+        packed = 0
+        unpacked = Annotation.objects.filter(packed_boxes__isnull=True).order_by('pk')
+        while True:
+            # Each batch leaves the filter once packed, so always take the first rows
+            batch = list(unpacked.only('pk', 'annotations_data')[:batch_size])
+            if not batch:
+                break
+            for annotation in batch:
+                annotation.packed_boxes = pack((annotation.annotations_data or {}).get('annotations', []))
+            Annotation.objects.bulk_update(batch, ['packed_boxes'])
+            packed += len(batch)
+        self.stdout.write(f"Packed {packed} annotation sessions")
+
+        if options['drop_index']:
+            deleted, _ = BoundingBox.objects.all().delete()
+            self.stdout.write(self.style.SUCCESS(f"Dropped {deleted} BoundingBox rows"))
+        elif options['rebuild_index']:
+            self.rebuild_index(batch_size)
+
+    def rebuild_index(self, batch_size):
+        created = 0
+        missing = Annotation.objects.filter(bounding_boxes__isnull=True).order_by('pk')
+        last = 0
+        while True:
+            batch = list(missing.filter(pk__gt=last).only('pk', 'packed_boxes')[:batch_size])
+            if not batch:
+                break
+            last = batch[-1].pk
+            boxes = []
+            for annotation in batch:
+                boxes.extend(build_bounding_boxes(annotation, unpack(annotation.packed_boxes).to_dicts()))
+            with transaction.atomic():
+                BoundingBox.objects.bulk_create(boxes, batch_size=BOX_BATCH_SIZE)
+            created += len(boxes)
+        self.stdout.write(self.style.SUCCESS(f"Created {created} BoundingBox rows"))
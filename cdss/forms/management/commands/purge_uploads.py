@@ -0,0 +1,26 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from forms.models import UploadSession
+from forms.uploads import discard_upload
+
+
+class Command(BaseCommand):
+    help = "Delete chunked uploads that were never finalized"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=48,
+                            help="Age in hours of the last received chunk (default 48)")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['older_than'])
+        stale = UploadSession.objects.filter(
+            status__in=[UploadSession.UPLOADING, UploadSession.FINALIZING], updated_at__lt=cutoff
+        )
+        count = 0
+        for session in stale.iterator():
+            discard_upload(session)
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f"Discarded {count} unfinished uploads"))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from forms import search
+
+
+class Command(BaseCommand):
+    help = "Recreate the case search triggers and text index and refill them from every case"
+
+    def handle(self, *args, **options):
+        if not search.is_supported():
+            raise CommandError(f"Case search does not support the {connection.vendor} backend")
+        with transaction.atomic():
+            search.install()
+            count = search.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} cases"))
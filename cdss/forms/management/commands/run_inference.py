@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from forms.inference import InferenceService, get_config
+from forms.models import Forms
+
+
+class Command(BaseCommand):
+    help = "Run model inference for pending cases (or the given cases) and wait for it to finish"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', help="Model id from settings.INFERENCE (default model if omitted)")
+        parser.add_argument('--case-ids', help="Comma separated CaseIDs to (re)run")
+        parser.add_argument('--failed', action='store_true', help="Also retry failed cases")
+        parser.add_argument('--workers', type=int, help="Override the number of inference processes")
+
+    def handle(self, *args, **options):
+        forms = Forms.objects.exclude(Image='')
+        if options['case_ids']:
+            forms = forms.filter(CaseID__in=[int(c) for c in options['case_ids'].split(',') if c.strip()])
+        else:
+            # 'running' rows were interrupted by a restart
+            statuses = [Forms.INFERENCE_PENDING, Forms.INFERENCE_RUNNING]
+            if options['failed']:
+                statuses.append(Forms.INFERENCE_FAILED)
+            forms = forms.filter(InferenceStatus__in=statuses)
+        case_ids = list(forms.values_list('CaseID', flat=True))
+        if not case_ids:
+            self.stdout.write("Nothing to do")
+            return
+
+        config = get_config()
+        if options['workers'] is not None:
+            config['WORKERS'] = options['workers']
+        if options['model'] and options['model'] not in config['MODELS']:
+            raise CommandError(f"Unknown model {options['model']}")
+
+        service = InferenceService(config)
+        Forms.objects.filter(CaseID__in=case_ids).update(InferenceStatus=Forms.INFERENCE_PENDING)
+        service.submit(case_ids, options['model'])
+        service.wait()
+        done = Forms.objects.filter(CaseID__in=case_ids, InferenceStatus=Forms.INFERENCE_DONE).count()
+        self.stdout.write(self.style.SUCCESS(f"Ran inference on {done} of {len(case_ids)} cases"))
@@ -0,0 +1,108 @@
+import json
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from forms.benchmark import load_synthetic_dataset
+from forms.inference import get_service
+from forms.stress import DEFAULT_MIX, StressRun, describe_connection
+
+
+class Command(BaseCommand):
+    help = ("Run concurrent uploads, annotation saves, autosaves and reads against a throwaway copy "
+            "of the configured database (see CDSS_DB_ENGINE in settings) and fail on any error, "
+            "such as 'database is locked'. The real database and media are never touched.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16, help="Concurrent client threads")
+        parser.add_argument('--duration', type=float, default=15.0, help="Seconds to run")
+        parser.add_argument('--cases', type=int, default=100, help="Cases in the database before the run")
+        parser.add_argument('--boxes', type=int, default=5, help="Boxes per case and per saved session")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--mix', help="Weights per operation, e.g. 'autosave=5,case_detail=1' "
+                                          f"(operations: {', '.join(DEFAULT_MIX)})")
+        parser.add_argument('--stock-sqlite', action='store_true',
+                            help="Drop the SQLite tuning (WAL, busy timeout, IMMEDIATE transactions) "
+                                 "to compare against Django's defaults")
+        parser.add_argument('--save', metavar='PATH', help="Write the results as JSON to PATH")
+        parser.add_argument('--keepdb', action='store_true',
+                            help="Keep the stress database afterwards (on SQLite, the test database file)")
+
+    def handle(self, *args, **options):
+        mix = self.parse_mix(options['mix']) if options['mix'] else None
+        if options['stock_sqlite'] and connection.vendor != 'sqlite':
+            raise CommandError("--stock-sqlite only applies to CDSS_DB_ENGINE=sqlite")
+
+        settings_dict = connection.settings_dict
+        old_options = settings_dict.get('OPTIONS', {})
+        with tempfile.TemporaryDirectory(prefix='cdss-stress-') as workdir:
+            test_settings = settings_dict.setdefault('TEST', {})
+            if connection.vendor == 'sqlite' and not options['keepdb']:
+                # A file of its own, apart from the test suite's, that every thread opens
+                test_settings['NAME'] = os.path.join(workdir, 'stress.sqlite3')
+            if options['stock_sqlite']:
+                # Thread connections are built from this same dict, so they all pick it up
+                settings_dict['OPTIONS'] = {}
+            old_name = connection.creation.create_test_db(
+                verbosity=0, autoclobber=True, serialize=False, keepdb=options['keepdb']
+            )
+            response_cache = {**getattr(settings, 'RESPONSE_CACHE', {}), 'ENABLED': False}
+            try:
+                with override_settings(MEDIA_ROOT=os.path.join(workdir, 'media'),
+                                       RESPONSE_CACHE=response_cache, ALLOWED_HOSTS=['testserver']):
+                    results = self.run(workdir, options, mix)
+            finally:
+                get_service().wait(60)
+                connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+                settings_dict['OPTIONS'] = old_options
+
+        if options['save']:
+            with open(options['save'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f"Results written to {options['save']}")
+
+        if results['failures']:
+            for failure in results['failures']:
+                self.stdout.write(self.style.ERROR(
+                    f"{failure['operation']}: {failure['error']} (x{failure['count']})"
+                ))
+            raise CommandError(f"{sum(f['count'] for f in results['failures'])} of "
+                               f"{results['requests']} requests failed")
+        self.stdout.write(self.style.SUCCESS(f"{results['requests']} requests, no errors"))
+
+    def parse_mix(self, value):
+        mix = {}
+        for part in value.split(','):
+            name, _, weight = part.partition('=')
+            name = name.strip()
+            if name not in DEFAULT_MIX:
+                raise CommandError(f"Unknown operation {name!r}")
+            try:
+                mix[name] = float(weight) if weight else 1.0
+            except ValueError:
+                raise CommandError(f"Invalid weight for {name}: {weight!r}")
+        return mix
+
+    def run(self, workdir, options, mix):
+        self.stdout.write(f"Generating {options['cases']} cases with {options['boxes']} boxes each...")
+        load_synthetic_dataset(workdir, options['cases'], options['boxes'], options['seed'])
+        described = describe_connection()
+        self.stdout.write(', '.join(f'{key}={value}' for key, value in described.items()))
+
+        self.stdout.write(f"Running {options['threads']} threads for {options['duration']:g}s...")
+        results = StressRun(options['threads'], options['duration'], options['boxes'],
+                            options['seed'], mix).run()
+        results['database'] = described
+
+        self.stdout.write(f"{'operation':<18}{'requests':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'errors':>8}")
+        for name, operation in results['operations'].items():
+            self.stdout.write(
+                f"{name:<18}{operation['requests']:>9}{operation['p50_ms']:>9.1f}{operation['p95_ms']:>9.1f}"
+                f"{operation['p99_ms']:>9.1f}{operation['max_ms']:>9.1f}{operation['errors']:>8}"
+            )
+        self.stdout.write(f"Latencies in ms; {results['throughput_rps']:.1f} requests/s overall")
+        return results
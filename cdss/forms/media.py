@@ -0,0 +1,180 @@
+# forms/media.py
+"""Serving of uploaded media (MEDIA_ROOT) with HTTP caching support.
+
+Files are streamed with FileResponse, which hands the file object to the
+server's wsgi.file_wrapper (sendfile on gunicorn/uWSGI). Strong ETags are
+derived from the file content without reading it where the hash is known:
+derivatives are named by it and case images have it in Forms.ImageHash.
+If-None-Match is answered with 304, single byte ranges are honoured, and
+content-hashed derivatives are marked immutable so browsers never
+revalidate them.
+"""
+import hashlib
+import mimetypes
+import os
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotAllowed, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.http import http_date
+
+from forms.models import Forms
+
+IMMUTABLE_PREFIXES = ('derivatives/',)
+UPLOAD_PREFIX = 'uploads/'  # Case images, uploads/<PatientID>/<name> (forms.models.get_upload_path)
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+DEFAULT_CACHE_CONTROL = 'public, max-age=3600'
+STREAM_BLOCK_SIZE = 64 * 1024
+HASHED_NAME_RE = re.compile(r'^([0-9a-f]{64})_')
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+@lru_cache(maxsize=4096)
+def _content_hash(path, mtime_ns, size):
+    # mtime and size are part of the cache key so a replaced file is rehashed
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(STREAM_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def case_image_hash(relative_path):
+    """Forms.ImageHash of the case image stored at relative_path, if recorded.
+
+    Found through the PatientID in the path, which is indexed; copies of the
+    image linked by forms.duplicates share the first case's file and path.
+    """
+    if not relative_path.startswith(UPLOAD_PREFIX):
+        return None
+    patient_id = relative_path[len(UPLOAD_PREFIX):].partition('/')[0]
+    return (Forms.objects.filter(PatientID=patient_id, Image=relative_path)
+            .exclude(ImageHash='').values_list('ImageHash', flat=True).first())
+
+
+def file_etag(relative_path, full_path, stat):
+    """Strong ETag for a media file, without reading files whose hash is known."""
+    name = os.path.basename(relative_path)
+    match = HASHED_NAME_RE.match(name)
+    if relative_path.startswith(IMMUTABLE_PREFIXES) and match:
+        return f'"{name}"'
+    image_hash = case_image_hash(relative_path)
+    if image_hash:
+        return f'"{image_hash}"'
+    return f'"{_content_hash(full_path, stat.st_mtime_ns, stat.st_size)}"'
+
+
+def etag_matches(header, etag):
+    """Weak comparison used by If-None-Match (RFC 9110 13.1.2)."""
+    if header.strip() == '*':
+        return True
+    candidates = [tag.strip() for tag in header.split(',')]
+    return any(tag.removeprefix('W/') == etag for tag in candidates)
+
+
+def parse_range(header, size):
+    """Return (start, end) inclusive for a single byte range, None to ignore it.
+
+    Raises ValueError when the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        # Multiple or malformed ranges: serving the full file is allowed
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError('Range not satisfiable')
+    return start, end
+
+
+def _iter_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            block = f.read(min(STREAM_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+def serve_media(request, path):
+    """Serve a file from MEDIA_ROOT with ETag, Range and Cache-Control support"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except (SuspiciousFileOperation, ValueError):
+        raise Http404('Invalid path')
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        raise Http404('File not found')
+    if not os.path.isfile(full_path):
+        raise Http404('File not found')
+
+    relative_path = path.replace('\\', '/')
+    etag = file_etag(relative_path, full_path, stat)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': (IMMUTABLE_CACHE_CONTROL if relative_path.startswith(IMMUTABLE_PREFIXES)
+                          else DEFAULT_CACHE_CONTROL),
+    }
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and etag_matches(if_none_match, etag):
+        response = HttpResponse(status=304)
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    size = stat.st_size
+    byte_range = None
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    # If-Range with a different validator means the client's copy is stale
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    if byte_range:
+        start, end = byte_range
+        length = end - start + 1
+        if request.method == 'HEAD':
+            response = HttpResponse(status=206, content_type=content_type)
+        else:
+            response = StreamingHttpResponse(
+                _iter_range(full_path, start, length), status=206, content_type=content_type
+            )
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(length)
+    elif request.method == 'HEAD':
+        response = HttpResponse(content_type=content_type)
+        response['Content-Length'] = str(size)
+    else:
+        response = FileResponse(open(full_path, 'rb'), content_type=content_type)
+
+    for header, value in headers.items():
+        response[header] = value
+    return response
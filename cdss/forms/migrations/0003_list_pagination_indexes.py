@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:52
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0002_caseimage_annotation_boundingbox'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='annotation',
+            index=models.Index(fields=['case_image', '-created_at'], name='annotations_latest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='forms',
+            index=models.Index(fields=['-Date', '-CaseID'], name='forms_date_caseid_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0003_list_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='caseimage',
+            name='diagnosis',
+            field=models.CharField(default='Not Annotated', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='caseimage',
+            name='latest_annotation',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='forms.annotation'),
+        ),
+        migrations.AddField(
+            model_name='caseimage',
+            name='negative_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='caseimage',
+            name='positive_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:57
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0004_caseimage_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=500)),
+                ('source_size', models.BigIntegerField(default=0)),
+                ('images_dir', models.CharField(blank=True, max_length=500)),
+                ('category_map', models.JSONField(blank=True, default=dict)),
+                ('phase', models.CharField(default='images', max_length=20)),
+                ('images_done', models.IntegerField(default=0)),
+                ('annotations_done', models.IntegerField(default=0)),
+                ('annotations_skipped', models.IntegerField(default=0)),
+                ('finalized_upto', models.BigIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'import_jobs',
+            },
+        ),
+        migrations.CreateModel(
+            name='ImportedImage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_image_id', models.BigIntegerField()),
+                ('width', models.IntegerField(blank=True, null=True)),
+                ('height', models.IntegerField(blank=True, null=True)),
+                ('annotation', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='forms.annotation')),
+                ('case_image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='forms.caseimage')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='images', to='forms.importjob')),
+            ],
+            options={
+                'db_table': 'imported_images',
+                'unique_together': {('job', 'source_image_id')},
+            },
+        ),
+    ]
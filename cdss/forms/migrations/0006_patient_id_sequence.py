@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0005_coco_import_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientIDSequence',
+            fields=[
+                ('period', models.CharField(max_length=7, primary_key=True, serialize=False)),
+                ('last_value', models.IntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'patient_id_sequences',
+            },
+        ),
+    ]
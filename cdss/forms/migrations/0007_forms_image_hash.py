@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 18:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0006_patient_id_sequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='forms',
+            name='ImageHash',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0008_upload_sessions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotation',
+            name='source',
+            field=models.CharField(choices=[('doctor', 'Doctor'), ('model', 'Model')], default='doctor', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='forms',
+            name='InferenceStatus',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0009_inference_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='forms',
+            name='ImagePHash',
+            field=models.CharField(blank=True, db_index=True, max_length=16),
+        ),
+        migrations.CreateModel(
+            name='PredictionCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image_hash', models.CharField(max_length=64)),
+                ('model_id', models.CharField(max_length=50)),
+                ('model_version', models.CharField(max_length=50)),
+                ('predictions', models.JSONField()),
+                ('hits', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'db_table': 'prediction_cache',
+                'unique_together': {('image_hash', 'model_id', 'model_version')},
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0010_prediction_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='forms',
+            name='DuplicateDistance',
+            field=models.SmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='forms',
+            name='DuplicateOf',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='duplicates', to='forms.forms'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0011_duplicate_links'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EvaluationRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_id', models.CharField(db_index=True, max_length=50)),
+                ('full', models.BooleanField(default=False)),
+                ('cases_total', models.IntegerField(default=0)),
+                ('cases_evaluated', models.IntegerField(default=0)),
+                ('cases_removed', models.IntegerField(default=0)),
+                ('report', models.JSONField(default=dict)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'evaluation_runs',
+            },
+        ),
+        migrations.CreateModel(
+            name='CaseEvaluation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_id', models.CharField(max_length=50)),
+                ('signature', models.CharField(max_length=50)),
+                ('matches', models.JSONField(default=dict)),
+                ('label_stats', models.JSONField(default=dict)),
+                ('confusion', models.JSONField(default=list)),
+                ('evaluated_at', models.DateTimeField(auto_now=True)),
+                ('case_image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='evaluations', to='forms.caseimage')),
+                ('ground_truth', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='forms.annotation')),
+                ('prediction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='forms.annotation')),
+            ],
+            options={
+                'db_table': 'case_evaluations',
+                'unique_together': {('case_image', 'model_id')},
+            },
+        ),
+    ]
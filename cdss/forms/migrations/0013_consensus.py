@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:26
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0012_evaluation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConsensusAnnotation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sessions', models.JSONField(default=list)),
+                ('raters', models.IntegerField(default=0)),
+                ('ratings', models.JSONField(default=dict)),
+                ('diagnosis', models.CharField(default='Not Annotated', max_length=20)),
+                ('diagnosis_agreement', models.FloatField(blank=True, null=True)),
+                ('boxes', models.JSONField(default=list)),
+                ('box_agreement', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('case_image', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='consensus', to='forms.caseimage')),
+            ],
+            options={
+                'db_table': 'consensus_annotations',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0013_consensus'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotation',
+            name='packed_boxes',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
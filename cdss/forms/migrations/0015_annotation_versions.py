@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0014_packed_boxes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='annotation',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.CreateModel(
+            name='AnnotationVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('delta', models.JSONField(default=dict)),
+                ('box_count', models.IntegerField(default=0)),
+                ('autosave', models.BooleanField(default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('annotation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='forms.annotation')),
+            ],
+            options={
+                'db_table': 'annotation_versions',
+                'unique_together': {('annotation', 'number')},
+            },
+        ),
+    ]
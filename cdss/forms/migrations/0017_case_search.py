@@ -0,0 +1,207 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# The text index and triggers as they were when this migration was written.
+# They are frozen here rather than taken from forms.search, which keeps
+# changing; install() there recreates the current ones.
+DOCUMENT_COLUMNS = 'case_id, patient_id, date, month, diagnosis, prediction, confidence, status, image_name'
+TEXT_COLUMNS = 'case_id, patient_id, image_name, diagnosis, prediction, status'
+DOCUMENT_SELECT = """
+    SELECT f."CaseID", f."PatientID", f."Date", {month},
+           COALESCE(c.diagnosis, 'Not Annotated'), f."Diagnosis", f."Confidence",
+           COALESCE(c.status, 'uploaded'), COALESCE(c.image_name, '')
+    FROM forms_forms f LEFT JOIN case_images c ON c.case_id = CAST(f."CaseID" AS TEXT)
+    {where}
+"""
+MONTH_EXPRESSIONS = {'sqlite': """strftime('%Y-%m', f."Date")""", 'postgresql': """to_char(f."Date", 'YYYY-MM')"""}
+
+
+def sqlite_refresh(key):
+    select = DOCUMENT_SELECT.format(month=MONTH_EXPRESSIONS['sqlite'], where=f'WHERE f."CaseID" = {key}')
+    return f"DELETE FROM case_search WHERE case_id = {key}; INSERT INTO case_search ({DOCUMENT_COLUMNS}) {select};"
+
+
+def sqlite_schema():
+    new = ', '.join(f'NEW.{column}' for column in TEXT_COLUMNS.split(', '))
+    old = ', '.join(f'OLD.{column}' for column in TEXT_COLUMNS.split(', '))
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS case_search_fts USING fts5(
+            {TEXT_COLUMNS}, content='case_search', content_rowid='case_id',
+            prefix='2 3', tokenize='unicode61 remove_diacritics 2')""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_fts_insert AFTER INSERT ON case_search BEGIN
+            INSERT INTO case_search_fts (rowid, {TEXT_COLUMNS}) VALUES (NEW.case_id, {new});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_fts_delete AFTER DELETE ON case_search BEGIN
+            INSERT INTO case_search_fts (case_search_fts, rowid, {TEXT_COLUMNS}) VALUES ('delete', OLD.case_id, {old});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_fts_update AFTER UPDATE ON case_search BEGIN
+            INSERT INTO case_search_fts (case_search_fts, rowid, {TEXT_COLUMNS}) VALUES ('delete', OLD.case_id, {old});
+            INSERT INTO case_search_fts (rowid, {TEXT_COLUMNS}) VALUES (NEW.case_id, {new});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_forms_insert AFTER INSERT ON forms_forms BEGIN
+            {sqlite_refresh('NEW."CaseID"')}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_forms_update
+            AFTER UPDATE OF "PatientID", "Date", "Diagnosis", "Confidence" ON forms_forms BEGIN
+            {sqlite_refresh('NEW."CaseID"')}
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS case_search_forms_delete AFTER DELETE ON forms_forms BEGIN
+            DELETE FROM case_search WHERE case_id = OLD."CaseID";
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_images_insert AFTER INSERT ON case_images BEGIN
+            {sqlite_refresh('CAST(NEW.case_id AS INTEGER)')}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_images_update
+            AFTER UPDATE OF case_id, image_name, status, diagnosis ON case_images BEGIN
+            {sqlite_refresh('CAST(OLD.case_id AS INTEGER)')}
+            {sqlite_refresh('CAST(NEW.case_id AS INTEGER)')}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_images_delete AFTER DELETE ON case_images BEGIN
+            {sqlite_refresh('CAST(OLD.case_id AS INTEGER)')}
+        END""",
+    ]
+
+
+def postgresql_schema():
+    document = "case_id::text || ' ' || patient_id || ' ' || image_name || ' ' || diagnosis || ' ' || prediction || ' ' || status"
+    select = DOCUMENT_SELECT.format(month=MONTH_EXPRESSIONS['postgresql'], where='WHERE f."CaseID" = key')
+    return [
+        f"""ALTER TABLE case_search ADD COLUMN IF NOT EXISTS document tsvector
+            GENERATED ALWAYS AS (to_tsvector('simple', {document})) STORED""",
+        "CREATE INDEX IF NOT EXISTS case_search_document_idx ON case_search USING GIN (document)",
+        f"""CREATE OR REPLACE FUNCTION refresh_case_search(key integer) RETURNS void AS $$
+        BEGIN
+            DELETE FROM case_search WHERE case_id = key;
+            INSERT INTO case_search ({DOCUMENT_COLUMNS}) {select};
+        END $$ LANGUAGE plpgsql""",
+        """CREATE OR REPLACE FUNCTION case_search_forms_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM case_search WHERE case_id = OLD."CaseID";
+            ELSE
+                PERFORM refresh_case_search(NEW."CaseID");
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        """CREATE OR REPLACE FUNCTION case_search_images_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' AND OLD.case_id ~ '^[0-9]{1,9}$' THEN
+                PERFORM refresh_case_search(OLD.case_id::integer);
+            END IF;
+            IF TG_OP <> 'DELETE' AND NEW.case_id ~ '^[0-9]{1,9}$' THEN
+                PERFORM refresh_case_search(NEW.case_id::integer);
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS case_search_forms ON forms_forms",
+        """CREATE TRIGGER case_search_forms
+            AFTER INSERT OR DELETE OR UPDATE OF "PatientID", "Date", "Diagnosis", "Confidence" ON forms_forms
+            FOR EACH ROW EXECUTE FUNCTION case_search_forms_changed()""",
+        "DROP TRIGGER IF EXISTS case_search_images ON case_images",
+        """CREATE TRIGGER case_search_images
+            AFTER INSERT OR DELETE OR UPDATE OF case_id, image_name, status, diagnosis ON case_images
+            FOR EACH ROW EXECUTE FUNCTION case_search_images_changed()""",
+    ]
+
+
+SCHEMAS = {'sqlite': sqlite_schema, 'postgresql': postgresql_schema}
+TEARDOWN = {
+    'sqlite': [
+        *(f'DROP TRIGGER IF EXISTS case_search_{name}' for name in (
+            'fts_insert', 'fts_delete', 'fts_update', 'forms_insert', 'forms_update', 'forms_delete',
+            'images_insert', 'images_update', 'images_delete',
+        )),
+        'DROP TABLE IF EXISTS case_search_fts',
+    ],
+    'postgresql': [
+        'DROP TRIGGER IF EXISTS case_search_forms ON forms_forms',
+        'DROP TRIGGER IF EXISTS case_search_images ON case_images',
+        'DROP FUNCTION IF EXISTS case_search_forms_changed(), case_search_images_changed(), '
+        'refresh_case_search(integer)',
+        'ALTER TABLE case_search DROP COLUMN IF EXISTS document',
+    ],
+}
+
+
+def install_search(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor not in SCHEMAS:
+        return
+    for statement in SCHEMAS[vendor]():
+        schema_editor.execute(statement, params=None)
+    select = DOCUMENT_SELECT.format(month=MONTH_EXPRESSIONS[vendor], where='')
+    schema_editor.execute(f'INSERT INTO case_search ({DOCUMENT_COLUMNS}) {select}', params=None)
+
+
+def uninstall_search(apps, schema_editor):
+    for statement in TEARDOWN.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement, params=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0016_annotation_updated_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CaseSearch',
+            fields=[
+                ('case_id', models.IntegerField(primary_key=True, serialize=False)),
+                ('patient_id', models.CharField(max_length=20)),
+                ('date', models.DateField()),
+                ('month', models.CharField(max_length=7)),
+                ('diagnosis', models.CharField(max_length=20)),
+                ('prediction', models.CharField(max_length=255)),
+                ('confidence', models.CharField(max_length=10)),
+                ('status', models.CharField(max_length=20)),
+                ('image_name', models.CharField(max_length=255)),
+            ],
+            options={
+                'db_table': 'case_search',
+            },
+        ),
+        migrations.RemoveIndex(
+            model_name='annotation',
+            name='annotations_latest_idx',
+        ),
+        migrations.AddIndex(
+            model_name='annotation',
+            index=models.Index(fields=['case_image', 'source', '-created_at'], name='annotations_latest_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='caseimage',
+            index=models.Index(fields=['status', '-uploaded_at'], name='case_images_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='caseimage',
+            index=models.Index(fields=['diagnosis', '-uploaded_at'], name='case_images_diagnosis_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='caseimage',
+            index=models.Index(fields=['patient_id'], name='case_images_patient_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='casesearch',
+            index=models.Index(fields=['-date', '-case_id'], name='case_search_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='casesearch',
+            index=models.Index(fields=['diagnosis', '-date', '-case_id'], name='case_search_diagnosis_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='casesearch',
+            index=models.Index(fields=['status', '-date', '-case_id'], name='case_search_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='casesearch',
+            index=models.Index(fields=['month', 'diagnosis', 'status'], name='case_search_month_idx'),
+        ),
+        # Text index and the triggers that keep case_search in step (forms.search)
+        migrations.RunPython(install_search, uninstall_search),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0017_case_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='caseimage',
+            name='height',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='caseimage',
+            name='width',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
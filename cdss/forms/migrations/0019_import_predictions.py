@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 20:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forms', '0018_caseimage_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importedimage',
+            name='prediction',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='forms.annotation'),
+        ),
+        migrations.AddField(
+            model_name='importjob',
+            name='model_id',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+    ]
@@ -1,11 +1,64 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 import json
 from datetime import datetime
 
+NOT_ANNOTATED = 'Not Annotated'
+DIAGNOSIS_CHOICES = ('Positive', 'Negative', NOT_ANNOTATED)
+
 def get_upload_path(instance, filename):
     return f'uploads/{instance.PatientID}/{filename}'
 
+def count_labels(annotations):
+    """Returns (total, positive, negative) for a list of frontend box dicts."""
+    positive = negative = 0
+    for annotation in annotations:
+        label = annotation.get('label')
+        if label == 'positive':
+            positive += 1
+        elif label == 'negative':
+            negative += 1
+    return len(annotations), positive, negative
+
+def diagnosis_from_counts(positive_count, negative_count):
+    """Diagnosis of an annotation session given its box counts."""
+    if positive_count:
+        return 'Positive'
+    if negative_count:
+        return 'Negative'
+    return NOT_ANNOTATED
+
+class PatientIDSequence(models.Model):
+    """Per-month counter behind Forms.PatientID ("YYYY-MM-NNNNNN")"""
+    period = models.CharField(max_length=7, primary_key=True)  # YYYY-MM
+    last_value = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'patient_id_sequences'
+
+    def __str__(self):
+        return f"{self.period}: {self.last_value}"
+
+    @classmethod
+    def allocate(cls, period, count=1):
+        """Atomically advance the counter for `period` by `count` and return the new last value.
+
+        The UPDATE takes a row lock (a write lock on SQLite) until the
+        transaction commits, so concurrent uploads are serialized on this one
+        row instead of racing on the Forms unique constraint.
+        """
+        with transaction.atomic():
+            if not cls.objects.filter(period=period).update(last_value=models.F('last_value') + count):
+                # First upload of the month: seed from any PatientIDs issued before
+                # the counter existed. get_or_create absorbs a concurrent insert.
+                last_issued = Forms.objects.filter(
+                    PatientID__startswith=f"{period}-"
+                ).aggregate(last=models.Max('PatientID'))['last']
+                seed = int(last_issued.rsplit('-', 1)[1]) if last_issued else 0
+                cls.objects.get_or_create(period=period, defaults={'last_value': seed})
+                cls.objects.filter(period=period).update(last_value=models.F('last_value') + count)
+            return cls.objects.filter(period=period).values_list('last_value', flat=True).get()
+
 class Forms(models.Model):
     CaseID = models.AutoField(primary_key=True)
     PatientID = models.CharField(max_length=20, unique=True, editable=False)
@@ -13,18 +66,38 @@ class Forms(models.Model):
     Diagnosis = models.CharField(max_length=255, blank=True)
     Confidence = models.CharField(max_length=10, blank=True)
     Image = models.ImageField(upload_to=get_upload_path)
+    ImageHash = models.CharField(max_length=64, blank=True, db_index=True)  # SHA-256 of Image
+    ImagePHash = models.CharField(max_length=16, blank=True, db_index=True)  # dHash of Image, see forms.hashing
+    DuplicateOf = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL,
+                                    related_name='duplicates')  # Earliest case with the same image, see forms.duplicates
+    DuplicateDistance = models.SmallIntegerField(null=True, blank=True)  # dHash bits differing from DuplicateOf
+    DerivativesAt = models.DateTimeField(null=True, blank=True)  # When every derivative was stored, see forms.derivatives
+    # Model prediction progress, see forms.inference; blank when never requested
+    InferenceStatus = models.CharField(max_length=10, blank=True)
+
+    INFERENCE_PENDING = 'pending'
+    INFERENCE_RUNNING = 'running'
+    INFERENCE_DONE = 'done'
+    INFERENCE_FAILED = 'failed'
+
+    class Meta:
+        indexes = [
+            # Keyset pagination order used by /list/
+            models.Index(fields=['-Date', '-CaseID'], name='forms_date_caseid_idx'),
+        ]
+
+    @classmethod
+    def allocate_patient_ids(cls, count):
+        """Reserve `count` consecutive PatientIDs for the current month."""
+        now = datetime.now()
+        period = f"{now.year}-{now.month:02}"
+        last = PatientIDSequence.allocate(period, count)
+        return [f"{period}-{n:06d}" for n in range(last - count + 1, last + 1)]
 
     def save(self, *args, **kwargs):
         if not self.PatientID:
-            now = datetime.now()
-            count = Forms.objects.filter(
-                PatientID__startswith=f"{now.year}-{now.month:02}"
-            ).count() + 1
-            self.PatientID = f"{now.year}-{now.month:02}-{count:06d}"
-        if not self.Diagnosis:
-            self.Diagnosis = "Cancer"  # simulate script.py
-        if not self.Confidence:
-            self.Confidence = "90%"  # simulate script.py
+            self.PatientID, = Forms.allocate_patient_ids(1)
+        # Diagnosis and Confidence are filled in by forms.inference
         super().save(*args, **kwargs)
 class CaseImage(models.Model):
     case_id = models.CharField(max_length=50, unique=True)
@@ -33,26 +106,92 @@ class CaseImage(models.Model):
     image_path = models.CharField(max_length=500, null=True, blank=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=20, default='uploaded')
+    # Pixel size after EXIF orientation, what relative box coordinates refer to (forms.dimensions)
+    width = models.IntegerField(null=True, blank=True)
+    height = models.IntegerField(null=True, blank=True)
+    # Denormalized summary of the latest annotation session, kept in sync by
+    # refresh_summary() whenever annotations are written or deleted
+    latest_annotation = models.ForeignKey(
+        'Annotation', on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    diagnosis = models.CharField(max_length=20, default=NOT_ANNOTATED)
+    positive_count = models.IntegerField(default=0)
+    negative_count = models.IntegerField(default=0)
     
     class Meta:
         db_table = 'case_images'
+        indexes = [
+            # /api/annotations/list/ and the export filters, newest first
+            models.Index(fields=['status', '-uploaded_at'], name='case_images_status_idx'),
+            models.Index(fields=['diagnosis', '-uploaded_at'], name='case_images_diagnosis_idx'),
+            models.Index(fields=['patient_id'], name='case_images_patient_idx'),
+        ]
         
     def __str__(self):
         return f"Case {self.case_id} - {self.image_name}"
 
+    def compute_summary(self):
+        """Recompute the latest annotation summary from the stored rows."""
+        latest_annotation = self.annotations.filter(
+            source=Annotation.DOCTOR
+        ).order_by('-created_at', '-id').first()
+        positive_count = negative_count = 0
+        if latest_annotation:
+            from forms.boxpack import load_packed
+            packed = load_packed([latest_annotation.pk])[latest_annotation.pk]
+            positive_count = int(packed.positive.sum())
+            negative_count = len(packed) - positive_count
+        return {
+            'latest_annotation': latest_annotation,
+            'diagnosis': diagnosis_from_counts(positive_count, negative_count),
+            'positive_count': positive_count,
+            'negative_count': negative_count,
+        }
+
+    def set_latest_annotation(self, annotation):
+        """Point the summary at a just-written annotation using its stored counts."""
+        self.latest_annotation = annotation
+        self.positive_count = annotation.positive_count
+        self.negative_count = annotation.negative_count
+        self.diagnosis = diagnosis_from_counts(self.positive_count, self.negative_count)
+
+    def refresh_summary(self, save=True):
+        """Update the denormalized summary fields; call inside the write transaction."""
+        for field, value in self.compute_summary().items():
+            setattr(self, field, value)
+        if save:
+            self.save(update_fields=['latest_annotation', 'diagnosis',
+                                     'positive_count', 'negative_count'])
+
 class Annotation(models.Model):
+    DOCTOR = 'doctor'
+    MODEL = 'model'
+
     case_image = models.ForeignKey(CaseImage, on_delete=models.CASCADE, related_name='annotations')
     annotation_id = models.CharField(max_length=100, unique=True)
     annotations_data = models.JSONField()  # Store all bounding boxes as JSON
+    # The same boxes as packed float32 columns plus a label bitmap (forms.boxpack)
+    packed_boxes = models.BinaryField(null=True, blank=True, editable=False)
     total_annotations = models.IntegerField(default=0)
     positive_count = models.IntegerField(default=0)
     negative_count = models.IntegerField(default=0)
     annotated_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    # Model predictions are kept as sessions too but never count as the diagnosis
+    source = models.CharField(max_length=10, default=DOCTOR,
+                              choices=[(DOCTOR, 'Doctor'), (MODEL, 'Model')])
+    # Head version of the session; earlier versions are rebuilt from AnnotationVersion deltas
+    version = models.PositiveIntegerField(default=1)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         db_table = 'annotations'
+        indexes = [
+            # Latest session of a source per case image
+            models.Index(fields=['case_image', 'source', '-created_at'], name='annotations_latest_idx'),
+            # Sessions changed since the spatial index last synced (forms.spatial)
+            models.Index(fields=['updated_at'], name='annotations_updated_idx'),
+        ]
         
     def __str__(self):
         return f"Annotation for Case {self.case_image.case_id}"
@@ -60,14 +199,42 @@ class Annotation(models.Model):
     def save(self, *args, **kwargs):
         # Auto-calculate counts when saving
         if self.annotations_data:
-            annotations = self.annotations_data.get('annotations', [])
-            self.total_annotations = len(annotations)
-            self.positive_count = len([a for a in annotations if a.get('label') == 'positive'])
-            self.negative_count = len([a for a in annotations if a.get('label') == 'negative'])
+            self.total_annotations, self.positive_count, self.negative_count = count_labels(
+                self.annotations_data.get('annotations', [])
+            )
         super().save(*args, **kwargs)
 
+class AnnotationVersion(models.Model):
+    """Change from version number - 1 to number of an annotation session (see forms.versions)"""
+    annotation = models.ForeignKey(Annotation, on_delete=models.CASCADE, related_name='versions')
+    number = models.PositiveIntegerField()
+    # {'added': [box], 'removed': [box], 'modified': [[old box, new box]]}, enough to go either way
+    delta = models.JSONField(default=dict)
+    box_count = models.IntegerField(default=0)  # Boxes in the session at this version
+    autosave = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'annotation_versions'
+        unique_together = ['annotation', 'number']
+
+    def __str__(self):
+        return f"{self.annotation_id} v{self.number}"
+
+class DeletedAnnotation(models.Model):
+    """Tombstone of a deleted Annotation, read by the spatial index of every process (see forms.spatial)"""
+    annotation_pk = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        db_table = 'deleted_annotations'
+
+    def __str__(self):
+        return f"Annotation {self.annotation_pk} deleted {self.deleted_at}"
+
 class BoundingBox(models.Model):
-    """Individual bounding box model (alternative to JSON storage)"""
+    """Queryable per-box index of Annotation.packed_boxes, kept while settings.BOUNDING_BOX_INDEX is on"""
     annotation = models.ForeignKey(Annotation, on_delete=models.CASCADE, related_name='bounding_boxes')
     box_id = models.IntegerField()  # ID within the annotation
     x = models.FloatField()
@@ -86,4 +253,169 @@ class BoundingBox(models.Model):
         unique_together = ['annotation', 'box_id']
         
     def __str__(self):
-        return f"Box {self.box_id} - {self.label}"
\ No newline at end of file
+        return f"Box {self.box_id} - {self.label}"
+
+class ImportJob(models.Model):
+    """Progress checkpoint for a COCO dataset import (see forms.coco)"""
+    PHASES = ['images', 'annotations', 'finalize', 'done']
+
+    source = models.CharField(max_length=500)
+    source_size = models.BigIntegerField(default=0)
+    images_dir = models.CharField(max_length=500, blank=True)
+    category_map = models.JSONField(default=dict, blank=True)  # COCO category id -> label
+    model_id = models.CharField(max_length=50, blank=True)  # Model named on sessions of scored boxes
+    phase = models.CharField(max_length=20, default='images')
+    images_done = models.IntegerField(default=0)
+    annotations_done = models.IntegerField(default=0)
+    annotations_skipped = models.IntegerField(default=0)
+    finalized_upto = models.BigIntegerField(default=0)  # last ImportedImage pk finalized
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'import_jobs'
+
+    def __str__(self):
+        return f"Import {self.pk} ({self.phase}) - {self.source}"
+
+class ImportedImage(models.Model):
+    """Maps a COCO image id of an import job to the case created for it"""
+    job = models.ForeignKey(ImportJob, on_delete=models.CASCADE, related_name='images')
+    source_image_id = models.BigIntegerField()
+    case_image = models.ForeignKey(CaseImage, on_delete=models.CASCADE, related_name='+')
+    annotation = models.ForeignKey(Annotation, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    # Model session for boxes that carry a score, kept apart from the ground truth
+    prediction = models.ForeignKey(Annotation, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    width = models.IntegerField(null=True, blank=True)
+    height = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'imported_images'
+        unique_together = ['job', 'source_image_id']
+
+class UploadSession(models.Model):
+    """State of a resumable chunked image upload (see forms.uploads)"""
+    UPLOADING = 'uploading'
+    FINALIZING = 'finalizing'  # Case being created from the parts, see forms.uploads.finalize_upload
+    COMPLETE = 'complete'
+
+    upload_id = models.UUIDField(unique=True)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64, blank=True)  # Expected digest of the whole file
+    offset = models.BigIntegerField(default=0)  # Bytes received so far
+    parts = models.JSONField(default=list)  # Storage names of the received chunks, in order
+    status = models.CharField(max_length=20, default=UPLOADING)
+    form = models.ForeignKey(Forms, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'upload_sessions'
+
+    def __str__(self):
+        return f"Upload {self.upload_id} ({self.offset}/{self.size})"
+
+class PredictionCache(models.Model):
+    """Model output for an image, keyed by content hash and model version"""
+    image_hash = models.CharField(max_length=64)
+    model_id = models.CharField(max_length=50)
+    model_version = models.CharField(max_length=50)
+    predictions = models.JSONField()  # {'width', 'height', 'boxes'}
+    hits = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        db_table = 'prediction_cache'
+        unique_together = ['image_hash', 'model_id', 'model_version']
+
+    def __str__(self):
+        return f"{self.model_id}@{self.model_version} {self.image_hash[:12]}"
+
+
+class ConsensusAnnotation(models.Model):
+    """Fused box set and agreement of all doctor sessions of a case (see forms.consensus)"""
+    case_image = models.OneToOneField(CaseImage, on_delete=models.CASCADE, related_name='consensus')
+    sessions = models.JSONField(default=list)  # Annotation pks fused, oldest first
+    raters = models.IntegerField(default=0)
+    ratings = models.JSONField(default=dict)  # rater key -> diagnosis of that rater's session
+    diagnosis = models.CharField(max_length=20, default=NOT_ANNOTATED)
+    diagnosis_agreement = models.FloatField(null=True, blank=True)  # Share of raters agreeing with the majority
+    boxes = models.JSONField(default=list)  # Frontend box dicts plus 'support' and 'labelAgreement'
+    box_agreement = models.JSONField(default=dict)  # Pairwise matching summary across raters
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'consensus_annotations'
+
+    def __str__(self):
+        return f"Consensus for {self.case_image_id} ({self.raters} raters)"
+
+class CaseEvaluation(models.Model):
+    """Matching of one model's latest predictions against the latest doctor annotation (see forms.evaluation)"""
+    case_image = models.ForeignKey(CaseImage, on_delete=models.CASCADE, related_name='evaluations')
+    model_id = models.CharField(max_length=50)
+    ground_truth = models.ForeignKey(Annotation, on_delete=models.CASCADE, related_name='+')
+    prediction = models.ForeignKey(Annotation, on_delete=models.CASCADE, related_name='+')
+    signature = models.CharField(max_length=50)  # Engine version and settings the row was computed with
+    # Columnar per prediction: {'scores', 'labels', 'tp'}; tp holds one bit per IoU threshold
+    matches = models.JSONField(default=dict)
+    label_stats = models.JSONField(default=dict)  # label -> {'gt', 'tp', 'fp', 'fn', 'actual', 'predicted'}
+    confusion = models.JSONField(default=list)  # 3x3, rows doctor / columns model: negative, positive, background
+    evaluated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'case_evaluations'
+        unique_together = ['case_image', 'model_id']
+
+    def __str__(self):
+        return f"Evaluation of {self.model_id} on {self.case_image_id}"
+
+class EvaluationRun(models.Model):
+    """One refresh of the evaluation tables and the dataset report it produced"""
+    model_id = models.CharField(max_length=50, db_index=True)
+    full = models.BooleanField(default=False)
+    cases_total = models.IntegerField(default=0)
+    cases_evaluated = models.IntegerField(default=0)
+    cases_removed = models.IntegerField(default=0)
+    report = models.JSONField(default=dict)
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'evaluation_runs'
+
+    def __str__(self):
+        return f"Evaluation run {self.pk} of {self.model_id}"
+
+
+class CaseSearch(models.Model):
+    """Searchable copy of each case's metadata (see forms.search).
+
+    Rows are written only by database triggers on Forms and CaseImage, which
+    also maintain the full-text index over them.
+    """
+    case_id = models.IntegerField(primary_key=True)  # Forms.CaseID
+    patient_id = models.CharField(max_length=20)
+    date = models.DateField()
+    month = models.CharField(max_length=7)  # YYYY-MM of date
+    diagnosis = models.CharField(max_length=20)  # Annotated diagnosis, as /list/ reports it
+    prediction = models.CharField(max_length=255)  # Forms.Diagnosis from the model
+    confidence = models.CharField(max_length=10)
+    status = models.CharField(max_length=20)
+    image_name = models.CharField(max_length=255)
+
+    class Meta:
+        db_table = 'case_search'
+        indexes = [
+            # Newest-first keyset order, on its own and under each facet filter
+            models.Index(fields=['-date', '-case_id'], name='case_search_date_idx'),
+            models.Index(fields=['diagnosis', '-date', '-case_id'], name='case_search_diagnosis_idx'),
+            models.Index(fields=['status', '-date', '-case_id'], name='case_search_status_idx'),
+            models.Index(fields=['month', 'diagnosis', 'status'], name='case_search_month_idx'),
+        ]
+
+    def __str__(self):
+        return f"Search entry for case {self.case_id}"
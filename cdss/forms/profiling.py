@@ -0,0 +1,298 @@
+# forms/profiling.py
+"""Opt-in per-endpoint request instrumentation.
+
+ProfilingMiddleware measures every request:
+
+- wall time;
+- database query count and time, through a wrapper in each connection's
+  execute_wrappers;
+- response payload size;
+- peak Python allocation, with tracemalloc. Optional, because tracemalloc
+  slows every allocation.
+
+Results are aggregated in memory per (route, method) and rendered in the
+Prometheus text format by render_metrics() for /metrics, which returns 404
+while profiling is disabled. Each response also carries a Server-Timing
+header.
+
+A sampled fraction of requests runs under cProfile. The dump is written to
+PROFILE_DIR only when the request turns out slower than PROFILE_SLOW_MS.
+
+The middleware is configured through settings.PROFILING. When ENABLED is
+false it removes itself from the stack.
+
+Queries are attributed to a request through a ContextVar. asgiref copies
+the ContextVar into sync_to_async threads, so the ORM calls of async views
+are counted too. tracemalloc and cProfile are process-wide or
+thread-local, so under concurrent load their figures are approximate.
+"""
+import cProfile
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from forms.response_cache import cache_stats
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONFIG = {
+    'ENABLED': False,
+    'TRACE_ALLOCATIONS': False,
+    'SERVER_TIMING': True,
+    'PROFILE_SAMPLE_RATE': 0.0,  # Fraction of requests run under cProfile
+    'PROFILE_SLOW_MS': 500,
+    'PROFILE_DIR': None,
+    'BUCKETS': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+}
+
+
+def get_config():
+    return {**DEFAULT_CONFIG, **getattr(settings, 'PROFILING', {})}
+
+
+# Query timing
+
+_current = contextvars.ContextVar('profiling_request', default=None)
+
+
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+
+
+def _record_query(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.query_time += time.perf_counter() - start
+        stats.queries += 1
+
+
+def _install_wrapper(connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+def _install_wrappers(**kwargs):
+    """Wrap the connections already open in the thread handling the request.
+
+    Connections are per thread, and one opened before the middleware was
+    loaded never sees connection_created. request_started is sent in the
+    thread that runs the request's queries, also for async views.
+    """
+    for connection in connections.all(initialized_only=True):
+        _install_wrapper(connection)
+
+
+# Aggregation
+
+class Metrics:
+    """Per-endpoint request statistics of this process."""
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.endpoints = defaultdict(lambda: {
+            'count': 0,
+            'duration': 0.0,
+            'buckets': [0] * len(self.buckets),
+            'queries': 0,
+            'query_time': 0.0,
+            'bytes': 0,
+            'peak_alloc': 0,
+            'statuses': defaultdict(int),
+        })
+
+    def observe(self, route, method, status, duration, stats, size, peak_alloc):
+        with self.lock:
+            endpoint = self.endpoints[route, method]
+            endpoint['count'] += 1
+            endpoint['duration'] += duration
+            for index, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    endpoint['buckets'][index] += 1
+            endpoint['queries'] += stats.queries
+            endpoint['query_time'] += stats.query_time
+            endpoint['bytes'] += size
+            endpoint['peak_alloc'] = max(endpoint['peak_alloc'], peak_alloc)
+            endpoint['statuses'][status] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                key: {**value, 'buckets': list(value['buckets']), 'statuses': dict(value['statuses'])}
+                for key, value in self.endpoints.items()
+            }
+
+
+metrics = Metrics(DEFAULT_CONFIG['BUCKETS'])
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_metrics():
+    """All collected metrics in the Prometheus text exposition format."""
+    lines = []
+
+    def family(name, kind, help_text):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+
+    snapshot = sorted(metrics.snapshot().items())
+    labels = {key: f'route="{_label(key[0])}",method="{key[1]}"' for key, _ in snapshot}
+
+    family('cdss_requests_total', 'counter', 'Requests handled, by status code.')
+    for key, endpoint in snapshot:
+        for status, count in sorted(endpoint['statuses'].items()):
+            lines.append(f'cdss_requests_total{{{labels[key]},status="{status}"}} {count}')
+
+    family('cdss_request_duration_seconds', 'histogram', 'Request wall time.')
+    for key, endpoint in snapshot:
+        for bound, count in zip(metrics.buckets, endpoint['buckets']):
+            lines.append(f'cdss_request_duration_seconds_bucket{{{labels[key]},le="{bound}"}} {count}')
+        lines.append(f'cdss_request_duration_seconds_bucket{{{labels[key]},le="+Inf"}} {endpoint["count"]}')
+        lines.append(f'cdss_request_duration_seconds_sum{{{labels[key]}}} {endpoint["duration"]:.6f}')
+        lines.append(f'cdss_request_duration_seconds_count{{{labels[key]}}} {endpoint["count"]}')
+
+    family('cdss_db_queries_total', 'counter', 'Database queries run while handling requests.')
+    for key, endpoint in snapshot:
+        lines.append(f'cdss_db_queries_total{{{labels[key]}}} {endpoint["queries"]}')
+
+    family('cdss_db_query_seconds_total', 'counter', 'Time spent in database queries.')
+    for key, endpoint in snapshot:
+        lines.append(f'cdss_db_query_seconds_total{{{labels[key]}}} {endpoint["query_time"]:.6f}')
+
+    family('cdss_response_bytes_total', 'counter', 'Response payload bytes.')
+    for key, endpoint in snapshot:
+        lines.append(f'cdss_response_bytes_total{{{labels[key]}}} {endpoint["bytes"]}')
+
+    family('cdss_request_peak_alloc_bytes', 'gauge', 'Largest peak Python allocation seen in one request.')
+    for key, endpoint in snapshot:
+        lines.append(f'cdss_request_peak_alloc_bytes{{{labels[key]}}} {endpoint["peak_alloc"]}')
+
+    cache = cache_stats()
+    family('cdss_response_cache_requests_total', 'counter', 'Response cache lookups, by outcome.')
+    for view, counts in cache.items():
+        lines.append(f'cdss_response_cache_requests_total{{view="{view}",outcome="hit"}} {counts["hits"]}')
+        lines.append(f'cdss_response_cache_requests_total{{view="{view}",outcome="miss"}} {counts["misses"]}')
+
+    return '\n'.join(lines) + '\n'
+
+
+# Middleware
+
+class ProfilingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.config = get_config()
+        if not self.config['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        metrics.buckets = tuple(self.config['BUCKETS'])
+        if self.config['TRACE_ALLOCATIONS'] and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        connection_created.connect(_install_wrapper)
+        request_started.connect(_install_wrappers)
+        self.profile_lock = threading.Lock()
+        self.sample_every = (round(1 / self.config['PROFILE_SAMPLE_RATE'])
+                             if self.config['PROFILE_SAMPLE_RATE'] > 0 else 0)
+        self.seen = 0
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            self.stop_profile(state)
+        return self.finish(request, response, state)
+
+    async def __acall__(self, request):
+        state = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            self.stop_profile(state)
+        return self.finish(request, response, state)
+
+    def start(self):
+        stats = RequestStats()
+        state = {'stats': stats, 'token': _current.set(stats), 'profile': None}
+        if self.config['TRACE_ALLOCATIONS']:
+            tracemalloc.reset_peak()
+            state['alloc_base'] = tracemalloc.get_traced_memory()[0]
+        if self.sample_every:
+            self.seen += 1
+            # Only one profiler at a time; overlapping samples are skipped
+            if self.seen % self.sample_every == 0 and self.profile_lock.acquire(blocking=False):
+                state['profile'] = cProfile.Profile()
+                state['profile'].enable()
+        state['start'] = time.perf_counter()
+        return state
+
+    def stop_profile(self, state):
+        state['duration'] = time.perf_counter() - state['start']
+        if state['profile'] is not None:
+            state['profile'].disable()
+            self.profile_lock.release()
+        _current.reset(state['token'])
+
+    def finish(self, request, response, state):
+        stats, duration = state['stats'], state['duration']
+        peak_alloc = 0
+        if 'alloc_base' in state:
+            peak_alloc = max(0, tracemalloc.get_traced_memory()[1] - state['alloc_base'])
+        if response.streaming:
+            size = int(response.get('Content-Length') or 0)
+        else:
+            size = len(response.content)
+
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match else 'unmatched'
+        metrics.observe(route, request.method, response.status_code, duration, stats, size, peak_alloc)
+
+        if state['profile'] is not None and duration * 1000 >= self.config['PROFILE_SLOW_MS']:
+            self.dump_profile(state['profile'], request, route, duration)
+
+        if self.config['SERVER_TIMING']:
+            db = stats.query_time * 1000
+            response['Server-Timing'] = (
+                f'total;dur={duration * 1000:.1f}, '
+                f'db;dur={db:.1f};desc="{stats.queries} queries", '
+                f'app;dur={max(0.0, duration * 1000 - db):.1f}'
+            )
+        return response
+
+    def dump_profile(self, profile, request, route, duration):
+        directory = self.config['PROFILE_DIR'] or os.path.join(settings.BASE_DIR, 'profiles')
+        os.makedirs(directory, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+        path = os.path.join(
+            directory, f'{time.strftime("%Y%m%d-%H%M%S")}_{os.getpid()}_{request.method}_{slug}_{duration * 1000:.0f}ms.prof'
+        )
+        profile.dump_stats(path)
+        logger.warning("Slow request %s %s took %.0f ms; profile written to %s",
+                       request.method, request.path, duration * 1000, path)
@@ -0,0 +1,143 @@
+# forms/response_cache.py
+"""Cache of rendered JSON for the read endpoints.
+
+Responses are stored in the Django cache named by RESPONSE_CACHE['ALIAS']
+(locmem, file-based or any other backend configured in CACHES). Each key
+embeds version counters for what the response depends on: `case:<id>` for
+one case and `cases` for the listings. Writers call invalidate_cases()
+after committing, which bumps those counters, so later reads miss without
+anything being deleted; stale entries age out through the TIMEOUT.
+
+The version counters live in the same cache, so invalidation only reaches
+processes sharing it: with several workers, or when management commands
+change data under a running server, use a shared backend (file-based,
+Redis, Memcached) rather than locmem.
+
+Hit/miss counters are kept per process and exposed by cache_stats().
+"""
+import functools
+import hashlib
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+
+DEFAULT_CONFIG = {
+    'ENABLED': True,
+    'ALIAS': 'default',
+    'TIMEOUT': 300,
+}
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def get_config():
+    return {**DEFAULT_CONFIG, **getattr(settings, 'RESPONSE_CACHE', {})}
+
+
+def get_cache():
+    return caches[get_config()['ALIAS']]
+
+
+def _version_key(scope):
+    return f'response-version:{scope}'
+
+
+def _new_version():
+    # Never reuses a number, so losing a version key cannot resurrect old entries
+    return time.time_ns()
+
+
+async def _versions(cache, scopes):
+    keys = [_version_key(scope) for scope in scopes]
+    found = await cache.aget_many(keys)
+    for key in keys:
+        if key not in found:
+            await cache.aadd(key, _new_version(), timeout=None)
+            found[key] = await cache.aget(key)
+    return [found[key] for key in keys]
+
+
+def _bump(scopes):
+    cache = get_cache()
+    for scope in scopes:
+        try:
+            cache.incr(_version_key(scope))
+        except ValueError:
+            cache.set(_version_key(scope), _new_version(), timeout=None)
+
+
+def invalidate_cases(case_ids=(), lists=True):
+    """Expire cached responses of the given cases (and of the listings) once committed."""
+    scopes = [f'case:{case_id}' for case_id in case_ids]
+    if lists:
+        scopes.append('cases')
+    if scopes:
+        transaction.on_commit(lambda: _bump(scopes))
+
+
+def invalidate_all():
+    """Expire every cached response, for bulk changes made outside the views."""
+    transaction.on_commit(lambda: _bump(['all']))
+
+
+def _record(name, outcome):
+    with _stats_lock:
+        _stats[name, outcome] += 1
+
+
+def cache_stats():
+    """Per-view hit/miss counts of this process."""
+    with _stats_lock:
+        names = sorted({name for name, _ in _stats})
+        stats = {}
+        for name in names:
+            hits, misses = _stats[name, 'hit'], _stats[name, 'miss']
+            stats[name] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else None,
+            }
+    return stats
+
+
+def cached_json(name, scopes):
+    """Cache the 200 JSON responses of an async GET view.
+
+    `scopes(request, *args, **kwargs)` names the version counters the
+    response depends on; query parameters are part of the key.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            config = get_config()
+            if request.method != 'GET' or not config['ENABLED']:
+                return await view(request, *args, **kwargs)
+
+            cache = get_cache()
+            versions = await _versions(cache, ['all', *scopes(request, *args, **kwargs)])
+            params = hashlib.sha1(
+                repr(sorted(request.GET.lists())).encode(), usedforsecurity=False
+            ).hexdigest()[:16]
+            key = f"response:{name}:{'-'.join(map(str, versions))}:{params}"
+
+            content = await cache.aget(key)
+            if content is not None:
+                _record(name, 'hit')
+                response = HttpResponse(content, content_type='application/json')
+                response['X-Cache'] = 'HIT'
+                return response
+
+            _record(name, 'miss')
+            response = await view(request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming:
+                await cache.aset(key, response.content, timeout=config['TIMEOUT'])
+            response['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
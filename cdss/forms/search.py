@@ -0,0 +1,369 @@
+# forms/search.py
+"""Full-text and faceted search over case metadata.
+
+CaseSearch (table case_search) holds one row per Forms case, joined with
+its CaseImage: patient id, date and month, annotated diagnosis, model
+prediction, status and image name. Database triggers on forms_forms and
+case_images rewrite a case's row whenever either side changes, including
+bulk_create(), bulk_update() and queryset updates that bypass model code.
+The row holds everything a result or facet needs, so a search reads one
+narrow table through its composite indexes.
+
+Text matching uses the database's own index:
+
+    SQLite      an FTS5 table (case_search_fts) over case_search as
+                external content, kept in step by triggers on case_search
+    PostgreSQL  a generated tsvector column (case_search.document) with a
+                GIN index
+
+Every word of the query must match as a prefix, so "2024 05" finds
+patient ids of May 2024 and "posit" finds positive cases. Other database
+backends are not supported.
+
+install() creates the index and triggers and rebuild() refills the table.
+Migration 0017 did both with the schema of its day; `manage.py
+rebuild_search_index` runs them again after restoring a database.
+
+On SQLite, a migration that alters forms_forms, case_images or case_search
+copies the table, which drops the table's triggers and fails on the other
+tables' triggers that name it. So a migrate that runs migrations of this
+app drops the triggers first (suspend_for_migrate) and puts them back and
+refills the table afterwards (restore_after_migrate). The system check
+check_triggers() (forms.W001, run by migrate and `manage.py check
+--database default`) reports triggers missing anyway, e.g. after a failed
+migrate.
+"""
+import logging
+import re
+from collections import Counter
+from datetime import date
+
+from django.core import checks
+from django.db import connection, connections, transaction
+from django.db.models import BooleanField, Count, Q
+from django.db.models.expressions import RawSQL
+
+from forms.models import DIAGNOSIS_CHOICES, NOT_ANNOTATED, CaseSearch
+
+logger = logging.getLogger(__name__)
+
+SEARCH_DEFAULT_LIMIT = 50
+SEARCH_MAX_LIMIT = 500
+FACETS = ('diagnosis', 'status', 'month')
+
+# A case's row from Forms and its CaseImage; {month} is the dialect's
+# YYYY-MM expression and {where} restricts the cases
+DOCUMENT_SELECT = f"""
+    SELECT f."CaseID", f."PatientID", f."Date", {{month}},
+           COALESCE(c.diagnosis, '{NOT_ANNOTATED}'), f."Diagnosis", f."Confidence",
+           COALESCE(c.status, 'uploaded'), COALESCE(c.image_name, '')
+    FROM forms_forms f LEFT JOIN case_images c ON c.case_id = CAST(f."CaseID" AS TEXT)
+    {{where}}
+"""
+DOCUMENT_COLUMNS = 'case_id, patient_id, date, month, diagnosis, prediction, confidence, status, image_name'
+TEXT_COLUMNS = ('case_id', 'patient_id', 'image_name', 'diagnosis', 'prediction', 'status')
+MONTH_EXPRESSIONS = {'sqlite': '''strftime('%Y-%m', f."Date")''', 'postgresql': '''to_char(f."Date", 'YYYY-MM')'''}
+
+
+def _sqlite_refresh(key):
+    select = DOCUMENT_SELECT.format(month=MONTH_EXPRESSIONS['sqlite'], where=f'WHERE f."CaseID" = {key}')
+    return f"DELETE FROM case_search WHERE case_id = {key}; INSERT INTO case_search ({DOCUMENT_COLUMNS}) {select};"
+
+
+def _sqlite_schema():
+    text = ', '.join(TEXT_COLUMNS)
+    new = ', '.join(f'NEW.{column}' for column in TEXT_COLUMNS)
+    old = ', '.join(f'OLD.{column}' for column in TEXT_COLUMNS)
+    image_key = 'CAST({}.case_id AS INTEGER)'
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS case_search_fts USING fts5(
+            {text}, content='case_search', content_rowid='case_id',
+            prefix='2 3', tokenize='unicode61 remove_diacritics 2')""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_fts_insert AFTER INSERT ON case_search BEGIN
+            INSERT INTO case_search_fts (rowid, {text}) VALUES (NEW.case_id, {new});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_fts_delete AFTER DELETE ON case_search BEGIN
+            INSERT INTO case_search_fts (case_search_fts, rowid, {text}) VALUES ('delete', OLD.case_id, {old});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_fts_update AFTER UPDATE ON case_search BEGIN
+            INSERT INTO case_search_fts (case_search_fts, rowid, {text}) VALUES ('delete', OLD.case_id, {old});
+            INSERT INTO case_search_fts (rowid, {text}) VALUES (NEW.case_id, {new});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_forms_insert AFTER INSERT ON forms_forms BEGIN
+            {_sqlite_refresh('NEW."CaseID"')}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_forms_update
+            AFTER UPDATE OF "PatientID", "Date", "Diagnosis", "Confidence" ON forms_forms BEGIN
+            {_sqlite_refresh('NEW."CaseID"')}
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS case_search_forms_delete AFTER DELETE ON forms_forms BEGIN
+            DELETE FROM case_search WHERE case_id = OLD."CaseID";
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_images_insert AFTER INSERT ON case_images BEGIN
+            {_sqlite_refresh(image_key.format('NEW'))}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_images_update
+            AFTER UPDATE OF case_id, image_name, status, diagnosis ON case_images BEGIN
+            {_sqlite_refresh(image_key.format('OLD'))}
+            {_sqlite_refresh(image_key.format('NEW'))}
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS case_search_images_delete AFTER DELETE ON case_images BEGIN
+            {_sqlite_refresh(image_key.format('OLD'))}
+        END""",
+    ]
+
+
+def _postgresql_schema():
+    document = " || ' ' || ".join(
+        f'{column}::text' if column == 'case_id' else column for column in TEXT_COLUMNS
+    )
+    select = DOCUMENT_SELECT.format(month=MONTH_EXPRESSIONS['postgresql'], where='WHERE f."CaseID" = key')
+    return [
+        f"""ALTER TABLE case_search ADD COLUMN IF NOT EXISTS document tsvector
+            GENERATED ALWAYS AS (to_tsvector('simple', {document})) STORED""",
+        "CREATE INDEX IF NOT EXISTS case_search_document_idx ON case_search USING GIN (document)",
+        f"""CREATE OR REPLACE FUNCTION refresh_case_search(key integer) RETURNS void AS $$
+        BEGIN
+            DELETE FROM case_search WHERE case_id = key;
+            INSERT INTO case_search ({DOCUMENT_COLUMNS}) {select};
+        END $$ LANGUAGE plpgsql""",
+        """CREATE OR REPLACE FUNCTION case_search_forms_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM case_search WHERE case_id = OLD."CaseID";
+            ELSE
+                PERFORM refresh_case_search(NEW."CaseID");
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        """CREATE OR REPLACE FUNCTION case_search_images_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP <> 'INSERT' AND OLD.case_id ~ '^[0-9]{1,9}$' THEN
+                PERFORM refresh_case_search(OLD.case_id::integer);
+            END IF;
+            IF TG_OP <> 'DELETE' AND NEW.case_id ~ '^[0-9]{1,9}$' THEN
+                PERFORM refresh_case_search(NEW.case_id::integer);
+            END IF;
+            RETURN NULL;
+        END $$ LANGUAGE plpgsql""",
+        "DROP TRIGGER IF EXISTS case_search_forms ON forms_forms",
+        """CREATE TRIGGER case_search_forms
+            AFTER INSERT OR DELETE OR UPDATE OF "PatientID", "Date", "Diagnosis", "Confidence" ON forms_forms
+            FOR EACH ROW EXECUTE FUNCTION case_search_forms_changed()""",
+        "DROP TRIGGER IF EXISTS case_search_images ON case_images",
+        """CREATE TRIGGER case_search_images
+            AFTER INSERT OR DELETE OR UPDATE OF case_id, image_name, status, diagnosis ON case_images
+            FOR EACH ROW EXECUTE FUNCTION case_search_images_changed()""",
+    ]
+
+
+SCHEMAS = {'sqlite': _sqlite_schema, 'postgresql': _postgresql_schema}
+TEARDOWN = {
+    'sqlite': [
+        *(f'DROP TRIGGER IF EXISTS case_search_{name}' for name in (
+            'fts_insert', 'fts_delete', 'fts_update', 'forms_insert', 'forms_update', 'forms_delete',
+            'images_insert', 'images_update', 'images_delete',
+        )),
+        'DROP TABLE IF EXISTS case_search_fts',
+    ],
+    'postgresql': [
+        'DROP TRIGGER IF EXISTS case_search_forms ON forms_forms',
+        'DROP TRIGGER IF EXISTS case_search_images ON case_images',
+        'DROP FUNCTION IF EXISTS case_search_forms_changed(), case_search_images_changed(), '
+        'refresh_case_search(integer)',
+        'ALTER TABLE case_search DROP COLUMN IF EXISTS document',
+    ],
+}
+
+
+# Triggers install() creates, by the name the database lists them under
+TRIGGERS = {
+    'sqlite': tuple(f'case_search_{name}' for name in (
+        'fts_insert', 'fts_delete', 'fts_update', 'forms_insert', 'forms_update', 'forms_delete',
+        'images_insert', 'images_update', 'images_delete',
+    )),
+    'postgresql': ('case_search_forms', 'case_search_images'),
+}
+TRIGGER_QUERIES = {
+    'sqlite': "SELECT name FROM sqlite_master WHERE type = 'trigger'",
+    'postgresql': 'SELECT tgname FROM pg_trigger WHERE NOT tgisinternal',
+}
+
+
+def is_supported(using=connection):
+    return using.vendor in SCHEMAS
+
+
+def missing_triggers(using=connection):
+    """Names of the search triggers absent from the database; [] before case_search exists."""
+    if not is_supported(using) or 'case_search' not in using.introspection.table_names():
+        return []
+    with using.cursor() as cursor:
+        cursor.execute(TRIGGER_QUERIES[using.vendor])
+        present = {name for name, in cursor.fetchall()}
+    return [name for name in TRIGGERS[using.vendor] if name not in present]
+
+
+def check_triggers(app_configs=None, databases=None, **kwargs):
+    """System check: the triggers that keep case_search current exist."""
+    errors = []
+    for alias in databases or ():
+        missing = missing_triggers(connections[alias])
+        if missing:
+            errors.append(checks.Warning(
+                f"Case search triggers missing from database '{alias}': {', '.join(missing)}. "
+                "Searches and /list/ diagnosis filters miss changes to cases.",
+                hint="Run `manage.py rebuild_search_index`.",
+                id='forms.W001',
+            ))
+    return errors
+
+
+def install(using=connection):
+    """Create the text index and triggers; safe to run again."""
+    if not is_supported(using):
+        return
+    with using.cursor() as cursor:
+        for statement in SCHEMAS[using.vendor]():
+            cursor.execute(statement)
+
+
+def uninstall(using=connection):
+    if not is_supported(using):
+        return
+    with using.cursor() as cursor:
+        for statement in TEARDOWN[using.vendor]:
+            cursor.execute(statement)
+
+
+def rebuild(using=connection):
+    """Refill case_search and the text index from every case."""
+    if not is_supported(using):
+        return 0
+    select = DOCUMENT_SELECT.format(month=MONTH_EXPRESSIONS[using.vendor], where='')
+    with using.cursor() as cursor:
+        cursor.execute('DELETE FROM case_search')
+        cursor.execute(f'INSERT INTO case_search ({DOCUMENT_COLUMNS}) {select}')
+        count = cursor.rowcount
+        if using.vendor == 'sqlite':
+            # Reindex from the table: entries written while triggers were missing no longer match it
+            cursor.execute("INSERT INTO case_search_fts (case_search_fts) VALUES ('rebuild')")
+        return count
+
+
+def suspend_for_migrate(using='default', plan=None, **kwargs):
+    """pre_migrate receiver: on SQLite, drop the triggers before migrations of this app run."""
+    database = connections[using]
+    if database.vendor != 'sqlite' or not any(migration.app_label == 'forms' for migration, _ in plan or ()):
+        return
+    with database.cursor() as cursor:
+        for name in TRIGGERS['sqlite']:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+
+
+def restore_after_migrate(using='default', **kwargs):
+    """post_migrate receiver: reinstall missing triggers and refill the table."""
+    database = connections[using]
+    missing = missing_triggers(database)
+    if missing:
+        logger.debug("Restoring case search triggers: %s", ', '.join(missing))
+        with transaction.atomic(using=using):
+            install(database)
+            rebuild(database)
+
+
+def _words(text):
+    return re.findall(r'[^\W_]+', text or '')
+
+
+def match_text(queryset, text):
+    """Narrow a CaseSearch queryset to rows matching every word of `text` as a prefix."""
+    words = _words(text)
+    if not words:
+        return queryset
+    if connection.vendor == 'sqlite':
+        query = ' '.join(f'"{word}"*' for word in words)
+        return queryset.filter(case_id__in=RawSQL(
+            'SELECT rowid FROM case_search_fts WHERE case_search_fts MATCH %s', [query]
+        ))
+    if connection.vendor == 'postgresql':
+        query = ' & '.join(f'{word}:*' for word in words)
+        return queryset.alias(
+            matched=RawSQL("document @@ to_tsquery('simple', %s)", [query], output_field=BooleanField())
+        ).filter(matched=True)
+    raise NotImplementedError(f"Case search does not support the {connection.vendor} backend")
+
+
+def matching_case_ids(text):
+    """Subquery of the CaseIDs whose metadata matches `text` (for the admin)."""
+    return match_text(CaseSearch.objects.all(), text).values('case_id')
+
+
+def parse_filters(params):
+    """Facet and date filters from query parameters. Raises ValueError on bad input.
+
+    Accepts `diagnosis`, `status`, `month` (YYYY-MM), `date_from` and
+    `date_to` (ISO dates).
+    """
+    filters = {}
+    diagnosis = params.get('diagnosis')
+    if diagnosis:
+        matches = [choice for choice in DIAGNOSIS_CHOICES if choice.lower() == diagnosis.lower()]
+        if not matches:
+            raise ValueError(f"diagnosis must be one of: {', '.join(DIAGNOSIS_CHOICES)}")
+        filters['diagnosis'] = matches[0]
+    if params.get('status'):
+        filters['status'] = params['status']
+    month = params.get('month')
+    if month:
+        if not re.fullmatch(r'\d{4}-\d{2}', month):
+            raise ValueError('month must be YYYY-MM')
+        filters['month'] = month
+    for param, lookup in (('date_from', 'date__gte'), ('date_to', 'date__lte')):
+        value = params.get(param)
+        if value:
+            try:
+                filters[lookup] = date.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f'{param} must be an ISO date (YYYY-MM-DD)')
+    return filters
+
+
+def facet_counts(queryset, filters):
+    """(total, {facet: {value: count}}) for the rows of `queryset` matching `filters`.
+
+    Each facet is counted under every filter but its own, so the other
+    values of a chosen facet keep their counts. One grouped query serves
+    the total and all FACETS.
+    """
+    groups = queryset.filter(
+        **{key: value for key, value in filters.items() if key not in FACETS}
+    ).values(*FACETS).annotate(count=Count('case_id')).order_by()
+    total = 0
+    facets = {facet: Counter() for facet in FACETS}
+    for row in groups:
+        missed = [facet for facet in FACETS if facet in filters and row[facet] != filters[facet]]
+        if not missed:
+            total += row['count']
+            for facet in FACETS:
+                facets[facet][row[facet]] += row['count']
+        elif len(missed) == 1:
+            facets[missed[0]][row[missed[0]]] += row['count']
+    return total, {facet: dict(sorted(counts.items())) for facet, counts in facets.items()}
+
+
+def search_cases(text='', filters=None, after=None, limit=SEARCH_DEFAULT_LIMIT):
+    """One page of matching cases, newest first, with their total and facets.
+
+    `after` is the (date, case_id) keyset position of the previous page's
+    last row. Returns (CaseSearch rows, total, facets, has_more).
+    """
+    filters = filters or {}
+    matched = match_text(CaseSearch.objects.all(), text)
+    total, facets = facet_counts(matched, filters)
+    rows = matched.filter(**filters).order_by('-date', '-case_id')
+    if after is not None:
+        rows = rows.filter(Q(date__lt=after[0]) | Q(date=after[0], case_id__lt=after[1]))
+    # One extra row tells whether another page exists
+    page = list(rows[:limit + 1])
+    return page[:limit], total, facets, len(page) > limit
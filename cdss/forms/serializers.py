@@ -1,5 +1,6 @@
 from rest_framework import serializers
-from forms.models import Forms, CaseImage, Annotation, BoundingBox
+from forms.boxpack import BOX_ID_RANGE, packed_session
+from forms.models import Forms, CaseImage, Annotation, BoundingBox, ImportJob
 
 class FormsSerializer(serializers.ModelSerializer):
     class Meta:
@@ -13,21 +14,26 @@ class BoundingBoxSerializer(serializers.ModelSerializer):
                  'label', 'confidence']
 
 class AnnotationSerializer(serializers.ModelSerializer):
-    bounding_boxes = BoundingBoxSerializer(many=True, read_only=True)
+    # Decoded from the packed columns; same shape as BoundingBoxSerializer
+    bounding_boxes = serializers.SerializerMethodField()
     
     class Meta:
         model = Annotation
-        fields = ['annotation_id', 'annotations_data', 'total_annotations',
+        fields = ['annotation_id', 'source', 'version', 'annotations_data', 'total_annotations',
                  'positive_count', 'negative_count', 'created_at', 'updated_at',
                  'bounding_boxes']
 
+    def get_bounding_boxes(self, obj):
+        return packed_session(obj).to_rows()
+
 class CaseImageSerializer(serializers.ModelSerializer):
     annotations = AnnotationSerializer(many=True, read_only=True)
     
     class Meta:
         model = CaseImage
         fields = ['case_id', 'patient_id', 'image_name', 'image_path',
-                 'uploaded_at', 'status', 'annotations']
+                 'uploaded_at', 'status', 'diagnosis', 'positive_count',
+                 'negative_count', 'annotations']
 
 # Request serializers for API endpoints
 class AnnotationRequestSerializer(serializers.Serializer):
@@ -38,12 +44,18 @@ class AnnotationRequestSerializer(serializers.Serializer):
         child=serializers.DictField(), 
         allow_empty=False
     )
+    # Existing session to update as a new version, and the version the client edited
+    annotationId = serializers.CharField(max_length=100, required=False)
+    version = serializers.IntegerField(min_value=1, required=False)
     
     def validate_annotations(self, value):
         """Validate each annotation in the list"""
         required_fields = ['id', 'x', 'y', 'width', 'height', 'label', 
                           'relativeX', 'relativeY', 'relativeWidth', 'relativeHeight']
+        numeric_fields = ['x', 'y', 'width', 'height',
+                          'relativeX', 'relativeY', 'relativeWidth', 'relativeHeight']
         
+        seen_ids = set()
         for annotation in value:
             for field in required_fields:
                 if field not in annotation:
@@ -52,14 +64,45 @@ class AnnotationRequestSerializer(serializers.Serializer):
             # Validate label
             if annotation['label'] not in ['positive', 'negative']:
                 raise serializers.ValidationError("Label must be 'positive' or 'negative'")
+
+            # Validate coordinates so a bad box cannot fail the insert halfway
+            for field in numeric_fields:
+                if isinstance(annotation[field], bool) or not isinstance(annotation[field], (int, float)):
+                    raise serializers.ValidationError(f"Field {field} must be a number")
+            if isinstance(annotation['id'], bool) or not isinstance(annotation['id'], int):
+                raise serializers.ValidationError("Field id must be an integer")
+            if annotation['id'] not in BOX_ID_RANGE:
+                raise serializers.ValidationError("Field id must fit in a 32-bit signed integer")
+            if annotation['id'] in seen_ids:
+                raise serializers.ValidationError(f"Duplicate annotation id: {annotation['id']}")
+            seen_ids.add(annotation['id'])
+
+            confidence = annotation.get('confidence')
+            if confidence is not None and (isinstance(confidence, bool) or not isinstance(confidence, (int, float))):
+                raise serializers.ValidationError("Field confidence must be a number")
                 
         return value
 
+class AnnotationAutosaveSerializer(AnnotationRequestSerializer):
+    # A draft may have every box removed
+    annotations = serializers.ListField(child=serializers.DictField(), allow_empty=True)
+
+class AnnotationBatchRequestSerializer(serializers.Serializer):
+    cases = AnnotationRequestSerializer(many=True, allow_empty=False, max_length=1000)
+
 class AnnotationResponseSerializer(serializers.Serializer):
     success = serializers.BooleanField()
     message = serializers.CharField()
     annotation_id = serializers.CharField(required=False)
+    version = serializers.IntegerField(required=False)
     case_id = serializers.CharField(required=False)
     total_annotations = serializers.IntegerField(required=False)
     positive_count = serializers.IntegerField(required=False)
-    negative_count = serializers.IntegerField(required=False)
\ No newline at end of file
+    negative_count = serializers.IntegerField(required=False)
+
+class ImportJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ImportJob
+        fields = ['id', 'source', 'phase', 'images_done', 'annotations_done',
+                 'annotations_skipped', 'category_map', 'model_id', 'error',
+                 'created_at', 'updated_at']
@@ -0,0 +1,461 @@
+# forms/spatial.py
+"""Spatial index over the boxes of every annotation session.
+
+Region and size questions ("positive boxes near this point", "boxes
+smaller than 2% of the image", "boxes overlapping this region") are asked
+against relative coordinates, so they compare across images of any size.
+BoundingBox has no index for them, and sessions written without the box
+index have no rows at all. Instead each process keeps an R-tree built from
+Annotation.packed_boxes.
+
+The tree is bulk-loaded with Sort-Tile-Recursive packing: the boxes are
+sorted by centre into vertical slices, each slice by centre y (alternating
+direction, so neighbouring leaves stay adjacent), and cut into full leaves
+of NODE_CAPACITY boxes. Each upper level groups consecutive nodes the same
+way. Every level is a flat (n, 4) array, and node i's children are entries
+i * capacity ... (i + 1) * capacity - 1 of the level below. A query tests
+one level at a time with NumPy, so it only looks at the nodes along the
+matching branches.
+
+As with forms.duplicates, the index is loaded on first use and every
+lookup first syncs it with one indexed query on Annotation.updated_at and
+one on the DeletedAnnotation tombstones that record_deletion() writes when
+a session is deleted. Rows of changed and deleted sessions are marked dead,
+and the new boxes of changed ones go to a pending list that is scanned
+directly. The tree is repacked once MAX_PENDING rows have gone stale.
+Tombstones are kept for DELETE_RETENTION seconds; an index that has not
+synced for longer than that is reloaded.
+
+Configured through settings.SPATIAL_INDEX.
+"""
+import threading
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from forms.boxpack import iter_packed
+from forms.models import Annotation, DeletedAnnotation
+
+DEFAULT_CONFIG = {
+    'NODE_CAPACITY': 16,  # Entries per tree node
+    'MAX_PENDING': 50000,  # Changed or dead rows tolerated before the tree is repacked
+    'SYNC_LAG': 5,  # Seconds re-read on every sync, for writes that committed late
+    'MAX_RESULTS': 1000,  # Largest page a search returns
+    'DELETE_RETENTION': 7 * 24 * 3600,  # Seconds tombstones of deleted sessions are kept
+}
+
+RELATIONS = ('overlaps', 'within', 'contains')
+SOURCE_IDS = {Annotation.DOCTOR: 0, Annotation.MODEL: 1}
+
+
+def get_config():
+    return {**DEFAULT_CONFIG, **getattr(settings, 'SPATIAL_INDEX', {})}
+
+
+def _overlapping(bounds, region):
+    """Rows of the (n, 4) corner array `bounds` that intersect `region`."""
+    x1, y1, x2, y2 = region
+    return (bounds[:, 0] <= x2) & (bounds[:, 2] >= x1) & (bounds[:, 1] <= y2) & (bounds[:, 3] >= y1)
+
+
+def _envelopes(bounds, capacity):
+    """Bounds of consecutive groups of `capacity` rows."""
+    starts = np.arange(0, len(bounds), capacity)
+    return np.column_stack([
+        np.minimum.reduceat(bounds[:, 0], starts),
+        np.minimum.reduceat(bounds[:, 1], starts),
+        np.maximum.reduceat(bounds[:, 2], starts),
+        np.maximum.reduceat(bounds[:, 3], starts),
+    ])
+
+
+def str_order(bounds, capacity):
+    """Sort-Tile-Recursive order of the (n, 4) corner boxes `bounds`."""
+    count = len(bounds)
+    if count <= capacity:
+        return np.arange(count)
+    centres = (bounds[:, :2] + bounds[:, 2:]) / 2
+    leaves = -(-count // capacity)
+    slice_size = capacity * int(np.ceil(np.sqrt(leaves)))
+    by_x = np.argsort(centres[:, 0], kind='stable')
+    order = []
+    for number, start in enumerate(range(0, count, slice_size)):
+        rows = by_x[start:start + slice_size]
+        rows = rows[np.argsort(centres[rows, 1], kind='stable')]
+        order.append(rows[::-1] if number % 2 else rows)
+    return np.concatenate(order)
+
+
+def _group_rows(annotations, offset=0):
+    """{Annotation pk: its row indices} for a row column of annotation pks."""
+    if not len(annotations):
+        return {}
+    order = np.argsort(annotations, kind='stable')
+    pks, starts = np.unique(annotations[order], return_index=True)
+    return dict(zip(pks.tolist(), np.split(order + offset, starts[1:])))
+
+
+class STRTree:
+    """Static R-tree over corner boxes.
+
+    `query(region)` returns the indices (into the boxes given) of every box
+    that intersects the region.
+    """
+    def __init__(self, bounds, capacity=DEFAULT_CONFIG['NODE_CAPACITY']):
+        bounds = np.asarray(bounds, dtype=np.float32).reshape(-1, 4)
+        self.capacity = capacity
+        self.order = str_order(bounds, capacity)
+        # Root first, entries last
+        self.levels = [bounds[self.order]]
+        while len(self.levels[0]) > capacity:
+            self.levels.insert(0, _envelopes(self.levels[0], capacity))
+
+    def __len__(self):
+        return len(self.order)
+
+    def query(self, region):
+        nodes = np.arange(len(self.levels[0]))
+        children = np.arange(self.capacity)
+        for depth, bounds in enumerate(self.levels):
+            nodes = nodes[_overlapping(bounds[nodes], region)]
+            if depth + 1 < len(self.levels):
+                nodes = (nodes[:, None] * self.capacity + children).ravel()
+                nodes = nodes[nodes < len(self.levels[depth + 1])]
+        return self.order[nodes]
+
+
+class SpatialIndex:
+    """Relative corner boxes of every session, with an STR tree over most of them.
+
+    Row arrays: `bounds` (N, 4) float32, `annotations` (N,) Annotation pk,
+    `box_ids`, `positive` (N,) bool, `confidence` (N,) float32 (NaN when
+    none), `sources` and `models` (codes into self.model_names), and
+    `alive`. Rows before `tree_size` are in the tree; the rest are pending.
+    """
+    COLUMNS = ('bounds', 'annotations', 'box_ids', 'positive', 'confidence', 'sources', 'models')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.synced_at = None
+        self.sessions = {}  # Annotation pk: its row indices
+        self.model_names = []
+        self.model_codes = {}
+        self.tree = STRTree(np.zeros((0, 4)))
+        self.tree_size = 0
+        self.stale = 0
+        self._set_rows(self._empty_rows())
+
+    def _empty_rows(self):
+        return {
+            'bounds': np.zeros((0, 4), dtype=np.float32),
+            'annotations': np.zeros(0, dtype=np.int64),
+            'box_ids': np.zeros(0, dtype=np.int32),
+            'positive': np.zeros(0, dtype=bool),
+            'confidence': np.zeros(0, dtype=np.float32),
+            'sources': np.zeros(0, dtype=np.int8),
+            'models': np.zeros(0, dtype=np.int32),
+        }
+
+    def _set_rows(self, rows):
+        for column in self.COLUMNS:
+            setattr(self, column, rows[column])
+        self.alive = np.ones(len(self.annotations), dtype=bool)
+
+    def _model_code(self, model):
+        if model is None:
+            return -1
+        if model not in self.model_codes:
+            self.model_codes[model] = len(self.model_names)
+            self.model_names.append(model)
+        return self.model_codes[model]
+
+    def _read(self, annotations):
+        """Row columns for a queryset of sessions, and {pk: row count}."""
+        chunks = {column: [] for column in self.COLUMNS}
+        counts = {}
+        for pk, source, model, packed in iter_packed(annotations, 'pk', 'source', 'annotations_data__model'):
+            counts[pk] = len(packed)
+            if not len(packed):
+                continue
+            coords = packed.coords
+            chunks['bounds'].append(np.column_stack([
+                coords[4], coords[5], coords[4] + coords[6], coords[5] + coords[7],
+            ]))
+            chunks['annotations'].append(np.full(len(packed), pk, dtype=np.int64))
+            chunks['box_ids'].append(packed.box_ids)
+            chunks['positive'].append(packed.positive)
+            chunks['confidence'].append(
+                packed.confidence if packed.confidence is not None
+                else np.full(len(packed), np.nan, dtype=np.float32)
+            )
+            chunks['sources'].append(np.full(len(packed), SOURCE_IDS.get(source, -1), dtype=np.int8))
+            chunks['models'].append(np.full(len(packed), self._model_code(model), dtype=np.int32))
+        empty = self._empty_rows()
+        rows = {
+            column: np.concatenate(parts).astype(empty[column].dtype, copy=False) if parts else empty[column]
+            for column, parts in chunks.items()
+        }
+        return rows, counts
+
+    def _repack(self, rows, sessions):
+        """Replace all rows and rebuild the tree over them."""
+        self._set_rows(rows)
+        self.tree = STRTree(self.bounds, get_config()['NODE_CAPACITY'])
+        self.tree_size = len(self.annotations)
+        self.stale = 0
+        sessions = dict.fromkeys(sessions, np.zeros(0, dtype=np.int64))
+        sessions.update(_group_rows(self.annotations))
+        self.sessions = sessions
+
+    def _load(self):
+        started = timezone.now()
+        rows, counts = self._read(Annotation.objects.order_by('pk'))
+        self._repack(rows, counts)
+        self.synced_at = started
+        self.loaded = True
+
+    def _drop(self, pks):
+        for pk in pks:
+            rows = self.sessions.pop(pk, None)
+            if rows is not None and len(rows):
+                self.alive[rows] = False
+                self.stale += len(rows)
+
+    def _sync(self):
+        config = get_config()
+        started = timezone.now()
+        if started - self.synced_at > timedelta(seconds=config['DELETE_RETENTION']):
+            # Tombstones this old may be pruned already
+            self._load()
+            return
+        since = self.synced_at - timedelta(seconds=config['SYNC_LAG'])
+
+        # Deletions first: SQLite can reuse the pk of a deleted session
+        self._drop(DeletedAnnotation.objects.filter(deleted_at__gte=since).values_list('annotation_pk', flat=True))
+
+        rows, counts = self._read(Annotation.objects.filter(updated_at__gte=since).order_by('pk'))
+        if counts:
+            self._drop(counts)
+            offset = len(self.annotations)
+            alive = self.alive
+            self._set_rows({
+                column: np.concatenate([getattr(self, column), rows[column]]) for column in self.COLUMNS
+            })
+            self.alive = np.concatenate([alive, np.ones(len(rows['annotations']), dtype=bool)])
+            self.stale += len(rows['annotations'])
+            self.sessions.update(dict.fromkeys(counts, np.zeros(0, dtype=np.int64)))
+            self.sessions.update(_group_rows(rows['annotations'], offset))
+
+        if self.stale > config['MAX_PENDING']:
+            keep = self.alive
+            self._repack({column: getattr(self, column)[keep] for column in self.COLUMNS}, list(self.sessions))
+        self.synced_at = started
+
+    def refresh(self):
+        """Load the index, or apply the sessions written since the last refresh."""
+        with self.lock:
+            if self.loaded:
+                self._sync()
+            else:
+                self._load()
+
+    def search(self, limit=100, offset=0, **filters):
+        """Count and page of the boxes matching every given filter (see _match()).
+
+        Matching, counting and reading the page happen under one lock, so a
+        concurrent refresh cannot renumber the rows in between. Returns
+        (total, positive count, box dicts) with boxes ordered by annotation
+        and box id.
+        """
+        with self.lock:
+            rows = self._match(**filters)
+            positive = int(np.count_nonzero(self.positive[rows]))
+            return len(rows), positive, self._rows(rows[offset:offset + limit])
+
+    def _match(self, region=None, relation='overlaps', near=None, radius=0.0,
+               min_area=None, max_area=None, label=None, source=None, model=None):
+        """Row indices matching every given filter, ordered by annotation and box id.
+
+        `region` is (x1, y1, x2, y2) in fractions of the image; `relation`
+        says whether boxes must overlap it, lie within it or contain it.
+        `near` is an (x, y) point that boxes must come within `radius` of.
+        Areas are fractions of the image area.
+        """
+        candidates = None
+        for area in ([region] if region is not None else []) + (
+                [(near[0] - radius, near[1] - radius, near[0] + radius, near[1] + radius)]
+                if near is not None else []):
+            rows = np.concatenate([
+                self.tree.query(area),
+                np.arange(self.tree_size, len(self.annotations))[
+                    _overlapping(self.bounds[self.tree_size:], area)
+                ],
+            ])
+            candidates = rows if candidates is None else np.intersect1d(candidates, rows)
+        if candidates is None:
+            candidates = np.arange(len(self.annotations))
+        candidates = candidates[self.alive[candidates]]
+
+        bounds = self.bounds[candidates].astype(np.float64)
+        keep = np.ones(len(candidates), dtype=bool)
+        if region is not None and relation == 'within':
+            keep &= (bounds[:, 0] >= region[0]) & (bounds[:, 1] >= region[1])
+            keep &= (bounds[:, 2] <= region[2]) & (bounds[:, 3] <= region[3])
+        elif region is not None and relation == 'contains':
+            keep &= (bounds[:, 0] <= region[0]) & (bounds[:, 1] <= region[1])
+            keep &= (bounds[:, 2] >= region[2]) & (bounds[:, 3] >= region[3])
+        if near is not None:
+            dx = np.maximum.reduce([bounds[:, 0] - near[0], np.zeros(len(bounds)), near[0] - bounds[:, 2]])
+            dy = np.maximum.reduce([bounds[:, 1] - near[1], np.zeros(len(bounds)), near[1] - bounds[:, 3]])
+            keep &= dx * dx + dy * dy <= radius * radius
+        if min_area is not None or max_area is not None:
+            areas = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+            if min_area is not None:
+                keep &= areas >= min_area
+            if max_area is not None:
+                keep &= areas <= max_area
+        if label is not None:
+            keep &= self.positive[candidates] == (label == 'positive')
+        if source is not None:
+            keep &= self.sources[candidates] == SOURCE_IDS[source]
+        if model is not None:
+            keep &= self.models[candidates] == self.model_codes.get(model, -2)
+        rows = candidates[keep]
+        return rows[np.lexsort((self.box_ids[rows], self.annotations[rows]))]
+
+    def _rows(self, indices):
+        """Box dicts of the given rows, without their session details."""
+        bounds = np.round(self.bounds[indices].astype(np.float64), 6).tolist()
+        confidence = np.round(self.confidence[indices].astype(np.float64), 6).tolist()
+        return [
+            {
+                'annotation': annotation,
+                'boxId': box_id,
+                'label': 'positive' if positive else 'negative',
+                'relativeX': x1,
+                'relativeY': y1,
+                'relativeWidth': round(x2 - x1, 6),
+                'relativeHeight': round(y2 - y1, 6),
+                'confidence': None if score != score else score,
+            }
+            for annotation, box_id, positive, (x1, y1, x2, y2), score in zip(
+                self.annotations[indices].tolist(), self.box_ids[indices].tolist(),
+                self.positive[indices].tolist(), bounds, confidence,
+            )
+        ]
+
+
+def _floats(params, name, count):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        numbers = [float(part) for part in value.split(',')]
+    except ValueError:
+        numbers = []
+    if len(numbers) != count:
+        raise ValueError(f"{name} must be {count} comma separated numbers")
+    return numbers
+
+
+def parse_filters(params):
+    """search_boxes() keyword arguments from query parameters. Raises ValueError on bad input.
+
+    `region` (x1,y1,x2,y2) with `relation` overlaps/within/contains, `near`
+    (x,y) with `radius`, all as fractions of the image; `min_area` and
+    `max_area` as fractions of the image area; `label`, `source`, `model`,
+    `limit` and `offset`.
+    """
+    filters = {}
+    region = _floats(params, 'region', 4)
+    if region is not None:
+        if region[0] > region[2] or region[1] > region[3]:
+            raise ValueError("region must be x1,y1,x2,y2 with x1 <= x2 and y1 <= y2")
+        filters['region'] = region
+        filters['relation'] = params.get('relation') or 'overlaps'
+        if filters['relation'] not in RELATIONS:
+            raise ValueError(f"relation must be one of: {', '.join(RELATIONS)}")
+    near = _floats(params, 'near', 2)
+    if near is not None:
+        filters['near'] = near
+        filters['radius'] = (_floats(params, 'radius', 1) or [0.0])[0]
+        if filters['radius'] < 0:
+            raise ValueError("radius must not be negative")
+    for name in ('min_area', 'max_area'):
+        value = _floats(params, name, 1)
+        if value is not None:
+            filters[name] = value[0]
+
+    label = params.get('label')
+    if label:
+        if label not in ('positive', 'negative'):
+            raise ValueError("label must be positive or negative")
+        filters['label'] = label
+    source = params.get('source')
+    if source:
+        if source not in SOURCE_IDS:
+            raise ValueError(f"source must be one of: {', '.join(SOURCE_IDS)}")
+        filters['source'] = source
+    if params.get('model'):
+        filters['model'] = params['model']
+
+    for name, default in (('limit', 100), ('offset', 0)):
+        value = params.get(name)
+        try:
+            filters[name] = int(value) if value else default
+        except ValueError:
+            raise ValueError(f"{name} must be an integer")
+        if filters[name] < 0:
+            raise ValueError(f"{name} must not be negative")
+    return filters
+
+
+def record_deletion(sender, instance, **kwargs):
+    """post_delete receiver for Annotation: leave a tombstone for every process's index.
+
+    Written in the deleting transaction, so a rolled back delete leaves none.
+    """
+    DeletedAnnotation.objects.create(annotation_pk=instance.pk)
+    DeletedAnnotation.objects.filter(
+        deleted_at__lt=timezone.now() - timedelta(seconds=get_config()['DELETE_RETENTION'])
+    ).delete()
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = SpatialIndex()
+        return _index
+
+
+def search_boxes(limit=100, offset=0, **filters):
+    """Page of boxes matching SpatialIndex.search() filters.
+
+    Returns (total, {'positive': n, 'negative': n}, boxes); each box dict
+    names its case, session and source, resolved with one query.
+    """
+    index = get_index()
+    index.refresh()
+    total, positive, boxes = index.search(limit=min(limit, get_config()['MAX_RESULTS']), offset=offset, **filters)
+    sessions = {
+        pk: (annotation_id, case_id, source)
+        for pk, annotation_id, case_id, source in Annotation.objects.filter(
+            pk__in={box['annotation'] for box in boxes}
+        ).values_list('pk', 'annotation_id', 'case_image__case_id', 'source')
+    }
+    page = []
+    for box in boxes:
+        pk = box.pop('annotation')
+        if pk not in sessions:
+            continue  # Deleted since the refresh
+        annotation_id, case_id, source = sessions[pk]
+        page.append({'caseId': case_id, 'annotationId': annotation_id, 'source': source, **box})
+    return total, {'positive': positive, 'negative': total - positive}, page
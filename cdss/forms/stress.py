@@ -0,0 +1,175 @@
+# forms/stress.py
+"""Concurrent mixed read/write load for `manage.py stress_db`.
+
+Where `manage.py benchmark` times one workload at a time, this runs
+uploads, annotation saves, autosaves and reads all at once from many
+client threads. The inference dispatcher writes predictions alongside
+them, so the database sees the same contention as a busy clinic. It checks
+the connection settings in cdss/settings.py: a run passes when no request
+fails, which on SQLite above all means no "database is locked".
+
+Each thread keeps one autosaved session of its own, so autosaves update a
+session (a new version or a folded one) instead of creating new ones.
+"""
+import json
+import random
+import statistics
+import threading
+import time
+from collections import Counter
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, connections
+from django.test import Client
+
+from forms.benchmark import annotation_payload, percentile, synthetic_image
+from forms.models import CaseImage
+
+# Share of requests per operation
+DEFAULT_MIX = {
+    'upload_image': 2,
+    'save_annotations': 3,
+    'autosave': 3,
+    'case_detail': 4,
+    'get_annotations': 4,
+    'list_forms': 2,
+}
+
+
+def describe_connection():
+    """The settings that decide how the default database behaves under load."""
+    settings_dict = connection.settings_dict
+    options = settings_dict.get('OPTIONS', {})
+    described = {
+        'vendor': connection.vendor,
+        'conn_max_age': settings_dict.get('CONN_MAX_AGE'),
+        'health_checks': settings_dict.get('CONN_HEALTH_CHECKS'),
+    }
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            for pragma in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'cache_size'):
+                cursor.execute(f'PRAGMA {pragma}')
+                described[pragma] = cursor.fetchone()[0]
+        described['transaction_mode'] = options.get('transaction_mode', 'DEFERRED')
+    else:
+        described['pool'] = options.get('pool') or None
+    return described
+
+
+class StressRun:
+    """One mixed run; `run()` returns a summary of every operation."""
+
+    def __init__(self, threads, duration, boxes_per_case, seed, mix=None):
+        self.threads = threads
+        self.duration = duration
+        self.boxes_per_case = boxes_per_case
+        self.seed = seed
+        self.mix = mix or DEFAULT_MIX
+        self.case_images = list(CaseImage.objects.order_by('pk'))
+        self.lock = threading.Lock()
+        self.latencies = {name: [] for name in self.mix}
+        self.failures = Counter()
+        self.upload_seed = seed * 1_000_003 + 30_000_000
+
+    def next_upload_seed(self):
+        with self.lock:
+            self.upload_seed += 1
+            return self.upload_seed
+
+    def request(self, name, client, rng, session):
+        """Issue one `name` request; True when it got the expected status."""
+        if name == 'upload_image':
+            image = SimpleUploadedFile('stress.jpg', synthetic_image(self.next_upload_seed()),
+                                       content_type='image/jpeg')
+            return client.post('/upload/', {'image': image}).status_code == 200
+        if name == 'save_annotations':
+            payload = annotation_payload(rng.choice(self.case_images), rng, self.boxes_per_case)
+            return client.post('/api/annotations/', payload, content_type='application/json').status_code == 201
+        if name == 'autosave':
+            return self.autosave(client, rng, session)
+        case_image = rng.choice(self.case_images)
+        if name == 'case_detail':
+            return client.get(f'/case/{case_image.case_id}/').status_code == 200
+        if name == 'get_annotations':
+            return client.get(f'/api/annotations/{case_image.case_id}/').status_code in (200, 404)
+        if name == 'list_forms':
+            return client.get('/list/', {'limit': 50}).status_code == 200
+        raise ValueError(f"Unknown operation {name!r}")
+
+    def autosave(self, client, rng, session):
+        """Autosave this thread's draft session, creating it on the first call."""
+        if 'payload' not in session:
+            session['payload'] = json.loads(
+                annotation_payload(rng.choice(self.case_images), rng, self.boxes_per_case)
+            )
+        payload = session['payload']
+        box = rng.choice(payload['annotations'])
+        box['x'] = round(box['x'] + rng.uniform(-2, 2), 1)
+        response = client.post('/api/annotations/autosave/', {
+            **payload, **{key: session[key] for key in ('annotationId', 'version') if key in session},
+        }, content_type='application/json')
+        if response.status_code != 200:
+            return False
+        data = response.json()
+        session['annotationId'] = data['annotation_id']
+        session['version'] = data['version']
+        return True
+
+    def worker(self, index, deadline):
+        client = Client()
+        rng = random.Random(f'{self.seed}:stress:{index}')
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        session = {}
+        try:
+            while time.perf_counter() < deadline:
+                name = rng.choices(names, weights)[0]
+                start = time.perf_counter()
+                try:
+                    ok = self.request(name, client, rng, session)
+                    failure = None if ok else 'unexpected status'
+                except Exception as e:
+                    # The test client re-raises view exceptions, e.g. OperationalError
+                    failure = f'{type(e).__name__}: {e}'.splitlines()[0][:200]
+                elapsed = (time.perf_counter() - start) * 1000
+                with self.lock:
+                    self.latencies[name].append(elapsed)
+                    if failure:
+                        self.failures[(name, failure)] += 1
+        finally:
+            connections.close_all()
+
+    def run(self):
+        deadline = time.perf_counter() + self.duration
+        workers = [threading.Thread(target=self.worker, args=(index, deadline)) for index in range(self.threads)]
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        wall = time.perf_counter() - start
+
+        operations = {}
+        for name, latencies in self.latencies.items():
+            latencies.sort()
+            operations[name] = {
+                'requests': len(latencies),
+                'errors': sum(count for (failed, _), count in self.failures.items() if failed == name),
+                'p50_ms': round(percentile(latencies, 0.50), 3),
+                'p95_ms': round(percentile(latencies, 0.95), 3),
+                'p99_ms': round(percentile(latencies, 0.99), 3),
+                'mean_ms': round(statistics.fmean(latencies), 3) if latencies else 0.0,
+                'max_ms': round(latencies[-1], 3) if latencies else 0.0,
+            }
+        total = sum(operation['requests'] for operation in operations.values())
+        return {
+            'threads': self.threads,
+            'duration_s': round(wall, 2),
+            'requests': total,
+            'throughput_rps': round(total / wall, 2) if wall else 0.0,
+            'operations': operations,
+            'failures': [
+                {'operation': name, 'error': error, 'count': count}
+                for (name, error), count in self.failures.most_common()
+            ],
+        }
@@ -1,3 +1,1703 @@
-from django.test import TestCase
+import atexit
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import types
+import zipfile
+from datetime import date, timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, transaction
+from django.db.migrations import Migration
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from forms.annotations import ingest_annotation_sessions
+from forms.benchmark import (
+    IMAGE_SIZE, build_workloads, compare_to_baseline, load_synthetic_dataset, percentile, run_workload,
+    synthetic_image,
+)
+from forms.boxpack import pack, packed_session, unpack
+from forms.coco import create_import_job, iter_coco_export, run_import
+from forms.consensus import update_consensus
+from forms.derivatives import (
+    DERIVATIVE_SIZES, derivative_name, derivative_urls, ensure_derivatives, lazy_derivative_urls,
+)
+from forms.duplicates import BKTree, DuplicateIndex
+from forms.evaluation import run_evaluation
+from forms.geometry import NMS_MATRIX_LIMIT, nms, pairwise_iou
+from forms.hashing import hash_field_file
+from forms.inference import (
+    InferenceService, OnnxBackend, cache_predictions, get_service, request_inference, run_batch, store_predictions,
+)
+from forms.models import (
+    Annotation, AnnotationVersion, CaseEvaluation, CaseImage, CaseSearch, ConsensusAnnotation, DeletedAnnotation,
+    Forms, ImportedImage, NOT_ANNOTATED, PatientIDSequence, PredictionCache, UploadSession,
+)
+from forms.profiling import Metrics
+from forms.response_cache import get_cache, invalidate_cases
+from forms.search import (
+    check_triggers, missing_triggers, restore_after_migrate, search_cases, suspend_for_migrate,
+)
+from forms.spatial import SpatialIndex
+from forms.stress import StressRun, describe_connection
+from forms.uploads import FINALIZE_TIMEOUT, finalize_upload
+from forms.versions import rebuild
+
+MEDIA_ROOT = tempfile.mkdtemp(prefix='cdss-tests-')
+atexit.register(shutil.rmtree, MEDIA_ROOT, ignore_errors=True)
+
+
+def box(index, x, y, width, height, label, canvas_width, canvas_height, confidence=None):
+    """A frontend box dict at pixel position (x, y) of a canvas of the given size."""
+    data = {
+        'id': index, 'x': x, 'y': y, 'width': width, 'height': height, 'label': label,
+        'relativeX': x / canvas_width, 'relativeY': y / canvas_height,
+        'relativeWidth': width / canvas_width, 'relativeHeight': height / canvas_height,
+    }
+    if confidence is not None:
+        data['confidence'] = confidence
+    return data
+
+
+def scaled_box(index, relative, label, canvas_width, canvas_height, confidence=None):
+    """A box at the given relative (x, y, width, height) drawn on a canvas of the given size."""
+    x, y, width, height = relative
+    return box(index, x * canvas_width, y * canvas_height, width * canvas_width, height * canvas_height,
+               label, canvas_width, canvas_height, confidence)
+
+
+def create_case(width=640, height=480):
+    """A Forms row and its sized CaseImage; the image file itself is never read."""
+    form = Forms.objects.create(Image=f'cases/test-{Forms.objects.count()}.jpg')
+    case_image = CaseImage.objects.create(
+        case_id=str(form.CaseID), patient_id=form.PatientID, image_name=form.Image.name,
+        image_path=form.Image.name, width=width, height=height,
+    )
+    return form, case_image
+
+
+def stored_case(seed):
+    """A Forms row with a real synthetic image in storage."""
+    return Forms.objects.create(Image=ContentFile(synthetic_image(seed), name='case.jpg'))
+
+
+def doctor_session(case_image, boxes):
+    return {
+        'caseId': case_image.case_id, 'patientId': case_image.patient_id,
+        'imageName': case_image.image_name, 'annotations': boxes,
+    }
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class BackfillCaseSummariesTests(TestCase):
+    def setUp(self):
+        _, self.positive = create_case()
+        _, self.negative = create_case()
+        _, self.empty = create_case()
+        ingest_annotation_sessions([
+            doctor_session(self.positive, [box(1, 10, 10, 20, 20, 'negative', 800, 600)]),
+            doctor_session(self.positive, [box(1, 10, 10, 20, 20, 'positive', 800, 600),
+                                           box(2, 50, 50, 20, 20, 'negative', 800, 600)]),
+            doctor_session(self.negative, [box(1, 10, 10, 20, 20, 'negative', 800, 600)]),
+        ])
+        self.expected = self.summaries()
+
+    def summaries(self):
+        return list(CaseImage.objects.order_by('pk').values_list(
+            'case_id', 'latest_annotation', 'diagnosis', 'positive_count', 'negative_count',
+        ))
+
+    def backfill(self, *args):
+        stdout = StringIO()
+        call_command('backfill_case_summaries', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_ingest_writes_current_summaries(self):
+        self.assertIn('All 3 case summaries are up to date', self.backfill('--verify'))
+        latest = self.positive.annotations.order_by('-created_at', '-id').first()
+        self.assertEqual(self.expected[0][1:], (latest.pk, 'Positive', 1, 1))
+        self.assertEqual(self.expected[2][1:], (None, NOT_ANNOTATED, 0, 0))
+
+    def test_backfill_repairs_stale_summaries(self):
+        CaseImage.objects.update(latest_annotation=None, diagnosis=NOT_ANNOTATED, positive_count=0, negative_count=0)
+
+        with self.assertRaisesMessage(CommandError, '2 of 3 case summaries are stale'):
+            self.backfill('--verify')
+        self.assertIn('Updated 2 of 3 case summaries', self.backfill('--batch-size', '2'))
+
+        self.assertEqual(self.summaries(), self.expected)
+        self.assertIn('Updated 0 of 3 case summaries', self.backfill())
+
+
+def save_payload(case_image, boxes, **session):
+    return json.dumps({**doctor_session(case_image, boxes), **session})
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class AnnotationSaveTests(TestCase):
+    def setUp(self):
+        _, self.case_image = create_case()
+        self.boxes = [
+            box(1, 100, 100, 50, 40, 'positive', 800, 600),
+            box(2, 300, 200, 60, 60, 'negative', 800, 600),
+        ]
+
+    def save(self, boxes, **session):
+        return self.client.post('/api/annotations/', save_payload(self.case_image, boxes, **session),
+                                content_type='application/json')
+
+    def save_batch(self, cases):
+        return self.client.post('/api/annotations/batch/', json.dumps({'cases': cases}),
+                                content_type='application/json')
+
+    def autosave(self, boxes, **session):
+        return self.client.post('/api/annotations/autosave/', save_payload(self.case_image, boxes, **session),
+                                content_type='application/json')
+
+    def test_save_creates_session_and_updates_case(self):
+        response = self.save(self.boxes)
+
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertEqual((data['total_annotations'], data['positive_count'], data['negative_count']), (2, 1, 1))
+        annotation = Annotation.objects.get(annotation_id=data['annotation_id'])
+        self.assertEqual(annotation.version, 1)
+        self.assertEqual(annotation.bounding_boxes.count(), 2)
+        self.case_image.refresh_from_db()
+        self.assertEqual(self.case_image.latest_annotation, annotation)
+        self.assertEqual((self.case_image.status, self.case_image.diagnosis), ('annotated', 'Positive'))
+
+        stored = self.client.get(f'/api/annotations/{self.case_image.case_id}/').json()['data']
+        session, = stored['annotations']
+        self.assertEqual([row['box_id'] for row in session['bounding_boxes']], [1, 2])
+
+    def test_save_rejects_invalid_boxes(self):
+        for boxes in ([{'id': 1, 'x': 10}], [dict(self.boxes[0], x='10')], [self.boxes[0], self.boxes[0]],
+                      [dict(self.boxes[0], id=2 ** 31)]):
+            with self.subTest(boxes=boxes):
+                self.assertEqual(self.save(boxes).status_code, 400)
+        self.assertFalse(Annotation.objects.exists())
+
+    def test_batch_saves_every_case(self):
+        _, other = create_case()
+
+        response = self.save_batch([
+            doctor_session(self.case_image, self.boxes),
+            doctor_session(other, self.boxes[1:]),
+            doctor_session(self.case_image, self.boxes[:1]),
+        ])
+
+        self.assertEqual(response.status_code, 201)
+        results = response.json()['results']
+        self.assertEqual([result['case_id'] for result in results],
+                         [self.case_image.case_id, other.case_id, self.case_image.case_id])
+        self.assertEqual(Annotation.objects.count(), 3)
+        # The last session of a case in the batch is its latest
+        diagnoses = dict(CaseImage.objects.values_list('case_id', 'diagnosis'))
+        self.assertEqual(diagnoses, {self.case_image.case_id: 'Positive', other.case_id: 'Negative'})
+        self.assertEqual(CaseImage.objects.get(pk=self.case_image.pk).latest_annotation.annotation_id,
+                         results[2]['annotation_id'])
+
+    def test_batch_with_an_invalid_case_writes_nothing(self):
+        _, other = create_case()
+
+        response = self.save_batch([
+            doctor_session(self.case_image, self.boxes),
+            doctor_session(other, [dict(self.boxes[0], label='unsure')]),
+        ])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Annotation.objects.exists())
+        self.assertFalse(CaseImage.objects.filter(status='annotated').exists())
+
+    def test_resave_stores_a_version_of_the_changes(self):
+        first = self.save(self.boxes).json()
+        moved = [self.boxes[0], {**self.boxes[1], 'x': 320, 'relativeX': 0.4}]
+
+        second = self.save(moved, annotationId=first['annotation_id'], version=1)
+
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second.json()['version'], 2)
+        annotation = Annotation.objects.get(annotation_id=first['annotation_id'])
+        self.assertEqual(annotation.bounding_boxes.get(box_id=2).x, 320)
+        version = annotation.versions.get(number=2)
+        self.assertEqual([old['x'] for old, _ in version.delta['modified']], [300])
+
+        history = self.client.get(f'/api/annotations/{self.case_image.case_id}/versions/1/').json()['data']
+        self.assertEqual(history['annotations'], self.boxes)
+
+    def test_resave_of_an_old_version_conflicts(self):
+        first = self.save(self.boxes).json()
+        self.save(self.boxes[:1], annotationId=first['annotation_id'], version=1)
+
+        response = self.save(self.boxes, annotationId=first['annotation_id'], version=1)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Annotation.objects.get(annotation_id=first['annotation_id']).version, 2)
+
+    def test_autosaves_fold_within_the_window(self):
+        first = self.autosave(self.boxes).json()
+        session = {'annotationId': first['annotation_id']}
+        edits = [dict(self.boxes[0], x=100 + step) for step in range(1, 4)]
+
+        versions = [self.autosave([edit], **session).json()['version'] for edit in edits]
+
+        self.assertEqual(versions, [2, 2, 2])
+        annotation = Annotation.objects.get(annotation_id=first['annotation_id'])
+        # The folded version still undoes to the session before the first autosave
+        self.assertEqual(annotation.versions.count(), 1)
+        self.assertEqual(rebuild(annotation, 1), self.boxes)
+        self.assertEqual(rebuild(annotation, 2), edits[-1:])
+
+    def test_autosave_window_runs_from_version_creation(self):
+        first = self.autosave(self.boxes).json()
+        session = {'annotationId': first['annotation_id']}
+        self.autosave(self.boxes[:1], **session)
+        annotation = Annotation.objects.get(annotation_id=first['annotation_id'])
+        # Folded into a minute ago, but created before the window
+        annotation.versions.filter(number=2).update(
+            created_at=timezone.now() - timedelta(seconds=120), updated_at=timezone.now(),
+        )
+
+        response = self.autosave([dict(self.boxes[0], x=150)], **session).json()
+
+        self.assertEqual(response['version'], 3)
+
+    def test_unchanged_autosave_writes_nothing(self):
+        first = self.autosave(self.boxes).json()
+
+        response = self.autosave(self.boxes, annotationId=first['annotation_id']).json()
+
+        self.assertFalse(response['changed'])
+        self.assertEqual(response['version'], 1)
+        self.assertFalse(AnnotationVersion.objects.exists())
+
+    def test_editing_a_case_resaves_its_session(self):
+        url = f'/case/{self.case_image.case_id}/'
+        moved = [self.boxes[0], {**self.boxes[1], 'x': 320, 'relativeX': 0.4}]
+        self.assertIsNone(self.client.get(url).json()['annotation_id'])
+
+        for boxes in (self.boxes, moved):
+            # What the receipt page hands to the labeling page
+            with self.captureOnCommitCallbacks(execute=True):
+                case = self.client.get(url).json()
+                session = {'annotationId': case['annotation_id'], 'version': case['version']}
+                self.assertEqual(self.save(boxes, **(session if case['annotation_id'] else {})).status_code, 201)
+
+        annotation, = Annotation.objects.all()
+        self.assertEqual(annotation.version, 2)
+        case = self.client.get(url).json()
+        self.assertEqual((case['annotation_id'], case['version']), (annotation.annotation_id, 2))
+        self.assertEqual([(box['id'], box['x']) for box in case['annotations']], [(1, 100), (2, 320)])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class CocoExportTests(TestCase):
+    relative = (0.25, 0.5, 0.1, 0.2)
+
+    def setUp(self):
+        _, self.positive = create_case(640, 480)
+        _, self.negative = create_case(1000, 800)
+        ingest_annotation_sessions([
+            doctor_session(self.positive, [scaled_box(1, self.relative, 'positive', 800, 600),
+                                           scaled_box(2, self.relative, 'negative', 800, 600)]),
+            doctor_session(self.negative, [scaled_box(1, self.relative, 'negative', 1000, 750, confidence=0.5)]),
+        ])
+
+    def export(self, **params):
+        response = self.client.get('/api/export/coco/', params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b''.join(response.streaming_content))
+
+    def test_boxes_are_scaled_to_the_image(self):
+        document = self.export()
+
+        images = {image['file_name']: (image['width'], image['height']) for image in document['images']}
+        self.assertEqual(images, {self.positive.image_name: (640, 480), self.negative.image_name: (1000, 800)})
+        bboxes = [(a['image_id'], a['category_id'], a['bbox']) for a in document['annotations']]
+        self.assertEqual(bboxes, [
+            (self.positive.pk, 2, [160.0, 240.0, 64.0, 96.0]),
+            (self.positive.pk, 1, [160.0, 240.0, 64.0, 96.0]),
+            (self.negative.pk, 1, [250.0, 400.0, 100.0, 160.0]),
+        ])
+        self.assertEqual([a['id'] for a in document['annotations']], [1, 2, 3])
+        self.assertEqual(document['annotations'][2]['score'], 0.5)
+
+    def test_small_chunks_join_into_the_same_document(self):
+        case_images = CaseImage.objects.all()
+        chunks = list(iter_coco_export(case_images, chunk_size=1))
+
+        self.assertGreater(len(chunks), 4)
+        document, whole = json.loads(''.join(chunks)), json.loads(''.join(iter_coco_export(case_images)))
+        for key in ('images', 'annotations', 'categories'):
+            self.assertEqual(document[key], whole[key])
+
+    def test_filters(self):
+        document = self.export(diagnosis='negative')
+
+        self.assertEqual([image['id'] for image in document['images']], [self.negative.pk])
+        self.assertEqual({a['image_id'] for a in document['annotations']}, {self.negative.pk})
+        self.assertEqual(self.client.get('/api/export/coco/', {'diagnosis': 'unsure'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/export/coco/', {'date_from': 'May'}).status_code, 400)
+
+    def test_images_of_unknown_size_are_left_out(self):
+        CaseImage.objects.filter(pk=self.negative.pk).update(width=None, height=None)
+
+        with self.assertLogs('forms', 'WARNING'):
+            document = self.export()
+
+        self.assertEqual([image['id'] for image in document['images']], [self.positive.pk])
+        self.assertEqual({a['image_id'] for a in document['annotations']}, {self.positive.pk})
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class CocoImportTests(TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(dir=MEDIA_ROOT)
+        with open(os.path.join(self.workdir, 'unsized.jpg'), 'wb') as f:
+            f.write(synthetic_image(3))
+
+    def run_import(self, images, annotations, images_dir=''):
+        source = os.path.join(self.workdir, 'dataset.coco.json')
+        with open(source, 'w', encoding='utf-8') as f:
+            json.dump({
+                'categories': [{'id': 1, 'name': 'Negative'}, {'id': 2, 'name': 'Positive'}],
+                'images': images, 'annotations': annotations,
+            }, f)
+        return run_import(create_import_job(source, images_dir=images_dir))
+
+    def sessions(self, source_image_id):
+        image = ImportedImage.objects.select_related('annotation', 'prediction').get(source_image_id=source_image_id)
+        return image.annotation, image.prediction
+
+    def test_boxes_are_relative_to_the_image_size(self):
+        job = self.run_import(
+            [{'id': 7, 'file_name': 'sized.jpg', 'width': 400, 'height': 200}],
+            [{'id': 1, 'image_id': 7, 'category_id': 2, 'bbox': [100, 50, 40, 20]},
+             {'id': 2, 'image_id': 7, 'category_id': 1, 'bbox': [0, 0, 200, 100], 'score': 0.75}],
+        )
+
+        self.assertEqual((job.phase, job.annotations_done, job.annotations_skipped), ('done', 2, 0))
+        annotation, prediction = self.sessions(7)
+        labelled, = annotation.annotations_data['annotations']
+        self.assertEqual([labelled[key] for key in ('relativeX', 'relativeY', 'relativeWidth', 'relativeHeight')],
+                         [0.25, 0.25, 0.1, 0.1])
+        self.assertEqual((prediction.source, prediction.total_annotations), (Annotation.MODEL, 1))
+        self.assertEqual(annotation.case_image.diagnosis, 'Positive')
+
+    def test_size_is_read_from_images_dir(self):
+        job = self.run_import(
+            [{'id': 7, 'file_name': 'unsized.jpg'}],
+            [{'id': 1, 'image_id': 7, 'category_id': 2, 'bbox': [64, 128, 32, 32]}],
+            images_dir=self.workdir,
+        )
+
+        self.assertEqual(job.annotations_skipped, 0)
+        annotation, _ = self.sessions(7)
+        self.assertEqual((annotation.case_image.width, annotation.case_image.height), (IMAGE_SIZE, IMAGE_SIZE))
+        labelled, = annotation.annotations_data['annotations']
+        self.assertEqual((labelled['relativeX'], labelled['relativeY']), (0.1, 0.2))
+
+    def test_boxes_of_images_of_unknown_size_are_skipped(self):
+        job = self.run_import(
+            [{'id': 7, 'file_name': 'missing.jpg'}, {'id': 8, 'file_name': 'sized.jpg', 'width': 400, 'height': 200}],
+            [{'id': 1, 'image_id': 7, 'category_id': 2, 'bbox': [10, 10, 20, 20]},
+             {'id': 2, 'image_id': 7, 'category_id': 2, 'bbox': [10, 10, 20, 20], 'score': 0.5},
+             {'id': 3, 'image_id': 8, 'category_id': 1, 'bbox': [10, 10, 20, 20]}],
+        )
+
+        self.assertEqual((job.annotations_done, job.annotations_skipped), (3, 2))
+        self.assertEqual(self.sessions(7), (None, None))
+        self.assertEqual(ImportedImage.objects.get(source_image_id=7).case_image.diagnosis, NOT_ANNOTATED)
+        self.assertEqual(self.sessions(8)[0].total_annotations, 1)
+
+    def test_boxes_with_ids_beyond_int32_are_skipped(self):
+        job = self.run_import(
+            [{'id': 7, 'file_name': 'sized.jpg', 'width': 400, 'height': 200}],
+            [{'id': 2 ** 31 - 1, 'image_id': 7, 'category_id': 2, 'bbox': [10, 10, 20, 20]},
+             {'id': 2 ** 31, 'image_id': 7, 'category_id': 2, 'bbox': [10, 10, 20, 20]},
+             {'id': 'a', 'image_id': 7, 'category_id': 1, 'bbox': [10, 10, 20, 20]}],
+        )
+
+        self.assertEqual((job.phase, job.annotations_done, job.annotations_skipped), ('done', 3, 2))
+        annotation, _ = self.sessions(7)
+        self.assertEqual([box['id'] for box in annotation.annotations_data['annotations']], [2 ** 31 - 1])
+        self.assertEqual([box['id'] for box in packed_session(annotation).to_dicts()], [2 ** 31 - 1])
+
+
+class PatientIDSequenceTests(TransactionTestCase):
+    period = '2024-05'
+
+    def allocate_concurrently(self, threads, count):
+        barrier = threading.Barrier(threads)
+        results, errors = [], []
+
+        def allocate():
+            try:
+                barrier.wait()
+                for _ in range(5):
+                    results.append(PatientIDSequence.allocate(self.period, count))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=allocate) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+        return results
+
+    def test_concurrent_allocations_get_disjoint_ranges(self):
+        results = self.allocate_concurrently(threads=6, count=3)
+
+        issued = sorted(n for last in results for n in range(last - 2, last + 1))
+        self.assertEqual(issued, list(range(1, 6 * 5 * 3 + 1)))
+        self.assertEqual(PatientIDSequence.objects.get(period=self.period).last_value, 90)
+
+    def test_first_allocation_continues_after_issued_ids(self):
+        Forms.objects.create(PatientID=f'{self.period}-000041', Image='cases/issued.jpg')
+
+        results = self.allocate_concurrently(threads=4, count=1)
+
+        self.assertEqual(sorted(results), list(range(42, 62)))
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class DerivativeTests(TestCase):
+    def setUp(self):
+        self.form = stored_case(5)
+        # Hashed at upload, but the derivatives were never generated
+        self.form.ImageHash, self.form.ImagePHash = hash_field_file(self.form.Image)
+        self.form.save()
+
+    def stored(self):
+        return [default_storage.exists(derivative_name(self.form.ImageHash, size)) for size in DERIVATIVE_SIZES]
+
+    def test_urls_are_lazy_until_the_derivatives_are_stored(self):
+        self.assertEqual(derivative_urls(self.form), lazy_derivative_urls(self.form))
+
+        response = self.client.get(f'/case/{self.form.CaseID}/image/thumb/')
+
+        self.form.refresh_from_db()
+        self.assertIsNotNone(self.form.DerivativesAt)
+        self.assertEqual(self.stored(), [True, True])
+        direct = derivative_urls(self.form)
+        self.assertEqual(direct['thumb'], default_storage.url(derivative_name(self.form.ImageHash, 'thumb')))
+        self.assertRedirects(response, direct['thumb'], fetch_redirect_response=False)
+
+    def test_generate_derivatives_command(self):
+        broken = Forms.objects.create(Image='cases/missing.jpg', ImageHash='0' * 64)
+        stderr = StringIO()
+
+        call_command('generate_derivatives', stdout=StringIO(), stderr=stderr)
+
+        self.form.refresh_from_db()
+        self.assertIsNotNone(self.form.DerivativesAt)
+        self.assertEqual(self.stored(), [True, True])
+        self.assertIn(f'Case {broken.CaseID}', stderr.getvalue())
+        self.assertEqual(derivative_urls(Forms.objects.get(pk=broken.pk)), lazy_derivative_urls(broken))
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class MediaTests(TestCase):
+    def setUp(self):
+        self.form = stored_case(8)
+        self.form.ImageHash, self.form.ImagePHash = hash_field_file(self.form.Image)
+        self.form.save()
+        self.url = f'/media/{self.form.Image.name}'
+        self.data = synthetic_image(8)
+
+    def get(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        response.body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response
+
+    def test_case_image_etag_is_its_recorded_hash(self):
+        with mock.patch('forms.media._content_hash', side_effect=AssertionError('file was hashed')):
+            response = self.get()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], f'"{self.form.ImageHash}"')
+        self.assertEqual(response.body, self.data)
+
+    def test_range(self):
+        response = self.get(Range='bytes=10-19')
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.data)}')
+        self.assertEqual(response.body, self.data[10:20])
+        self.assertEqual(self.get(Range='bytes=-5').body, self.data[-5:])
+
+    def test_unsatisfiable_range(self):
+        response = self.get(Range=f'bytes={len(self.data)}-')
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.data)}')
+
+    def test_if_range(self):
+        etag = f'"{self.form.ImageHash}"'
+
+        stale = self.get(Range='bytes=0-9', **{'If-Range': '"' + '0' * 64 + '"'})
+        current = self.get(Range='bytes=0-9', **{'If-Range': etag})
+
+        self.assertEqual((stale.status_code, stale.body), (200, self.data))
+        self.assertEqual((current.status_code, current.body), (206, self.data[:10]))
+
+    def test_if_none_match(self):
+        etag = f'"{self.form.ImageHash}"'
+
+        for header in (etag, f'W/{etag}', f'"other", {etag}', '*'):
+            with self.subTest(header=header):
+                response = self.get(**{'If-None-Match': header})
+                self.assertEqual((response.status_code, response.body), (304, b''))
+                self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.get(**{'If-None-Match': '"other"'}).status_code, 200)
+
+    def test_derivatives_are_immutable(self):
+        location = self.client.get(f'/case/{self.form.CaseID}/image/thumb/')['Location']
+
+        response = self.client.get(location)
+
+        self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(response['ETag'], f'"{os.path.basename(location)}"')
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        self.image = synthetic_image(17)
+
+    def start(self, image, **fields):
+        response = self.client.post('/upload/chunked/', {'filename': 'case.jpg', 'size': len(image), **fields},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        return response.json()['upload_id']
+
+    def put(self, upload_id, chunk, offset, checksum=None):
+        headers = {'Upload-Offset': str(offset)}
+        if checksum:
+            headers['Upload-Checksum'] = checksum
+        return self.client.put(f'/upload/chunked/{upload_id}/', chunk, content_type='application/octet-stream',
+                               headers=headers)
+
+    def finalize(self, upload_id):
+        return self.client.post(f'/upload/chunked/{upload_id}/finalize/')
+
+    def send(self, upload_id, image, chunk_size):
+        for offset in range(0, len(image), chunk_size):
+            response = self.put(upload_id, image[offset:offset + chunk_size], offset)
+            self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_offset_advances_per_chunk(self):
+        upload_id = self.start(self.image)
+        half = len(self.image) // 2
+
+        response = self.put(upload_id, self.image[:half], 0, hashlib.sha256(self.image[:half]).hexdigest())
+
+        self.assertEqual(response.json()['offset'], half)
+        self.assertEqual(self.client.get(f'/upload/chunked/{upload_id}/').json()['offset'], half)
+
+    def test_chunk_at_the_wrong_offset_reports_where_to_resume(self):
+        upload_id = self.start(self.image)
+        self.put(upload_id, self.image[:100], 0)
+
+        response = self.put(upload_id, self.image[:100], 0)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 100)
+
+    def test_chunk_checksum_mismatch_is_discarded(self):
+        upload_id = self.start(self.image)
+
+        response = self.put(upload_id, self.image[:100], 0, checksum='0' * 64)
+
+        self.assertEqual(response.status_code, 400)
+        session = UploadSession.objects.get(upload_id=upload_id)
+        self.assertEqual((session.offset, session.parts), (0, []))
+
+    def test_finalize_needs_every_byte(self):
+        upload_id = self.start(self.image)
+        self.put(upload_id, self.image[:100], 0)
+
+        self.assertEqual(self.finalize(upload_id).status_code, 409)
+        self.assertEqual(UploadSession.objects.get(upload_id=upload_id).status, UploadSession.UPLOADING)
+
+    def test_finalize_creates_the_case_once(self):
+        upload_id = self.start(self.image, sha256=hashlib.sha256(self.image).hexdigest())
+        self.send(upload_id, self.image, 1000)
+
+        first = self.finalize(upload_id)
+        retry = self.finalize(upload_id)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.json()['CaseID'], first.json()['CaseID'])
+        form = Forms.objects.get()
+        self.assertEqual(form.Image.read(), self.image)
+        self.assertEqual(form.ImageHash, hashlib.sha256(self.image).hexdigest())
+        self.assertEqual(CaseImage.objects.get(case_id=str(form.CaseID)).width, IMAGE_SIZE)
+        session = UploadSession.objects.get(upload_id=upload_id)
+        self.assertEqual((session.status, session.form), (UploadSession.COMPLETE, form))
+        self.assertFalse(any(default_storage.exists(name) for name in session.parts))
+
+    def test_finalize_checksum_mismatch_can_be_retried(self):
+        upload_id = self.start(self.image, sha256='0' * 64)
+        self.send(upload_id, self.image, 4096)
+
+        response = self.finalize(upload_id)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(Forms.objects.exists())
+        self.assertEqual(UploadSession.objects.get(upload_id=upload_id).status, UploadSession.UPLOADING)
+
+    def test_retry_resumes_from_the_saved_case(self):
+        upload_id = self.start(self.image)
+        self.send(upload_id, self.image, 4096)
+        session = UploadSession.objects.get(upload_id=upload_id)
+
+        with mock.patch('forms.uploads.prepare_case', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                finalize_upload(session)
+        session.refresh_from_db()
+        self.assertEqual((session.status, session.form), (UploadSession.UPLOADING, Forms.objects.get()))
+        self.assertFalse(CaseImage.objects.exists())
+
+        response = self.finalize(upload_id)
+
+        self.assertEqual(response.json()['CaseID'], session.form_id)
+        self.assertEqual(Forms.objects.count(), 1)
+        self.assertTrue(CaseImage.objects.filter(case_id=str(session.form_id)).exists())
+        self.assertEqual(UploadSession.objects.get(upload_id=upload_id).status, UploadSession.COMPLETE)
+
+    def test_stalled_finalize_is_taken_over_from_the_saved_case(self):
+        upload_id = self.start(self.image)
+        self.send(upload_id, self.image, 4096)
+        with mock.patch('forms.uploads.prepare_case', side_effect=OSError('worker killed')):
+            with self.assertRaises(OSError):
+                finalize_upload(UploadSession.objects.get(upload_id=upload_id))
+        stalled = timezone.now() - timedelta(seconds=FINALIZE_TIMEOUT + 1)
+        UploadSession.objects.filter(upload_id=upload_id).update(status=UploadSession.FINALIZING, updated_at=stalled)
+
+        with self.assertLogs('forms.uploads', 'WARNING'):
+            response = self.finalize(upload_id)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['CaseID'], Forms.objects.get().CaseID)
+
+    def test_finalize_after_the_case_was_deleted(self):
+        upload_id = self.start(self.image)
+        self.send(upload_id, self.image, 4096)
+        self.finalize(upload_id)
+        Forms.objects.get().delete()
+
+        response = self.finalize(upload_id)
+
+        self.assertEqual(response.status_code, 410)
+        self.assertFalse(Forms.objects.exists())
+
+    def test_finalize_in_progress_conflicts(self):
+        upload_id = self.start(self.image)
+        self.send(upload_id, self.image, 4096)
+        UploadSession.objects.filter(upload_id=upload_id).update(status=UploadSession.FINALIZING)
+
+        self.assertEqual(self.finalize(upload_id).status_code, 409)
+        self.assertEqual(self.client.delete(f'/upload/chunked/{upload_id}/').status_code, 409)
+        self.assertFalse(Forms.objects.exists())
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class BatchIngestTests(TestCase):
+    def setUp(self):
+        self.images = {'a.jpg': synthetic_image(20), 'b.jpg': synthetic_image(21)}
+
+    def archive(self):
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            archive.writestr('cases/a.jpg', self.images['a.jpg'])
+            archive.writestr('cases/b.jpg', self.images['b.jpg'])
+            archive.writestr('cases/copy-of-a.jpg', self.images['a.jpg'])
+            archive.writestr('cases/broken.jpg', b'not an image')
+            archive.writestr('__MACOSX/cases/._a.jpg', b'resource fork')
+            archive.writestr('notes.txt', b'not an image name')
+        return SimpleUploadedFile('cases.zip', buffer.getvalue(), content_type='application/zip')
+
+    def lines(self, chunks):
+        return [json.loads(line) for line in b''.join(chunks).decode().splitlines()]
+
+    def check_results(self, results):
+        *rows, summary = results
+        self.assertEqual(summary, {'summary': {'created': 3, 'invalid': 1, 'failed': 0}})
+        self.assertEqual([(row['name'], row['status']) for row in rows], [
+            ('cases/a.jpg', 'created'), ('cases/b.jpg', 'created'),
+            ('cases/copy-of-a.jpg', 'created'), ('cases/broken.jpg', 'invalid'),
+        ])
+        first, _, copy = (Forms.objects.get(CaseID=row['CaseID']) for row in rows[:3])
+        # The exact copy shares the first file instead of storing it again
+        self.assertEqual((copy.DuplicateOf, copy.DuplicateDistance, copy.Image.name), (first, 0, first.Image.name))
+        self.assertEqual(first.Image.read(), self.images['a.jpg'])
+        self.assertFalse(Forms.objects.filter(DerivativesAt__isnull=True).exists())
+        self.assertEqual(CaseImage.objects.get(case_id=str(first.CaseID)).width, IMAGE_SIZE)
+
+    def test_zip_archive_streams_a_line_per_image(self):
+        response = self.client.post('/upload/batch/', {'archive': self.archive()})
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.check_results(self.lines(response.streaming_content))
+
+    async def test_zip_archive_streams_under_asgi(self):
+        response = await self.async_client.post('/upload/batch/', {'archive': self.archive()})
+
+        self.assertTrue(response.is_async)
+        results = self.lines([chunk async for chunk in response.streaming_content])
+        await sync_to_async(self.check_results)(results)
+
+    def test_directory(self):
+        root = tempfile.mkdtemp(dir=MEDIA_ROOT)
+        for name, data in self.images.items():
+            with open(os.path.join(root, name), 'wb') as f:
+                f.write(data)
+
+        with override_settings(INGEST_DIRECTORIES=[root]):
+            response = self.client.post('/upload/batch/', {'directory': root})
+        *rows, summary = self.lines(response.streaming_content)
+
+        self.assertEqual([(row['name'], row['status']) for row in rows], [('a.jpg', 'created'), ('b.jpg', 'created')])
+        self.assertEqual(self.client.post('/upload/batch/', {'directory': root}).status_code, 403)
+
+    def test_bad_requests(self):
+        not_zip = SimpleUploadedFile('cases.zip', b'not a zip file')
+
+        self.assertEqual(self.client.post('/upload/batch/', {'archive': not_zip}).status_code, 400)
+        self.assertEqual(self.client.post('/upload/batch/').status_code, 400)
+
+    def test_failed_derivatives_are_logged_and_served_lazily(self):
+        with mock.patch('forms.ingest.ensure_derivatives', side_effect=OSError('disk full')):
+            with self.assertLogs('forms.ingest', 'WARNING') as logs:
+                response = self.client.post('/upload/batch/', {'archive': self.archive()})
+                results = self.lines(response.streaming_content)
+
+        self.assertEqual(results[-1]['summary']['created'], 3)
+        self.assertIn('disk full', logs.output[0])
+        form = Forms.objects.get(CaseID=results[0]['CaseID'])
+        self.assertIsNone(form.DerivativesAt)
+        self.assertEqual(derivative_urls(form), lazy_derivative_urls(form))
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class InferenceDispatcherTests(TransactionTestCase):
+    def setUp(self):
+        # Batches run in the dispatcher thread rather than worker processes
+        self.service = InferenceService({
+            **settings.INFERENCE, 'WORKERS': 0, 'MAX_BATCH_SIZE': 3, 'MAX_BATCH_WAIT': 0.5,
+        })
+        self.batches = []
+
+    def run_batch(self, model_id, image_names):
+        self.batches.append(len(image_names))
+        return run_batch(model_id, image_names)
+
+    def test_cases_are_predicted_in_micro_batches(self):
+        forms = [stored_case(seed) for seed in range(7)]
+
+        with mock.patch('forms.inference.run_batch', self.run_batch):
+            self.service.submit([form.CaseID for form in forms])
+            self.assertTrue(self.service.wait(30))
+
+        self.assertEqual(sorted(self.batches), [1, 3, 3])
+        for form in Forms.objects.all():
+            self.assertEqual(form.InferenceStatus, Forms.INFERENCE_DONE)
+            self.assertIn(form.Diagnosis, ('Positive', 'Negative'))
+            prediction = Annotation.objects.get(case_image__case_id=str(form.CaseID), source=Annotation.MODEL)
+            self.assertGreater(prediction.total_annotations, 0)
+            self.assertTrue(all(0.5 <= box['confidence'] <= 1 for box in prediction.annotations_data['annotations']))
+            self.assertEqual(CaseImage.objects.get(case_id=str(form.CaseID)).width, IMAGE_SIZE)
+        # Only model sessions were written: the doctor diagnosis is untouched
+        self.assertFalse(CaseImage.objects.exclude(diagnosis=NOT_ANNOTATED).exists())
+
+    def test_failures_are_recorded_per_case(self):
+        readable = stored_case(1)
+        unreadable = Forms.objects.create(Image='cases/missing.jpg')
+        deleted = stored_case(2)
+        case_ids = [readable.CaseID, unreadable.CaseID, deleted.CaseID]
+        deleted.delete()
+
+        with self.assertLogs('forms.inference', 'WARNING'):
+            self.service.submit(case_ids)
+            self.assertTrue(self.service.wait(30))
+
+        statuses = dict(Forms.objects.values_list('CaseID', 'InferenceStatus'))
+        self.assertEqual(statuses, {readable.CaseID: Forms.INFERENCE_DONE, unreadable.CaseID: Forms.INFERENCE_FAILED})
+
+    def test_a_failed_batch_fails_its_cases(self):
+        form = stored_case(3)
+
+        with mock.patch('forms.inference.run_batch', side_effect=RuntimeError('model crashed')):
+            with self.assertLogs('forms.inference', 'ERROR'):
+                self.service.submit([form.CaseID])
+                self.assertTrue(self.service.wait(30))
+
+        form.refresh_from_db()
+        self.assertEqual((form.InferenceStatus, form.Diagnosis), (Forms.INFERENCE_FAILED, ''))
+
+
+class FakeOnnxSession:
+    """Stands in for onnxruntime.InferenceSession with a fixed YOLOv8-layout output."""
+    # cx, cy, w, h in input pixels, then the negative and positive class scores
+    anchors = [
+        (16, 16, 8, 8, 0.1, 0.9),
+        (17, 16, 8, 8, 0.2, 0.8),  # Overlaps the first: suppressed
+        (40, 20, 10, 6, 0.7, 0.1),
+        (50, 10, 4, 4, 0.1, 0.2),  # Below SCORE_THRESHOLD
+    ]
+
+    def __init__(self, path, options, providers):
+        self.inputs = []
+
+    def get_inputs(self):
+        return [types.SimpleNamespace(name='images')]
+
+    def run(self, outputs, feed):
+        import numpy as np
+        batch = feed['images']
+        self.inputs.append(batch)
+        return [np.repeat(np.array(self.anchors, dtype=np.float32).T[None], len(batch), axis=0)]
+
+
+class OnnxBackendTests(TestCase):
+    config = {'PATH': 'model.onnx', 'INPUT_SIZE': 64, 'VERSION': '2'}
+
+    def backend(self):
+        onnxruntime = types.SimpleNamespace(
+            SessionOptions=types.SimpleNamespace, InferenceSession=FakeOnnxSession,
+        )
+        with mock.patch.dict(sys.modules, {'onnxruntime': onnxruntime}):
+            return OnnxBackend('yolo', self.config)
+
+    def test_missing_runtime(self):
+        with mock.patch.dict(sys.modules, {'onnxruntime': None}):
+            with self.assertRaises(ImproperlyConfigured):
+                OnnxBackend('yolo', self.config)
+
+    def test_boxes_are_decoded_to_image_pixels(self):
+        from PIL import Image
+
+        backend = self.backend()
+        # Letterboxed into the 64 pixel input at half scale
+        boxes, = backend.predict_batch([Image.new('RGB', (128, 64))])
+
+        batch, = backend.session.inputs
+        self.assertEqual((batch.shape, str(batch.dtype)), ((1, 3, 64, 64), 'float32'))
+        self.assertEqual(backend.version, '2')
+        self.assertEqual([(box['label'], box['confidence']) for box in boxes], [('positive', 0.9), ('negative', 0.7)])
+        self.assertEqual([[box[key] for key in ('x', 'y', 'width', 'height')] for box in boxes],
+                         [[24.0, 24.0, 16.0, 16.0], [70.0, 34.0, 20.0, 12.0]])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class PredictionCacheTests(TestCase):
+    boxes = [{'x': 64, 'y': 48, 'width': 32, 'height': 24, 'label': 'positive', 'confidence': 0.8}]
+
+    def case(self, image_hash):
+        form, _ = create_case()
+        Forms.objects.filter(pk=form.pk).update(ImageHash=image_hash)
+        form.refresh_from_db()
+        return form
+
+    def predictions(self, form):
+        return Annotation.objects.filter(case_image__case_id=str(form.CaseID), source=Annotation.MODEL)
+
+    def request(self, form):
+        """Case ids the request sent to the model."""
+        with mock.patch('forms.inference.get_service') as get_service:
+            with self.captureOnCommitCallbacks(execute=True):
+                request_inference([form])
+        return [case_ids for (case_ids, model_id), _ in get_service.return_value.submit.call_args_list]
+
+    def test_miss_queues_the_case(self):
+        form = self.case('a' * 64)
+
+        self.assertEqual(self.request(form), [[form.CaseID]])
+        form.refresh_from_db()
+        self.assertEqual(form.InferenceStatus, Forms.INFERENCE_PENDING)
+        self.assertFalse(self.predictions(form).exists())
+
+    def test_hit_is_answered_without_the_model(self):
+        seen = self.case('a' * 64)
+        cache_predictions('dummy', '1', [seen], [(640, 480, self.boxes)])
+        upload = self.case('a' * 64)
+
+        self.assertEqual(self.request(upload), [])
+        upload.refresh_from_db()
+        self.assertEqual((upload.InferenceStatus, upload.Diagnosis, upload.Confidence),
+                         (Forms.INFERENCE_DONE, 'Positive', '80%'))
+        stored, = self.predictions(upload).get().annotations_data['annotations']
+        self.assertEqual((stored['relativeX'], stored['relativeY'], stored['confidence']), (0.1, 0.1, 0.8))
+        self.assertEqual(PredictionCache.objects.get().hits, 1)
+
+    def test_other_model_versions_miss_and_are_dropped(self):
+        seen = self.case('a' * 64)
+        cache_predictions('dummy', '0', [seen], [(640, 480, self.boxes)])
+        upload = self.case('a' * 64)
+
+        self.assertEqual(self.request(upload), [[upload.CaseID]])
+
+        cache_predictions('dummy', '1', [seen], [(640, 480, self.boxes)])
+        self.assertEqual(list(PredictionCache.objects.values_list('model_version', flat=True)), ['1'])
+
+    def test_failed_outputs_are_not_cached(self):
+        cache_predictions('dummy', '1', [self.case('a' * 64)], ['Could not read image'])
+
+        self.assertFalse(PredictionCache.objects.exists())
+
+    @override_settings(INFERENCE={**settings.INFERENCE, 'CACHE_SIZE': 2})
+    def test_least_recently_used_entries_are_evicted(self):
+        first, second, third = (self.case(character * 64) for character in 'abc')
+        cache_predictions('dummy', '1', [first, second], [(640, 480, self.boxes)] * 2)
+        self.request(self.case('a' * 64))  # A hit makes the first entry recent
+
+        cache_predictions('dummy', '1', [third], [(640, 480, self.boxes)])
+
+        self.assertEqual(sorted(PredictionCache.objects.values_list('image_hash', flat=True)), ['a' * 64, 'c' * 64])
+
+
+class BKTreeTests(TestCase):
+    def test_search_matches_a_linear_scan(self):
+        rng = random.Random(4)
+        values = [rng.getrandbits(64) for _ in range(500)]
+        # Near copies of a few values, so small distances are populated too
+        values += [value ^ (1 << rng.randrange(64)) ^ (1 << rng.randrange(64)) for value in values[:50]]
+        tree = BKTree()
+        for index, value in enumerate(values):
+            tree.add(value, index)
+
+        for query in values[:20] + [rng.getrandbits(64) for _ in range(20)]:
+            for max_distance in (0, 2, 6, 20):
+                expected = sorted(((value ^ query).bit_count(), index) for index, value in enumerate(values)
+                                  if (value ^ query).bit_count() <= max_distance)
+                self.assertEqual(tree.search(query, max_distance), expected)
+        self.assertEqual(tree.size, len(values))
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class DuplicateTests(TestCase):
+    def setUp(self):
+        # The process-wide index would otherwise remember cases of earlier tests
+        patcher = mock.patch('forms.duplicates._index', DuplicateIndex())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.image = synthetic_image(30)
+
+    def upload(self, data):
+        response = self.client.post('/upload/', {'image': SimpleUploadedFile('case.jpg', data)})
+        self.assertEqual(response.status_code, 200)
+        return Forms.objects.get(CaseID=response.json()['CaseID'])
+
+    def stored_uploads(self):
+        return sorted(os.path.join(root, name) for root, _, names in os.walk(default_storage.path('uploads'))
+                      for name in names)
+
+    def recompressed(self, size):
+        from PIL import Image
+
+        buffer = BytesIO()
+        with Image.open(BytesIO(self.image)) as image:
+            image.resize((size, size)).save(buffer, 'JPEG', quality=60)
+        return buffer.getvalue()
+
+    def test_exact_copy_shares_the_stored_file(self):
+        first = self.upload(self.image)
+        stored = self.stored_uploads()
+
+        copy = self.upload(self.image)
+
+        self.assertEqual((copy.DuplicateOf, copy.DuplicateDistance), (first, 0))
+        self.assertEqual(copy.Image.name, first.Image.name)
+        self.assertEqual(CaseImage.objects.get(case_id=str(copy.CaseID)).image_path, first.Image.name)
+        # The copy's own upload was removed
+        self.assertEqual(self.stored_uploads(), stored)
+
+    def test_near_copy_is_linked_but_stored(self):
+        first = self.upload(self.image)
+        other = self.upload(synthetic_image(31))
+
+        near = self.upload(self.recompressed(480))
+
+        self.assertEqual(near.DuplicateOf, first)
+        self.assertLessEqual(near.DuplicateDistance, 6)
+        self.assertNotEqual(near.Image.name, first.Image.name)
+        self.assertIsNone(other.DuplicateOf)
+
+    def test_copies_link_to_the_earliest_case(self):
+        first = self.upload(self.image)
+        near = self.upload(self.recompressed(480))
+
+        copy_of_near = self.upload(self.recompressed(480))
+
+        self.assertEqual(copy_of_near.DuplicateOf, first)
+        self.assertEqual(copy_of_near.Image.name, near.Image.name)
+
+    def test_deleting_a_case_keeps_files_other_cases_share(self):
+        first = self.upload(self.image)
+        copy = self.upload(self.image)
+        derivatives = [derivative_name(first.ImageHash, size) for size in DERIVATIVE_SIZES]
+
+        self.assertEqual(self.client.delete(f'/case/{first.CaseID}/').status_code, 200)
+
+        self.assertTrue(default_storage.exists(first.Image.name))
+        self.assertTrue(all(default_storage.exists(name) for name in derivatives))
+        self.assertEqual(self.client.get(f'/media/{copy.Image.name}').status_code, 200)
+
+        self.assertEqual(self.client.delete(f'/case/{copy.CaseID}/').status_code, 200)
+
+        self.assertFalse(default_storage.exists(first.Image.name))
+        self.assertFalse(any(default_storage.exists(name) for name in derivatives))
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, RESPONSE_CACHE={'ENABLED': False})
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.form, self.case_image = create_case()
+        self.boxes = [
+            box(1, 100, 100, 50, 40, 'positive', 800, 600),
+            box(2, 300, 200, 60, 60, 'negative', 800, 600),
+        ]
+        ingest_annotation_sessions([
+            doctor_session(self.case_image, [box(1, 10, 10, 20, 20, 'negative', 800, 600)]),
+            doctor_session(self.case_image, self.boxes),
+        ])
+
+    async def test_case_detail_returns_the_latest_session(self):
+        response = await self.async_client.get(f'/case/{self.form.CaseID}/')
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data['CaseID'], data['Diagnosis']), (self.form.CaseID, 'Positive'))
+        self.assertEqual([item['label'] for item in data['annotations']], ['positive', 'negative'])
+        self.assertEqual((await self.async_client.get('/case/999999/')).status_code, 404)
+
+    async def test_get_and_list_annotations(self):
+        _, unannotated = await sync_to_async(create_case)()
+
+        response = await self.async_client.get(f'/api/annotations/{self.case_image.case_id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['data']['annotations']), 2)
+        response = await self.async_client.get(f'/api/annotations/{unannotated.case_id}/')
+        self.assertEqual(response.json()['data']['annotations'], [])
+        self.assertEqual((await self.async_client.get('/api/annotations/999999/')).status_code, 404)
+        self.assertEqual((await self.async_client.post(f'/api/annotations/{self.case_image.case_id}/')).status_code,
+                         405)
+
+        response = await self.async_client.get('/api/annotations/list/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 1)
+        self.assertEqual(response.json()['data'][0]['case_id'], self.case_image.case_id)
+
+    async def test_delete_removes_the_case_and_its_files(self):
+        form = await sync_to_async(stored_case)(40)
+        await sync_to_async(ensure_derivatives)(form)
+        files = [form.Image.name] + [derivative_name(form.ImageHash, size) for size in DERIVATIVE_SIZES]
+
+        response = await self.async_client.delete(f'/case/{form.CaseID}/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(await Forms.objects.filter(pk=form.pk).aexists())
+        self.assertFalse(any(default_storage.exists(name) for name in files))
+
+    async def test_delete_logs_files_it_cannot_remove(self):
+        form = await sync_to_async(stored_case)(41)
+        await sync_to_async(ensure_derivatives)(form)
+
+        with mock.patch('forms.views.delete_stored_file', side_effect=OSError('read-only')), \
+                self.assertLogs('forms.views', 'WARNING') as logs:
+            response = await self.async_client.delete(f'/case/{form.CaseID}/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(await Forms.objects.filter(pk=form.pk).aexists())
+        self.assertEqual(len(logs.records), 1 + len(DERIVATIVE_SIZES))
+        self.assertIn('read-only', logs.records[0].getMessage())
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class ResponseCacheTests(TestCase):
+    def setUp(self):
+        get_cache().clear()
+        _, self.case_image = create_case()
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_case_reads_are_cached_until_a_save(self):
+        url = f'/api/annotations/{self.case_image.case_id}/'
+        self.assertEqual(self.get(url)['X-Cache'], 'MISS')
+        self.assertEqual(self.get(url)['X-Cache'], 'HIT')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ingest_annotation_sessions([
+                doctor_session(self.case_image, [box(1, 10, 10, 20, 20, 'negative', 800, 600)]),
+            ])
+
+        response = self.get(url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json()['data']['diagnosis'], 'Negative')
+        self.assertEqual(self.get(url)['X-Cache'], 'HIT')
+
+    def test_save_expires_the_listing_but_not_other_cases(self):
+        _, other = create_case()
+        other_url = f'/api/annotations/{other.case_id}/'
+        self.get('/list/')
+        self.get(other_url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ingest_annotation_sessions([
+                doctor_session(self.case_image, [box(1, 10, 10, 20, 20, 'positive', 800, 600)]),
+            ])
+
+        listing = self.get('/list/')
+        self.assertEqual(listing['X-Cache'], 'MISS')
+        diagnoses = {form['CaseID']: form['Diagnosis'] for form in listing.json()['forms']}
+        self.assertEqual(diagnoses[int(self.case_image.case_id)], 'Positive')
+        self.assertEqual(self.get(other_url)['X-Cache'], 'HIT')
+
+    def test_rolled_back_writes_keep_the_cache(self):
+        url = f'/api/annotations/{self.case_image.case_id}/'
+        self.get(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    invalidate_cases([self.case_image.case_id])
+                    raise DatabaseError
+            except DatabaseError:
+                pass
+
+        self.assertEqual(self.get(url)['X-Cache'], 'HIT')
+
+
+PROFILING = {'ENABLED': True, 'SERVER_TIMING': True, 'PROFILE_SAMPLE_RATE': 0.0}
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, RESPONSE_CACHE={'ENABLED': False}, PROFILING=PROFILING)
+class ProfilingTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch('forms.profiling.metrics', Metrics((0.1, 1.0)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.form, self.case_image = create_case()
+
+    def metrics(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        return response.content.decode().splitlines()
+
+    def sample(self, lines, name, labels):
+        prefix = f'{name}{{{labels}}} '
+        return [float(line[len(prefix):]) for line in lines if line.startswith(prefix)]
+
+    def test_requests_are_counted_per_route(self):
+        for _ in range(2):
+            response = self.client.get('/list/')
+            self.assertIn('db;dur=', response['Server-Timing'])
+        self.client.get('/case/999999/')
+
+        lines = self.metrics()
+
+        self.assertEqual(self.sample(lines, 'cdss_requests_total', 'route="list/",method="GET",status="200"'), [2])
+        self.assertEqual(
+            self.sample(lines, 'cdss_requests_total', 'route="case/<int:case_id>/",method="GET",status="404"'), [1]
+        )
+        self.assertEqual(
+            self.sample(lines, 'cdss_request_duration_seconds_count', 'route="list/",method="GET"'), [2]
+        )
+        self.assertGreater(self.sample(lines, 'cdss_db_queries_total', 'route="list/",method="GET"')[0], 0)
+        self.assertGreater(self.sample(lines, 'cdss_response_bytes_total', 'route="list/",method="GET"')[0], 0)
+
+    async def test_queries_of_async_views_are_counted(self):
+        response = await self.async_client.get(f'/case/{self.form.CaseID}/')
+        self.assertEqual(response.status_code, 200)
+        queries = int(response['Server-Timing'].split('desc="')[1].split(' ')[0])
+        self.assertGreater(queries, 0)
+
+        lines = await sync_to_async(self.metrics)()
+        self.assertEqual(self.sample(lines, 'cdss_db_queries_total', 'route="case/<int:case_id>/",method="GET"'),
+                         [queries])
+
+    def test_slow_sampled_requests_are_profiled(self):
+        directory = tempfile.mkdtemp(dir=MEDIA_ROOT)
+        config = {**PROFILING, 'PROFILE_SAMPLE_RATE': 1.0, 'PROFILE_SLOW_MS': 0, 'PROFILE_DIR': directory}
+
+        with self.settings(PROFILING=config), self.assertLogs('forms.profiling', 'WARNING'):
+            self.client.get('/list/')
+
+        [dump] = os.listdir(directory)
+        self.assertTrue(dump.endswith('.prof'))
+        self.assertIn('_GET_list_', dump)
+
+    @override_settings(PROFILING={'ENABLED': False})
+    def test_metrics_are_not_served_while_disabled(self):
+        response = self.client.get('/list/')
+
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, RESPONSE_CACHE={'ENABLED': False})
+class BenchmarkTests(TestCase):
+    def test_percentile_interpolates(self):
+        values = [10.0, 20.0, 30.0, 40.0]
+        self.assertEqual([percentile(values, fraction) for fraction in (0, 0.5, 0.9, 1)], [10.0, 25.0, 37.0, 40.0])
+        self.assertEqual(percentile([5.0], 0.99), 5.0)
+        self.assertEqual(percentile([], 0.5), 0.0)
+
+    def test_regressions_against_a_baseline(self):
+        baseline = {'results': {
+            'list_forms': {'p95_ms': 10.0, 'queries_mean': 3},
+            'case_detail': {'p95_ms': 10.0, 'queries_mean': 3},
+        }}
+        results = {
+            'list_forms': {'p95_ms': 11.9, 'queries_mean': 3},
+            'case_detail': {'p95_ms': 12.5, 'queries_mean': 4},
+            'upload_image': {'p95_ms': 100.0, 'queries_mean': 10},
+        }
+
+        regressions = compare_to_baseline(results, baseline, 0.2)
+
+        self.assertEqual([name for name, _ in regressions], ['case_detail', 'case_detail'])
+        self.assertIn('p95 10.0 -> 12.5 ms', regressions[0][1])
+
+    def test_workloads_run_against_the_synthetic_dataset(self):
+        job = load_synthetic_dataset(tempfile.mkdtemp(dir=MEDIA_ROOT), 3, 2, seed=7)
+        self.assertEqual((job.phase, job.images_done, job.annotations_done), ('done', 3, 6))
+
+        for workload in build_workloads(2, seed=7):
+            with self.subTest(workload.name):
+                result = run_workload(workload, 3, seed=7)
+                self.assertEqual((result['iterations'], result['errors']), (3, 0))
+                self.assertGreater(result['queries_max'], 0)
+                self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+
+def naive_iou(a, b):
+    width = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    height = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def naive_nms(boxes, scores, iou_threshold, labels=None):
+    keep = []
+    for index in sorted(range(len(boxes)), key=lambda index: -scores[index]):
+        if all(naive_iou(boxes[index], boxes[kept]) <= iou_threshold
+               for kept in keep if labels is None or labels[kept] == labels[index]):
+            keep.append(index)
+    return keep
+
+
+class GeometryTests(TestCase):
+    def random_boxes(self, count, extent, seed):
+        rng = np.random.default_rng(seed)
+        corners = rng.uniform(0, extent, (count, 2))
+        boxes = np.concatenate([corners, corners + rng.uniform(20, 60, (count, 2))], axis=1)
+        boxes[0, 2:] = boxes[0, :2]  # A zero-area box
+        return boxes, rng.random(count), rng.integers(0, 2, count)
+
+    def test_pairwise_iou_matches_a_naive_loop(self):
+        for count in (5, 50, 3000):
+            with self.subTest(count=count):
+                boxes, _, _ = self.random_boxes(count, 400, count)
+                iou = pairwise_iou(boxes)
+                self.assertEqual(iou.shape, (count, count))
+                # Every pair for the small sets, a sample of rows for the large one
+                rows = range(count) if count <= 50 else range(0, count, 150)
+                expected = [[naive_iou(boxes[row], other) for other in boxes] for row in rows]
+                np.testing.assert_allclose(iou[list(rows)], expected, rtol=1e-12, atol=1e-12)
+                np.testing.assert_allclose(pairwise_iou(boxes[:3], boxes), iou[:3])
+
+    def test_nms_matches_a_naive_loop(self):
+        for count in (5, 50, 3000):
+            boxes, scores, labels = self.random_boxes(count, 100, count + 1)
+            for threshold in (0.3, 0.5):
+                with self.subTest(count=count, threshold=threshold):
+                    self.assertEqual(nms(boxes, scores, threshold).tolist(), naive_nms(boxes, scores, threshold))
+                    self.assertEqual(nms(boxes, scores, threshold, labels=labels).tolist(),
+                                     naive_nms(boxes, scores, threshold, labels))
+
+    def test_nms_without_the_matrix_gives_the_same_result(self):
+        boxes, scores, labels = self.random_boxes(200, 100, 3)
+        self.assertLess(len(boxes), NMS_MATRIX_LIMIT)
+        expected = nms(boxes, scores, 0.4, labels=labels)
+
+        with mock.patch('forms.geometry.NMS_MATRIX_LIMIT', 0):
+            np.testing.assert_array_equal(nms(boxes, scores, 0.4, labels=labels), expected)
+        self.assertEqual(nms(np.zeros((0, 4)), []).tolist(), [])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class EvaluationTests(TestCase):
+    def setUp(self):
+        self.form, self.case_image = create_case(640, 480)
+        self.relative = (0.25, 0.5, 0.1, 0.2)
+        # Drawn on the 800 pixel labeling canvas, predicted on the 640x480 image
+        ingest_annotation_sessions([
+            doctor_session(self.case_image, [scaled_box(1, self.relative, 'positive', 800, 600)]),
+        ])
+        prediction = scaled_box(0, self.relative, 'positive', 640, 480, confidence=0.9)
+        store_predictions('test-model', '1', [self.form], [(640, 480, [prediction])])
+
+    def evaluate(self):
+        with self.assertLogs('forms.evaluation', 'INFO') as logs:
+            run = run_evaluation('test-model')
+        self.assertEqual(logs.output, ['INFO:forms.evaluation:Evaluated test-model on 1 of 1 cases'])
+        return run
+
+    def test_doctor_canvas_and_model_image_pixels_match(self):
+        run = self.evaluate()
+
+        self.assertEqual(run.cases_evaluated, 1)
+        stats = CaseEvaluation.objects.get(case_image=self.case_image).label_stats['positive']
+        self.assertEqual((stats['tp'], stats['fp'], stats['fn']), (1, 0, 0))
+
+    def test_report_is_only_read_by_get(self):
+        self.assertEqual(self.client.get('/api/evaluation/', {'model': 'test-model'}).status_code, 404)
+        self.assertFalse(CaseEvaluation.objects.exists())
+
+        run = self.evaluate()
+
+        response = self.client.get('/api/evaluation/', {'model': 'test-model'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data']['run'], run.pk)
+        self.assertEqual(response.json()['data']['casesEvaluated'], 1)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class ConsensusTests(TestCase):
+    relative = (0.3, 0.1, 0.2, 0.4)
+
+    def test_fuses_boxes_drawn_on_different_canvases(self):
+        _, case_image = create_case(640, 480)
+        sessions = ingest_annotation_sessions([
+            doctor_session(case_image, [scaled_box(1, self.relative, 'positive', 800, 600)]),
+            doctor_session(case_image, [scaled_box(1, self.relative, 'positive', 1000, 750)]),
+        ])
+        for session, username in zip(sessions, ('first', 'second')):
+            Annotation.objects.filter(pk=session.pk).update(annotated_by=User.objects.create(username=username))
+        update_consensus([case_image.pk])
+
+        consensus = ConsensusAnnotation.objects.get(case_image=case_image)
+        self.assertEqual(consensus.raters, 2)
+        self.assertEqual(consensus.box_agreement['matched'], 1)
+        fused, = consensus.boxes
+        self.assertEqual(fused['support'], 1.0)
+        self.assertEqual(
+            [fused[key] for key in ('relativeX', 'relativeY', 'relativeWidth', 'relativeHeight')],
+            list(self.relative),
+        )
+        # Absolute coordinates are in image pixels, not either canvas's
+        self.assertEqual([fused[key] for key in ('x', 'y', 'width', 'height')], [192.0, 48.0, 128.0, 192.0])
+
+    def test_anonymous_sessions_are_one_rater(self):
+        _, case_image = create_case(640, 480)
+        first = doctor_session(case_image, [scaled_box(1, self.relative, 'positive', 800, 600)])
+        latest = doctor_session(case_image, [scaled_box(1, (0.5, 0.5, 0.1, 0.1), 'negative', 800, 600)])
+        ingest_annotation_sessions([first])
+        ingest_annotation_sessions([latest])
+
+        consensus = ConsensusAnnotation.objects.get(case_image=case_image)
+        self.assertEqual(consensus.raters, 1)
+        self.assertEqual(list(consensus.ratings), ['anonymous'])
+        self.assertEqual([box['label'] for box in consensus.boxes], ['negative'])
+
+
+class BoxPackTests(TestCase):
+    def test_round_trip(self):
+        boxes = [
+            box(-2 ** 31, 10.5, 20.25, 30, 40, 'positive', 800, 600),
+            box(0, 0, 0, 800, 600, 'negative', 800, 600, confidence=0.125),
+            box(2 ** 31 - 1, 799.999, 1.001, 0.5, 0.25, 'positive', 800, 600),
+        ]
+
+        packed = unpack(pack(boxes))
+
+        self.assertEqual(packed.box_ids.tolist(), [-2 ** 31, 0, 2 ** 31 - 1])
+        self.assertEqual(packed.labels, ['positive', 'negative', 'positive'])
+        self.assertEqual(packed.confidences(), [None, 0.125, None])
+        for decoded, original in zip(packed.to_dicts(), boxes):
+            for key in ('x', 'y', 'width', 'height'):
+                self.assertAlmostEqual(decoded[key], original[key], places=3)
+            for key in ('relativeX', 'relativeY', 'relativeWidth', 'relativeHeight'):
+                self.assertAlmostEqual(decoded[key], original[key], places=6)
+        self.assertEqual(len(unpack(pack([]))), 0)
+
+    def test_ids_beyond_int32_are_refused(self):
+        for box_id in (2 ** 31, -2 ** 31 - 1):
+            with self.subTest(box_id=box_id), self.assertRaises(OverflowError):
+                pack([box(box_id, 10, 10, 20, 20, 'negative', 800, 600)])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, SPATIAL_INDEX={'NODE_CAPACITY': 4, 'MAX_PENDING': 10, 'SYNC_LAG': 0})
+class SpatialSearchTests(TestCase):
+    def setUp(self):
+        # The process-wide index would otherwise remember sessions of earlier tests
+        self.index = SpatialIndex()
+        patcher = mock.patch('forms.spatial._index', self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        rng = random.Random(5)
+        self.cases = {}
+        for _ in range(6):
+            _, case_image = create_case()
+            boxes = []
+            for index in range(1, 16):
+                width, height = rng.uniform(20, 200), rng.uniform(20, 150)
+                boxes.append(box(index, rng.uniform(0, 800 - width), rng.uniform(0, 600 - height), width, height,
+                                 rng.choice(['positive', 'negative']), 800, 600))
+            self.cases[case_image.case_id] = boxes
+            self.save(case_image, boxes)
+
+    def save(self, case_image, boxes, **session):
+        response = self.client.post('/api/annotations/', save_payload(case_image, boxes, **session),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        return response.json()
+
+    def search(self, **params):
+        response = self.client.get('/api/boxes/', {'limit': 1000, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['data']
+
+    def found(self, **params):
+        return sorted((item['caseId'], item['boxId']) for item in self.search(**params)['boxes'])
+
+    def expected(self, keep):
+        return sorted((case_id, item['id']) for case_id, boxes in self.cases.items() for item in boxes if keep(
+            (item['relativeX'], item['relativeY'],
+             item['relativeX'] + item['relativeWidth'], item['relativeY'] + item['relativeHeight']),
+            item,
+        ))
+
+    def test_filters_match_a_linear_scan(self):
+        x1, y1, x2, y2 = 0.2, 0.3, 0.6, 0.7
+        point, radius = (0.5, 0.5), 0.1
+
+        def distance(bounds):
+            dx = max(bounds[0] - point[0], 0, point[0] - bounds[2])
+            dy = max(bounds[1] - point[1], 0, point[1] - bounds[3])
+            return (dx * dx + dy * dy) ** 0.5
+
+        cases = [
+            ({'region': '0.2,0.3,0.6,0.7'},
+             lambda b, _: b[0] <= x2 and b[2] >= x1 and b[1] <= y2 and b[3] >= y1),
+            ({'region': '0.2,0.3,0.6,0.7', 'relation': 'within'},
+             lambda b, _: b[0] >= x1 and b[1] >= y1 and b[2] <= x2 and b[3] <= y2),
+            ({'region': '0.3,0.35,0.32,0.37', 'relation': 'contains'},
+             lambda b, _: b[0] <= 0.3 and b[1] <= 0.35 and b[2] >= 0.32 and b[3] >= 0.37),
+            ({'near': '0.5,0.5', 'radius': radius}, lambda b, _: distance(b) <= radius),
+            ({'max_area': 0.01, 'label': 'positive'},
+             lambda b, item: (b[2] - b[0]) * (b[3] - b[1]) <= 0.01 and item['label'] == 'positive'),
+        ]
+        for params, keep in cases:
+            with self.subTest(params=params):
+                expected = self.expected(keep)
+                self.assertTrue(expected)
+                self.assertEqual(self.found(**params), expected)
+        self.assertGreater(len(self.index.tree.levels), 2)
+
+    def test_count_and_pages(self):
+        everything = self.search()
+        first, second = self.search(limit=50), self.search(limit=50, offset=50)
+
+        self.assertEqual(everything['count'], 90)
+        self.assertEqual(sum(everything['labels'].values()), 90)
+        self.assertEqual(everything['labels']['positive'],
+                         sum(item['label'] == 'positive' for boxes in self.cases.values() for item in boxes))
+        self.assertEqual(first['boxes'] + second['boxes'], everything['boxes'])
+        self.assertEqual((first['count'], second['offset']), (90, 50))
+        self.assertEqual(self.client.get('/api/boxes/', {'region': '0.5,0.5,0.1,0.1'}).status_code, 400)
+
+    def test_changed_and_deleted_sessions_are_synced(self):
+        self.search()
+        case_id, boxes = next(iter(self.cases.items()))
+        case_image = CaseImage.objects.get(case_id=case_id)
+        session = self.save(case_image, boxes)  # A second session of the case
+        self.cases[case_id] = boxes[:1]
+        self.save(case_image, boxes[:1], annotationId=session['annotation_id'], version=1)
+
+        found = self.found()
+        self.assertEqual(len(found), 90 + 1)
+        self.assertEqual(found.count((case_id, 1)), 2)
+        self.assertLess(self.index.tree_size, len(self.index.annotations))  # New rows are pending
+
+        other = list(self.cases)[1]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.delete(f'/api/annotations/{other}/delete/').status_code, 200)
+        self.assertTrue(DeletedAnnotation.objects.exists())
+
+        with self.assertNumQueries(2):
+            self.index.refresh()
+        self.assertNotIn(other, {case for case, _ in self.found()})
+        self.assertEqual(len(self.found()), 90 + 1 - 15)
+        # Past MAX_PENDING stale rows the tree is rebuilt without them
+        self.assertEqual(self.index.tree_size, len(self.index.annotations))
+        self.assertTrue(self.index.alive.all())
+
+    def test_rolled_back_deletes_leave_no_tombstone(self):
+        try:
+            with transaction.atomic():
+                Annotation.objects.all().delete()
+                raise DatabaseError
+        except DatabaseError:
+            pass
+
+        self.assertFalse(DeletedAnnotation.objects.exists())
+        self.assertEqual(self.search()['count'], 90)
+
+
+class SearchTriggerTests(TestCase):
+    def test_migrations_install_the_triggers(self):
+        self.assertEqual(missing_triggers(), [])
+        self.assertEqual(check_triggers(databases=['default']), [])
+
+    def test_case_search_follows_forms_and_case_images(self):
+        form, case_image = create_case()
+        ingest_annotation_sessions([doctor_session(case_image, [box(1, 10, 10, 20, 20, 'positive', 800, 600)])])
+        Forms.objects.filter(pk=form.pk).update(Date=date(2024, 5, 1))
+
+        row = CaseSearch.objects.get(case_id=form.CaseID)
+        self.assertEqual((row.diagnosis, row.status, row.month), ('Positive', 'annotated', '2024-05'))
+
+    def test_check_reports_missing_triggers(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER ' + {
+                'sqlite': 'case_search_images_update', 'postgresql': 'case_search_images ON case_images',
+            }[connection.vendor])
+
+        warning, = check_triggers(databases=['default'])
+        self.assertEqual(warning.id, 'forms.W001')
+
+
+class SearchTriggerMigrationTests(TransactionTestCase):
+    def migrate_field(self, old_field, new_field):
+        """Alter a CaseImage field the way a migration of this app does, signals included."""
+        suspend_for_migrate(using='default', plan=[(Migration('0099_test', 'forms'), False)])
+        with connection.schema_editor() as editor:
+            editor.alter_field(CaseImage, old_field, new_field)
+        restore_after_migrate(using='default')
+
+    def test_triggers_survive_a_table_rebuild(self):
+        form, case_image = create_case()
+        old_field = CaseImage._meta.get_field('image_name')
+        new_field = old_field.clone()
+        new_field.set_attributes_from_name('image_name')
+        new_field.max_length = 300
+
+        self.migrate_field(old_field, new_field)
+        try:
+            self.assertEqual(missing_triggers(), [])
+            CaseImage.objects.filter(pk=case_image.pk).update(status='annotated')
+            self.assertEqual(CaseSearch.objects.get(case_id=form.CaseID).status, 'annotated')
+            _, total, _, _ = search_cases('annotated')
+            self.assertEqual(total, 1)
+        finally:
+            self.migrate_field(new_field, old_field)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT, RESPONSE_CACHE={'ENABLED': False})
+class ListPaginationTests(TestCase):
+    def setUp(self):
+        # Two cases per day, so pages break between cases of the same date
+        self.case_images = []
+        for index in range(7):
+            form, case_image = create_case()
+            Forms.objects.filter(pk=form.pk).update(Date=date(2024, 5, 1) + timedelta(days=index // 2))
+            self.case_images.append(case_image)
+        for case_image in self.case_images[::3]:
+            ingest_annotation_sessions([doctor_session(case_image, [box(1, 10, 10, 20, 20, 'positive', 800, 600)])])
+
+    def pages(self, **params):
+        case_ids, cursor = [], None
+        while True:
+            query = {**params, 'limit': 2, **({'cursor': cursor} if cursor else {})}
+            data = self.client.get('/list/', query).json()
+            self.assertLessEqual(len(data['forms']), 2)
+            case_ids.extend(form['CaseID'] for form in data['forms'])
+            if not data['has_more']:
+                self.assertIsNone(data['next_cursor'])
+                return case_ids
+            cursor = data['next_cursor']
+
+    def test_pages_cover_the_full_listing_in_order(self):
+        listing = [form['CaseID'] for form in self.client.get('/list/').json()['forms']]
+        expected = [
+            form.CaseID for form in sorted(Forms.objects.all(), key=lambda form: (form.Date, form.CaseID), reverse=True)
+        ]
+
+        self.assertEqual(listing, expected)
+        self.assertEqual(self.pages(), expected)
+
+    def test_pages_of_a_diagnosis(self):
+        positive = [int(case_image.case_id) for case_image in reversed(self.case_images[::3])]
+
+        self.assertEqual(self.pages(diagnosis='positive'), positive)
+        self.assertEqual(self.pages(diagnosis='Not Annotated'),
+                         [int(case_image.case_id) for case_image in reversed(self.case_images)
+                          if int(case_image.case_id) not in positive])
+
+    def test_date_range(self):
+        data = self.client.get('/list/', {'date_from': '2024-05-02', 'date_to': '2024-05-02'}).json()
+
+        self.assertEqual([form['CaseID'] for form in data['forms']],
+                         [int(case_image.case_id) for case_image in reversed(self.case_images[2:4])])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/list/', {'cursor': 'nonsense'}).status_code, 400)
+
+
+@override_settings(
+    MEDIA_ROOT=MEDIA_ROOT, ALLOWED_HOSTS=['testserver'],
+    INFERENCE={**settings.INFERENCE, 'WORKERS': 0},  # Predictions are written from the dispatcher thread
+    RESPONSE_CACHE={**settings.RESPONSE_CACHE, 'ENABLED': False},
+)
+class ConcurrentWriteTests(TransactionTestCase):
+    """Writers on many threads against the configured database settings (cdss/settings.py)."""
+    mix = {'upload_image': 2, 'save_annotations': 3, 'autosave': 3}
+
+    def test_concurrent_writers_do_not_fail(self):
+        for _ in range(4):
+            create_case()
+        if connection.vendor == 'sqlite':
+            self.assertEqual(describe_connection()['journal_mode'], 'wal')
+
+        results = StressRun(threads=8, duration=3, boxes_per_case=5, seed=7, mix=self.mix).run()
+        self.assertTrue(get_service().wait(60))
+
+        locked = [failure for failure in results['failures'] if 'database is locked' in failure['error']]
+        self.assertEqual(locked, [])
+        self.assertEqual(results['failures'], [])
+        self.assertGreater(results['operations']['save_annotations']['requests'], 0)
+        uploads = results['operations']['upload_image']['requests']
+        self.assertEqual(Forms.objects.count(), 4 + uploads)
+        self.assertEqual(Forms.objects.filter(InferenceStatus=Forms.INFERENCE_DONE).count(), uploads)
@@ -0,0 +1,309 @@
+# forms/uploads.py
+"""Case creation from uploaded images, including resumable chunked uploads.
+
+A chunked upload is initiated with the final size (and optionally its
+SHA-256), then sent as consecutive chunks, each with its byte offset and
+checksum. Every chunk is streamed into its own part in the storage backend,
+so neither the request nor the whole image is ever held in memory.
+Finalizing concatenates the parts into Forms.Image and creates the case
+exactly once, however often the client retries.
+"""
+import hashlib
+import io
+import logging
+import os
+import uuid
+from datetime import timedelta
+
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+
+from forms.derivatives import derivative_urls, ensure_derivatives, lazy_derivative_urls
+from forms.dimensions import read_size
+from forms.duplicates import canonical_id, find_duplicates, get_index
+from forms.hashing import hash_field_file
+from forms.inference import request_inference
+from forms.models import CaseImage, Forms, UploadSession
+from forms.response_cache import invalidate_cases
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 4 * 1024 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+MAX_UPLOAD_SIZE = 200 * 1024 * 1024
+READ_BLOCK_SIZE = 64 * 1024
+FINALIZE_TIMEOUT = 10 * 60  # Seconds after which a stalled finalize may be taken over
+
+
+class UploadError(Exception):
+    """Client error in the chunked upload protocol; carries the HTTP status"""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def link_duplicate(form):
+    """Save a new case's hashes and link it to an earlier copy of its image.
+
+    An exact copy reuses the earlier case's stored file and the upload is
+    deleted, so identical images are stored once.
+    """
+    match, distance = find_duplicates([(form.ImageHash, form.ImagePHash)], exclude=[form.CaseID])[0]
+    fields = {'ImageHash': form.ImageHash, 'ImagePHash': form.ImagePHash}
+    redundant = None
+    if match is not None:
+        form.DuplicateOf_id, form.DuplicateDistance = canonical_id(match), distance
+        fields.update(DuplicateOf_id=form.DuplicateOf_id, DuplicateDistance=distance)
+        if match.ImageHash == form.ImageHash and match.Image.name != form.Image.name:
+            redundant, form.Image.name = form.Image.name, match.Image.name
+            fields['Image'] = form.Image.name
+    Forms.objects.filter(pk=form.pk).update(**fields)
+    get_index().add(form.CaseID, form.ImagePHash)
+    if redundant:
+        default_storage.delete(redundant)
+
+
+def create_case(image, on_saved=None):
+    """Create the Forms and CaseImage rows for an image file, queue inference and prepare previews.
+
+    `on_saved(form)` is called as soon as the Forms row exists, so a caller
+    can record the case before the slower steps run. Returns (form,
+    derivative urls).
+    """
+    form = Forms(Image=image)
+    form.save()
+    if on_saved is not None:
+        on_saved(form)
+    return form, prepare_case(form)
+
+
+def prepare_case(form):
+    """Everything create_case does once the Forms row is saved; returns derivative urls.
+
+    Steps already done are skipped, so this can finish a case whose
+    creation was interrupted.
+    """
+    # Hashes key the prediction cache, so they are needed before inference
+    if not form.ImageHash:
+        try:
+            form.ImageHash, form.ImagePHash = hash_field_file(form.Image)
+        except Exception as e:
+            logger.warning("Could not hash image of case %s: %s", form.CaseID, e)
+        else:
+            link_duplicate(form)
+    size = read_size(form.Image.name) or (None, None)
+    CaseImage.objects.get_or_create(case_id=str(form.CaseID), defaults={
+        'patient_id': form.PatientID,
+        'image_name': os.path.basename(form.Image.name),
+        'image_path': form.Image.name,
+        'width': size[0],
+        'height': size[1],
+    })
+    invalidate_cases([form.CaseID])
+    if not form.InferenceStatus:
+        request_inference([form])
+
+    # Previews are generated up front; if that fails they are retried
+    # lazily by case_image_derivative
+    try:
+        return ensure_derivatives(form)
+    except Exception as e:
+        logger.warning("Could not generate derivatives for case %s: %s", form.CaseID, e)
+        return lazy_derivative_urls(form)
+
+
+class HashingReader:
+    """Non-seekable reader that hashes and counts bytes as storage consumes them."""
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.remaining = limit
+        self.size = limit
+        self.digest = hashlib.sha256()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.stream.read(min(size, READ_BLOCK_SIZE))
+        self.remaining -= len(data)
+        self.bytes_read += len(data)
+        self.digest.update(data)
+        if not data:
+            self.remaining = 0
+        return data
+
+
+class PartsReader(io.RawIOBase):
+    """Read the stored parts of an upload back as one continuous stream."""
+    def __init__(self, part_names):
+        self.part_names = list(part_names)
+        self.current = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while True:
+            if self.current is None:
+                if not self.part_names:
+                    return 0
+                self.current = default_storage.open(self.part_names.pop(0), 'rb')
+            data = self.current.read(len(buffer))
+            if data:
+                buffer[:len(data)] = data
+                return len(data)
+            self.current.close()
+            self.current = None
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+        super().close()
+
+
+def initiate_upload(filename, size, sha256=''):
+    if not filename:
+        raise UploadError('filename is required')
+    if size <= 0 or size > MAX_UPLOAD_SIZE:
+        raise UploadError(f'size must be between 1 and {MAX_UPLOAD_SIZE} bytes')
+    return UploadSession.objects.create(
+        upload_id=uuid.uuid4(),
+        filename=filename.replace('/', '_').replace('\\', '_'),
+        size=size,
+        sha256=(sha256 or '').lower(),
+    )
+
+
+def write_chunk(session, offset, stream, length, checksum=''):
+    """Store one chunk at `offset`; returns the session with its new offset.
+
+    The part is written before taking the session lock so a slow client does
+    not hold the lock. If another request advanced the offset meanwhile, the
+    part is discarded and a 409 tells the client where to resume.
+    """
+    if session.status != UploadSession.UPLOADING:
+        raise UploadError('Upload is already finalized', status=409)
+    if offset != session.offset:
+        raise UploadError(f'Expected offset {session.offset}', status=409)
+    if length <= 0 or length > MAX_CHUNK_SIZE:
+        raise UploadError(f'Chunk length must be between 1 and {MAX_CHUNK_SIZE} bytes')
+    if offset + length > session.size:
+        raise UploadError('Chunk extends past the declared upload size')
+
+    reader = HashingReader(stream, length)
+    part_name = default_storage.save(
+        f'chunked/{session.upload_id}/{offset:012d}-{uuid.uuid4().hex[:8]}.part', File(reader)
+    )
+    if reader.bytes_read != length:
+        default_storage.delete(part_name)
+        raise UploadError(f'Received {reader.bytes_read} of {length} bytes')
+    if checksum and reader.digest.hexdigest() != checksum.lower():
+        default_storage.delete(part_name)
+        raise UploadError('Chunk checksum mismatch')
+
+    with transaction.atomic():
+        locked = UploadSession.objects.select_for_update().get(pk=session.pk)
+        if locked.status != UploadSession.UPLOADING or locked.offset != offset:
+            default_storage.delete(part_name)
+            raise UploadError(f'Expected offset {locked.offset}', status=409)
+        locked.parts.append(part_name)
+        locked.offset += length
+        locked.save(update_fields=['parts', 'offset', 'updated_at'])
+    return locked
+
+
+def _delete_parts(part_names):
+    for name in part_names:
+        try:
+            default_storage.delete(name)
+        except Exception as e:
+            logger.warning("Could not delete upload part %s: %s", name, e)
+
+
+def _claim_for_finalize(session):
+    """Mark a fully received session as finalizing, in a transaction of its own.
+
+    Returns the session, or its finished case as (form, derivative urls)
+    when an earlier call already completed it.
+    """
+    with transaction.atomic():
+        session = UploadSession.objects.select_related('form').select_for_update().get(pk=session.pk)
+        if session.status == UploadSession.COMPLETE:
+            if session.form is None:
+                # The FK is SET_NULL: the case was deleted since
+                raise UploadError('The case created by this upload has been deleted', status=410)
+            return session, (session.form, derivative_urls(session.form))
+        if session.status == UploadSession.FINALIZING:
+            if timezone.now() - session.updated_at < timedelta(seconds=FINALIZE_TIMEOUT):
+                raise UploadError('Upload is being finalized; retry shortly', status=409)
+            # The request that claimed it died; take over
+            logger.warning("Taking over stalled finalize of upload %s", session.upload_id)
+        elif session.offset != session.size:
+            raise UploadError(f'Upload incomplete: {session.offset} of {session.size} bytes', status=409)
+        session.status = UploadSession.FINALIZING
+        session.save(update_fields=['status', 'updated_at'])
+    return session, None
+
+
+def _create_case_from_parts(session, on_saved):
+    if session.sha256:
+        digest = hashlib.sha256()
+        with PartsReader(session.parts) as parts:
+            for block in iter(lambda: parts.read(READ_BLOCK_SIZE), b''):
+                digest.update(block)
+        if digest.hexdigest() != session.sha256:
+            raise UploadError('Upload checksum mismatch; restart the upload', status=422)
+
+    with PartsReader(session.parts) as parts:
+        image = File(io.BufferedReader(parts, READ_BLOCK_SIZE), name=session.filename)
+        image.size = session.size
+        return create_case(image, on_saved=on_saved)
+
+
+def finalize_upload(session):
+    """Assemble the parts into a new case; repeated calls return the same case.
+
+    The session row is locked only to claim it (status FINALIZING) and to
+    record the result. Checksum, case creation, derivatives and inference
+    run in between without a transaction, so on SQLite they do not hold the
+    database write lock. A concurrent call gets a 409 until the first one
+    finishes. The form is recorded on the session as soon as it is saved,
+    so a retry or takeover after a failure finishes that case instead of
+    creating another. Returns (form, derivative urls).
+    """
+    session, finished = _claim_for_finalize(session)
+    if finished:
+        return finished
+
+    def record_form(form):
+        UploadSession.objects.filter(pk=session.pk).update(form=form, updated_at=timezone.now())
+
+    try:
+        if session.form is not None:
+            # An earlier attempt saved the case before it failed or stalled
+            form = session.form
+            derivatives = prepare_case(form)
+        else:
+            form, derivatives = _create_case_from_parts(session, record_form)
+    except BaseException:
+        # Let a retry claim it again
+        UploadSession.objects.filter(pk=session.pk, status=UploadSession.FINALIZING).update(
+            status=UploadSession.UPLOADING, updated_at=timezone.now()
+        )
+        raise
+
+    UploadSession.objects.filter(pk=session.pk).update(
+        form=form, status=UploadSession.COMPLETE, updated_at=timezone.now()
+    )
+    _delete_parts(session.parts)
+    return form, derivatives
+
+
+def discard_upload(session):
+    _delete_parts(session.parts)
+    session.delete()
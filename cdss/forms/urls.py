@@ -5,7 +5,28 @@ from . import views
 urlpatterns = [
     # Annotation endpoints
     path('annotations/', views.save_annotations, name='save_annotations'),
-    path('annotations/<str:case_id>/', views.get_annotations, name='get_annotations'),
+    path('annotations/batch/', views.save_annotations_batch, name='save_annotations_batch'),
+    path('annotations/autosave/', views.autosave_annotations, name='autosave_annotations'),
     path('annotations/list/', views.list_annotations, name='list_annotations'),
+    path('annotations/<str:case_id>/', views.get_annotations, name='get_annotations'),
     path('annotations/<str:case_id>/delete/', views.delete_annotations, name='delete_annotations'),
+    path('annotations/<str:case_id>/versions/', views.annotation_versions, name='annotation_versions'),
+    path('annotations/<str:case_id>/versions/<int:number>/', views.annotation_version,
+         name='annotation_version'),
+    # Dataset export and import
+    path('export/coco/', views.export_coco, name='export_coco'),
+    path('import/coco/', views.import_coco, name='import_coco'),
+    path('import/coco/<int:job_id>/', views.import_coco_status, name='import_coco_status'),
+    # Consensus of all doctor sessions
+    path('consensus/', views.consensus_report, name='consensus_report'),
+    path('consensus/<str:case_id>/', views.case_consensus, name='case_consensus'),
+    # Full-text and faceted case search
+    path('cases/search/', views.case_search, name='case_search'),
+    # Spatial search over the boxes of every session
+    path('boxes/', views.box_search, name='box_search'),
+    # Model evaluation against doctor annotations
+    path('evaluation/', views.evaluation_report, name='evaluation_report'),
+    path('evaluation/<str:case_id>/', views.case_evaluation, name='case_evaluation'),
+    # Response cache counters
+    path('cache/stats/', views.response_cache_stats, name='response_cache_stats'),
 ]
\ No newline at end of file
@@ -0,0 +1,91 @@
+# forms/versions.py
+"""Version history of annotation sessions as box deltas.
+
+An Annotation always holds the head version of its session in full (its
+annotations_data, packed_boxes and optional BoundingBox rows). Every
+update adds one AnnotationVersion row. The row carries only the boxes that
+changed between the previous version and the new one, keyed by box id:
+
+    {'added': [box], 'removed': [box], 'modified': [[old box, new box]]}
+
+Because removed and modified boxes keep their old values, a delta can be
+applied forwards or undone. rebuild() walks back from the head with one
+query, however large the session is.
+
+Autosaves from the labeling page would otherwise add a row every few
+seconds. Instead, an autosave that lands within AUTOSAVE_WINDOW seconds of
+the creation of the head autosave version is folded into that version, so
+a steadily autosaved draft gets one version per window. Only MAX_VERSIONS rows
+are kept per session; older history is dropped.
+
+Configured through settings.ANNOTATION_VERSIONS.
+"""
+from django.conf import settings
+
+DEFAULT_CONFIG = {
+    'AUTOSAVE_WINDOW': 60,  # Seconds during which consecutive autosaves share one version
+    'MAX_VERSIONS': 200,  # Versions kept per session
+}
+
+
+class VersionConflict(Exception):
+    """The client edited a version that is no longer the head."""
+
+
+class VersionUnavailable(Exception):
+    """The requested version was pruned or never existed."""
+
+
+def get_config():
+    return {**DEFAULT_CONFIG, **getattr(settings, 'ANNOTATION_VERSIONS', {})}
+
+
+def diff(old, new):
+    """Delta turning the box list `old` into `new`; empty lists when nothing changed."""
+    before = {box['id']: box for box in old}
+    after = {box['id']: box for box in new}
+    return {
+        'added': [box for box_id, box in after.items() if box_id not in before],
+        'removed': [box for box_id, box in before.items() if box_id not in after],
+        'modified': [
+            [before[box_id], box] for box_id, box in after.items()
+            if box_id in before and before[box_id] != box
+        ],
+    }
+
+
+def is_empty(delta):
+    return not (delta['added'] or delta['removed'] or delta['modified'])
+
+
+def undo(boxes, delta):
+    """The box list before `delta` was applied to `boxes`, ordered by box id."""
+    state = {box['id']: box for box in boxes}
+    for box in delta['added']:
+        state.pop(box['id'], None)
+    for box in delta['removed']:
+        state[box['id']] = box
+    for old, _ in delta['modified']:
+        state[old['id']] = old
+    return [state[box_id] for box_id in sorted(state)]
+
+
+def summarize(delta):
+    return {key: len(delta[key]) for key in ('added', 'removed', 'modified')}
+
+
+def rebuild(annotation, number):
+    """Box list of an annotation session at version `number`."""
+    if not 1 <= number <= annotation.version:
+        raise VersionUnavailable(f"Version {number} does not exist")
+    boxes = (annotation.annotations_data or {}).get('annotations', [])
+    if number == annotation.version:
+        return boxes
+    deltas = list(
+        annotation.versions.filter(number__gt=number).order_by('-number').values_list('number', 'delta')
+    )
+    if [row_number for row_number, _ in deltas] != list(range(annotation.version, number, -1)):
+        raise VersionUnavailable(f"Version {number} is no longer kept")
+    for _, delta in deltas:
+        boxes = undo(boxes, delta)
+    return boxes
@@ -1,41 +1,118 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse, Http404
-from django.shortcuts import get_object_or_404
-from django.core.files.storage import default_storage
-from forms.models import Forms, CaseImage, Annotation, BoundingBox
+from django.http import HttpResponse, JsonResponse, Http404, HttpResponseRedirect, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404, get_object_or_404
+from django.db import transaction
+from django.db.models import CharField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Cast, Coalesce
+from django.core.files.storage import FileSystemStorage, default_storage
+from forms.models import (
+    Forms, CaseImage, CaseSearch, Annotation, CaseEvaluation, ConsensusAnnotation, EvaluationRun, ImportJob,
+    UploadSession, DIAGNOSIS_CHOICES, NOT_ANNOTATED,
+)
 from rest_framework.response import Response
 from rest_framework import status
+from .annotations import ingest_annotation_sessions, update_annotation_session
+from .boxpack import packed_session
+from .consensus import agreement_report, consensus_data, update_consensus
+from .search import SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT, parse_filters as parse_search_filters, search_cases
+from .spatial import parse_filters, search_boxes
+from .versions import VersionConflict, VersionUnavailable, rebuild, summarize
+from .evaluation import case_report, default_model_id, run_evaluation
+from .derivatives import DERIVATIVE_SIZES, derivative_name, derivative_urls, ensure_derivatives
+from .profiling import get_config as get_profiling_config, render_metrics
+from .response_cache import cache_stats, cached_json, invalidate_cases
+from .ingest import ingest_entries, iter_directory_entries, iter_zip_entries
+from .uploads import (
+    CHUNK_SIZE, UploadError, create_case, discard_upload, finalize_upload, initiate_upload, write_chunk,
+)
+from .coco import (
+    EXPORT_LABELS, create_import_job, filter_case_images, iter_coco_export, parse_category_map, start_import_thread,
+)
 from .serializers import (
+    AnnotationAutosaveSerializer,
+    AnnotationBatchRequestSerializer,
     AnnotationRequestSerializer, 
     AnnotationResponseSerializer,
     CaseImageSerializer,
-    AnnotationSerializer
+    AnnotationSerializer,
+    ImportJobSerializer
 )
-import uuid
-from datetime import datetime
-from django.utils import timezone
+import base64
+import binascii
+import json
+import logging
+import os
+import zipfile
+from datetime import date
 from rest_framework.decorators import api_view
 
+logger = logging.getLogger(__name__)
+
 def get_diagnosis_from_annotations(case_id_str):
     """Determines diagnosis based on the latest annotations for a case."""
+    # The diagnosis is materialized on CaseImage whenever annotations change
+    diagnosis = CaseImage.objects.filter(case_id=case_id_str).values_list('diagnosis', flat=True).first()
+    return diagnosis or NOT_ANNOTATED
+
+LIST_DEFAULT_LIMIT = 50
+LIST_MAX_LIMIT = 200
+
+def annotate_diagnosis(queryset):
+    """Annotates Forms rows with the diagnosis stored on their CaseImage.
+
+    Evaluated inside the list query so a page of cases costs one query.
+    """
+    diagnosis = CaseImage.objects.filter(
+        case_id=Cast(OuterRef('CaseID'), CharField())
+    ).values('diagnosis')[:1]
+    return queryset.annotate(
+        annotated_diagnosis=Coalesce(Subquery(diagnosis), Value(NOT_ANNOTATED))
+    )
+
+def encode_list_cursor(form):
+    """Encodes the (Date, CaseID) keyset position of the last row on a page."""
+    raw = f"{form.Date.isoformat()}:{form.CaseID}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_list_cursor(cursor):
+    """Decodes a cursor from encode_list_cursor into (Date, CaseID)."""
     try:
-        case_image = CaseImage.objects.get(case_id=case_id_str)
-        # Get the latest annotation session for this image
-        latest_annotation = case_image.annotations.order_by('-created_at').first()
-        if not latest_annotation:
-            return "Not Annotated"
-
-        # Check for any positive bounding boxes
-        if latest_annotation.bounding_boxes.filter(label='positive').exists():
-            return "Positive"
-        # If there are boxes, but none are positive, they must all be negative
-        elif latest_annotation.bounding_boxes.exists():
-            return "Negative"
-        else:
-            # This case means an Annotation object exists but has no BoundingBox objects
-            return "Not Annotated"
-    except CaseImage.DoesNotExist:
-        return "Not Annotated"
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        date_str, case_id = raw.split(':')
+        return date.fromisoformat(date_str), int(case_id)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+def filter_forms(params):
+    """Cases matching the diagnosis and date range filters accepted by /list/.
+
+    Returns (queryset, date field, id field), ordered newest first. With a
+    diagnosis the rows come from case_search (forms.search), whose
+    (diagnosis, date, case_id) index serves a filtered page in keyset order;
+    filtering on the diagnosis subquery would compute it for every case.
+    """
+    diagnosis = params.get('diagnosis')
+    if diagnosis:
+        matches = [choice for choice in DIAGNOSIS_CHOICES if choice.lower() == diagnosis.lower()]
+        if not matches:
+            raise ValueError(f"diagnosis must be one of: {', '.join(DIAGNOSIS_CHOICES)}")
+        queryset = CaseSearch.objects.filter(diagnosis=matches[0])
+        date_field, id_field = 'date', 'case_id'
+    else:
+        queryset = annotate_diagnosis(Forms.objects.all())
+        date_field, id_field = 'Date', 'CaseID'
+
+    for param, lookup in (('date_from', 'gte'), ('date_to', 'lte')):
+        value = params.get(param)
+        if value:
+            try:
+                queryset = queryset.filter(**{f'{date_field}__{lookup}': date.fromisoformat(value)})
+            except ValueError:
+                raise ValueError(f'{param} must be an ISO date (YYYY-MM-DD)')
+    return queryset.order_by(f'-{date_field}', f'-{id_field}'), date_field, id_field
 
 @csrf_exempt
 def upload_image(request):
@@ -44,122 +121,380 @@ def upload_image(request):
         if not image:
             return JsonResponse({'error': 'No image provided'}, status=400)
 
-        form = Forms(Image=image)
-        form.save()
-
-        return JsonResponse({
-            'message': 'Upload successful',
-            'CaseID': form.CaseID,
-            'PatientID': form.PatientID,
-            'Diagnosis': form.Diagnosis,
-            'Confidence': form.Confidence,
-            'Date': form.Date
-        })
+        form, derivatives = create_case(image)
+        return JsonResponse(upload_response(form, derivatives))
 
     return JsonResponse({'error': 'Invalid method'}, status=405)
 
-def list_forms(request):
-    forms = Forms.objects.all().order_by('-Date')
-    
+def upload_response(form, derivatives):
+    return {
+        'message': 'Upload successful',
+        'CaseID': form.CaseID,
+        'PatientID': form.PatientID,
+        'Diagnosis': form.Diagnosis,
+        'Confidence': form.Confidence,
+        'InferenceStatus': form.InferenceStatus,
+        'DuplicateOf': form.DuplicateOf_id,
+        'DuplicateDistance': form.DuplicateDistance,
+        'Date': form.Date,
+        'Thumbnail': derivatives['thumb'],
+        'Preview': derivatives['medium'],
+    }
+
+def upload_session_data(session):
+    return {
+        'upload_id': str(session.upload_id),
+        'filename': session.filename,
+        'size': session.size,
+        'offset': session.offset,
+        'chunk_size': CHUNK_SIZE,
+        'status': session.status,
+        'CaseID': session.form_id,
+    }
+
+@csrf_exempt
+def batch_upload(request):
+    """Ingest a ZIP archive (`archive` file) or a server directory (`directory`).
+
+    Streams one JSON line per image as it is processed, then a summary line.
+    Directories must lie inside one of settings.INGEST_DIRECTORIES.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid method'}, status=405)
+
+    archive = request.FILES.get('archive')
+    directory = request.POST.get('directory')
+    if archive:
+        try:
+            zip_file = zipfile.ZipFile(archive)
+        except zipfile.BadZipFile:
+            return JsonResponse({'error': 'archive is not a valid ZIP file'}, status=400)
+        entries = iter_zip_entries(zip_file)
+    elif directory:
+        root = os.path.realpath(directory)
+        allowed = [os.path.realpath(d) for d in settings.INGEST_DIRECTORIES]
+        if not any(os.path.commonpath([root, d]) == d for d in allowed):
+            return JsonResponse({'error': 'directory is not in INGEST_DIRECTORIES'}, status=403)
+        if not os.path.isdir(root):
+            return JsonResponse({'error': 'directory does not exist'}, status=400)
+        entries = iter_directory_entries(root)
+    else:
+        return JsonResponse({'error': 'Provide an archive file or a directory'}, status=400)
+
+    def progress():
+        counts = {'created': 0, 'invalid': 0, 'failed': 0}
+        for result in ingest_entries(entries):
+            counts[result['status']] += 1
+            yield json.dumps(result) + '\n'
+        yield json.dumps({'summary': counts}) + '\n'
+
+    return streaming_lines(request, progress(), content_type='application/x-ndjson')
+
+def streaming_lines(request, lines, content_type):
+    """StreamingHttpResponse that reaches the client as each item of `lines` is produced.
+
+    WSGI servers stream a sync generator as it is. Under ASGI Django would
+    drain a sync iterator in a thread before sending any of it, so there the
+    generator is advanced one item at a time through sync_to_async. Its
+    database work then stays on the one thread that sync views use.
+    """
+    if not isinstance(request, ASGIRequest):
+        return StreamingHttpResponse(lines, content_type=content_type)
+
+    async def stream():
+        step = sync_to_async(next)
+        try:
+            while (line := await step(lines, None)) is not None:
+                yield line
+        finally:
+            # Also runs when the client disconnects mid-stream
+            await sync_to_async(lines.close)()
+
+    return StreamingHttpResponse(stream(), content_type=content_type)
+
+@csrf_exempt
+def chunked_upload(request):
+    """Start a resumable upload: JSON body with filename, size and optional sha256"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid method'}, status=405)
+    try:
+        data = json.loads(request.body or b'{}')
+        session = initiate_upload(data.get('filename', ''), int(data.get('size', 0)), data.get('sha256', ''))
+    except (ValueError, TypeError):
+        return JsonResponse({'error': 'Expected a JSON body with filename and size'}, status=400)
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    return JsonResponse(upload_session_data(session), status=201)
+
+@csrf_exempt
+def chunked_upload_detail(request, upload_id):
+    """GET the resume offset, PUT the next chunk, or DELETE an unfinished upload.
+
+    A chunk is the raw request body, sent with an Upload-Offset header and
+    optionally Upload-Checksum (hex SHA-256 of the chunk).
+    """
+    session = get_object_or_404(UploadSession, upload_id=upload_id)
+    if request.method == 'GET':
+        return JsonResponse(upload_session_data(session))
+
+    elif request.method == 'PUT':
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return JsonResponse({'error': 'Upload-Offset and Content-Length are required'}, status=400)
+        try:
+            session = write_chunk(session, offset, request, length, request.headers.get('Upload-Checksum', ''))
+        except UploadError as e:
+            response = upload_session_data(session)
+            response['error'] = str(e)
+            return JsonResponse(response, status=e.status)
+        return JsonResponse(upload_session_data(session))
+
+    elif request.method == 'DELETE':
+        if session.status != UploadSession.UPLOADING:
+            return JsonResponse({'error': 'Upload is already finalized'}, status=409)
+        discard_upload(session)
+        return JsonResponse({'message': 'Upload discarded'})
+
+    return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+@csrf_exempt
+def chunked_upload_finalize(request, upload_id):
+    """Assemble a fully received upload into a case; safe to retry"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Invalid method'}, status=405)
+    session = get_object_or_404(UploadSession, upload_id=upload_id)
+    try:
+        form, derivatives = finalize_upload(session)
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    return JsonResponse(upload_response(form, derivatives))
+
+@cached_json('list_forms', lambda request: ['cases'])
+async def list_forms(request):
+    """List cases with their annotation-based diagnosis.
+
+    Without `limit`/`cursor` every matching case is returned, as before.
+    Passing either switches to keyset pagination ordered by (Date, CaseID)
+    descending; follow `next_cursor` to fetch the next page.
+    Optional filters: `diagnosis`, `date_from`, `date_to`.
+    Async, so under ASGI waiting on the database does not hold a thread.
+    """
+    params = request.GET
+    try:
+        rows, date_field, id_field = filter_forms(params)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    paginate = 'limit' in params or 'cursor' in params
+    if paginate:
+        try:
+            limit = int(params.get('limit', LIST_DEFAULT_LIMIT))
+        except ValueError:
+            return JsonResponse({'error': 'limit must be an integer'}, status=400)
+        limit = max(1, min(limit, LIST_MAX_LIMIT))
+
+        cursor = params.get('cursor')
+        if cursor:
+            try:
+                cursor_date, cursor_case_id = decode_list_cursor(cursor)
+            except ValueError as e:
+                return JsonResponse({'error': str(e)}, status=400)
+            rows = rows.filter(
+                Q(**{f'{date_field}__lt': cursor_date})
+                | Q(**{date_field: cursor_date, f'{id_field}__lt': cursor_case_id})
+            )
+        # Fetch one extra row to know whether another page exists
+        rows = [row async for row in rows[:limit + 1]]
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+    else:
+        rows = [row async for row in rows]
+
+    if rows and isinstance(rows[0], CaseSearch):
+        found = await sync_to_async(Forms.objects.in_bulk)([row.case_id for row in rows])
+        forms = []
+        for row in rows:
+            form = found.get(row.case_id)
+            if form is not None:
+                form.annotated_diagnosis = row.diagnosis
+                forms.append(form)
+    else:
+        forms = rows
+
     response_data = []
     for form in forms:
-        # Calculate diagnosis based on annotations
-        diagnosis = get_diagnosis_from_annotations(str(form.CaseID))
-        
         response_data.append({
             'CaseID': form.CaseID,
             'PatientID': form.PatientID,
             'Date': str(form.Date),
-            'Diagnosis': diagnosis,
+            'Diagnosis': form.annotated_diagnosis,
             'Confidence': form.Confidence,
+            'Thumbnail': derivative_urls(form)['thumb'],
         })
 
-    return JsonResponse({'forms': response_data})
+    if not paginate:
+        return JsonResponse({'forms': response_data})
+
+    return JsonResponse({
+        'forms': response_data,
+        'next_cursor': encode_list_cursor(forms[-1]) if has_more and forms else None,
+        'has_more': has_more,
+    })
+
+@cached_json('search_cases', lambda request: ['cases'])
+async def case_search(request):
+    """Full-text case search with facet counts by diagnosis, status and month.
+
+    `q` matches case id, patient id, image name, diagnosis, model prediction
+    and status by word prefix; `diagnosis`, `status`, `month`, `date_from`
+    and `date_to` filter. Pages are keyset ordered like /list/: follow
+    `next_cursor`. See forms.search.
+    """
+    if request.method != 'GET':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+    params = request.GET
+    try:
+        filters = parse_search_filters(params)
+        limit = int(params.get('limit', SEARCH_DEFAULT_LIMIT))
+        after = decode_list_cursor(params['cursor']) if params.get('cursor') else None
+    except ValueError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+
+    def search():
+        rows, total, facets, has_more = search_cases(params.get('q', ''), filters, after, limit)
+        forms = Forms.objects.in_bulk([row.case_id for row in rows])
+        return rows, total, facets, has_more, forms
+
+    rows, total, facets, has_more, forms = await sync_to_async(search)()
+    cases = []
+    for row in rows:
+        form = forms.get(row.case_id)
+        cases.append({
+            'CaseID': row.case_id,
+            'PatientID': row.patient_id,
+            'Date': str(row.date),
+            'Diagnosis': row.diagnosis,
+            'Confidence': row.confidence,
+            'Prediction': row.prediction,
+            'Status': row.status,
+            'ImageName': row.image_name,
+            'Thumbnail': derivative_urls(form)['thumb'] if form else None,
+        })
+    last = forms.get(rows[-1].case_id) if rows else None
+    return JsonResponse({
+        'success': True,
+        'data': {
+            'cases': cases,
+            'count': total,
+            'facets': facets,
+            'next_cursor': encode_list_cursor(last) if has_more and last else None,
+            'has_more': has_more,
+        }
+    })
+
+async def delete_stored_file(name):
+    """Delete a file from storage in a worker thread, off the event loop"""
+    await sync_to_async(default_storage.delete, thread_sensitive=False)(name)
 
 @csrf_exempt
-def case_detail(request, case_id):
+@cached_json('case_detail', lambda request, case_id: [f'case:{case_id}'])
+async def case_detail(request, case_id):
     """Get or delete a specific case by ID"""
     if request.method == 'GET':
+        form = await aget_object_or_404(Forms, CaseID=case_id)
+        derivatives = derivative_urls(form)
+
+        diagnosis = NOT_ANNOTATED
+        annotations_data = []
+        annotation = None
         try:
-            form = get_object_or_404(Forms, CaseID=case_id)
-            
-            # Calculate diagnosis based on annotations
-            diagnosis = get_diagnosis_from_annotations(str(form.CaseID))
+            # The case_id in CaseImage is a string representation of Forms.CaseID
+            case_image = await CaseImage.objects.aget(case_id=str(form.CaseID))
+            diagnosis = case_image.diagnosis
+
+            if case_image.latest_annotation_id:
+                # Decode the boxes of the latest annotation session from its packed columns
+                annotation = await Annotation.objects.aget(pk=case_image.latest_annotation_id)
+                annotations_data = packed_session(annotation).to_dicts()
+        except CaseImage.DoesNotExist:
+            # No annotations exist for this case, which is a valid state.
+            pass
+
+        return JsonResponse({
+            'CaseID': form.CaseID,
+            'PatientID': form.PatientID,
+            'Date': str(form.Date),
+            'Diagnosis': diagnosis, # Use calculated diagnosis
+            'Confidence': form.Confidence,
+            'InferenceStatus': form.InferenceStatus,
+            'DuplicateOf': form.DuplicateOf_id,
+            'DuplicateDistance': form.DuplicateDistance,
+            'Image': form.Image.url if form.Image else None,
+            'Thumbnail': derivatives['thumb'],
+            'Preview': derivatives['medium'],
+            'imageName': form.Image.name.split('/')[-1] if form.Image else None,
+            'annotations': annotations_data,
+            # Editing resaves this session as a new version, see save_annotations
+            'annotation_id': annotation.annotation_id if annotation else None,
+            'version': annotation.version if annotation else None,
+        })
 
-            annotations_data = []
-            try:
-                # The case_id in CaseImage is a string representation of Forms.CaseID
-                case_image = CaseImage.objects.get(case_id=str(form.CaseID))
-                # Get the latest annotation session for this image
-                latest_annotation = case_image.annotations.order_by('-created_at').first()
-
-                if latest_annotation:
-                    # Get all bounding boxes for this annotation
-                    for box in latest_annotation.bounding_boxes.all():
-                        annotations_data.append({
-                            'id': box.box_id,
-                            'x': box.x,
-                            'y': box.y,
-                            'width': box.width,
-                            'height': box.height,
-                            'label': box.label,
-                            'relativeX': box.relative_x,
-                            'relativeY': box.relative_y,
-                            'relativeWidth': box.relative_width,
-                            'relativeHeight': box.relative_height,
-                        })
-            except CaseImage.DoesNotExist:
-                # No annotations exist for this case, which is a valid state.
-                pass
-
-            return JsonResponse({
-                'CaseID': form.CaseID,
-                'PatientID': form.PatientID,
-                'Date': str(form.Date),
-                'Diagnosis': diagnosis, # Use calculated diagnosis
-                'Confidence': form.Confidence,
-                'Image': form.Image.url if form.Image else None,
-                'imageName': form.Image.name.split('/')[-1] if form.Image else None,
-                'annotations': annotations_data,
-            })
-        except Forms.DoesNotExist:
-            return JsonResponse({'error': 'Case not found'}, status=404)
-    
     elif request.method == 'DELETE':
+        form = await aget_object_or_404(Forms, CaseID=case_id)
         try:
-            form = get_object_or_404(Forms, CaseID=case_id)
-            
-            # Find and delete related CaseImage, which will cascade to Annotations and BoundingBoxes
-            try:
-                # The case_id in CaseImage is a string representation of Forms.CaseID
-                case_image = CaseImage.objects.get(case_id=str(form.CaseID))
-                case_image.delete() # This will cascade delete Annotations and BoundingBoxes
-            except CaseImage.DoesNotExist:
-                # If no CaseImage, there are no annotations to delete.
-                pass
-            
-            # Delete the image file from storage if it exists
-            if form.Image:
+            # Delete the related CaseImage, which will cascade to Annotations and BoundingBoxes.
+            # The case_id in CaseImage is a string representation of Forms.CaseID
+            await CaseImage.objects.filter(case_id=str(form.CaseID)).adelete()
+
+            # Delete the image file from storage unless exact duplicates share it
+            others = Forms.objects.exclude(pk=form.pk)
+            if form.Image and not await others.filter(Image=form.Image.name).aexists():
                 try:
-                    default_storage.delete(form.Image.name)
+                    await delete_stored_file(form.Image.name)
                 except Exception as e:
-                    print(f"Warning: Could not delete image file: {e}")
-            
+                    logger.warning("Could not delete image file %s: %s", form.Image.name, e)
+
+            # Derivatives are shared by content hash, so keep them while another case uses them
+            if form.ImageHash and not await others.filter(ImageHash=form.ImageHash).aexists():
+                for size in DERIVATIVE_SIZES:
+                    try:
+                        await delete_stored_file(derivative_name(form.ImageHash, size))
+                    except Exception as e:
+                        logger.warning("Could not delete derivative file of case %s: %s", form.CaseID, e)
+
             # Delete the database record
-            form.delete()
-            
+            await form.adelete()
+            await sync_to_async(invalidate_cases)([form.CaseID])
+
             return JsonResponse({'message': 'Case deleted successfully'})
-        except Forms.DoesNotExist:
-            return JsonResponse({'error': 'Case not found'}, status=404)
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=500)
-    
+
     return JsonResponse({'error': 'Method not allowed'}, status=405)
 
-@api_view(['POST'])
+def case_image_derivative(request, case_id, size):
+    """Redirect to a resized copy of a case image, generating it on first use"""
+    if size not in DERIVATIVE_SIZES:
+        raise Http404('Unknown image size')
+    form = get_object_or_404(Forms, CaseID=case_id)
+    if not form.Image:
+        raise Http404('Case has no image')
+    try:
+        derivatives = ensure_derivatives(form)
+    except Exception as e:
+        return JsonResponse({'error': f'Could not generate image: {e}'}, status=500)
+    return HttpResponseRedirect(derivatives[size])
+
+@api_view(['POST', 'PUT'])
 def save_annotations(request):
     """
     Save annotations for a case image
+
+    With annotationId the boxes replace that session's as a new version
+    (only the changed boxes are stored); otherwise a new session is created.
     """
     try:
         # Validate request data
@@ -173,57 +508,18 @@ def save_annotations(request):
         
         validated_data = serializer.validated_data
         
-        # Get or create case image
-        case_image, created = CaseImage.objects.get_or_create(
-            case_id=validated_data['caseId'],
-            defaults={
-                'patient_id': validated_data['patientId'],
-                'image_name': validated_data['imageName'],
-                'status': 'uploaded'
-            }
-        )
-        
-        # Generate unique annotation ID
-        annotation_id = f"ann_{validated_data['caseId']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
-        
-        # Create annotation record
-        annotation = Annotation.objects.create(
-            case_image=case_image,
-            annotation_id=annotation_id,
-            annotations_data={
-                'caseId': validated_data['caseId'],
-                'patientId': validated_data['patientId'],
-                'imageName': validated_data['imageName'],
-                'annotations': validated_data['annotations'],
-                'annotated_at': timezone.now().isoformat()
-            }
-        )
-        
-        # Create individual bounding box records
-        for box_data in validated_data['annotations']:
-            BoundingBox.objects.create(
-                annotation=annotation,
-                box_id=box_data['id'],
-                x=box_data['x'],
-                y=box_data['y'],
-                width=box_data['width'],
-                height=box_data['height'],
-                relative_x=box_data['relativeX'],
-                relative_y=box_data['relativeY'],
-                relative_width=box_data['relativeWidth'],
-                relative_height=box_data['relativeHeight'],
-                label=box_data['label']
-            )
-        
-        # Update case image status
-        case_image.status = 'annotated'
-        case_image.save()
+        if validated_data.get('annotationId'):
+            annotation, _ = update_annotation_session(validated_data)
+        else:
+            annotation, = ingest_annotation_sessions([validated_data])
+        annotation_id = annotation.annotation_id
         
         # Prepare response
         response_data = {
             'success': True,
             'message': f'Successfully saved {annotation.total_annotations} annotations',
             'annotation_id': annotation_id,
+            'version': annotation.version,
             'case_id': validated_data['caseId'],
             'total_annotations': annotation.total_annotations,
             'positive_count': annotation.positive_count,
@@ -232,49 +528,214 @@ def save_annotations(request):
         
         return Response(response_data, status=status.HTTP_201_CREATED)
         
+    except Annotation.DoesNotExist:
+        return Response({
+            'success': False,
+            'message': 'Annotation session not found for this case'
+        }, status=status.HTTP_404_NOT_FOUND)
+    except VersionConflict as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_409_CONFLICT)
     except Exception as e:
         return Response({
             'success': False,
             'message': f'Failed to save annotations: {str(e)}'
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@api_view(['POST'])
+def autosave_annotations(request):
+    """
+    Autosave the labeling page's draft
+
+    The first autosave creates the session; later ones pass its annotationId
+    and are folded into one version per AUTOSAVE_WINDOW. Unchanged drafts
+    write nothing.
+    """
+    serializer = AnnotationAutosaveSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response({
+            'success': False,
+            'message': 'Invalid data provided',
+            'errors': serializer.errors
+        }, status=status.HTTP_400_BAD_REQUEST)
+    draft = serializer.validated_data
+
+    try:
+        if draft.get('annotationId'):
+            annotation, changed = update_annotation_session(draft, autosave=True)
+        elif draft['annotations']:
+            annotation, = ingest_annotation_sessions([draft])
+            changed = True
+        else:
+            # Nothing drawn yet: no session to create
+            return Response({'success': True, 'changed': False}, status=status.HTTP_200_OK)
+    except Annotation.DoesNotExist:
+        return Response({
+            'success': False,
+            'message': 'Annotation session not found for this case'
+        }, status=status.HTTP_404_NOT_FOUND)
+    except VersionConflict as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_409_CONFLICT)
+
+    return Response({
+        'success': True,
+        'changed': changed,
+        'annotation_id': annotation.annotation_id,
+        'version': annotation.version,
+        'total_annotations': annotation.total_annotations,
+    }, status=status.HTTP_200_OK)
+
 @api_view(['GET'])
-def get_annotations(request, case_id):
+def annotation_versions(request, case_id):
+    """
+    Version history of a case's latest doctor session (or ?annotation=<annotation_id>)
+    """
+    annotation = _versioned_session(request, case_id)
+    if annotation is None:
+        return Response({
+            'success': False,
+            'message': f'No annotation session for case {case_id}'
+        }, status=status.HTTP_404_NOT_FOUND)
+    versions = [
+        {
+            'version': version.number,
+            'autosave': version.autosave,
+            'boxCount': version.box_count,
+            'changes': summarize(version.delta),
+            'savedAt': version.updated_at.isoformat(),
+        }
+        for version in annotation.versions.order_by('-number')
+    ]
+    return Response({
+        'success': True,
+        'data': {
+            'annotation_id': annotation.annotation_id,
+            'version': annotation.version,
+            'versions': versions,
+        }
+    }, status=status.HTTP_200_OK)
+
+@api_view(['GET'])
+def annotation_version(request, case_id, number):
+    """
+    Boxes of a case's latest doctor session (or ?annotation=<annotation_id>) at one version
+    """
+    annotation = _versioned_session(request, case_id)
+    if annotation is None:
+        return Response({
+            'success': False,
+            'message': f'No annotation session for case {case_id}'
+        }, status=status.HTTP_404_NOT_FOUND)
+    try:
+        boxes = rebuild(annotation, number)
+    except VersionUnavailable as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_404_NOT_FOUND)
+    return Response({
+        'success': True,
+        'data': {
+            'annotation_id': annotation.annotation_id,
+            'version': number,
+            'annotations': boxes,
+        }
+    }, status=status.HTTP_200_OK)
+
+def _versioned_session(request, case_id):
+    sessions = Annotation.objects.filter(case_image__case_id=case_id, source=Annotation.DOCTOR)
+    if request.query_params.get('annotation'):
+        return sessions.filter(annotation_id=request.query_params['annotation']).first()
+    return sessions.order_by('-created_at', '-id').first()
+
+@api_view(['POST'])
+def save_annotations_batch(request):
+    """
+    Save annotations for many case images in one atomic request
+    """
+    try:
+        serializer = AnnotationBatchRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({
+                'success': False,
+                'message': 'Invalid data provided',
+                'errors': serializer.errors
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+        annotations = ingest_annotation_sessions(serializer.validated_data['cases'])
+
+        return Response({
+            'success': True,
+            'message': f'Successfully saved annotations for {len(annotations)} cases',
+            'results': [{
+                'annotation_id': annotation.annotation_id,
+                'case_id': annotation.case_image.case_id,
+                'total_annotations': annotation.total_annotations,
+                'positive_count': annotation.positive_count,
+                'negative_count': annotation.negative_count
+            } for annotation in annotations]
+        }, status=status.HTTP_201_CREATED)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': f'Failed to save annotations: {str(e)}'
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@cached_json('get_annotations', lambda request, case_id: [f'case:{case_id}'])
+async def get_annotations(request, case_id):
     """
     Get annotations for a specific case
     """
+    if request.method != 'GET':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
+    try:
+        # Prefetched inside the query so serializing needs no further (sync) queries
+        case_image = await CaseImage.objects.prefetch_related('annotations').aget(case_id=case_id)
+    except CaseImage.DoesNotExist:
+        return JsonResponse({'detail': 'No CaseImage matches the given query.'}, status=404)
+
     try:
-        case_image = get_object_or_404(CaseImage, case_id=case_id)
         serializer = CaseImageSerializer(case_image)
-        
-        return Response({
+
+        return JsonResponse({
             'success': True,
             'data': serializer.data
         }, status=status.HTTP_200_OK)
-        
+
     except Exception as e:
-        return Response({
+        return JsonResponse({
             'success': False,
             'message': f'Failed to retrieve annotations: {str(e)}'
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-@api_view(['GET'])
-def list_annotations(request):
+@cached_json('list_annotations', lambda request: ['cases'])
+async def list_annotations(request):
     """
     List all annotated cases
     """
+    if request.method != 'GET':
+        return JsonResponse({'detail': f'Method "{request.method}" not allowed.'}, status=405)
     try:
         case_images = CaseImage.objects.filter(status='annotated').order_by('-uploaded_at')
+        case_images = [
+            case_image async for case_image in case_images.prefetch_related('annotations')
+        ]
         serializer = CaseImageSerializer(case_images, many=True)
-        
-        return Response({
+
+        return JsonResponse({
             'success': True,
             'data': serializer.data,
             'count': len(case_images)
         }, status=status.HTTP_200_OK)
-        
+
     except Exception as e:
-        return Response({
+        return JsonResponse({
             'success': False,
             'message': f'Failed to list annotations: {str(e)}'
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
@@ -287,15 +748,18 @@ def delete_annotations(request, case_id):
     try:
         case_image = get_object_or_404(CaseImage, case_id=case_id)
         
-        # Delete all annotations for this case
-        deleted_count = 0
-        for annotation in case_image.annotations.all():
-            deleted_count += annotation.bounding_boxes.count()
-            annotation.delete()
-        
-        # Update case status
-        case_image.status = 'uploaded'
-        case_image.save()
+        with transaction.atomic():
+            # Delete all doctor sessions of this case; each leaves a tombstone for forms.spatial
+            sessions = case_image.annotations.filter(source=Annotation.DOCTOR)
+            deleted_count = sessions.aggregate(total=Sum('total_annotations'))['total'] or 0
+            sessions.delete()
+            
+            # Update case status and reset the materialized diagnosis
+            case_image.status = 'uploaded'
+            case_image.refresh_summary(save=False)
+            case_image.save()
+            update_consensus([case_image.pk])
+            invalidate_cases([case_image.case_id])
         
         return Response({
             'success': True,
@@ -306,4 +770,212 @@ def delete_annotations(request, case_id):
         return Response({
             'success': False,
             'message': f'Failed to delete annotations: {str(e)}'
-        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+def export_coco(request):
+    """Stream a COCO JSON export of the latest (or consensus) annotations for the filtered cases"""
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    try:
+        case_images = filter_case_images(request.GET)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    labels = request.GET.get('labels', 'latest')
+    if labels not in EXPORT_LABELS:
+        return JsonResponse({'error': f"labels must be one of: {', '.join(EXPORT_LABELS)}"}, status=400)
+
+    response = StreamingHttpResponse(iter_coco_export(case_images, labels=labels), content_type='application/json')
+    response['Content-Disposition'] = 'attachment; filename="cdss_annotations.coco.json"'
+    return response
+
+@api_view(['POST'])
+def import_coco(request):
+    """
+    Upload a COCO file and import it in the background
+
+    Boxes with a score are imported as predictions of `model`.
+    """
+    upload = request.FILES.get('file')
+    if not upload:
+        return Response({
+            'success': False,
+            'message': 'No COCO file provided'
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        category_map = None
+        if request.data.get('category_map'):
+            category_map = parse_category_map(request.data['category_map'])
+    except ValueError as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        # Kept out of MEDIA_ROOT, which serve_media exposes
+        storage = FileSystemStorage(location=settings.IMPORT_ROOT)
+        name = storage.save(os.path.basename(upload.name), upload)
+        job = create_import_job(storage.path(name), category_map=category_map,
+                                model_id=request.data.get('model', ''))
+        start_import_thread(job)
+
+        return Response({
+            'success': True,
+            'message': 'Import started',
+            'data': ImportJobSerializer(job).data
+        }, status=status.HTTP_202_ACCEPTED)
+
+    except Exception as e:
+        return Response({
+            'success': False,
+            'message': f'Failed to start import: {str(e)}'
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+@api_view(['GET'])
+def import_coco_status(request, job_id):
+    """
+    Get the progress of a COCO import
+    """
+    job = get_object_or_404(ImportJob, pk=job_id)
+    return Response({
+        'success': True,
+        'data': ImportJobSerializer(job).data
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def consensus_report(request):
+    """
+    Inter-annotator agreement across all doctor sessions (export filters apply)
+    """
+    try:
+        case_images = filter_case_images(request.query_params)
+    except ValueError as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
+    return Response({
+        'success': True,
+        'data': agreement_report(case_images)
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def case_consensus(request, case_id):
+    """
+    Fused consensus boxes and rater agreement for one case
+    """
+    consensus = ConsensusAnnotation.objects.select_related('case_image').filter(
+        case_image__case_id=case_id
+    ).first()
+    if consensus is None:
+        return Response({
+            'success': False,
+            'message': f'No doctor annotations for case {case_id}'
+        }, status=status.HTTP_404_NOT_FOUND)
+    return Response({
+        'success': True,
+        'data': consensus_data(consensus)
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def box_search(request):
+    """
+    Boxes of every session by region, distance, size, label and source
+
+    Coordinates and areas are fractions of the image, so boxes compare
+    across images of any size (see forms.spatial).
+    """
+    try:
+        filters = parse_filters(request.query_params)
+    except ValueError as e:
+        return Response({
+            'success': False,
+            'message': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
+    total, labels, boxes = search_boxes(**filters)
+    return Response({
+        'success': True,
+        'data': {
+            'count': total,
+            'labels': labels,
+            'offset': filters['offset'],
+            'boxes': boxes,
+        }
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def response_cache_stats(request):
+    """
+    Hit/miss counters of the response cache in this server process
+    """
+    return Response({
+        'success': True,
+        'data': cache_stats()
+    }, status=status.HTTP_200_OK)
+
+@api_view(['GET', 'POST'])
+def evaluation_report(request):
+    """
+    Dataset report of model predictions against doctor annotations
+
+    GET returns the report of the latest run, or 404 before the first one
+    (runs are left to POST and the evaluate_models command); POST
+    re-evaluates the changed cases first, or every case with "full": true.
+    Optional "model" selects the model (default model otherwise).
+    """
+    params = request.data if request.method == 'POST' else request.query_params
+    model_id = params.get('model') or default_model_id()
+    if request.method == 'GET':
+        run = EvaluationRun.objects.filter(model_id=model_id, finished_at__isnull=False).order_by('-id').first()
+        if run is None:
+            return Response({
+                'success': False,
+                'message': f'No evaluation of {model_id} yet; run manage.py evaluate_models or POST here'
+            }, status=status.HTTP_404_NOT_FOUND)
+    else:
+        run = run_evaluation(model_id, full=bool(params.get('full')))
+    return Response({
+        'success': True,
+        'data': {
+            'run': run.pk,
+            'full': run.full,
+            'casesTotal': run.cases_total,
+            'casesEvaluated': run.cases_evaluated,
+            'casesRemoved': run.cases_removed,
+            'finishedAt': run.finished_at.isoformat(),
+            'report': run.report,
+        }
+    }, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def case_evaluation(request, case_id):
+    """
+    Per-case matching, sensitivity and specificity from the last evaluation run
+    """
+    model_id = request.query_params.get('model') or default_model_id()
+    evaluation = CaseEvaluation.objects.select_related('case_image', 'ground_truth', 'prediction').filter(
+        case_image__case_id=case_id, model_id=model_id
+    ).first()
+    if evaluation is None:
+        return Response({
+            'success': False,
+            'message': f'No evaluation of {model_id} for case {case_id}'
+        }, status=status.HTTP_404_NOT_FOUND)
+    return Response({
+        'success': True,
+        'data': case_report(evaluation)
+    }, status=status.HTTP_200_OK)
+
+
+def metrics(request):
+    """Request, query and cache metrics of this process in the Prometheus text format"""
+    # Nothing is collected while the profiling middleware is disabled
+    if not get_profiling_config()['ENABLED']:
+        raise Http404('Profiling is disabled')
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')